@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for the codecs used to serialize values stored in memcached.
+
+This script encodes and decodes realistic examples of the values that the
+memcached backend stores, and reports the time taken and encoded size for
+each codec.  The examples are:
+
+    * metadata:  the per-user metadata blob, with timestamps for all the
+                 standard collections.
+    * meta:      a cached "meta" collection holding the meta/global record.
+    * clients:   a cached "clients" collection with several client records.
+    * tabs:      a cache-only "tabs" collection with a record for each client,
+                 each listing many open tabs.
+
+Item payloads are the encrypted envelopes sent by real clients, i.e. JSON
+holding base64-encoded ciphertext, which compresses only moderately.
+
+Run it like so:
+
+    python benchmarks/bench_cache_codec.py [--clients N] [--runs N]
+
+"""
+
+import os
+import sys
+import time
+import base64
+import optparse
+
+from syncstorage.util import get_timestamp, json_dumps
+from syncstorage.storage.cachecodec import JSONCodec, BinaryCodec, lz4
+
+
+STANDARD_COLLECTIONS = ("clients", "crypto", "forms", "history", "keys",
+                        "meta", "bookmarks", "prefs", "tabs", "passwords",
+                        "addons", "addresses", "creditcards")
+
+
+def make_payload(plaintext_size):
+    """Make an encrypted payload envelope for the given size of plaintext."""
+    # Ciphertext is padded to a multiple of the AES block size.
+    ciphertext = os.urandom((plaintext_size // 16 + 1) * 16)
+    return json_dumps({
+        "ciphertext": base64.b64encode(ciphertext),
+        "IV": base64.b64encode(os.urandom(16)),
+        "hmac": os.urandom(32).encode("hex"),
+    })
+
+
+def make_collection(now, num_items, plaintext_size, ttl=None):
+    """Make the cached data for a collection of similar items."""
+    items = {}
+    for i in xrange(num_items):
+        bso = {
+            "id": base64.urlsafe_b64encode(os.urandom(9)),
+            "payload": make_payload(plaintext_size),
+            "modified": now - i * 100,
+        }
+        if ttl is not None:
+            bso["ttl"] = int(now) + ttl
+        items[bso["id"]] = bso
+    return {"modified": now, "items": items}
+
+
+def make_examples(num_clients):
+    """Make (name, value) pairs of realistic values to be cached."""
+    now = get_timestamp()
+    metadata = {
+        "size": 12345678,
+        "last_size_recalc": int(now),
+        "modified": now,
+        "collections": dict((c, now - i * 1000)
+                            for i, c in enumerate(STANDARD_COLLECTIONS)),
+    }
+    return [
+        ("metadata", metadata),
+        ("meta", make_collection(now, 1, 600)),
+        ("clients", make_collection(now, num_clients, 400)),
+        # Each tab has a title, a url and a short history of urls,
+        # amounting to a few hundred bytes.
+        ("tabs", make_collection(now, num_clients, 50 * 300, ttl=1814400)),
+    ]
+
+
+def time_codec(codec, value, num_runs):
+    """Time encoding and decoding a value, returning best seconds taken."""
+    encode_time = decode_time = None
+    for _ in xrange(num_runs):
+        start = time.time()
+        data = codec.encode(value)
+        middle = time.time()
+        decoded = codec.decode(data)
+        end = time.time()
+        if encode_time is None or middle - start < encode_time:
+            encode_time = middle - start
+        if decode_time is None or end - middle < decode_time:
+            decode_time = end - middle
+    assert decoded == value
+    return len(data), encode_time, decode_time
+
+
+def main(args=None):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--clients", type="int", default=8,
+                      help="Number of clients syncing to the account")
+    parser.add_option("", "--runs", type="int", default=100,
+                      help="Number of times to encode and decode each value")
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    codecs = [
+        ("json", JSONCodec()),
+        ("binary", BinaryCodec("none")),
+        ("binary+zlib", BinaryCodec("zlib", compress_threshold=0)),
+    ]
+    if lz4 is not None:
+        codecs.append(("binary+lz4", BinaryCodec("lz4", compress_threshold=0)))
+
+    print "%-10s %-12s %10s %12s %12s" % ("value", "codec", "bytes",
+                                          "encode ms", "decode ms")
+    for name, value in make_examples(opts.clients):
+        for codec_name, codec in codecs:
+            size, encode_time, decode_time = time_codec(codec, value,
+                                                        opts.runs)
+            print "%-10s %-12s %10d %12.3f %12.3f" % (name, codec_name, size,
+                                                      encode_time * 1000,
+                                                      decode_time * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for finding expired items in cached collections.
+
+The memcached backend purges expired items from a cached collection on every
+write, and skips them on every read.  This script compares doing so with a
+scan of every item, as was done originally, against using the list of item
+ids sorted by ttl that is now kept in the cached data.  It builds a cached
+collection in which a given fraction of the items have expired, and reports
+the time taken for each approach at each collection size.
+
+Both of the approaches that use the sorted lists of ids first make sure
+that those lists are present, as every read and write of the cached data
+does.  The "index" method times this for data stamped as having current
+lists, and the "check" method for unstamped data whose lists must be
+checked against every item before they can be used.
+
+Run it like so:
+
+    python benchmarks/bench_cache_ttl_sweep.py [--sizes N,N] [--runs N]
+
+"""
+
+import sys
+import time
+import copy
+import optparse
+
+from syncstorage.util import get_timestamp
+from syncstorage.storage.memcached import (_ensure_sort_orders,
+                                           _find_expired_ids,
+                                           _purge_expired_items,
+                                           _remove_from_sort_orders,
+                                           _stamp_sort_orders)
+
+
+def make_collection(now, num_items, expired_fraction):
+    """Make cached data for a collection of items with ttls.
+
+    Every item has a ttl, like the items in the "tabs" collection, and
+    the given fraction of them expired before the current time.
+    """
+    items = {}
+    num_expired = int(num_items * expired_fraction)
+    for i in xrange(num_items):
+        id = "item%06d" % (i,)
+        if i < num_expired:
+            ttl = int(now) - 1 - i
+        else:
+            ttl = int(now) + 1 + i
+        items[id] = {
+            "id": id,
+            "payload": "x",
+            "modified": get_timestamp(now - i),
+            "ttl": ttl,
+        }
+    data = {"modified": get_timestamp(now), "items": items}
+    _ensure_sort_orders(data)
+    return data
+
+
+def scan_purge(data, expiry_time):
+    """Purge expired items by checking every item, as originally done."""
+    expired_ids = set()
+    for id, bso in data["items"].iteritems():
+        ttl = bso.get("ttl")
+        if ttl is not None and ttl < expiry_time:
+            expired_ids.add(id)
+    for id in expired_ids:
+        _remove_from_sort_orders(data, data["items"][id])
+        del data["items"][id]
+    return expired_ids
+
+
+def scan_filter(data, now):
+    """Filter out expired items by checking every item on read."""
+    return [bso for bso in data["items"].itervalues()
+            if bso.get("ttl") is None or bso["ttl"] > now]
+
+
+def index_purge(data, now):
+    """Purge expired items using the list of ids sorted by ttl.
+
+    This does the same work as a write of the cached data, other than
+    setting the new items.
+    """
+    _ensure_sort_orders(data)
+    expired_ids = _purge_expired_items(data, now)
+    _stamp_sort_orders(data)
+    return expired_ids
+
+
+def index_filter(data, now):
+    """Filter out expired items using the list of ids sorted by ttl."""
+    _ensure_sort_orders(data)
+    expired_ids = set(_find_expired_ids(data, now))
+    bsos = data["items"].itervalues()
+    if expired_ids:
+        bsos = (bso for bso in bsos if bso["id"] not in expired_ids)
+    return list(bsos)
+
+
+def check_purge(data, now):
+    """Purge expired items from data whose sorted ids must be checked."""
+    data.pop("sort_orders", None)
+    return index_purge(data, now)
+
+
+def check_filter(data, now):
+    """Filter out expired items from data whose sorted ids must be checked."""
+    data.pop("sort_orders", None)
+    return index_filter(data, now)
+
+
+def time_func(func, data, now, num_runs, copy_data=False):
+    """Time calling func(data, now), returning best seconds taken."""
+    best = None
+    for _ in xrange(num_runs):
+        if copy_data:
+            run_data = copy.deepcopy(data)
+        else:
+            run_data = data
+        start = time.time()
+        func(run_data, now)
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best
+
+
+def main(args=None):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--sizes", default="1000,10000",
+                      help="Comma-separated numbers of items to test")
+    parser.add_option("", "--expired", type="float", default=0.01,
+                      help="Fraction of the items that have expired")
+    parser.add_option("", "--runs", type="int", default=20,
+                      help="Number of times to run each operation")
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    methods = [
+        ("scan", scan_purge, scan_filter),
+        ("index", index_purge, index_filter),
+        ("check", check_purge, check_filter),
+    ]
+    now = time.time()
+    print "%-8s %-8s %12s %12s" % ("items", "method", "purge ms", "filter ms")
+    for size in opts.sizes.split(","):
+        data = make_collection(now, int(size), opts.expired)
+        for method, purge, filter_ in methods:
+            purge_time = time_func(purge, data, now, opts.runs, True)
+            filter_time = time_func(filter_, data, now, opts.runs)
+            print "%-8s %-8s %12.3f %12.3f" % (size, method,
+                                               purge_time * 1000,
+                                               filter_time * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Microbenchmark for the rendered-query cache in the SQL backend.
+
+This script measures the per-query CPU cost of preparing the FIND_ITEMS and
+ITEM_DETAILS queries, both with and without the DBConnector's cache of
+rendered queries.  It reports the time taken to render each query string,
+and the time taken to render and execute it against an sqlite database.
+
+Run it like so:
+
+    python benchmarks/bench_query_cache.py [--iterations N] [sqluri]
+
+"""
+
+import sys
+import time
+import optparse
+
+from syncstorage.storage.sql import SQLStorage
+
+
+_USER = {"uid": 42}
+
+
+def make_find_items_params():
+    return {
+        "userid": _USER["uid"],
+        "collectionid": 4,
+        "ttl": int(time.time()),
+        "newer": 0,
+        "sort": "newest",
+        "limit": 11,
+        "force_consistent_sort_order": True,
+    }
+
+
+def make_item_details_params():
+    return {
+        "userid": _USER["uid"],
+        "collectionid": 4,
+        "item": "item5",
+        "ttl": int(time.time()),
+    }
+
+
+QUERIES = (
+    ("FIND_ITEMS", make_find_items_params),
+    ("ITEM_DETAILS", make_item_details_params),
+)
+
+
+def time_render(storage, query_name, make_params, iterations):
+    """Time the rendering of the named query, in microseconds per query."""
+    connector = storage.dbconnector
+    connection = connector.connect()
+    start = time.time()
+    for _ in xrange(iterations):
+        params = make_params()
+        query = connector.get_query(query_name, params)
+        connection._render_query(query, params, {"queryName": query_name})
+    return (time.time() - start) * 1000000 / iterations
+
+
+def time_execute(storage, query_name, make_params, iterations):
+    """Time the execution of the named query, in microseconds per query."""
+    connector = storage.dbconnector
+    with connector.connect() as connection:
+        start = time.time()
+        for _ in xrange(iterations):
+            params = make_params()
+            list(connection.query_fetchall(query_name, params))
+        return (time.time() - start) * 1000000 / iterations
+
+
+def make_storage(sqluri, cache_queries):
+    storage = SQLStorage(sqluri, standard_collections=True,
+                         create_tables=True, cache_queries=cache_queries,
+                         force_consistent_sort_order=True)
+    items = [{"id": "item%d" % (i,), "payload": "x" * 200, "sortindex": i}
+             for i in xrange(100)]
+    storage.set_items(_USER, "history", items)
+    return storage
+
+
+def main(args=None):
+    usage = "usage: %prog [options] [sqluri]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--iterations", type="int", default=10000,
+                      help="Number of times to run each query")
+    opts, args = parser.parse_args(args)
+    if len(args) > 1:
+        parser.print_usage()
+        return 1
+    sqluri = args[0] if args else "sqlite:///:memory:"
+
+    results = {}
+    for cache_queries in (False, True):
+        storage = make_storage(sqluri, cache_queries)
+        for query_name, make_params in QUERIES:
+            render = time_render(storage, query_name, make_params,
+                                 opts.iterations)
+            execute = time_execute(storage, query_name, make_params,
+                                   opts.iterations)
+            results[(query_name, cache_queries)] = (render, execute)
+
+    print "%-14s %-8s %14s %14s" % ("query", "cache", "render (us)",
+                                    "execute (us)")
+    for query_name, _ in QUERIES:
+        for cache_queries in (False, True):
+            render, execute = results[(query_name, cache_queries)]
+            print "%-14s %-8s %14.1f %14.1f" % (query_name, cache_queries,
+                                                render, execute)
+        uncached = results[(query_name, False)]
+        cached = results[(query_name, True)]
+        print "%-14s %-8s %14.1f %14.1f" % (query_name, "saved",
+                                            uncached[0] - cached[0],
+                                            uncached[1] - cached[1])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
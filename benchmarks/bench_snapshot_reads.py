@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for concurrent readers and writers on a single user's collection.
+
+This script runs a mix of reader and writer threads against the same user
+and collection, and measures how long each of them waits to acquire its
+lock.  It compares locking reads (SELECT ... LOCK IN SHARE MODE/FOR SHARE)
+against lock-free consistent-snapshot reads, as enabled by the SQLStorage
+"snapshot_reads" option.
+
+It needs a MySQL or PostgreSQL database to be meaningful; SQLite locks the
+whole database regardless.  Run it like so:
+
+    python benchmarks/bench_snapshot_reads.py [--readers N] [--writers N]
+                                               [--duration SECS] SQLURI
+
+"""
+
+import sys
+import time
+import threading
+import optparse
+
+from syncstorage.storage.sql import SQLStorage
+
+
+_USER = {"uid": 42}
+
+
+class Worker(threading.Thread):
+    """Thread repeatedly reading or writing until told to stop."""
+
+    def __init__(self, storage, write, stop):
+        super(Worker, self).__init__()
+        self.storage = storage
+        self.write = write
+        self.stop = stop
+        self.waits = []
+
+    def run(self):
+        storage = self.storage
+        if self.write:
+            lock = storage.lock_for_write
+        else:
+            lock = storage.lock_for_read
+        count = 0
+        while not self.stop.is_set():
+            start = time.time()
+            try:
+                with lock(_USER, "history"):
+                    self.waits.append(time.time() - start)
+                    if self.write:
+                        count += 1
+                        items = [{"id": "item%d" % (i,), "payload": "x" * 500,
+                                  "sortindex": count}
+                                 for i in xrange(count % 10, count % 10 + 10)]
+                        storage.set_items(_USER, "history", items)
+                        # Hold the lock a little while, as a real POST would.
+                        time.sleep(0.005)
+                    else:
+                        storage.get_items(_USER, "history", limit=100)
+            except Exception:
+                # Conflicts are expected with so many concurrent writers.
+                pass
+
+
+def run_workload(sqluri, snapshot_reads, num_readers, num_writers, duration):
+    """Run the workload, returning (reads, read wait, writes, write wait)."""
+    storage = SQLStorage(sqluri, create_tables=True,
+                         standard_collections=True,
+                         snapshot_reads=snapshot_reads,
+                         pool_size=num_readers + num_writers)
+    storage.delete_storage(_USER)
+    storage.set_items(_USER, "history", [{"id": "item0", "payload": "x"}])
+    stop = threading.Event()
+    workers = [Worker(storage, False, stop) for _ in xrange(num_readers)]
+    workers += [Worker(storage, True, stop) for _ in xrange(num_writers)]
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    storage.delete_storage(_USER)
+    storage.dbconnector.engine.dispose()
+    results = []
+    for write in (False, True):
+        waits = [wait for worker in workers if worker.write == write
+                 for wait in worker.waits]
+        results.append(len(waits))
+        results.append(sum(waits) / max(len(waits), 1))
+    return results
+
+
+def main(args=None):
+    usage = "usage: %prog [options] sqluri"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--readers", type="int", default=8,
+                      help="Number of reader threads")
+    parser.add_option("", "--writers", type="int", default=2,
+                      help="Number of writer threads")
+    parser.add_option("", "--duration", type="float", default=10,
+                      help="Number of seconds to run each workload for")
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    print "%-16s %10s %14s %10s %14s" % ("read locks", "reads",
+                                         "read wait ms", "writes",
+                                         "write wait ms")
+    for snapshot_reads in (False, True):
+        reads, read_wait, writes, write_wait = run_workload(
+            args[0], snapshot_reads, opts.readers, opts.writers,
+            opts.duration)
+        print "%-16s %10d %14.2f %10d %14.2f" % (
+            "snapshot" if snapshot_reads else "shared row lock",
+            reads, read_wait * 1000, writes, write_wait * 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for POSTing batches of items to the SQL backend on SQLite.
+
+This script compares the throughput of SQLStorage.set_items() using the
+multi-row "INSERT ... ON CONFLICT DO UPDATE" upsert against the generic
+one-item-at-a-time UPDATE-then-INSERT fallback.  Each POST writes a batch
+of records, half of which are updates to items written by an earlier POST.
+
+Run it like so:
+
+    python benchmarks/bench_sqlite_upsert.py [--posts N] [--batch-size N]
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import optparse
+
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage.sql import dbconnect
+
+
+_USER = {"uid": 42}
+
+
+def run_posts(use_upsert, num_posts, batch_size):
+    """Time a series of POSTs, returning the number of records per second."""
+    dbconnect.SQLITE_SUPPORTS_UPSERT = use_upsert
+    fd, dbfile = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        storage = SQLStorage("sqlite:///" + dbfile, create_tables=True,
+                             standard_collections=True)
+        start = time.time()
+        for post in xrange(num_posts):
+            # Overlap each batch half-way with the previous one.
+            first = post * batch_size // 2
+            items = [{"id": "item%d" % (i,), "payload": "x" * 500,
+                      "sortindex": i, "ttl": 3600}
+                     for i in xrange(first, first + batch_size)]
+            storage.set_items(_USER, "history", items)
+        duration = time.time() - start
+        storage.dbconnector.engine.dispose()
+    finally:
+        os.unlink(dbfile)
+    return num_posts * batch_size / duration
+
+
+def main(args=None):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--posts", type="int", default=200,
+                      help="Number of POSTs to send")
+    parser.add_option("", "--batch-size", type="int", default=100,
+                      help="Number of records in each POST")
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+    if not dbconnect.SQLITE_SUPPORTS_UPSERT:
+        print "SQLite version is too old to support ON CONFLICT DO UPDATE"
+        return 1
+
+    generic = run_posts(False, opts.posts, opts.batch_size)
+    upsert = run_posts(True, opts.posts, opts.batch_size)
+    print "%-24s %12s" % ("strategy", "records/sec")
+    print "%-24s %12.0f" % ("UPDATE then INSERT", generic)
+    print "%-24s %12.0f" % ("ON CONFLICT DO UPDATE", upsert)
+    print "%-24s %11.1fx" % ("speedup", upsert / generic)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmark for timestamp handling in a full=1 GET of a large collection.
+
+This script times fetching all items of a collection from the SQL backend
+and rendering them to JSON, which converts and formats the timestamp of
+every item.  It compares the integer-centisecond Timestamp type against
+the previous approach of converting each timestamp through a float and a
+string into a quantized decimal.Decimal.
+
+Run it like so:
+
+    python benchmarks/bench_timestamps.py [--items N] [--runs N]
+
+"""
+
+import sys
+import time
+import decimal
+import optparse
+
+from syncstorage.util import json_dumps, TWO_DECIMAL_PLACES
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage import sql
+
+
+_USER = {"uid": 42}
+
+
+def decimal_bigint2ts(bigint):
+    """The previous, decimal-based implementation of bigint2ts()."""
+    value = decimal.Decimal(str(bigint / 1000.0))
+    return value.quantize(TWO_DECIMAL_PLACES, rounding=decimal.ROUND_CEILING)
+
+
+def time_full_get(storage, num_runs):
+    """Time a full=1 GET of the collection, returning best seconds taken."""
+    best = None
+    for _ in xrange(num_runs):
+        start = time.time()
+        with storage.lock_for_read(_USER, "history"):
+            items = storage.get_items(_USER, "history")["items"]
+            body = json_dumps(items)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    assert len(items) and body
+    return best
+
+
+def main(args=None):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--items", type="int", default=10000,
+                      help="Number of items in the collection")
+    parser.add_option("", "--runs", type="int", default=5,
+                      help="Number of GETs to time for each strategy")
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    storage = SQLStorage("sqlite:///:memory:", create_tables=True,
+                         standard_collections=True)
+    # Write the items in several batches, so they have varied timestamps.
+    for first in xrange(0, opts.items, 100):
+        items = [{"id": "item%d" % (i,), "payload": "x" * 100,
+                  "sortindex": i}
+                 for i in xrange(first, min(first + 100, opts.items))]
+        storage.set_items(_USER, "history", items)
+
+    integer = time_full_get(storage, opts.runs)
+    bigint2ts = sql.bigint2ts
+    sql.bigint2ts = decimal_bigint2ts
+    try:
+        legacy = time_full_get(storage, opts.runs)
+    finally:
+        sql.bigint2ts = bigint2ts
+
+    print "%-24s %12s" % ("timestamps", "ms per GET")
+    print "%-24s %12.1f" % ("decimal.Decimal", legacy * 1000)
+    print "%-24s %12.1f" % ("integer centiseconds", integer * 1000)
+    print "%-24s %11.1fx" % ("speedup", legacy / integer)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,9 @@
 Memcache data clearing script for SyncStorage.
 
 This script takes a syncstorage config file, and reads a list of userids
-from STDIN.  The memcache data for each user is wiped.
+from STDIN.  The memcache data for each user is wiped.  If there are several
+memcache servers, each key is deleted from all of them, in case copies were
+left behind when servers were added to or removed from the hash ring.
 
 """
 
@@ -33,7 +35,7 @@ def clear_memcache_data(config_file, input_file):
     config = syncstorage.get_configurator({"__file__": config_file})
 
     # Search all configured storages to find one that uses memcached.
-    # We assume that all storages share a single memcached server, and
+    # We assume that all storages share the same memcached servers, and
     # so we can use this single instance as a representative.  This is
     # how things are deployed at Mozilla, but is not guaranteed by the code.
     for _, backend in get_all_storages(config):
@@ -41,7 +43,8 @@ def clear_memcache_data(config_file, input_file):
             break
     else:
         raise RuntimeError("No memcached storage backends found.")
-    logger.debug("Using memcache server at %r", backend.cache.pool.server)
+    logger.debug("Using memcache servers at %s",
+                 ", ".join(backend.cache.servers))
 
     with maybe_open(input_file, "rt") as input_fileobj:
         for uid in input_fileobj:
@@ -49,7 +52,7 @@ def clear_memcache_data(config_file, input_file):
             if uid:
                 logger.info("Clearing data for %s", uid)
                 for key in backend.iter_cache_keys({"uid": uid}):
-                    backend.cache.delete(key)
+                    backend.cache.delete_everywhere(key)
                 logger.debug("Cleared data for %s", uid)
 
     logger.info("Finished clearing memcache data")
@@ -7,7 +7,9 @@
 Memcache data reading script for SyncStorage.
 
 This script takes a syncstorage config file, and reads a list of userids
-from STDIN.  The memcache data for each user is printed to stdout.
+from STDIN.  The memcache data for each user is printed to stdout.  With the
+--show-servers option, each copy of each key is printed along with the
+address of the memcache server that holds it.
 
 """
 
@@ -25,14 +27,15 @@ from syncstorage.storage.memcached import MemcachedStorage
 logger = logging.getLogger(__name__)
 
 
-def read_memcache_data(config_file, input_file, output_file):
+def read_memcache_data(config_file, input_file, output_file,
+                       show_servers=False):
     """Read memcache data for all userids listed in the given input file."""
     logger.info("Reading data for uids in %s", input_file)
     logger.debug("Using config file %r", config_file)
     config = syncstorage.get_configurator({"__file__": config_file})
 
     # Search all configured storages to find one that uses memcached.
-    # We assume that all storages share a single memcached server, and
+    # We assume that all storages share the same memcached servers, and
     # so we can use this single instance as a representative.  This is
     # how things are deployed at Mozilla, but is not guaranteed by the code.
     for _, backend in get_all_storages(config):
@@ -40,7 +43,8 @@ def read_memcache_data(config_file, input_file, output_file):
             break
     else:
         raise RuntimeError("No memcached storage backends found.")
-    logger.debug("Using memcache server at %r", backend.cache.pool.server)
+    logger.debug("Using memcache servers at %s",
+                 ", ".join(backend.cache.servers))
 
     with maybe_open(input_file, "rt") as input_fileobj:
         with maybe_open(output_file, "wt") as output_fileobj:
@@ -50,9 +54,15 @@ def read_memcache_data(config_file, input_file, output_file):
                 if uid:
                     logger.info("Reading data for %s", uid)
                     for key in backend.iter_cache_keys({"uid": uid}):
-                        value = backend.cache.get(key)
-                        if value is not None:
-                            output_fileobj.write("%s %s\n" % (key, value))
+                        if show_servers:
+                            replicas = backend.cache.get_replicas(key)
+                            for server, value in replicas:
+                                line = "%s %s %s\n" % (key, server, value)
+                                output_fileobj.write(line)
+                        else:
+                            value = backend.cache.get(key)
+                            if value is not None:
+                                output_fileobj.write("%s %s\n" % (key, value))
                     logger.debug("Read data for %s", uid)
 
     logger.info("Finished reading memcache data")
@@ -89,6 +99,8 @@ def main(args=None):
                       help="The file from which to read userids")
     parser.add_option("-o", "--output-file", default="-",
                       help="The file to which to write memcache data")
+    parser.add_option("-s", "--show-servers", action="store_true",
+                      help="Show every copy of each key and its server")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
                       help="Control verbosity of log messages")
 
@@ -105,7 +117,8 @@ def main(args=None):
         opts.input_file = sys.stdin
     if opts.output_file == "-":
         opts.output_file = sys.stdout
-    read_memcache_data(config_file, opts.input_file, opts.output_file)
+    read_memcache_data(config_file, opts.input_file, opts.output_file,
+                       opts.show_servers)
     return 0
 
 
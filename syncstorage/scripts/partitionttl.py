@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Partition management script for SyncStorage.
+
+This script takes a syncstorage config file and loops through each SQL
+storage backend therein that has partition_by_ttl enabled, creating the
+time-range partitions of its batch tables ahead of time.  It should be run
+regularly, e.g. from cron, so that new batches are always written into a
+partition that purgettl.py can drop once they have all expired.  Batches
+written beyond the last partition go into a catch-all partition that is
+never dropped.
+
+"""
+
+import os
+import time
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage import get_all_storages
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage.sql.dbconnect import TTL_PARTITIONS_AHEAD
+
+
+logger = logging.getLogger(__name__)
+
+
+def create_partitions(config_file, ahead=TTL_PARTITIONS_AHEAD):
+    """Create partitions covering the next few seconds in each backend."""
+    logger.info("Creating partitions")
+    logger.debug("Using config file %r", config_file)
+    config = syncstorage.scripts.load_configurator(config_file)
+    until = int(time.time()) + ahead
+
+    for hostname, backend in get_all_storages(config):
+        # Find the underlying SQL storage, e.g. in case of memcached.
+        while hasattr(backend, "storage"):
+            backend = backend.storage
+        if not isinstance(backend, SQLStorage):
+            logger.debug("Skipping non-SQL backend for %s", hostname)
+            continue
+        dbconnector = backend.dbconnector
+        if not dbconnector.partition_by_ttl:
+            logger.debug("Skipping unpartitioned backend for %s", hostname)
+            continue
+        for server in dbconnector.get_shard_servers():
+            for table in dbconnector.get_partitioned_tables():
+                ends = dbconnector.create_ttl_partitions(table, until, server)
+                logger.info("Created %d partitions of %s for %s",
+                            len(ends), table, hostname)
+
+    logger.info("Finished creating partitions")
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the create_partitions() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--ahead", type="int", default=TTL_PARTITIONS_AHEAD,
+                      help="Number of seconds ahead to create partitions for")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    create_partitions(config_file, opts.ahead)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
@@ -17,8 +17,13 @@ import os
 import time
 import logging
 import optparse
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 import syncstorage.scripts
+from syncstorage.util import json_dumps, json_loads
 from syncstorage.storage import get_all_storages
 
 
@@ -26,37 +31,155 @@ logger = logging.getLogger(__name__)
 
 
 def purge_expired_items(config_file, grace_period=0, max_per_loop=1000,
-                        backend_interval=0):
+                        backend_interval=0, max_workers=1,
+                        checkpoint_file=None):
     """Purge expired BSOs from all storage backends in the given config file.
 
     This function iterates through each storage backend in the given config
     file and calls its purge_expired_items() method.  The result is a
     gradual pruning of expired items from each database.
+
+    If max_workers is greater than one, then backends that can be split into
+    independent per-table tasks (i.e. SQL backends) will have those tasks
+    run concurrently, in a pool of that many threads shared by all backends.
+
+    If checkpoint_file is given, then the name of each task is recorded in
+    that file once it has purged all of its expired items.  If the purge is
+    interrupted then the next run will skip any tasks that were already
+    completed, and the file is removed at the end of the pass.
     """
     logger.info("Purging expired items")
     logger.debug("Using config file %r", config_file)
     config = syncstorage.scripts.load_configurator(config_file)
-
-    for hostname, backend in get_all_storages(config):
-        logger.debug("Purging backend for %s", hostname)
-        config.begin()
-        t_start = time.time()
+    checkpoint = PurgeCheckpoint(checkpoint_file)
+
+    if max_workers <= 1:
+        for hostname, backend in get_all_storages(config):
+            logger.debug("Purging backend for %s", hostname)
+            for name, run in get_purge_tasks(hostname, backend,
+                                             grace_period, max_per_loop):
+                if name not in checkpoint:
+                    run_purge_task(config, checkpoint, name, run)
+            logger.debug("Sleeping for %d seconds", backend_interval)
+            time.sleep(backend_interval)
+    else:
+        tasks = []
+        for hostname, backend in get_all_storages(config):
+            for name, run in get_purge_tasks(hostname, backend,
+                                             grace_period, max_per_loop):
+                if name not in checkpoint:
+                    tasks.append((name, run))
+        logger.debug("Running %d purge tasks with %d workers",
+                     len(tasks), max_workers)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
         try:
-            backend.purge_expired_items(grace_period, max_per_loop)
-        except Exception:
-            logger.exception("Error while purging backend for %s", hostname)
-        else:
-            logger.debug("Purged backend for %s", hostname)
+            for name, run in tasks:
+                executor.submit(run_purge_task, config, checkpoint, name, run)
         finally:
-            t_duration = min(0, time.time() - t_start)
-            logger.debug("Purge took %.4f seconds", t_duration)
-            config.end()
-        logger.debug("Sleeping for %d seconds", backend_interval)
-        time.sleep(backend_interval)
+            executor.shutdown(wait=True)
 
+    checkpoint.finish()
     logger.info("Finished purging expired items")
 
 
+def get_purge_tasks(hostname, backend, grace_period, max_per_loop):
+    """Get (name, callable) pairs for independent purge tasks in a backend.
+
+    Backends that don't support splitting the purge into separate tasks
+    are purged as a single task.
+    """
+    # Find the underlying storage, e.g. in case of memcached,
+    # which just passes the purge through.
+    storage = backend
+    while hasattr(storage, "storage"):
+        storage = storage.storage
+    if not hasattr(storage, "get_purge_tasks"):
+        def run():
+            return backend.purge_expired_items(grace_period, max_per_loop)
+        return [(hostname, run)]
+    return [("%s:%s" % (hostname, task.name), task.run)
+            for task in storage.get_purge_tasks(grace_period, max_per_loop)]
+
+
+def run_purge_task(config, checkpoint, name, run):
+    """Run a single purge task, logging its throughput."""
+    config.begin()
+    t_start = time.time()
+    try:
+        res = run()
+    except Exception:
+        logger.exception("Error while purging %s", name)
+    else:
+        t_duration = time.time() - t_start
+        num_purged = res.get("num_purged")
+        if num_purged is None:
+            num_purged = sum(v for k, v in res.iteritems()
+                             if k.startswith("num_"))
+        logger.info("Purged %d items from %s in %.4f seconds (%.1f/sec)",
+                    num_purged, name, t_duration,
+                    num_purged / max(t_duration, 0.0001))
+        if "batch_size" in res:
+            logger.info("Finished %s with batch size %d, after throttling "
+                        "%d of %d batches", name, res["batch_size"],
+                        res["num_throttled"], res["num_batches"])
+        # A task that bailed out early still has expired items to purge,
+        # so it shouldn't be skipped if this pass is resumed.
+        if res.get("is_complete", True):
+            checkpoint.add(name, num_purged, t_duration)
+    finally:
+        config.end()
+
+
+class PurgeCheckpoint(object):
+    """Record of purge tasks completed in the current pass.
+
+    The record is kept in a JSON file, which is atomically replaced each
+    time a task is completed.  If no filename is given then nothing is
+    recorded, and no tasks are ever skipped.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.completed = {}
+        self._lock = threading.Lock()
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, "rb") as f:
+                    self.completed = json_loads(f.read())["completed"]
+            except (EnvironmentError, ValueError, KeyError):
+                logger.exception("Ignoring invalid checkpoint file")
+            else:
+                logger.info("Resuming purge, skipping %d completed tasks",
+                            len(self.completed))
+
+    def __contains__(self, name):
+        return name in self.completed
+
+    def add(self, name, num_purged, duration):
+        with self._lock:
+            self.completed[name] = {
+                "num_purged": num_purged,
+                "duration": duration,
+            }
+            self._save()
+
+    def finish(self):
+        """Clear the record, at the end of a full purge pass."""
+        with self._lock:
+            self.completed = {}
+            if self.filename is not None and os.path.exists(self.filename):
+                os.unlink(self.filename)
+
+    def _save(self):
+        if self.filename is None:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".purgettl")
+        with os.fdopen(fd, "wb") as f:
+            f.write(json_dumps({"completed": self.completed}))
+        os.rename(tmpname, self.filename)
+
+
 def main(args=None):
     """Main entry-point for running this script.
 
@@ -73,6 +196,10 @@ def main(args=None):
                       help="Number of seconds grace to allow after expiry")
     parser.add_option("", "--max-per-loop", type="int", default=1000,
                       help="Maximum number of items to delete in one go")
+    parser.add_option("", "--max-workers", type="int", default=1,
+                      help="Number of tables to purge concurrently")
+    parser.add_option("", "--checkpoint-file",
+                      help="File in which to record progress, for resuming")
     parser.add_option("", "--oneshot", action="store_true",
                       help="Do a single purge run and then exit")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
@@ -90,14 +217,19 @@ def main(args=None):
     purge_expired_items(config_file,
                         grace_period=opts.grace_period,
                         max_per_loop=opts.max_per_loop,
-                        backend_interval=opts.backend_interval)
+                        backend_interval=opts.backend_interval,
+                        max_workers=opts.max_workers,
+                        checkpoint_file=opts.checkpoint_file)
     if not opts.oneshot:
         while True:
             logger.debug("Sleeping for %d seconds", opts.purge_interval)
             time.sleep(opts.purge_interval)
             purge_expired_items(config_file,
                                 grace_period=opts.grace_period,
-                                backend_interval=opts.backend_interval)
+                                max_per_loop=opts.max_per_loop,
+                                backend_interval=opts.backend_interval,
+                                max_workers=opts.max_workers,
+                                checkpoint_file=opts.checkpoint_file)
     return 0
 
 
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Shard distribution reporting script for SyncStorage.
+
+This script takes a syncstorage config file and loops through each SQL
+storage backend therein, reporting how many users have data stored on each
+of its database servers.  The output has one line per server, giving the
+hostname of the backend, the server's URI, the range of BSO shards that it
+holds and the number of users.
+
+"""
+
+import os
+import sys
+import logging
+import optparse
+
+import syncstorage.scripts
+from syncstorage.storage import get_all_storages
+from syncstorage.storage.sql import SQLStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def report_shard_distribution(config_file, output_file):
+    """Report the distribution of users across servers in each backend."""
+    logger.info("Reporting shard distribution")
+    logger.debug("Using config file %r", config_file)
+    config = syncstorage.scripts.load_configurator(config_file)
+
+    for hostname, backend in get_all_storages(config):
+        # Find the underlying SQL storage, e.g. in case of memcached.
+        while hasattr(backend, "storage"):
+            backend = backend.storage
+        if not isinstance(backend, SQLStorage):
+            logger.debug("Skipping non-SQL backend for %s", hostname)
+            continue
+        for server in backend.get_shard_distribution():
+            if server["shards"]:
+                shards = "%d-%d" % (server["shards"][0], server["shards"][-1])
+            else:
+                shards = "-"
+            output_file.write("%s %s %s %d\n" % (hostname, server["sqluri"],
+                                                 shards, server["num_users"]))
+
+    logger.info("Finished reporting shard distribution")
+
+
+def main(args=None):
+    """Main entry-point for running this script.
+
+    This function parses command-line arguments and passes them on
+    to the report_shard_distribution() function.
+    """
+    usage = "usage: %prog [options] config_file"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.print_usage()
+        return 1
+
+    syncstorage.scripts.configure_script_logging(opts)
+
+    config_file = os.path.abspath(args[0])
+
+    report_shard_distribution(config_file, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    syncstorage.scripts.run_script(main)
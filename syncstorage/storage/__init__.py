@@ -9,6 +9,8 @@ Abstract interface definition for storage backends.
 
 import sys
 import abc
+import atexit
+import base64
 import logging
 
 from mozsvc.plugin import resolve_name
@@ -56,6 +58,36 @@ class InvalidBatch(StorageError, ValueError):
     pass
 
 
+def encode_index_offset(sortindex, id):
+    """Encode an "offset token" for resuming a query sorted by sortindex.
+
+    The token encodes the (sortindex, id) pair of the last item returned,
+    so that the next query can seek directly to the following item.  The
+    id is base64-encoded to keep the token safe for use in a URL.
+    """
+    if sortindex is None:
+        sortindex = ""
+    id = base64.urlsafe_b64encode(id.encode("ascii")).rstrip("=")
+    return "%s:%s" % (sortindex, id)
+
+
+def decode_index_offset(offset):
+    """Decode an "offset token" produced by encode_index_offset().
+
+    This returns the (sortindex, id) pair encoded in the token, raising
+    InvalidOffsetError if it is malformed.
+    """
+    try:
+        sortindex, id = offset.split(":", 1)
+        sortindex = int(sortindex) if sortindex else None
+        id = base64.urlsafe_b64decode(str(id) + "=" * (-len(id) % 4))
+    except (ValueError, TypeError):
+        raise InvalidOffsetError(offset)
+    if not id:
+        raise InvalidOffsetError(offset)
+    return sortindex, id
+
+
 class SyncStorage(object):
     """Abstract Base Class for storage backends.
 
@@ -572,9 +604,11 @@ def includeme(config):
         host_settings.setdefaults(settings)
         storage = load_storage_from_settings("storage", host_settings)
         config.registry[host_cache_key] = storage
+        _close_at_exit(storage)
     # Create the default backend to be used by all other hosts.
     storage = load_storage_from_settings("storage", settings)
     config.registry["syncstorage:storage:default"] = storage
+    _close_at_exit(storage)
     # Scan for additional config from any storage plugins.
     # Some might fail to import, use the onerror callback to ignore them.
     config.scan("syncstorage.storage", onerror=_ignore_import_errors)
@@ -603,6 +637,17 @@ def load_storage_from_settings(section_name, settings):
         return klass(wrapped_storage, **section_settings)
 
 
+def _close_at_exit(storage):
+    """Close the given backend when the process exits, if it can be closed.
+
+    Backends that do work in background threads provide a close() method
+    to finish that work, which would otherwise be lost on shutdown.
+    """
+    close = getattr(storage, "close", None)
+    if close is not None:
+        atexit.register(close)
+
+
 def _ignore_import_errors(name):
     """Venusian scan callback that will ignore any ImportError instances."""
     if not issubclass(sys.exc_info()[0], ImportError):
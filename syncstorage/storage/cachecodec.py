@@ -0,0 +1,193 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Codecs for serializing values stored in memcached.
+
+The memcached backend stores the metadata and items of each cached collection
+as a single value, so the cost of serializing it is paid on every read and
+write of the collection, and its serialized size limits how many items the
+collection can hold.  The following codecs are available:
+
+    * JSONCodec:    plain JSON, with timestamps written as decimal numbers.
+                    This is the original format, and remains the default.
+
+    * BinaryCodec:  data serialized with the marshal module, with timestamps
+                    held as integer centiseconds.  Values larger than a given
+                    threshold are compressed with zlib, or with lz4 if it is
+                    installed and selected.
+
+Binary values begin with a format byte identifying the encoding and any
+compression that was applied, which can never be the first byte of a JSON
+document.  Every codec can therefore read values written by any other codec.
+To switch codecs without flushing the cache, first deploy code that can read
+the new format everywhere, and then enable it.
+
+Like the previous JSON format, the binary format trusts the memcached server
+to return only the data that was stored in it; marshal is not robust against
+maliciously-constructed input.
+
+"""
+
+import zlib
+import marshal
+import decimal
+
+from mozsvc.plugin import resolve_name
+
+from syncstorage.util import Timestamp, get_timestamp, json_dumps, json_loads
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None  # NOQA
+
+
+# Format bytes at the start of each binary value.
+# Note that none of these can appear at the start of a JSON document.
+FORMAT_MARSHAL = "\x01"
+FORMAT_MARSHAL_ZLIB = "\x02"
+FORMAT_MARSHAL_LZ4 = "\x03"
+
+# Version of the marshal format to use.  It's stable across python 2.x.
+MARSHAL_VERSION = 2
+
+# Only compress values larger than this many bytes, since compression costs
+# more CPU time than it saves in network time on small values.
+DEFAULT_COMPRESS_THRESHOLD = 64 * 1024
+
+# Favour speed over size, since this happens on the request path.
+ZLIB_LEVEL = 1
+
+# Types that can be marshalled as-is.
+_SCALAR_TYPES = frozenset((str, unicode, int, long, bool, type(None)))
+
+
+def _pack(value):
+    """Convert a value into a form that can be marshalled.
+
+    Timestamps are replaced by a 1-tuple holding their integer centiseconds,
+    and so any tuples in the data are converted into lists.  Other floats and
+    Decimals are taken to be timestamps, as when loading JSON.  Dict keys are
+    converted to strings, and subclasses of dict or list (such as BSO objects)
+    are converted to the base type.  All of these match what a round-trip
+    through JSON would produce.
+    """
+    if isinstance(value, dict):
+        packed = {}
+        for k, v in value.iteritems():
+            # Check for the common types directly, to avoid the overhead
+            # of a recursive call for each leaf value.
+            typ = type(v)
+            if typ is Timestamp:
+                v = (v.centis,)
+            elif typ not in _SCALAR_TYPES:
+                v = _pack(v)
+            if type(k) is not str and type(k) is not unicode:
+                k = str(k)
+            packed[k] = v
+        return packed
+    if isinstance(value, (list, tuple)):
+        return [_pack(item) for item in value]
+    if isinstance(value, (float, decimal.Decimal)):
+        return (get_timestamp(value).centis,)
+    return value
+
+
+def _unpack(value):
+    """Restore timestamps in unmarshalled data, modifying it in-place."""
+    typ = type(value)
+    if typ is dict:
+        for k, v in value.iteritems():
+            typ = type(v)
+            if typ is tuple:
+                value[k] = Timestamp(v[0])
+            elif typ is dict or typ is list:
+                _unpack(v)
+    elif typ is list:
+        for i, v in enumerate(value):
+            typ = type(v)
+            if typ is tuple:
+                value[i] = Timestamp(v[0])
+            elif typ is dict or typ is list:
+                _unpack(v)
+    elif typ is tuple:
+        value = Timestamp(value[0])
+    return value
+
+
+def decode_value(data):
+    """Decode a value written by any of the available codecs."""
+    header = data[:1]
+    if header == FORMAT_MARSHAL:
+        return _unpack(marshal.loads(data[1:]))
+    if header == FORMAT_MARSHAL_ZLIB:
+        return _unpack(marshal.loads(zlib.decompress(data[1:])))
+    if header == FORMAT_MARSHAL_LZ4:
+        if lz4 is None:
+            raise ValueError("lz4 is required to decode this value")
+        return _unpack(marshal.loads(lz4.block.decompress(data[1:])))
+    return json_loads(data, timestamps=True)
+
+
+class JSONCodec(object):
+    """Codec storing values as plain JSON."""
+
+    def encode(self, value):
+        return json_dumps(value)
+
+    def decode(self, data):
+        return decode_value(data)
+
+
+class BinaryCodec(object):
+    """Codec storing values in a compact binary format.
+
+    Values whose serialized form is larger than compress_threshold bytes are
+    compressed using the named compression scheme, which may be "zlib" or
+    "lz4".  A compression of "none" disables compression entirely.
+    """
+
+    def __init__(self, compression="zlib",
+                 compress_threshold=DEFAULT_COMPRESS_THRESHOLD):
+        if compression == "none":
+            compression = None
+        if compression not in (None, "zlib", "lz4"):
+            raise ValueError("Unknown compression: %r" % (compression,))
+        if compression == "lz4" and lz4 is None:
+            raise ValueError("The lz4 module is not installed")
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+    def encode(self, value):
+        data = marshal.dumps(_pack(value), MARSHAL_VERSION)
+        if self.compression is None or len(data) <= self.compress_threshold:
+            return FORMAT_MARSHAL + data
+        if self.compression == "zlib":
+            return FORMAT_MARSHAL_ZLIB + zlib.compress(data, ZLIB_LEVEL)
+        return FORMAT_MARSHAL_LZ4 + lz4.block.compress(data)
+
+    def decode(self, data):
+        return decode_value(data)
+
+
+CODECS = {
+    "json": JSONCodec,
+    "binary": BinaryCodec,
+}
+
+
+def load_codec(name, **kwds):
+    """Create a codec given its short name or dotted class name.
+
+    Any keyword arguments are passed on to the codec class, except for the
+    JSON codec which takes no options.
+    """
+    if name == "json":
+        return JSONCodec()
+    try:
+        klass = CODECS[name]
+    except KeyError:
+        klass = resolve_name(name)
+    return klass(**kwds)
@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Circuit breaker for calls to a backend service.
+
+When a backend such as memcached is down or badly degraded, every call to it
+waits for a timeout before failing, and a request that makes several calls
+waits several times over.  The CircuitBreaker class notices when calls are
+failing and short-circuits further calls for a while, so that they fail
+immediately and callers can fall back to some other way of doing things.
+
+The breaker starts out "closed", letting calls through.  It is tripped into
+the "open" state by a given number of consecutive failures, where calls that
+succeed but take longer than a given time also count as failures.  While open
+it refuses all calls by raising CircuitOpenError.  After a given time it goes
+"half-open", letting a single probe call through at a time; the breaker
+closes again if the probe succeeds, and re-opens if it fails.
+
+"""
+
+import time
+import logging
+import threading
+import contextlib
+
+from mozsvc.exceptions import BackendError
+
+
+logger = logging.getLogger(__name__)
+
+# The states that the breaker can be in.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# Default number of consecutive failures needed to trip the breaker.
+DEFAULT_MAX_FAILURES = 5
+
+# Default number of seconds after which a call is counted as a failure.
+DEFAULT_SLOW_CALL_TIME = 1
+
+# Default number of seconds for which the breaker stays open.
+DEFAULT_RESET_TIMEOUT = 10
+
+
+class CircuitOpenError(BackendError):
+    """Error raised when a call is refused because the breaker is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Circuit breaker tracking the success of calls to a backend.
+
+    Calls should be made within the guard() context manager, which raises
+    CircuitOpenError if the breaker is open and otherwise records whether
+    the call succeeded.  Failures are signalled by raising BackendError;
+    any other exception means that the backend did respond.
+
+    A max_failures of zero disables the breaker, and a slow_call_time of
+    zero disables counting slow calls as failures.  The current state is
+    available from the "state" attribute.  The "num_trips" and "num_refused"
+    attributes count the times that the breaker has tripped and the number
+    of calls that it has refused.  If given, on_state_change is called with
+    the old and new states whenever the state changes.
+    """
+
+    def __init__(self, name="backend", max_failures=DEFAULT_MAX_FAILURES,
+                 slow_call_time=DEFAULT_SLOW_CALL_TIME,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, on_state_change=None):
+        self.name = name
+        self.max_failures = max_failures
+        self.slow_call_time = slow_call_time
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change
+        self.state = CLOSED
+        self.num_trips = 0
+        self.num_refused = 0
+        self._failures = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def guard(self):
+        """Context manager guarding a single call to the backend."""
+        if not self.allow():
+            retry_after = self._opened_at + self.reset_timeout - time.time()
+            raise CircuitOpenError("%s is unavailable" % (self.name,),
+                                   retry_after=max(int(retry_after) + 1, 1))
+        start = time.time()
+        failed = True
+        try:
+            yield None
+            failed = False
+        except BackendError:
+            raise
+        except Exception:
+            failed = False
+            raise
+        finally:
+            if failed:
+                self.record_failure()
+            else:
+                self.record_success(time.time() - start)
+
+    def allow(self):
+        """Check whether a call may be made.
+
+        Callers that are allowed to proceed must then report the outcome
+        using record_success() or record_failure().
+        """
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() < self._opened_at + self.reset_timeout:
+                    self.num_refused += 1
+                    return False
+                self._set_state(HALF_OPEN)
+            elif self.state == CLOSED:
+                return True
+            # Only let a single probe through at a time.
+            if self._probing:
+                self.num_refused += 1
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self, duration=0):
+        """Record a call that succeeded, taking the given number of seconds."""
+        if self.slow_call_time and duration > self.slow_call_time:
+            self.record_failure()
+            return
+        with self._lock:
+            self._failures = 0
+            if self.state == HALF_OPEN:
+                self._probing = False
+                self._set_state(CLOSED)
+                logger.info("%s has recovered; closing circuit breaker",
+                            self.name)
+
+    def record_failure(self):
+        """Record a call that failed."""
+        with self._lock:
+            self._failures += 1
+            if self.state == HALF_OPEN:
+                self._trip()
+            elif self.state == CLOSED:
+                if self.max_failures and self._failures >= self.max_failures:
+                    self._trip()
+
+    def _trip(self):
+        self._opened_at = time.time()
+        self._probing = False
+        self.num_trips += 1
+        self._set_state(OPEN)
+        logger.warning("%s is failing; opening circuit breaker for %ss",
+                       self.name, self.reset_timeout)
+
+    def _set_state(self, state):
+        old_state = self.state
+        self.state = state
+        if self.on_state_change is not None:
+            self.on_state_change(old_state, state)
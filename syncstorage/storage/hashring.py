@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Consistent hashing of keys onto a set of servers.
+
+To spread cached data over several memcached servers, each key must be
+mapped to one of them.  Simply taking a hash of the key modulo the number of
+servers would move almost every key whenever a server is added or removed,
+and the resulting flood of cache misses would land on the underlying store.
+
+The HashRing class instead places each server at many pseudo-random points
+on a circle of hash values, and maps each key to the server owning the first
+point at or after the key's own hash.  Adding or removing one of N servers
+then moves only about 1/N of the keys, and using many points per server
+("virtual nodes") keeps the share of keys held by each server even.
+
+"""
+
+import struct
+import bisect
+import hashlib
+
+
+# Default number of points on the ring for each server.
+DEFAULT_VNODES = 160
+
+
+def _hash(value):
+    """Hash a string to a point on the ring."""
+    return struct.unpack(">I", hashlib.md5(value).digest()[:4])[0]
+
+
+class HashRing(object):
+    """Consistent-hash ring mapping keys onto a set of nodes.
+
+    Nodes are given as strings, such as server addresses, and each one is
+    placed at vnodes points around the ring.  The placement depends only on
+    the node names, so every process configured with the same nodes will
+    map keys in the same way.
+    """
+
+    def __init__(self, nodes, vnodes=DEFAULT_VNODES):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("HashRing needs at least one node")
+        self.vnodes = vnodes
+        points = []
+        for node in self.nodes:
+            for i in xrange(vnodes):
+                points.append((_hash("%s-%d" % (node, i)), node))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._point_nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """Get the node that owns the given key."""
+        i = bisect.bisect_left(self._points, _hash(key))
+        return self._point_nodes[i % len(self._points)]
+
+    def get_nodes(self, key, count):
+        """Get up to count distinct nodes for the given key.
+
+        The first is the node that owns the key, and the others are those
+        found next going around the ring, which is where replicas of the
+        key should be kept.
+        """
+        count = min(count, len(self.nodes))
+        nodes = []
+        num_points = len(self._points)
+        i = bisect.bisect_left(self._points, _hash(key))
+        for j in xrange(num_points):
+            node = self._point_nodes[(i + j) % num_points]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
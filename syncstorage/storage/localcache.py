@@ -0,0 +1,100 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+In-process cache of recently-used values.
+
+The memcached backend reads each user's metadata from memcache at least once
+per request, and a single sync often involves a burst of requests from the
+same user landing on the same worker process.  The LocalCache class keeps
+such values in memory for a short time, so that those requests can skip the
+round trip to memcache.
+
+Entries expire after a fixed number of seconds, and the least-recently-used
+ones are evicted once there are too many.  There is no way to know when
+another process changes the value in memcache, so the expiry time bounds how
+stale a value can be, and should be kept short.  Changes made by the current
+process should update or discard the local copy directly.
+
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+# Default maximum number of entries to keep.
+DEFAULT_MAX_SIZE = 10000
+
+# Default number of seconds for which an entry may be used.
+DEFAULT_TTL = 2
+
+
+class LocalCache(object):
+    """Bounded LRU cache of values that expire after a given time.
+
+    The number of lookups that found a value and those that did not are
+    counted in the "hits" and "misses" attributes respectively.  Values are
+    shared between threads, so callers must not modify them in place.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Entries are (expiry time, value), in least-recently-used order.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self):
+        """The proportion of lookups that found a value, if any were made."""
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return float(self.hits) / total
+
+    def __contains__(self, key):
+        """Check for an unexpired value, without counting it as a lookup."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.time()
+
+    def get(self, key):
+        """Get the value for the given key, or None if there isn't one."""
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires <= time.time():
+                self.misses += 1
+                return None
+            # Mark it as recently used.
+            self._entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store the value for the given key."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Discard any value for the given key."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Discard all values."""
+        with self._lock:
+            self._entries.clear()
@@ -32,27 +32,139 @@ It has the following structure:
 
 For each collection to be stored in memcache, the corresponding key contains
 a JSON mapping from item ids to BSO objects along with a record of the last-
-modified timestamp for that collection:
+modified timestamp for that collection, and the item ids in sorted order:
 
     {
-      "modified":   <last-modified timestamp for the collection>,
+      "modified":     <last-modified timestamp for the collection>,
       "items": {
-        <item id>:  <BSO object for that item>,
-      }
+        <item id>:    <BSO object for that item>,
+      },
+      "by_modified":  [<item ids sorted by modified timestamp, then id>],
+      "by_index":     [<item ids sorted by sortindex, then id>],
+      "by_ttl":       [<ids of items with a ttl, sorted by ttl, then id>],
+      "sort_orders":  [<format version of the lists>, <"modified" value>]
+    }
+
+The sorted ids are kept up to date as items are written and deleted, so that
+reads can find the items newer or older than a given timestamp by bisection,
+and return a page of them without sorting the whole collection.  Likewise the
+expired items can be found without checking the ttl of every item.  The lists
+are trusted if "sort_orders" gives the current format version along with the
+collection's current timestamp, which would be left behind by any code that
+changed the items without updating the lists.  Otherwise they're checked
+against the items, and sorted again if they don't match.
+
+Large collections can instead be split across several keys, by setting
+"cache_collection_chunks" to the number of chunks to use.  The collection
+key then holds a small index recording the version of each chunk:
+
+    {
+      "modified":     <last-modified timestamp for the collection>,
+      "chunks":       [<version of chunk 0>, <version of chunk 1>, ...],
     }
 
+The items themselves are divided between the chunks by a hash of their id.
+Each non-empty chunk is stored in a key named for its number and version,
+userid:c:<collection>:<chunk>:<version>, holding the "items" of just those
+items along with their own "by_modified", "by_index" and "by_ttl" lists and
+"sort_orders" version, which are merged when the collection is read.  Writes
+store new versions of the chunks that they change and then update the index
+with CAS, so that only the changed chunks need to be sent to memcache, and
+readers always see a consistent set of chunks.
+
+These structures are shown as JSON, which is how they are serialized by
+default.  The more compact binary codecs from syncstorage.storage.cachecodec
+can be selected with the "cache_codec" setting.
+
 To avoid the cached data getting out of sync with the underlying storage, we
 explicitly mark the cache as dirty before performing any write operations.
 In the unlikely event of a mid-operation crash, we'll notice the dirty cache
 and fall back to the underlying store instead of using potentially inconsistent
 data from memcache.
+
+Most operations act on a single collection while holding a lock on it.  Once
+the lock has been taken, the metadata key and the keys for that collection are
+fetched together in a single round trip.  The number of round trips made to
+memcached is reported in the "syncstorage.storage.memcached.round_trips"
+metric for each request.
+
+The cached size is kept up to date as items are written and deleted, but must
+periodically be recalculated from the underlying store to account for items
+that expired.  Requests that find it more than an hour old queue the user for
+recalculation by a pool of background threads, and continue using the stale
+value in the meantime.  Only a user who is close to their quota will have it
+recalculated on the request path.
+
+Cache-only collections can optionally be saved to the underlying store in the
+background, by setting "cache_only_write_behind".  Some time after each write,
+a snapshot of the cached data is stored as a single item in a collection
+named <collection>:snapshot, which is hidden from the collection listings
+and reloaded into memcache if the cached data goes missing.
+
+Other collections can also be cached automatically while they're small and
+frequently read, by setting "cache_auto_promote".  Reads of such collections
+go through the cache, but writes go straight to the underlying store, so the
+cached data is only used if its timestamp matches that in the metadata.  See
+syncstorage.storage.promotion for the policy used to choose them.
+
+Each process also keeps the metadata of recently-active users in memory for
+a couple of seconds, so that a burst of requests from one user's devices can
+skip the round trip to memcache.  Writes made by the process update the local
+copy, but writes made by other processes can go unseen until it expires.
+Requests holding a write lock always read the metadata from memcache.  Set
+"cache_local_metadata" to false to disable this.
+
+Calls to memcached go through a circuit breaker, which opens after several
+consecutive failures or slow calls so that later calls fail immediately
+rather than each waiting for a timeout.  While it is open, reads of the
+metadata and of cached collections go straight to the underlying store.
+Cache-only collections, memcache-level locks and writes, which must mark the
+cached metadata as dirty, fail fast with a 503 error.  After a while single
+probe calls are let through, and the breaker closes again once one succeeds.
+See syncstorage.storage.circuitbreaker for details.
+
+If several "cache_servers" are given, the keys are spread between them using
+a consistent-hash ring, so that adding or removing a server moves only a
+share of the keys to a different server.  Each server has its own circuit
+breaker.  The small but frequently-read metadata key can also be kept on more
+than one server, by setting "cache_metadata_replicas", so that it can still
+be read and written while one of them is down.  Reads of the metadata check
+every replica and use the newest copy, which is the one with the latest
+"modified" time unless any of them is marked as dirty.  That way a server
+which missed some writes while it was down doesn't serve stale metadata when
+it comes back.  See the module syncstorage.storage.hashring for details.
 """
 
 import time
+import zlib
+import heapq
+import itertools
 import threading
 import contextlib
 
-from syncstorage.util import get_timestamp, json_loads, json_dumps
+from syncstorage.util import get_timestamp, json_dumps, json_loads
+from syncstorage.storage.sizerefresh import (BackgroundRefresher,
+                                             DEFAULT_NUM_WORKERS,
+                                             DEFAULT_MAX_PENDING)
+from syncstorage.storage.writebehind import (WriteBehindQueue,
+                                             DEFAULT_FLUSH_DELAY,
+                                             DEFAULT_MAX_FLUSH_RATE,
+                                             DEFAULT_MAX_DIRTY)
+from syncstorage.storage.promotion import (CollectionPromoter,
+                                           DEFAULT_WINDOW,
+                                           DEFAULT_MIN_READS,
+                                           DEFAULT_MAX_SIZE,
+                                           DEFAULT_MAX_PROMOTED)
+from syncstorage.storage.localcache import LocalCache
+from syncstorage.storage.hashring import HashRing, DEFAULT_VNODES
+from syncstorage.storage.circuitbreaker import (CircuitBreaker,
+                                                CircuitOpenError,
+                                                OPEN,
+                                                DEFAULT_MAX_FAILURES,
+                                                DEFAULT_SLOW_CALL_TIME,
+                                                DEFAULT_RESET_TIMEOUT)
+from syncstorage.storage.cachecodec import (JSONCodec, load_codec,
+                                            DEFAULT_COMPRESS_THRESHOLD)
 from syncstorage.storage import (SyncStorage,
                                  StorageError,
                                  ConflictError,
@@ -60,10 +172,14 @@ from syncstorage.storage import (SyncStorage,
                                  ItemNotFoundError,
                                  InvalidOffsetError,
                                  InvalidBatch,
-                                 BATCH_LIFETIME)
+                                 BATCH_LIFETIME,
+                                 encode_index_offset,
+                                 decode_index_offset)
 
 from pyramid.settings import aslist
 
+from mozsvc.exceptions import BackendError
+from mozsvc.metrics import annotate_request
 from mozsvc.storage.mcclient import MemcachedClient
 
 
@@ -76,30 +192,757 @@ DEFAULT_CACHE_LOCK_TTL = 5 * 60
 # Grace period to allow between expiring of ttl's items, and deletion.
 TTL_EXPIRY_GRACE_PERIOD = 60 * 60 * 24  # 1 day, in seconds
 
+# Name of the per-request metric counting round trips to memcached.
+ROUND_TRIPS_METRIC = "syncstorage.storage.memcached.round_trips"
+
+# Expire the lease for filling a missing cache key after thirty seconds.
+DEFAULT_FILL_LEASE_TTL = 30
+
+# Wait at most half a second for someone else to fill a missing cache key.
+DEFAULT_FILL_WAIT = 0.5
+
+# Interval at which to poll while waiting for a cache key to be filled.
+FILL_POLL_INTERVAL = 0.05
+
+# Names of the per-request metrics recording use of fill leases.
+LEASE_FILLS_METRIC = "syncstorage.storage.memcached.lease.fills"
+LEASE_WAITS_METRIC = "syncstorage.storage.memcached.lease.waits"
+LEASE_FALLBACKS_METRIC = "syncstorage.storage.memcached.lease.fallbacks"
+
+# Name of the per-request metric counting background size recalculations.
+SIZE_REFRESHES_METRIC = "syncstorage.storage.memcached.size_refreshes"
+
+# Give up on a background size recalculation if it's clobbered this often.
+SIZE_REFRESH_ATTEMPTS = 3
+
+# Id of the item holding a saved snapshot of a cache-only collection.
+SNAPSHOT_ITEM_ID = "snapshot"
+
+# Names of the per-request metrics reporting on write-behind saves.
+WRITE_BEHIND_DEPTH_METRIC = "syncstorage.storage.memcached.write_behind.depth"
+WRITE_BEHIND_LAG_METRIC = "syncstorage.storage.memcached.write_behind.lag"
+WRITE_BEHIND_DROPS_METRIC = "syncstorage.storage.memcached.write_behind.drops"
+SNAPSHOT_RELOADS_METRIC = "syncstorage.storage.memcached.snapshot_reloads"
+
+# Name of the per-request metric counting reads that had to sort cached data.
+SORT_ORDER_REBUILDS_METRIC = "syncstorage.storage.memcached.sort_rebuilds"
+
+# Names of the per-request metrics counting reads of promoted collections.
+PROMOTED_HITS_METRIC = "syncstorage.storage.memcached.promoted.hits"
+PROMOTED_MISSES_METRIC = "syncstorage.storage.memcached.promoted.misses"
+
+# Default number of users whose metadata is kept in memory by each process.
+DEFAULT_LOCAL_METADATA_SIZE = 10000
+
+# Default number of seconds for which metadata is kept in memory.
+DEFAULT_LOCAL_METADATA_TTL = 2
+
+# Names of the per-request metrics counting lookups of in-memory metadata.
+LOCAL_METADATA_HITS_METRIC = "syncstorage.storage.memcached.local.hits"
+LOCAL_METADATA_MISSES_METRIC = "syncstorage.storage.memcached.local.misses"
+
+# Names of the per-request metrics reporting on the circuit breaker.
+BREAKER_TRIPS_METRIC = "syncstorage.storage.memcached.breaker.trips"
+BREAKER_RECOVERIES_METRIC = "syncstorage.storage.memcached.breaker.recoveries"
+BREAKER_REFUSED_METRIC = "syncstorage.storage.memcached.breaker.refused"
+BREAKER_FALLBACKS_METRIC = "syncstorage.storage.memcached.breaker.fallbacks"
+
+# Arguments to get_items() that select only some of the items.
+_PARTIAL_READ_KWDS = ("newer", "older", "limit", "offset", "ids")
+
+# Arguments to get_items() for paginated reads.  These always go to the
+# underlying store, since its offset tokens can't be used with the cache.
+_PAGINATION_KWDS = ("limit", "offset")
+
 
 def _key(*names):
     return ":".join(map(str, names))
 
 
+def _is_metadata_key(key):
+    """Check whether the given key holds a user's metadata."""
+    return key.endswith(":metadata")
+
+
+def _metadata_version(data):
+    """Get the version of a metadata dict, for comparing replicas of it.
+
+    Metadata marked as dirty counts as newer than any other, since it's
+    always safe to fall back to the underlying store.  Otherwise the one
+    with the latest modified time is the newest.
+    """
+    if data["modified"] is None:
+        return (1, None)
+    return (0, data["modified"])
+
+
+def _chunk_for_id(id, num_chunks):
+    """Get the number of the chunk in which to store the given item id."""
+    if isinstance(id, unicode):
+        id = id.encode("utf8")
+    return (zlib.crc32(id) & 0xffffffff) % num_chunks
+
+
+def _copy_metadata(data):
+    """Copy a metadata dict, so that the copy can be changed safely."""
+    data = data.copy()
+    data["collections"] = data["collections"].copy()
+    return data
+
+
 def bso_sort_key_index(bso):
-    return (bso["sortindex"], bso["id"])
+    # Items read from the underlying store have no sortindex if it's null.
+    return (bso.get("sortindex"), bso["id"])
 
 
 def bso_sort_key_modified(bso):
     return (bso["modified"], bso["id"])
 
 
+def bso_sort_key_ttl(bso):
+    return (bso["ttl"], bso["id"])
+
+
+def _has_ttl(bso):
+    return bso.get("ttl") is not None
+
+
+# Names of the sorted lists of item ids in cached data, the sort key used
+# for each of them, and the test for which items they include, if not all.
+# The version must be changed whenever the lists' format changes.
+SORT_ORDERS_VERSION = 1
+_SORT_ORDERS = (
+    ("by_modified", bso_sort_key_modified, None),
+    ("by_index", bso_sort_key_index, None),
+    ("by_ttl", bso_sort_key_ttl, _has_ttl),
+)
+
+
+def _bisect(ids, key, target, right=False):
+    """Find the position of target in a list of ids sorted by key(id).
+
+    Like the functions in the bisect module, this returns the position of
+    the first id whose key is not less than target, or if right is true,
+    the first id whose key is greater than target.
+    """
+    lo = 0
+    hi = len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        k = key(ids[mid])
+        if k < target or (right and k == target):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _is_sort_order(ids, items, sort_key, include):
+    """Check that a list of ids holds exactly the matching items, in order.
+
+    Since each sort key ends with the item id, the keys must be strictly
+    increasing, which also rules out duplicates.
+    """
+    if include is None:
+        num_included = len(items)
+    else:
+        num_included = sum(1 for bso in items.itervalues() if include(bso))
+    if len(ids) != num_included:
+        return False
+    prev_key = None
+    for id in ids:
+        bso = items.get(id)
+        if bso is None or (include is not None and not include(bso)):
+            return False
+        key = sort_key(bso)
+        if prev_key is not None and key <= prev_key:
+            return False
+        prev_key = key
+    return True
+
+
+def _stamp_sort_orders(data):
+    """Record that the sorted lists of ids in cached data are up to date.
+
+    This must be called after changing the data's items or timestamp.
+    """
+    data["sort_orders"] = [SORT_ORDERS_VERSION, data.get("modified")]
+
+
+def _ensure_sort_orders(data):
+    """Add the sorted lists of item ids to cached data, if it's missing them.
+
+    Lists stamped with the current version and timestamp are trusted as-is.
+    Any others that don't match the items, e.g. because they were written
+    by a version of the code that didn't keep them up to date, are replaced.
+    This returns True if they had to be added.
+    """
+    if data.get("sort_orders") == [SORT_ORDERS_VERSION, data.get("modified")]:
+        if all(name in data for name, _, _ in _SORT_ORDERS):
+            return False
+    items = data["items"]
+    missing = False
+    for name, sort_key, include in _SORT_ORDERS:
+        ids = data.get(name)
+        if ids is None or not _is_sort_order(ids, items, sort_key, include):
+            bsos = items.itervalues()
+            if include is not None:
+                bsos = (bso for bso in bsos if include(bso))
+            data[name] = [bso["id"] for bso in sorted(bsos, key=sort_key)]
+            missing = True
+    _stamp_sort_orders(data)
+    return missing
+
+
+def _merge_sort_orders(data, chunks):
+    """Merge the sorted lists of ids from each chunk into the cached data.
+
+    This returns False if any chunk is missing them or has them in an older
+    format, in which case they're left for _ensure_sort_orders() to add.
+    """
+    for chunk in chunks:
+        if chunk.get("sort_orders") != [SORT_ORDERS_VERSION, None]:
+            return False
+    items = data["items"]
+    merged = {}
+    for name, sort_key, _ in _SORT_ORDERS:
+        keyed = []
+        for chunk in chunks:
+            ids = chunk.get(name)
+            if ids is None:
+                return False
+            try:
+                keyed.append([(sort_key(items[id]), id) for id in ids])
+            except KeyError:
+                return False
+        merged[name] = [id for _, id in heapq.merge(*keyed)]
+    data.update(merged)
+    _stamp_sort_orders(data)
+    return True
+
+
+def _add_to_sort_orders(data, bso):
+    """Insert an item into the sorted lists of ids in cached data."""
+    items = data["items"]
+    for name, sort_key, include in _SORT_ORDERS:
+        if include is not None and not include(bso):
+            continue
+        ids = data[name]
+        pos = _bisect(ids, lambda id: sort_key(items[id]), sort_key(bso))
+        ids.insert(pos, bso["id"])
+
+
+def _remove_from_sort_orders(data, bso):
+    """Remove an item from the sorted lists of ids in cached data.
+
+    The item must still have the values that it was sorted by.
+    """
+    items = data["items"]
+    for name, sort_key, include in _SORT_ORDERS:
+        if include is not None and not include(bso):
+            continue
+        ids = data[name]
+        pos = _bisect(ids, lambda id: sort_key(items[id]), sort_key(bso))
+        if pos < len(ids) and ids[pos] == bso["id"]:
+            del ids[pos]
+        else:
+            ids.remove(bso["id"])
+
+
+def _find_expired_ids(data, expiry_time):
+    """Get the ids of cached items whose ttl is no later than expiry_time.
+
+    Only the expired items are looked at, using the list of ids sorted
+    by ttl, which must be present in the data.
+    """
+    items = data["items"]
+    ids = data["by_ttl"]
+    end = _bisect(ids, lambda id: items[id]["ttl"], expiry_time, right=True)
+    return ids[:end]
+
+
+def _purge_expired_items(data, expiry_time):
+    """Remove cached items whose ttl is before expiry_time.
+
+    This returns the ids of the items that were removed.
+    """
+    items = data["items"]
+    ids = data["by_ttl"]
+    end = _bisect(ids, lambda id: items[id]["ttl"], expiry_time)
+    expired_ids = ids[:end]
+    for id in expired_ids:
+        _remove_from_sort_orders(data, items[id])
+        del items[id]
+    return expired_ids
+
+
 class MemcachedClient(MemcachedClient):
-    """MemcachedClient that can handle decimal.Decimal instances."""
+    """MemcachedClient that can handle timestamp values.
+
+    Values are serialized using the given codec object, which defaults to
+    JSON.  All non-integer numbers stored in the cache are timestamps, so they
+    are loaded back as Timestamp instances rather than as generic Decimals.
+
+    Each round trip to memcached is counted in the per-request metrics.
+    To cut down on round trips, a set of keys can be fetched all at once
+    using the prefetching() context manager, after which get() and gets()
+    calls for those keys are answered locally.
+
+    Round trips are guarded by the given CircuitBreaker object, if any, and
+    raise CircuitOpenError without contacting memcached while it is open.
+    """
+
+    def __init__(self, *args, **kwds):
+        codec = kwds.pop("codec", None)
+        breaker = kwds.pop("breaker", None)
+        super(MemcachedClient, self).__init__(*args, **kwds)
+        if codec is None:
+            codec = JSONCodec()
+        self.codec = codec
+        if breaker is None:
+            breaker = CircuitBreaker("memcached", max_failures=0)
+        self.breaker = breaker
+        # Prefetched values are tracked per-thread, since each thread will
+        # be working on a different request.
+        self._tldata = threading.local()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        try:
+            with self.breaker.guard():
+                annotate_request(None, ROUND_TRIPS_METRIC, 1)
+                with super(MemcachedClient, self)._connect() as mc:
+                    yield mc
+        except CircuitOpenError:
+            annotate_request(None, BREAKER_REFUSED_METRIC, 1)
+            raise
 
     def _encode_value(self, value):
-        value = json_dumps(value)
+        value = self.codec.encode(value)
         if len(value) > self.max_value_size:
             raise ValueError("value too long")
         return value, 0
 
     def _decode_value(self, value, flags):
-        return json_loads(value)
+        return self.codec.decode(value)
+
+    @contextlib.contextmanager
+    def prefetching(self, keys):
+        """Context manager to fetch the given keys in a single round trip.
+
+        On entry the keys are all fetched with a single gets_multi() request.
+        Within the context, get() and gets() calls for those keys return the
+        prefetched values, while any write to a key through this client will
+        discard its prefetched value.  Nested uses fetch only those keys that
+        are not already prefetched.  Nothing is prefetched while the circuit
+        breaker is open, leaving the individual calls to fail or fall back.
+        """
+        prefetched = getattr(self._tldata, "prefetched", None)
+        outermost = prefetched is None
+        if outermost:
+            prefetched = self._tldata.prefetched = {}
+        try:
+            missing = [key for key in keys if key not in prefetched]
+            if missing:
+                # Keep the raw data rather than the decoded value, so that
+                # callers can freely modify what they get back.
+                try:
+                    items = self._gets_multi(missing)
+                except CircuitOpenError:
+                    pass
+                else:
+                    for key in missing:
+                        prefetched[key] = items.get(key)
+            yield None
+        finally:
+            if outermost:
+                del self._tldata.prefetched
+
+    def is_prefetched(self, key):
+        """Check whether a value for the key was prefetched."""
+        return key in getattr(self._tldata, "prefetched", ())
+
+    def _get_prefetched(self, key):
+        """Get the raw prefetched (data, flags, casid) for the given key.
+
+        This raises KeyError if the key was not prefetched, and returns None
+        if it was prefetched but not found in memcached.
+        """
+        try:
+            prefetched = self._tldata.prefetched
+        except AttributeError:
+            raise KeyError(key)
+        return prefetched[key]
+
+    def forget_prefetched(self, key):
+        """Discard any prefetched value for the given key."""
+        prefetched = getattr(self._tldata, "prefetched", None)
+        if prefetched is not None:
+            prefetched.pop(key, None)
+
+    def _gets_multi(self, keys):
+        """Get raw (data, flags, casid) tuples for the given keys."""
+        with self._connect() as mc:
+            encoded_keys = [self._encode_key(key) for key in keys]
+            encoded_items = mc.gets_multi(encoded_keys)
+        items = {}
+        for key, res in encoded_items.iteritems():
+            assert res is not None
+            items[self._decode_key(key)] = res
+        return items
+
+    def get(self, key):
+        try:
+            res = self._get_prefetched(key)
+        except KeyError:
+            return super(MemcachedClient, self).get(key)
+        if res is None:
+            return None
+        data, flags, _ = res
+        return self._decode_value(data, flags)
+
+    def gets(self, key):
+        try:
+            res = self._get_prefetched(key)
+        except KeyError:
+            return super(MemcachedClient, self).gets(key)
+        if res is None:
+            return None, None
+        data, flags, casid = res
+        return self._decode_value(data, flags), casid
+
+    def gets_multi(self, keys):
+        """Get the values and casids for the given keys in a single request."""
+        items = {}
+        for key, (data, flags, casid) in self._gets_multi(keys).iteritems():
+            items[key] = (self._decode_value(data, flags), casid)
+        return items
+
+    def set(self, key, value, time=0):
+        self.forget_prefetched(key)
+        return super(MemcachedClient, self).set(key, value, time)
+
+    def add(self, key, value, time=0):
+        self.forget_prefetched(key)
+        return super(MemcachedClient, self).add(key, value, time)
+
+    def replace(self, key, value, time=0):
+        self.forget_prefetched(key)
+        return super(MemcachedClient, self).replace(key, value, time)
+
+    def cas(self, key, value, casid, time=0):
+        self.forget_prefetched(key)
+        return super(MemcachedClient, self).cas(key, value, casid, time)
+
+    def delete(self, key):
+        self.forget_prefetched(key)
+        return super(MemcachedClient, self).delete(key)
+
+    @property
+    def servers(self):
+        """The addresses of the memcached servers used by this client."""
+        return [self.pool.server]
+
+    def get_servers(self, key):
+        """Get the addresses of the servers that hold the given key."""
+        return self.servers
+
+    def breaker_for(self, key):
+        """Get the circuit breaker guarding calls for the given key."""
+        return self.breaker
+
+    def get_replicas(self, key):
+        """Get a list of (server, value) pairs for each copy of the key."""
+        value = self.get(key)
+        if value is None:
+            return []
+        return [(self.pool.server, value)]
+
+    def delete_everywhere(self, key):
+        """Delete the given key from every server that might hold it."""
+        return self.delete(key)
+
+
+class HashRingMemcachedClient(MemcachedClient):
+    """MemcachedClient that spreads keys over several servers.
+
+    Each key is stored on the server chosen for it by a consistent-hash ring,
+    so that adding or removing a server moves only a fraction of the keys.
+    Keys for which replicate(key) returns True are also kept on the next
+    num_replicas - 1 servers around the ring.  Writes to such keys go to
+    every replica whose circuit breaker is closed, and reads are answered
+    by the first replica that responds.
+
+    If a version function is given, then reads of replicated keys instead
+    check every replica that responds and return the copy with the highest
+    version(value).  Values written by add() or cas() are copied to the
+    other replicas with CAS, and never replace a copy with a higher version.
+
+    The clients argument maps each server address to the MemcachedClient
+    used to talk to it, each with its own circuit breaker.  The casids given
+    out by this class record the server that they came from, so that cas()
+    can be sent back to the same server.
+
+    A server that drops out and later comes back, without being restarted,
+    may hold replicas that missed some writes in the meantime.  Without a
+    version function they may be read in place of the newer copies, and
+    even with one, keys that were deleted while it was away can come back.
+    It's best flushed before being put back into service.
+    """
+
+    def __init__(self, clients, replicate=None, num_replicas=1,
+                 vnodes=DEFAULT_VNODES, version=None):
+        # There's no single connection pool, so the base class constructor
+        # isn't called.  The clients for each server do the actual work.
+        self.clients = clients
+        self.ring = HashRing(clients, vnodes)
+        self.replicate = replicate
+        self.num_replicas = num_replicas
+        self.version = version
+        self.codec = clients[self.ring.nodes[0]].codec
+        self._tldata = threading.local()
+
+    @property
+    def servers(self):
+        return list(self.ring.nodes)
+
+    def get_servers(self, key):
+        if self.replicate is not None and self.replicate(key):
+            return self.ring.get_nodes(key, self.num_replicas)
+        return [self.ring.get_node(key)]
+
+    def breaker_for(self, key):
+        return self.clients[self.ring.get_node(key)].breaker
+
+    def get_replicas(self, key):
+        # Report whatever copies can be read, skipping unavailable servers.
+        replicas = []
+        for server in self.get_servers(key):
+            try:
+                value = self.clients[server].get(key)
+            except BackendError:
+                continue
+            if value is not None:
+                replicas.append((server, value))
+        return replicas
+
+    def delete_everywhere(self, key):
+        # Servers other than its current owners may still hold copies
+        # of the key from before the set of servers was changed.
+        self.forget_prefetched(key)
+        deleted = False
+        for client in self.clients.itervalues():
+            if client.delete(key):
+                deleted = True
+        return deleted
+
+    def _is_versioned(self, key):
+        """Check whether reads of the key should look for the newest copy."""
+        return self.version is not None and len(self.get_servers(key)) > 1
+
+    def _read_newest(self, key):
+        """Read the given key from every replica, to find the newest copy.
+
+        This returns the address of the server holding the newest copy,
+        along with its value and casid.  Servers that don't respond are
+        skipped, unless none of them do.
+        """
+        servers = self.get_servers(key)
+        newest = (servers[0], None, None)
+        newest_version = None
+        responded = False
+        for server in servers:
+            try:
+                value, casid = self.clients[server].gets(key)
+            except BackendError:
+                if not responded and server == servers[-1]:
+                    raise
+                continue
+            responded = True
+            if value is not None:
+                version = self.version(value)
+                if newest[1] is None or version > newest_version:
+                    newest = (server, value, casid)
+                    newest_version = version
+        return newest
+
+    def _read_any(self, key, read):
+        """Read the given key from the first replica that responds.
+
+        This returns the address of the server that was read from, along
+        with the result of calling read() with the client for that server.
+        """
+        servers = self.get_servers(key)
+        for server in servers[:-1]:
+            try:
+                return server, read(self.clients[server])
+            except BackendError:
+                pass
+        return servers[-1], read(self.clients[servers[-1]])
+
+    def _write_all(self, key, write):
+        """Write the given key to each replica that is available.
+
+        This returns the result of calling write() with the client for the
+        first replica, or the first one that responded if it's unavailable.
+        """
+        self.forget_prefetched(key)
+        servers = self.get_servers(key)
+        result = None
+        written = False
+        for server in servers:
+            try:
+                res = write(self.clients[server])
+            except CircuitOpenError:
+                # It'll be refused until it's back, so carry on without it.
+                # If none of them are available then so is this call.
+                if not written and server == servers[-1]:
+                    raise
+                continue
+            if not written:
+                result = res
+                written = True
+        return result
+
+    def _copy_to_replicas(self, key, value, time, servers):
+        """Copy a value that was just written to the other replicas.
+
+        If there's a version function then each copy is made with CAS, and
+        is skipped if the replica already holds a newer value or changes
+        while it's being checked.
+        """
+        for server in servers:
+            client = self.clients[server]
+            try:
+                if self.version is None:
+                    client.set(key, value, time)
+                    continue
+                current, casid = client.gets(key)
+                if current is None:
+                    client.add(key, value, time)
+                elif self.version(value) >= self.version(current):
+                    client.cas(key, value, casid, time)
+            except CircuitOpenError:
+                pass
+
+    def _gets_multi_newest(self, keys):
+        """Get raw (data, flags, casid) for the newest copy of each key.
+
+        Each server is asked for all of its keys at once, and any that
+        don't respond are skipped, unless none of a key's servers do.
+        """
+        keys_by_server = {}
+        for key in keys:
+            for server in self.get_servers(key):
+                keys_by_server.setdefault(server, []).append(key)
+        newest = {}
+        responded = set()
+        error = None
+        for server, server_keys in keys_by_server.iteritems():
+            try:
+                res = self.clients[server]._gets_multi(server_keys)
+            except BackendError as e:
+                error = e
+                continue
+            responded.update(server_keys)
+            for key, (data, flags, casid) in res.iteritems():
+                version = self.version(self._decode_value(data, flags))
+                if key not in newest or version > newest[key][0]:
+                    newest[key] = (version, (data, flags, (server, casid)))
+        if len(responded) < len(keys):
+            raise error
+        return dict((key, item) for key, (_, item) in newest.iteritems())
+
+    def _gets_multi(self, keys):
+        items = {}
+        versioned = [key for key in keys if self._is_versioned(key)]
+        if versioned:
+            items.update(self._gets_multi_newest(versioned))
+            versioned = set(versioned)
+            keys = [key for key in keys if key not in versioned]
+        # Fetch the keys for each server together, trying the next replica
+        # of any replicated keys whose server doesn't respond.
+        pending = dict((key, self.get_servers(key)) for key in keys)
+        while pending:
+            keys_by_server = {}
+            for key, servers in pending.iteritems():
+                keys_by_server.setdefault(servers[0], []).append(key)
+            retry = {}
+            for server, server_keys in keys_by_server.iteritems():
+                try:
+                    res = self.clients[server]._gets_multi(server_keys)
+                except BackendError:
+                    for key in server_keys:
+                        if len(pending[key]) == 1:
+                            raise
+                        retry[key] = pending[key][1:]
+                    continue
+                for key, (data, flags, casid) in res.iteritems():
+                    items[key] = (data, flags, (server, casid))
+            pending = retry
+        return items
+
+    def get(self, key):
+        if self.is_prefetched(key):
+            return super(HashRingMemcachedClient, self).get(key)
+        if self._is_versioned(key):
+            return self._read_newest(key)[1]
+        return self._read_any(key, lambda client: client.get(key))[1]
+
+    def gets(self, key):
+        if self.is_prefetched(key):
+            return super(HashRingMemcachedClient, self).gets(key)
+        if self._is_versioned(key):
+            server, value, casid = self._read_newest(key)
+        else:
+            server, (value, casid) = self._read_any(
+                key, lambda client: client.gets(key))
+        if casid is not None:
+            casid = (server, casid)
+        return value, casid
+
+    def get_multi(self, keys):
+        items = {}
+        for key, (data, flags, _) in self._gets_multi(keys).iteritems():
+            items[key] = self._decode_value(data, flags)
+        return items
+
+    def set(self, key, value, time=0):
+        return self._write_all(key,
+                               lambda client: client.set(key, value, time))
+
+    def replace(self, key, value, time=0):
+        return self._write_all(key,
+                               lambda client: client.replace(key, value, time))
+
+    def delete(self, key):
+        return self._write_all(key, lambda client: client.delete(key))
+
+    def add(self, key, value, time=0):
+        self.forget_prefetched(key)
+        servers = self.get_servers(key)
+        # Only the first available replica decides whether it's added.
+        for i, server in enumerate(servers):
+            try:
+                added = self.clients[server].add(key, value, time)
+            except CircuitOpenError:
+                if i == len(servers) - 1:
+                    raise
+                continue
+            if added:
+                self._copy_to_replicas(key, value, time, servers[i + 1:])
+            return added
+
+    def cas(self, key, value, casid, time=0):
+        if casid is None:
+            return self.add(key, value, time)
+        self.forget_prefetched(key)
+        server, casid = casid
+        if not self.clients[server].cas(key, value, casid, time):
+            return False
+        others = [s for s in self.get_servers(key) if s != server]
+        self._copy_to_replicas(key, value, time, others)
+        return True
 
 
 class MemcachedStorage(SyncStorage):
@@ -119,16 +962,126 @@ class MemcachedStorage(SyncStorage):
                              useful for namespacing in shared cache setups.
         * cache_pool_size:  the maximum number of active memcache clients.
         * cache_pool_timeout:  the maximum lifetime of each memcache client.
+        * cache_codec:  the codec used to serialize values in memcache,
+                        either "json", "binary" or a dotted class name.
+        * cache_compression:  the compression scheme used by the codec for
+                              large values, either "zlib", "lz4" or "none".
+        * cache_compress_threshold:  the size in bytes above which values
+                                     are compressed.
+        * cache_collection_chunks:  the number of keys across which to split
+                                    the items of each cached collection, or
+                                    zero to store each in a single key.
+        * cache_fill_lease_ttl:  the maximum time for which one request may
+                                 hold the lease to fill a missing key, or
+                                 zero to let every request fill it.
+        * cache_fill_wait:  the time for which other requests will wait for
+                            a missing key to be filled before reading from
+                            the underlying storage.
+        * cache_size_refresh_workers:  the number of background threads used
+                                       to recalculate stale storage sizes, or
+                                       zero to only recalculate them on the
+                                       request path when close to quota.
+        * cache_size_refresh_queue:  the maximum number of users waiting to
+                                     have their size recalculated.
+        * cache_only_write_behind:  whether to save snapshots of cache-only
+                                    collections to the underlying storage.
+        * cache_write_behind_delay:  the time to wait after a write before
+                                     saving the snapshot, so that several
+                                     writes can be saved together.
+        * cache_write_behind_rate:  the maximum number of snapshots to save
+                                    per second.
+        * cache_write_behind_queue:  the maximum number of collections
+                                     waiting to have a snapshot saved.
+        * cache_auto_promote:  whether to automatically cache other small,
+                               frequently-read collections.
+        * cache_promote_window:  the time in seconds over which reads are
+                                 counted to decide on promotion.
+        * cache_promote_min_reads:  the number of reads in each window
+                                    needed for a collection to be promoted.
+        * cache_promote_max_size:  the maximum average size in bytes of a
+                                   promoted collection.
+        * cache_promote_max_collections:  the maximum number of collections
+                                          that may be promoted at once.
+        * cache_local_metadata:  whether to keep recently-used metadata in
+                                 memory, to avoid reading it from memcache.
+        * cache_local_metadata_ttl:  the time in seconds for which metadata
+                                     may be used from memory.
+        * cache_local_metadata_size:  the maximum number of users whose
+                                      metadata is kept in memory.
+        * cache_breaker_failures:  the number of consecutive failed calls
+                                   to memcached that trip the circuit
+                                   breaker, or zero to disable it.
+        * cache_breaker_slow_call:  the time in seconds after which a call
+                                    to memcached counts as a failure, or
+                                    zero to ignore slow calls.
+        * cache_breaker_reset:  the time in seconds for which the breaker
+                                stays open before probing for recovery.
+        * cache_metadata_replicas:  the number of servers on which to keep
+                                    each user's metadata, when several
+                                    cache_servers are given.
+        * cache_ring_vnodes:  the number of points on the consistent-hash
+                              ring for each server.
 
     """
 
     def __init__(self, storage, cache_servers=None, cache_key_prefix="",
                  cache_pool_size=None, cache_pool_timeout=60,
                  cached_collections=(), cache_only_collections=(),
-                 cache_lock=False, cache_lock_ttl=None, **kwds):
+                 cache_lock=False, cache_lock_ttl=None, cache_codec="json",
+                 cache_compression="zlib",
+                 cache_compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 cache_collection_chunks=0,
+                 cache_fill_lease_ttl=DEFAULT_FILL_LEASE_TTL,
+                 cache_fill_wait=DEFAULT_FILL_WAIT,
+                 cache_size_refresh_workers=DEFAULT_NUM_WORKERS,
+                 cache_size_refresh_queue=DEFAULT_MAX_PENDING,
+                 cache_only_write_behind=False,
+                 cache_write_behind_delay=DEFAULT_FLUSH_DELAY,
+                 cache_write_behind_rate=DEFAULT_MAX_FLUSH_RATE,
+                 cache_write_behind_queue=DEFAULT_MAX_DIRTY,
+                 cache_auto_promote=False,
+                 cache_promote_window=DEFAULT_WINDOW,
+                 cache_promote_min_reads=DEFAULT_MIN_READS,
+                 cache_promote_max_size=DEFAULT_MAX_SIZE,
+                 cache_promote_max_collections=DEFAULT_MAX_PROMOTED,
+                 cache_local_metadata=True,
+                 cache_local_metadata_ttl=DEFAULT_LOCAL_METADATA_TTL,
+                 cache_local_metadata_size=DEFAULT_LOCAL_METADATA_SIZE,
+                 cache_breaker_failures=DEFAULT_MAX_FAILURES,
+                 cache_breaker_slow_call=DEFAULT_SLOW_CALL_TIME,
+                 cache_breaker_reset=DEFAULT_RESET_TIMEOUT,
+                 cache_metadata_replicas=1,
+                 cache_ring_vnodes=DEFAULT_VNODES,
+                 **kwds):
         self.storage = storage
-        self.cache = MemcachedClient(cache_servers, cache_key_prefix,
-                                     cache_pool_size, cache_pool_timeout)
+        self.cache_collection_chunks = cache_collection_chunks
+        self.cache_fill_lease_ttl = cache_fill_lease_ttl
+        self.cache_fill_wait = float(cache_fill_wait)
+        codec = load_codec(cache_codec, compression=cache_compression,
+                           compress_threshold=cache_compress_threshold)
+
+        def make_client(server):
+            name = "memcached at %s" % (server,) if server else "memcached"
+            breaker = CircuitBreaker(
+                name, max_failures=cache_breaker_failures,
+                slow_call_time=float(cache_breaker_slow_call),
+                reset_timeout=cache_breaker_reset,
+                on_state_change=self._breaker_state_changed)
+            return MemcachedClient(server, cache_key_prefix,
+                                   cache_pool_size, cache_pool_timeout,
+                                   codec=codec, breaker=breaker)
+
+        # Keys are spread over multiple servers using a consistent-hash ring.
+        servers = aslist(cache_servers or "")
+        if len(servers) > 1:
+            clients = dict((server, make_client(server))
+                           for server in servers)
+            self.cache = HashRingMemcachedClient(
+                clients, replicate=_is_metadata_key,
+                num_replicas=cache_metadata_replicas,
+                vnodes=cache_ring_vnodes, version=_metadata_version)
+        else:
+            self.cache = make_client(servers[0] if servers else None)
         self.cached_collections = {}
         for collection in aslist(cached_collections):
             colmgr = CachedManager(self, collection)
@@ -145,13 +1098,67 @@ class MemcachedStorage(SyncStorage):
         # Keep a threadlocal to track the currently-held locks.
         # This is needed to make the read locking API reentrant.
         self._tldata = threading.local()
+        if cache_size_refresh_workers:
+            self.size_refresher = BackgroundRefresher(
+                self._refresh_total_size,
+                num_workers=cache_size_refresh_workers,
+                max_pending=cache_size_refresh_queue)
+        else:
+            self.size_refresher = None
+        if cache_only_write_behind:
+            self.write_behind = WriteBehindQueue(
+                self._save_snapshot,
+                delay=cache_write_behind_delay,
+                max_rate=cache_write_behind_rate,
+                max_dirty=cache_write_behind_queue)
+        else:
+            self.write_behind = None
+        if cache_auto_promote:
+            self.promoter = CollectionPromoter(
+                window=cache_promote_window,
+                min_reads=cache_promote_min_reads,
+                max_size=cache_promote_max_size,
+                max_promoted=cache_promote_max_collections)
+        else:
+            self.promoter = None
+        if cache_local_metadata and cache_local_metadata_ttl > 0:
+            self.local_metadata = LocalCache(
+                max_size=cache_local_metadata_size,
+                ttl=cache_local_metadata_ttl)
+        else:
+            self.local_metadata = None
+        # Snapshots of cache-only collections live in the underlying storage,
+        # but must be hidden from anything that lists its collections.
+        self._snapshot_collections = frozenset(
+            colmgr.snapshot_collection
+            for colmgr in self.cache_only_collections.itervalues())
+
+    def close(self):
+        """Finish any background work and stop the background threads.
+
+        Collections waiting to be saved by write-behind are saved before
+        this returns, so it should be called when the process shuts down.
+        """
+        if self.write_behind is not None:
+            self.write_behind.close()
+        if self.size_refresher is not None:
+            self.size_refresher.close()
+
+    def _breaker_state_changed(self, old_state, new_state):
+        """Report changes in the state of the circuit breaker."""
+        if new_state == OPEN:
+            annotate_request(None, BREAKER_TRIPS_METRIC, 1)
+        elif old_state != OPEN:
+            annotate_request(None, BREAKER_RECOVERIES_METRIC, 1)
 
     def iter_cache_keys(self, user):
         """Iterator over all potential cache keys for the given user.
 
         This method yields all potential cache keys for the given user,
         including their metadata key and the keys for any cached collections.
-        The yielded keys do *not* include the key prefix, if any.
+        The yielded keys do *not* include the key prefix, if any.  When there
+        are several cache servers the keys are spread between them, and the
+        servers holding each one can be found with self.cache.get_servers().
         """
         yield _key(user["uid"], "metadata")
         for colmgr in self.cached_collections.itervalues():
@@ -175,6 +1182,8 @@ class MemcachedStorage(SyncStorage):
             try:
                 return self.cache_only_collections[collection]
             except KeyError:
+                if self.promoter is not None:
+                    return AdaptiveManager(self, collection)
                 return UncachedManager(self, collection)
 
     #
@@ -191,16 +1200,44 @@ class MemcachedStorage(SyncStorage):
     def lock_for_read(self, user, collection):
         """Acquire a shared read lock on the named collection."""
         if self.cache_lock or collection in self.cache_only_collections:
-            return self._lock_in_memcache(user, collection)
+            lock = self._lock_in_memcache(user, collection)
         else:
-            return self.storage.lock_for_read(user, collection)
+            lock = self.storage.lock_for_read(user, collection)
+        return self._prefetch_when_locked(lock, user, collection, False)
 
     def lock_for_write(self, user, collection):
         """Acquire an exclusive write lock on the named collection."""
         if self.cache_lock or collection in self.cache_only_collections:
-            return self._lock_in_memcache(user, collection)
+            lock = self._lock_in_memcache(user, collection)
         else:
-            return self.storage.lock_for_write(user, collection)
+            lock = self.storage.lock_for_write(user, collection)
+        return self._prefetch_when_locked(lock, user, collection, True)
+
+    @contextlib.contextmanager
+    def _prefetch_when_locked(self, lock, user, collection, for_write):
+        """Helper method to prefetch cache keys while holding a lock.
+
+        Almost every operation on a collection needs the user's metadata
+        as well as the collection's own cached data, so we fetch them all
+        in a single round trip once the lock has been taken.  They must not
+        be fetched before then, since they could be changed by whoever holds
+        the lock in the meantime.
+
+        Readers can make do with the metadata kept in memory, if there is
+        any, but writers must always have the latest version.
+        """
+        with lock as res:
+            keys = []
+            local = self.local_metadata
+            if for_write or local is None or user["uid"] not in local:
+                keys.append(_key(user["uid"], "metadata"))
+            colmgr = self._get_collection_manager(collection)
+            keys.extend(colmgr.iter_cache_keys(user))
+            if not keys:
+                yield res
+            else:
+                with self.cache.prefetching(keys):
+                    yield res
 
     @contextlib.contextmanager
     def _lock_in_memcache(self, user, collection):
@@ -230,6 +1267,125 @@ class MemcachedStorage(SyncStorage):
                 raise RuntimeError(msg)
             self.cache.delete(key)
 
+    #
+    # When a key is missing from the cache, only one request at a time is
+    # allowed to fill it in from the underlying storage.  Others wait for it
+    # to appear, and eventually give up and read the underlying storage
+    # without writing to the cache.  This avoids a stampede of requests
+    # reading the same data from the database, e.g. after a memcache restart.
+    #
+
+    def _fill_with_lease(self, key, load, fill):
+        """Helper method to fill a missing cache key under a lease.
+
+        The load() callback should read the data from the cache, and fill()
+        should read it from the underlying storage and write it to the cache
+        only if its argument is true.  Both must return a (data, casid) pair
+        with data of None if it was not found.  This method returns the pair
+        from whichever of them provided the data.
+        """
+        if not self.cache_fill_lease_ttl:
+            return fill(True)
+        lease_key = _key(key, "lease")
+        if self.cache.add(lease_key, True, time=self.cache_fill_lease_ttl):
+            try:
+                # Someone else may have filled it before we got the lease.
+                self.cache.forget_prefetched(key)
+                data, casid = load()
+                if data is None:
+                    annotate_request(None, LEASE_FILLS_METRIC, 1)
+                    data, casid = fill(True)
+            finally:
+                self.cache.delete(lease_key)
+            return data, casid
+        annotate_request(None, LEASE_WAITS_METRIC, 1)
+        deadline = time.time() + self.cache_fill_wait
+        while time.time() < deadline:
+            time.sleep(FILL_POLL_INTERVAL)
+            self.cache.forget_prefetched(key)
+            data, casid = load()
+            if data is not None:
+                return data, casid
+            # Stop waiting if the lease was released without filling it,
+            # e.g. because there turned out to be nothing to fill it with.
+            if self.cache.get(lease_key) is None:
+                break
+        annotate_request(None, LEASE_FALLBACKS_METRIC, 1)
+        return fill(False)
+
+    #
+    # APIs for write-behind of cache-only collections.
+    #
+    # Writes to cache-only collections note that the collection is dirty,
+    # and a background thread later saves a snapshot of it as a single item
+    # in the underlying storage.  The snapshot is reloaded if the collection
+    # goes missing from the cache.  Writes made between the last save and
+    # the loss of the cached data are lost, as they would be without this.
+    #
+
+    def _schedule_write_behind(self, user, collection, deleted=False):
+        """Schedule a save of the given cache-only collection, if enabled."""
+        if self.write_behind is None:
+            return
+        if not self.write_behind.schedule(user, collection, deleted):
+            annotate_request(None, WRITE_BEHIND_DROPS_METRIC, 1)
+        annotate_request(None, WRITE_BEHIND_DEPTH_METRIC,
+                         self.write_behind.depth)
+        annotate_request(None, WRITE_BEHIND_LAG_METRIC,
+                         self.write_behind.flush_lag)
+
+    def _save_snapshot(self, user, collection, deleted):
+        """Save the cached data for the given cache-only collection.
+
+        If the collection is not in the cache, then its snapshot is deleted
+        if the collection was deleted, and otherwise left alone so that it
+        can be reloaded.
+        """
+        colmgr = self.cache_only_collections[collection]
+        data, _ = colmgr._load_cached_data(user)
+        if data is None:
+            if deleted:
+                try:
+                    self.storage.delete_collection(user,
+                                                   colmgr.snapshot_collection)
+                except CollectionNotFoundError:
+                    pass
+            return
+        payload = json_dumps({
+            "modified": data["modified"],
+            "items": data["items"],
+        })
+        self.storage.set_item(user, colmgr.snapshot_collection,
+                              SNAPSHOT_ITEM_ID, {"payload": payload})
+
+    def _hide_snapshots(self, mapping):
+        """Remove snapshot collections from a mapping of collection names."""
+        for collection in self._snapshot_collections:
+            mapping.pop(collection, None)
+        return mapping
+
+    def _get_visible_storage_timestamp(self, user, timestamps=None):
+        """Get the storage timestamp from the backend, ignoring snapshots.
+
+        Saving a snapshot isn't a change that clients can see, so it mustn't
+        move the storage timestamp.  If the mapping of backend collection
+        timestamps is given then it is re-used, and the snapshots are
+        removed from it.
+        """
+        ts = self.storage.get_storage_timestamp(user)
+        if not self._snapshot_collections:
+            return ts
+        if timestamps is None:
+            timestamps = self.storage.get_collection_timestamps(user)
+        snapshot_timestamps = [timestamps.pop(collection)
+                               for collection in self._snapshot_collections
+                               if collection in timestamps]
+        if snapshot_timestamps and ts <= max(snapshot_timestamps):
+            ts = get_timestamp(0)
+            if timestamps:
+                ts = max(timestamps.itervalues())
+        return ts
+
     #
     # APIs to operate on the entire storage.
     #
@@ -240,7 +1396,7 @@ class MemcachedStorage(SyncStorage):
         ts = self._get_metadata(user)["modified"]
         # Fall back to live data if it's dirty.
         if ts is None:
-            ts = self.storage.get_storage_timestamp(user)
+            ts = self._get_visible_storage_timestamp(user)
             for colmgr in self.cache_only_collections.itervalues():
                 try:
                     ts = max(ts, colmgr.get_timestamp(user))
@@ -265,12 +1421,12 @@ class MemcachedStorage(SyncStorage):
     def get_collection_counts(self, user):
         """Returns the collection counts."""
         # Read most of the data from the database.
-        counts = self.storage.get_collection_counts(user)
+        counts = self._hide_snapshots(self.storage.get_collection_counts(user))
         # Add in counts for collections stored only in memcache.
         for colmgr in self.cache_only_collections.itervalues():
             try:
                 items = colmgr.get_items(user)["items"]
-            except CollectionNotFoundError:
+            except (CollectionNotFoundError, CircuitOpenError):
                 pass
             else:
                 counts[colmgr.collection] = len(items)
@@ -279,29 +1435,52 @@ class MemcachedStorage(SyncStorage):
     def get_collection_sizes(self, user):
         """Returns the total size for each collection."""
         # Read most of the data from the database.
-        sizes = self.storage.get_collection_sizes(user)
+        sizes = self._hide_snapshots(self.storage.get_collection_sizes(user))
         # Add in sizes for collections stored only in memcache.
         for colmgr in self.cache_only_collections.itervalues():
             try:
                 items = colmgr.get_items(user)["items"]
                 payloads = (item.get("payload", "") for item in items)
                 sizes[colmgr.collection] = sum(len(p) for p in payloads)
-            except CollectionNotFoundError:
+            except (CollectionNotFoundError, CircuitOpenError):
                 pass
         # Since we've just gone to the trouble of recalculating sizes,
         # we might as well update the cached total size as well.
-        self._update_total_size(user, sum(sizes.itervalues()))
+        try:
+            self._update_total_size(user, sum(sizes.itervalues()))
+        except CircuitOpenError:
+            pass
         return sizes
 
     def get_total_size(self, user, recalculate=False):
         """Returns the total size of a user's storage data."""
-        return self._get_metadata(user, recalculate)["size"]
+        data = self._get_metadata(user, recalculate)
+        # If it's out of date, have it recalculated in the background.
+        # There's no point while memcache is unavailable.
+        breaker = self.cache.breaker_for(_key(user["uid"], "metadata"))
+        if not recalculate and self.size_refresher is not None \
+                and breaker.state != OPEN:
+            recalc_period = time.time() - data["last_size_recalc"]
+            if recalc_period > SIZE_RECALCULATION_PERIOD:
+                if self.size_refresher.schedule(user):
+                    annotate_request(None, SIZE_REFRESHES_METRIC, 1)
+        return data["size"]
 
     def delete_storage(self, user):
         """Removes all data for the user."""
+        # Chunked collection data can only be found through its index,
+        # so it must be cleared before deleting the other keys.
+        for colmgr in self.cached_collections.itervalues():
+            colmgr.clear_cached_data(user)
+        for colmgr in self.cache_only_collections.itervalues():
+            colmgr.clear_cached_data(user)
         for key in self.iter_cache_keys(user):
             self.cache.delete(key)
+        self._forget_local_metadata(user)
         self.storage.delete_storage(user)
+        # Make sure that any snapshots saved in the meantime are deleted.
+        for colmgr in self.cache_only_collections.itervalues():
+            self._schedule_write_behind(user, colmgr.collection, deleted=True)
 
     #
     # APIs to operate on an individual collection
@@ -443,6 +1622,41 @@ class MemcachedStorage(SyncStorage):
     #  Private APIs for managing the cached metadata
     #
 
+    def _gets_metadata(self, user):
+        """Get the cached metadata dict and its casid.
+
+        This uses the copy kept in memory if there is one, unless the
+        metadata was prefetched when locking a collection.  The returned
+        dict may be freely modified by the caller.
+        """
+        key = _key(user["uid"], "metadata")
+        if self.local_metadata is not None:
+            if not self.cache.is_prefetched(key):
+                res = self.local_metadata.get(user["uid"])
+                if res is not None:
+                    annotate_request(None, LOCAL_METADATA_HITS_METRIC, 1)
+                    return _copy_metadata(res[0]), res[1]
+                annotate_request(None, LOCAL_METADATA_MISSES_METRIC, 1)
+        data, casid = self.cache.gets(key)
+        if data is not None:
+            self._set_local_metadata(user, data, casid)
+        return data, casid
+
+    def _set_local_metadata(self, user, data, casid=None):
+        """Keep a copy of the given metadata in memory, if enabled."""
+        if self.local_metadata is None:
+            return
+        # Metadata that's marked as dirty will soon be replaced.
+        if data["modified"] is None:
+            self.local_metadata.delete(user["uid"])
+        else:
+            self.local_metadata.set(user["uid"], (_copy_metadata(data), casid))
+
+    def _forget_local_metadata(self, user):
+        """Discard any copy of the metadata kept in memory."""
+        if self.local_metadata is not None:
+            self.local_metadata.delete(user["uid"])
+
     def _get_metadata(self, user, recalculate_size=False):
         """Get the metadata dict, recalculating things if necessary.
 
@@ -454,52 +1668,79 @@ class MemcachedStorage(SyncStorage):
         be recalculated from the store if it is more than an hour old.
         """
         key = _key(user["uid"], "metadata")
-        data, casid = self.cache.gets(key)
+        try:
+            data, casid = self._gets_metadata(user)
+        except CircuitOpenError:
+            # Memcache is unavailable, so use the underlying storage.
+            annotate_request(None, BREAKER_FALLBACKS_METRIC, 1)
+            return self._fill_metadata(user, recalculate_size)
         # If there is no cached metadata, initialize it from the storage.
         # Use CAS to avoid overwriting other changes, but don't error out if
         # the write fails - it just means that someone else beat us to it.
         if data is None:
-            # Get the mapping of collection names to timestamps.
-            # Make sure to include any cache-only collections.
-            timestamps = self.storage.get_collection_timestamps(user)
-            for colmgr in self.cached_collections.itervalues():
-                if colmgr.collection not in timestamps:
-                    try:
-                        ts = colmgr.get_timestamp(user)
-                        timestamps[colmgr.collection] = ts
-                    except CollectionNotFoundError:
-                        pass
-            # Get the storage-level modified time.
-            # Make sure it's not less than any collection-level timestamp.
-            ts = self.storage.get_storage_timestamp(user)
-            if timestamps:
-                ts = max(ts, max(timestamps.itervalues()))
-            # Calculate the total size if requested,
-            # but don't bother if it's not necessary.
-            if not recalculate_size:
-                last_size_recalc = 0
-                size = 0
-            else:
-                last_size_recalc = int(time.time())
-                size = self._recalculate_total_size(user)
-            # Store it all back into the cache.
-            data = {
-                "size": size,
-                "last_size_recalc": last_size_recalc,
-                "modified": ts,
-                "collections": timestamps,
-            }
-            self.cache.cas(key, data, casid)
+
+            def load():
+                return self.cache.gets(key)
+
+            def fill(store):
+                data = self._fill_metadata(user, recalculate_size)
+                if store:
+                    self.cache.cas(key, data, None)
+                return data, None
+
+            data, casid = self._fill_with_lease(key, load, fill)
+            self._set_local_metadata(user, data, casid)
         # Recalculate the size if it appears to be out of date.
         # Use CAS to avoid clobbering changes but don't let it fail us.
-        elif recalculate_size:
+        if recalculate_size:
             recalc_period = time.time() - data["last_size_recalc"]
             if recalc_period > SIZE_RECALCULATION_PERIOD:
                 data["last_size_recalc"] = int(time.time())
                 data["size"] = self._recalculate_total_size(user)
-                self.cache.cas(key, data, casid)
+                if casid is None:
+                    # The casid isn't known if we've just written the data
+                    # ourselves, and a CAS without one would fall back to
+                    # an add that's bound to fail.  Re-read it instead.
+                    self._update_total_size(user, data["size"])
+                else:
+                    self.cache.cas(key, data, casid)
+                    self._forget_local_metadata(user)
         return data
 
+    def _fill_metadata(self, user, recalculate_size=False):
+        """Calculate the metadata dict from the underlying storage.
+
+        Cache-only collections are left out if memcache is unavailable.
+        """
+        # Get the mapping of collection names to timestamps, and the
+        # storage-level modified time, leaving out any saved snapshots.
+        timestamps = self.storage.get_collection_timestamps(user)
+        ts = self._get_visible_storage_timestamp(user, timestamps)
+        # Make sure to include any cache-only collections.
+        for colmgr in self.cache_only_collections.itervalues():
+            if colmgr.collection not in timestamps:
+                try:
+                    timestamps[colmgr.collection] = colmgr.get_timestamp(user)
+                except (CollectionNotFoundError, CircuitOpenError):
+                    pass
+        # Make sure it's not less than any collection-level timestamp.
+        if timestamps:
+            ts = max(ts, max(timestamps.itervalues()))
+        # Calculate the total size if requested,
+        # but don't bother if it's not necessary.
+        if not recalculate_size:
+            last_size_recalc = 0
+            size = 0
+        else:
+            last_size_recalc = int(time.time())
+            size = self._recalculate_total_size(user)
+        return {
+            "size": size,
+            "last_size_recalc": last_size_recalc,
+            "modified": ts,
+            "collections": timestamps,
+        }
+
     def _update_total_size(self, user, size):
         """Update the cached value for total storage size."""
         key = _key(user["uid"], "metadata")
@@ -507,19 +1748,51 @@ class MemcachedStorage(SyncStorage):
         if data is None:
             self._get_metadata(user)
             data, casid = self.cache.gets(key)
+            # If someone else is still filling it in, leave them to it.
+            if data is None:
+                return
         data["last_size_recalc"] = int(time.time())
         data["size"] = size
         self.cache.cas(key, data, casid)
+        self._forget_local_metadata(user)
+
+    def _refresh_total_size(self, user):
+        """Re-calculate total size and update the cached value.
+
+        This is run in the background, concurrently with writes that adjust
+        the cached value.  To avoid clobbering those adjustments, the result
+        is discarded if the metadata changes while it's being calculated.
+        """
+        key = _key(user["uid"], "metadata")
+        for _ in xrange(SIZE_REFRESH_ATTEMPTS):
+            data, casid = self.cache.gets(key)
+            # If there's no cached value, there's nothing to refresh.
+            # It may also have been refreshed since this was scheduled.
+            if data is None:
+                return
+            recalc_period = time.time() - data["last_size_recalc"]
+            if recalc_period <= SIZE_RECALCULATION_PERIOD:
+                return
+            data["size"] = self._recalculate_total_size(user)
+            data["last_size_recalc"] = int(time.time())
+            if self.cache.cas(key, data, casid):
+                self._forget_local_metadata(user)
+                return
 
     def _recalculate_total_size(self, user):
         """Re-calculate total size from the database."""
-        size = self.storage.get_total_size(user)
+        if self.write_behind is None:
+            size = self.storage.get_total_size(user)
+        else:
+            # Don't count the snapshots as well as the cached data.
+            sizes = self.storage.get_collection_sizes(user)
+            size = sum(self._hide_snapshots(sizes).itervalues())
         for colmgr in self.cache_only_collections.itervalues():
             try:
                 items = colmgr.get_items(user)["items"]
                 payloads = (item.get("payload", "") for item in items)
                 size += sum(len(p) for p in payloads)
-            except CollectionNotFoundError:
+            except (CollectionNotFoundError, CircuitOpenError):
                 pass
         return size
 
@@ -544,22 +1817,37 @@ class MemcachedStorage(SyncStorage):
                 update(ts, ts, len("TEST"))
 
         """
-        # Get the old values from the metadata.
-        # We can't call _get_metadata directly because we also want the casid.
         key = _key(user["uid"], "metadata")
-        data, casid = self.cache.gets(key)
-        if data is None:
-            # No cached data, so refresh.
-            self._get_metadata(user)
+        self._forget_local_metadata(user)
+        # The metadata may have been prefetched when the collection was
+        # locked, and changed since by a write to some other collection.
+        # If so then it's worth retrying once with fresh data.
+        may_retry = self.cache.is_prefetched(key)
+        while True:
+            # Get the old values from the metadata.
+            # We can't call _get_metadata directly because we want the casid.
             data, casid = self.cache.gets(key)
-
-        # Write None into the metadata to mark things as dirty.
-        ts = data["modified"]
-        col_ts = data["collections"].get(collection)
-        data["modified"] = None
-        data["collections"][collection] = None
-        if not self.cache.cas(key, data, casid):
-            raise ConflictError
+            if data is None:
+                # No cached data, so refresh.
+                filled = self._get_metadata(user)
+                data, casid = self.cache.gets(key)
+                # If someone else is still filling it in, we must write our
+                # own copy in order to mark it as dirty.  Retry if they beat
+                # us to it.
+                if data is None:
+                    data = filled
+                    may_retry = True
+
+            # Write None into the metadata to mark things as dirty.
+            ts = data["modified"]
+            col_ts = data["collections"].get(collection)
+            data["modified"] = None
+            data["collections"][collection] = None
+            if self.cache.cas(key, data, casid):
+                break
+            if not may_retry:
+                raise ConflictError
+            may_retry = False
 
         # Define the callback function for the calling code to use.
         # We also use this function internally to recover from errors.
@@ -577,6 +1865,7 @@ class MemcachedStorage(SyncStorage):
             # We assume the write lock is held to avoid conflicting changes.
             # Sadly, using CAS again would require another round-trip.
             self.cache.set(key, data)
+            self._set_local_metadata(user, data)
 
         # Yield out to the calling code.
         # It can call the yielded function to provide new metadata.
@@ -613,6 +1902,9 @@ class UncachedManager(object):
         self.owner = owner
         self.collection = collection
 
+    def iter_cache_keys(self, user):
+        return iter(())
+
     def get_timestamp(self, user):
         storage = self.owner.storage
         return storage.get_collection_timestamp(user, self.collection)
@@ -690,6 +1982,9 @@ class _CachedManagerBase(object):
     def get_key(self, user):
         return _key(user["uid"], "c", self.collection)
 
+    def get_chunk_key(self, user, chunk, version):
+        return _key(user["uid"], "c", self.collection, chunk, version)
+
     def iter_cache_keys(self, user):
         yield self.get_key(user)
 
@@ -724,6 +2019,151 @@ class _CachedManagerBase(object):
     def del_item(self, user, item):
         raise NotImplementedError
 
+    #
+    # Helper methods for reading and writing the cached data, which
+    # may be stored either in a single key or split into chunks.
+    #
+
+    def _load_cached_data(self, user):
+        """Load the cached data, along with the casid of its key.
+
+        For chunked collections the data also includes the version of each
+        chunk under "chunks" and the items in each chunk under "chunk_items",
+        which are needed in order to write it back out again.
+        """
+        key = self.get_key(user)
+        while True:
+            data, casid = self.cache.gets(key)
+            if data is None or "chunks" not in data:
+                return data, casid
+            versions = data["chunks"]
+            chunk_keys = [self.get_chunk_key(user, i, version)
+                          for i, version in enumerate(versions) if version]
+            chunks = self.cache.get_multi(chunk_keys) if chunk_keys else {}
+            if len(chunks) == len(chunk_keys):
+                break
+            # Some chunks are missing.  If the index has changed then they
+            # were replaced by a concurrent write, so we can try again.
+            # Otherwise they've been evicted and the data is unusable, so
+            # remove it along with whichever chunks are left.
+            self.cache.forget_prefetched(key)
+            if self.cache.gets(key)[1] == casid:
+                self.cache.delete(key)
+                self._delete_chunks(user, versions)
+                return None, None
+        items = {}
+        chunk_items = []
+        for i, version in enumerate(versions):
+            if version:
+                chunk = chunks[self.get_chunk_key(user, i, version)]["items"]
+            else:
+                chunk = {}
+            items.update(chunk)
+            chunk_items.append(chunk)
+        data["items"] = items
+        # Chunks written without their own sorted ids need to be rewritten,
+        # so don't let them be re-used.
+        if _merge_sort_orders(data, chunks.values()):
+            data["chunk_items"] = chunk_items
+        else:
+            data["chunk_items"] = None
+        return data, casid
+
+    def _store_cached_data(self, user, data, casid, changed_ids=None):
+        """Store the cached data, if the casid of its key still matches.
+
+        If changed_ids is given then only the chunks holding those item ids
+        are written out, otherwise the entire collection is written.  This
+        returns True if the data was stored, and False if the CAS failed.
+        """
+        key = self.get_key(user)
+        _ensure_sort_orders(data)
+        old_versions = data.pop("chunks", None) or ()
+        chunk_items = data.pop("chunk_items", None)
+        num_chunks = self.owner.cache_collection_chunks
+        if not num_chunks:
+            new_versions = ()
+            if not self.cache.cas(key, data, casid):
+                return False
+        else:
+            items = data["items"]
+            if changed_ids is None or len(old_versions) != num_chunks \
+                    or chunk_items is None:
+                chunk_items = [{} for _ in xrange(num_chunks)]
+                for id, bso in items.iteritems():
+                    chunk_items[_chunk_for_id(id, num_chunks)][id] = bso
+                changed_chunks = xrange(num_chunks)
+                new_versions = [0] * num_chunks
+            else:
+                changed_chunks = set(_chunk_for_id(id, num_chunks)
+                                     for id in changed_ids)
+                chunk_items = list(chunk_items)
+                for i in changed_chunks:
+                    chunk_items[i] = dict((id, items[id])
+                                          for id in chunk_items[i]
+                                          if id in items)
+                for id in changed_ids:
+                    if id in items:
+                        i = _chunk_for_id(id, num_chunks)
+                        chunk_items[i][id] = items[id]
+                new_versions = list(old_versions)
+            # Store changed chunks under new keys, so that anyone reading
+            # the current index still sees a consistent set of chunks.
+            # Using the collection timestamp as the version number ensures
+            # that it will always be new.
+            version = get_timestamp(data["modified"]).centis
+            new_chunk_keys = []
+            for i in changed_chunks:
+                if not chunk_items[i]:
+                    new_versions[i] = 0
+                    continue
+                if i < len(old_versions):
+                    new_versions[i] = max(version, old_versions[i] + 1)
+                else:
+                    new_versions[i] = version
+                chunk_key = self.get_chunk_key(user, i, new_versions[i])
+                # The chunk's sorted ids are picked out of the full lists,
+                # which is cheaper than sorting its items again.
+                chunk = {"items": chunk_items[i]}
+                for name, _, _ in _SORT_ORDERS:
+                    chunk[name] = [id for id in data[name]
+                                   if id in chunk_items[i]]
+                _stamp_sort_orders(chunk)
+                self.cache.set(chunk_key, chunk)
+                new_chunk_keys.append(chunk_key)
+            index = {
+                "modified": data["modified"],
+                "chunks": new_versions,
+            }
+            if not self.cache.cas(key, index, casid):
+                for chunk_key in new_chunk_keys:
+                    self.cache.delete(chunk_key)
+                return False
+            data["chunks"] = new_versions
+            data["chunk_items"] = chunk_items
+        # Clean up any chunks that are no longer in use.
+        for i, version in enumerate(old_versions):
+            if version:
+                if i >= len(new_versions) or new_versions[i] != version:
+                    self.cache.delete(self.get_chunk_key(user, i, version))
+        return True
+
+    def clear_cached_data(self, user):
+        """Remove all the cached data, returning False if there was none."""
+        key = self.get_key(user)
+        data, _ = self.cache.gets(key)
+        if not self.cache.delete(key):
+            return False
+        if data is not None:
+            self._delete_chunks(user, data.get("chunks"))
+        return True
+
+    def _delete_chunks(self, user, versions):
+        """Delete the chunks with the given versions, if there are any."""
+        for i, version in enumerate(versions or ()):
+            if version:
+                self.cache.delete(self.get_chunk_key(user, i, version))
+
     #
     # Helper methods for updating cached collection data.
     # Subclasses use this common logic for updating the cache, but
@@ -746,6 +2186,7 @@ class _CachedManagerBase(object):
             data = {"modified": modified, "items": {}}
         elif data["modified"] >= modified:
             raise ConflictError
+        _ensure_sort_orders(data)
         num_created = 0
         for item in items:
             # Cache only the fields we need.
@@ -763,29 +2204,29 @@ class _CachedManagerBase(object):
                 else:
                     bso["ttl"] = int(modified) + item["ttl"]
             # Update it in-place, or create if it doesn't exist.
-            try:
-                data["items"][bso["id"]].update(bso)
-            except KeyError:
+            # Either way, it has to be moved to its new sorted position.
+            existing = data["items"].get(bso["id"])
+            if existing is not None:
+                _remove_from_sort_orders(data, existing)
+                existing.update(bso)
+                bso = existing
+            else:
                 num_created += 1
                 # Set default payload on newly-created items.
                 bso["modified"] = modified
                 if "payload" not in bso:
                     bso["payload"] = ""
                 data["items"][bso["id"]] = bso
+            _add_to_sort_orders(data, bso)
             data["modified"] = modified
         # Purge any items that have expired.
         # We can't do this as part of the purge_expired_items()
         # because we don't have a way to enumerate all user ids.
-        expired_ids = set()
         expiry_time = int(time.time()) - TTL_EXPIRY_GRACE_PERIOD
-        for id, bso in data["items"].iteritems():
-            ttl = bso.get("ttl")
-            if ttl is not None and ttl < expiry_time:
-                expired_ids.add(id)
-        for id in expired_ids:
-            del data["items"][id]
-        key = self.get_key(user)
-        if not self.cache.cas(key, data, casid):
+        expired_ids = _purge_expired_items(data, expiry_time)
+        _stamp_sort_orders(data)
+        changed_ids = set(expired_ids).union(item["id"] for item in items)
+        if not self._store_cached_data(user, data, casid, changed_ids):
             raise ConflictError
         return num_created
 
@@ -803,16 +2244,20 @@ class _CachedManagerBase(object):
             raise CollectionNotFoundError
         if data["modified"] >= modified:
             raise ConflictError
-        num_deleted = 0
+        _ensure_sort_orders(data)
+        deleted_ids = []
         for id in items:
-            if data["items"].pop(id, None) is not None:
-                num_deleted += 1
-        if num_deleted > 0:
+            bso = data["items"].get(id)
+            if bso is not None:
+                _remove_from_sort_orders(data, bso)
+                del data["items"][id]
+                deleted_ids.append(id)
+        if deleted_ids:
             data["modified"] = modified
-        key = self.get_key(user)
-        if not self.cache.cas(key, data, casid):
+            _stamp_sort_orders(data)
+        if not self._store_cached_data(user, data, casid, deleted_ids):
             raise ConflictError
-        return num_deleted
+        return len(deleted_ids)
 
     #
     # Methods whose implementation can be shared between subclasses.
@@ -838,56 +2283,124 @@ class _CachedManagerBase(object):
         data, _ = self.get_cached_data(user)
         if data is None:
             raise CollectionNotFoundError
-        # Restrict to certain item ids if specified.
+        if _ensure_sort_orders(data):
+            annotate_request(None, SORT_ORDER_REBUILDS_METRIC, 1)
         bsos_by_id = data["items"]
+        # The offset may be a (sortindex, id) bound when sorting by sortindex,
+        # in the same format as used by the backend storage.
+        offset_token = offset
+        bound = None
+        if offset is not None:
+            if sort == "index" and ":" in str(offset):
+                bound = decode_index_offset(offset)
+                offset = None
+            else:
+                try:
+                    offset = int(offset)
+                except ValueError:
+                    raise InvalidOffsetError(offset)
         if ids is not None:
-            bsos = (bsos_by_id[item] for item in ids if item in bsos_by_id)
+            # Restrict to certain item ids if specified.
+            # There are usually few enough of them to just sort them here.
+            bsos = [bsos_by_id[item] for item in ids if item in bsos_by_id]
+            if newer is not None:
+                bsos = [bso for bso in bsos if bso["modified"] > newer]
+            if older is not None:
+                bsos = [bso for bso in bsos if bso["modified"] < older]
+            if bound is not None:
+                bsos = [bso for bso in bsos
+                        if bso_sort_key_index(bso) < bound]
+            if sort == "index":
+                bsos.sort(key=bso_sort_key_index, reverse=True)
+            elif sort == "oldest":
+                bsos.sort(key=bso_sort_key_modified)
+            else:
+                bsos.sort(key=lambda bso: bso["id"])
+                bsos.sort(key=lambda bso: bso["modified"], reverse=True)
         else:
-            bsos = bsos_by_id.itervalues()
-        # Apply the various filters as generator expressions.
-        if newer is not None:
-            bsos = (bso for bso in bsos if bso["modified"] > newer)
-        if older is not None:
-            bsos = (bso for bso in bsos if bso["modified"] < older)
+            bsos = self._iter_sorted_items(data, sort, newer, older, bound)
         # Filter out any that have expired.
-        bsos = self._filter_expired_items(bsos)
-        # Sort the resulting list.
-        # We always sort so that offset/limit work correctly.
-        # Using the id as a secondary key produces a unique ordering.
-        bsos = list(bsos)
-        if sort == "index":
-            reverse = True
-            key = bso_sort_key_index
-        else:
-            reverse = False if sort == "oldest" else True
-            key = bso_sort_key_modified
-        bsos.sort(key=key, reverse=reverse)
-        # Trim to the specified offset, if any.
-        # Note that we defaulted it to zero above.
-        if offset is not None:
-            try:
-                offset = int(offset)
-            except ValueError:
-                raise InvalidOffsetError(offset)
-            bsos = bsos[offset:]
-        # Trim to the specified limit, if any.
+        expired_ids = _find_expired_ids(data, int(time.time()))
+        if expired_ids:
+            expired_ids = set(expired_ids)
+            bsos = (bso for bso in bsos if bso["id"] not in expired_ids)
+        # Trim to the specified offset and limit, if any.  Reading one more
+        # than the limit tells us whether there are any more to come.
+        if offset:
+            bsos = itertools.islice(bsos, offset, None)
         next_offset = None
-        if limit is not None:
+        if limit is None:
+            bsos = list(bsos)
+        else:
+            bsos = list(itertools.islice(bsos, limit + 1))
             if limit < len(bsos):
                 bsos = bsos[:limit]
-                next_offset = (offset or 0) + limit
+                if sort != "index":
+                    next_offset = (offset or 0) + limit
+                elif bsos:
+                    next_offset = encode_index_offset(
+                        bsos[-1].get("sortindex"), bsos[-1]["id"])
+                else:
+                    next_offset = offset_token or 0
         # Return the necessary information.
         return {
             "items": bsos,
             "next_offset": next_offset
         }
 
-    def _filter_expired_items(self, bsos):
-        now = int(time.time())
-        for bso in bsos:
-            ttl = bso.get("ttl")
-            if ttl is None or ttl > now:
-                yield bso
+    def _iter_sorted_items(self, data, sort, newer, older, bound):
+        """Iterate over the cached items in the requested order.
+
+        This uses the sorted lists of ids in the cached data, so that items
+        are produced lazily without having to sort the entire collection.
+        Using the id as a secondary key produces a unique ordering.
+        """
+        bsos_by_id = data["items"]
+        if sort == "index":
+            ids = data["by_index"]
+            end = len(ids)
+            if bound is not None:
+                end = _bisect(ids, lambda id: bso_sort_key_index(
+                    bsos_by_id[id]), bound)
+            bsos = (bsos_by_id[ids[i]] for i in xrange(end - 1, -1, -1))
+            if newer is not None:
+                bsos = (bso for bso in bsos if bso["modified"] > newer)
+            if older is not None:
+                bsos = (bso for bso in bsos if bso["modified"] < older)
+            return bsos
+        # Find the range of items within the requested timestamps.
+        ids = data["by_modified"]
+        start = 0
+        end = len(ids)
+
+        def modified(id):
+            return bsos_by_id[id]["modified"]
+
+        if newer is not None:
+            start = _bisect(ids, modified, newer, right=True)
+        if older is not None:
+            end = _bisect(ids, modified, older)
+        if sort == "oldest":
+            return (bsos_by_id[ids[i]] for i in xrange(start, end))
+        return self._iter_newest_items(bsos_by_id, ids, start, end)
+
+    def _iter_newest_items(self, bsos_by_id, ids, start, end):
+        """Iterate backwards over a range of the ids sorted by timestamp.
+
+        Items with the same timestamp are produced in ascending order of id,
+        in the same order as the backend storage, so that reads of promoted
+        collections are consistent.
+        """
+        while end > start:
+            group_start = end - 1
+            modified = bsos_by_id[ids[group_start]]["modified"]
+            while group_start > start:
+                if bsos_by_id[ids[group_start - 1]]["modified"] != modified:
+                    break
+                group_start -= 1
+            for i in xrange(group_start, end):
+                yield bsos_by_id[ids[i]]
+            end = group_start
 
     def get_item_ids(self, user, **kwds):
         res = self.get_items(user, **kwds)
@@ -910,8 +2423,16 @@ class CacheOnlyManager(_CachedManagerBase):
     This manager class stores collection data in memcache without writing
     it through to the underlying store.  It manages its own timestamps
     internally and uses CAS to avoid conflicting writes.
+
+    If write-behind is enabled then a snapshot of the collection is saved
+    to the underlying store after each write, and reloaded from there if
+    the cached data goes missing.
     """
 
+    @property
+    def snapshot_collection(self):
+        return _key(self.collection, "snapshot")
+
     def get_batches_key(self, user):
         return _key(user["uid"], "c", self.collection, "batches")
 
@@ -921,16 +2442,42 @@ class CacheOnlyManager(_CachedManagerBase):
         yield self.get_batches_key(user)
 
     def get_cached_data(self, user):
-        return self.cache.gets(self.get_key(user))
+        data, casid = self._load_cached_data(user)
+        if data is None and self.owner.write_behind is not None:
+
+            def load():
+                return self._load_cached_data(user)
+
+            def fill(store):
+                try:
+                    item = self.storage.get_item(user,
+                                                 self.snapshot_collection,
+                                                 SNAPSHOT_ITEM_ID)
+                except (CollectionNotFoundError, ItemNotFoundError):
+                    return None, None
+                annotate_request(None, SNAPSHOT_RELOADS_METRIC, 1)
+                data = json_loads(item["payload"], timestamps=True)
+                if not store:
+                    return data, None
+                self._store_cached_data(user, data, None)
+                return self._load_cached_data(user)
+
+            data, casid = self.owner._fill_with_lease(self.get_key(user),
+                                                      load, fill)
+        return data, casid
 
     def set_items(self, user, items):
         modified = get_timestamp()
         data, casid = self.get_cached_data(user)
         self._set_items(user, items, modified, data, casid)
+        self.owner._schedule_write_behind(user, self.collection)
         return modified
 
     def del_collection(self, user):
-        if not self.cache.delete(self.get_key(user)):
+        # Make sure that any saved snapshot is deleted along with it.
+        cleared = self.clear_cached_data(user)
+        self.owner._schedule_write_behind(user, self.collection, deleted=True)
+        if not cleared:
             raise CollectionNotFoundError
         return get_timestamp()
 
@@ -938,6 +2485,7 @@ class CacheOnlyManager(_CachedManagerBase):
         modified = get_timestamp()
         data, casid = self.get_cached_data(user)
         self._del_items(user, items, modified, data, casid)
+        self.owner._schedule_write_behind(user, self.collection)
         return data["modified"]
 
     def set_item(self, user, item, bso):
@@ -945,6 +2493,7 @@ class CacheOnlyManager(_CachedManagerBase):
         modified = get_timestamp()
         data, casid = self.get_cached_data(user)
         num_created = self._set_items(user, [bso], modified, data, casid)
+        self.owner._schedule_write_behind(user, self.collection)
         return {
             "created": num_created == 1,
             "modified": modified,
@@ -956,6 +2505,7 @@ class CacheOnlyManager(_CachedManagerBase):
         num_deleted = self._del_items(user, [item], modified, data, casid)
         if num_deleted == 0:
             raise ItemNotFoundError
+        self.owner._schedule_write_behind(user, self.collection)
         return modified
 
     def get_cached_batches(self, user, ts=None):
@@ -1020,6 +2570,7 @@ class CacheOnlyManager(_CachedManagerBase):
 
         data, casid = self.get_cached_data(user)
         self._set_items(user, bdata[batchid]["items"], modified, data, casid)
+        self.owner._schedule_write_behind(user, self.collection)
         return modified
 
     def close_batch(self, user, batch):
@@ -1047,36 +2598,67 @@ class CachedManager(_CachedManagerBase):
     they are known to have completed.  If something goes wrong, the cache
     data can be restored on next read from the known-good data in the
     underlying store.
+
+    Reads go straight to the underlying store while memcache's circuit
+    breaker is open.
     """
 
+    def get_timestamp(self, user):
+        try:
+            return super(CachedManager, self).get_timestamp(user)
+        except CircuitOpenError:
+            annotate_request(None, BREAKER_FALLBACKS_METRIC, 1)
+            return self.storage.get_collection_timestamp(user, self.collection)
+
+    def get_items(self, user, **kwds):
+        try:
+            return super(CachedManager, self).get_items(user, **kwds)
+        except CircuitOpenError:
+            annotate_request(None, BREAKER_FALLBACKS_METRIC, 1)
+            return self.storage.get_items(user, self.collection, **kwds)
+
     def get_cached_data(self, user, refresh_if_missing=True):
         """Get the cached collection data, pulling into cache if missing.
 
         This method returns the cached collection data, populating it from
         the underlying store if it is not cached.
         """
-        key = self.get_key(user)
-        data, casid = self.cache.gets(key)
+        data, casid = self._load_cached_data(user)
         if data is None and refresh_if_missing:
-            data = {}
+
+            def load():
+                return self._load_cached_data(user)
+
+            def fill(store):
+                data = self._read_from_storage(user)
+                if not store:
+                    return data, None
+                self._store_cached_data(user, data, None)
+                return self._load_cached_data(user)
+
             try:
-                storage = self.storage
-                collection = self.collection
-                ttl_base = int(get_timestamp())
-                with self.owner.lock_for_read(user, collection):
-                    ts = storage.get_collection_timestamp(user, collection)
-                    data["modified"] = ts
-                    data["items"] = {}
-                    for bso in storage.get_items(user, collection)["items"]:
-                        if bso.get("ttl") is not None:
-                            bso["ttl"] = ttl_base + bso["ttl"]
-                        data["items"][bso["id"]] = bso
-                self.cache.add(key, data)
-                data, casid = self.cache.gets(key)
+                data, casid = self.owner._fill_with_lease(self.get_key(user),
+                                                          load, fill)
             except CollectionNotFoundError:
                 data = None
         return data, casid
 
+    def _read_from_storage(self, user):
+        """Read the collection data from the underlying store."""
+        data = {}
+        storage = self.storage
+        collection = self.collection
+        ttl_base = int(get_timestamp())
+        with self.owner.lock_for_read(user, collection):
+            ts = storage.get_collection_timestamp(user, collection)
+            data["modified"] = ts
+            data["items"] = {}
+            for bso in storage.get_items(user, collection)["items"]:
+                if bso.get("ttl") is not None:
+                    bso["ttl"] = ttl_base + bso["ttl"]
+                data["items"][bso["id"]] = bso
+        return data
+
     def set_items(self, user, items):
         storage = self.storage
         # Leave the cache empty if any of posted bsos were missing a payload.
@@ -1086,7 +2668,8 @@ class CachedManager(_CachedManagerBase):
             if "payload" not in item:
                 refresh_if_missing = False
                 break
-        with self._mark_dirty(user, refresh_if_missing) as (data, casid):
+        with self._mark_dirty(user, refresh_if_missing,
+                              restore=refresh_if_missing) as (data, casid):
             ts = storage.set_items(user, self.collection, items)
         # Update the cached data in-place to reflect the changes.
         if refresh_if_missing:
@@ -1094,7 +2677,7 @@ class CachedManager(_CachedManagerBase):
         return ts
 
     def del_collection(self, user):
-        self.cache.delete(self.get_key(user))
+        self.clear_cached_data(user)
         return self.storage.delete_collection(user, self.collection)
 
     def del_items(self, user, items):
@@ -1113,7 +2696,8 @@ class CachedManager(_CachedManagerBase):
         refresh_if_missing = True
         if "payload" not in bso:
             refresh_if_missing = False
-        with self._mark_dirty(user, refresh_if_missing) as (data, casid):
+        with self._mark_dirty(user, refresh_if_missing,
+                              restore=refresh_if_missing) as (data, casid):
             res = storage.set_item(user, self.collection, item, bso)
         # Update the cached data in-place to reflect the change.
         if refresh_if_missing:
@@ -1146,7 +2730,7 @@ class CachedManager(_CachedManagerBase):
         # Applying the batch will render our cached data inaccurate.
         # Just leave it emptied, and lazily re-populate on next fetch.
         storage = self.storage
-        with self._mark_dirty(user):
+        with self._mark_dirty(user, restore=False):
             ts = storage.apply_batch(user, self.collection, batchid)
         return ts
 
@@ -1155,7 +2739,7 @@ class CachedManager(_CachedManagerBase):
         storage.close_batch(user, self.collection, batchid)
 
     @contextlib.contextmanager
-    def _mark_dirty(self, user, refresh_if_missing=False):
+    def _mark_dirty(self, user, refresh_if_missing=False, restore=True):
         """Context manager to temporarily remove the cached data during write.
 
         All operations that may modify the underlying collection should be
@@ -1164,13 +2748,17 @@ class CachedManager(_CachedManagerBase):
         it is safe to do so.
 
         Once the write operation has successfully completed, the calling code
-        should update the cache with the new data.
+        should update the cache with the new data, unless restore is false in
+        which case the cached data is left cleared.
         """
         # Grab the current cache state so we can pass it to calling function.
         key = self.get_key(user)
         data, casid = self.get_cached_data(user, refresh_if_missing)
+        versions = data.get("chunks") if data is not None else None
         # Remove it from the cache so that we don't serve stale data.
         # A CAS-DELETE here would be nice, but memcached doesn't have one.
+        # Any chunks are left in place, to be re-used when it's restored,
+        # and must be deleted if it won't be.
         if data is not None:
             self.cache.delete(key)
         # Yield control back the the calling function.
@@ -1181,10 +2769,15 @@ class CachedManager(_CachedManagerBase):
             # If they get a storage-related error, it's safe to rollback
             # the cache. For any other sort of error we leave the cache clear.
             if data is not None:
-                self.cache.add(key, data)
+                self._store_cached_data(user, data, None, ())
+            raise
+        except Exception:
+            self._delete_chunks(user, versions)
             raise
+        if not restore:
+            self._delete_chunks(user, versions)
 
-    def _set_items(self, user, *args):
+    def _set_items(self, user, items, modified, data, casid):
         """Update cached data with new items, or clear it on conflict.
 
         This method extends the base class _set_items method so that any
@@ -1193,12 +2786,15 @@ class CachedManager(_CachedManagerBase):
         store, so instead of reporting an error because of the cache, we
         just clear the cached data and let it re-populate on demand.
         """
+        versions = data.get("chunks") if data is not None else None
         try:
-            return super(CachedManager, self)._set_items(user, *args)
+            return super(CachedManager, self)._set_items(user, items,
+                                                         modified, data, casid)
         except StorageError:
-            self.cache.delete(self.get_key(user))
+            self.clear_cached_data(user)
+            self._delete_chunks(user, versions)
 
-    def _del_items(self, user, *args):
+    def _del_items(self, user, items, modified, data, casid):
         """Update cached data with deleted items, or clear it on conflict.
 
         This method extends the base class _del_items method so that any
@@ -1207,7 +2803,118 @@ class CachedManager(_CachedManagerBase):
         store, so instead of reporting an error because of the cache, we
         just clear the cached data and let it re-populate on demand.
         """
+        versions = data.get("chunks") if data is not None else None
         try:
-            return super(CachedManager, self)._del_items(user, *args)
+            return super(CachedManager, self)._del_items(user, items,
+                                                         modified, data, casid)
         except StorageError:
-            self.cache.delete(self.get_key(user))
+            self.clear_cached_data(user)
+            self._delete_chunks(user, versions)
+
+
+class PromotedManager(CachedManager):
+    """Object for reading a promoted collection through the cache.
+
+    Collections may be promoted into the cache and demoted again at any time,
+    and not necessarily at the same time by every process.  Writes to them
+    always go straight to the underlying store, so this class only uses the
+    cached data if its timestamp matches the one in the metadata, which is
+    kept up to date by every write.  Otherwise it's re-read from the store,
+    and cached again if it is no bigger than the promoter's size limit.
+    """
+
+    def get_cached_data(self, user, refresh_if_missing=True):
+        promoter = self.owner.promoter
+        timestamps = self.owner._get_metadata(user)["collections"]
+        modified = timestamps.get(self.collection)
+        data, casid = self._load_cached_data(user)
+        if data is not None and data["modified"] == modified:
+            promoter.record_hit(self.collection)
+            annotate_request(None, PROMOTED_HITS_METRIC, 1)
+            return data, casid
+        annotate_request(None, PROMOTED_MISSES_METRIC, 1)
+        # Stale data must be removed before it can be filled in again.
+        if data is not None:
+            self.clear_cached_data(user)
+
+        def load():
+            data, casid = self._load_cached_data(user)
+            if data is not None and data["modified"] != modified:
+                return None, None
+            return data, casid
+
+        def fill(store):
+            data = self._read_from_storage(user)
+            size = sum(len(bso.get("payload", ""))
+                       for bso in data["items"].itervalues())
+            promoter.record_miss(self.collection, size)
+            if store and size <= promoter.max_size:
+                self._store_cached_data(user, data, None)
+            return data, None
+
+        try:
+            return self.owner._fill_with_lease(self.get_key(user), load, fill)
+        except CollectionNotFoundError:
+            return None, None
+
+
+class AdaptiveManager(UncachedManager):
+    """Manager for collections that are cached only while they're hot.
+
+    This class passes writes straight through to the underlying store, like
+    its base class.  Reads are reported to the owner's promoter, and go
+    through a PromotedManager if the collection is currently promoted.
+    """
+
+    def __init__(self, owner, collection):
+        super(AdaptiveManager, self).__init__(owner, collection)
+        self.promoted = PromotedManager(owner, collection)
+
+    def iter_cache_keys(self, user):
+        if self.owner.promoter.is_promoted(self.collection):
+            return self.promoted.iter_cache_keys(user)
+        return iter(())
+
+    def _read_through_cache(self, user, kwds=None):
+        """Check whether reads should go through the cache."""
+        promoter = self.owner.promoter
+        if not promoter.is_promoted(self.collection):
+            return False
+        if kwds and any(kwds.get(kwd) is not None
+                        for kwd in _PAGINATION_KWDS):
+            return False
+        # If the collection doesn't exist or is being written to,
+        # the underlying store has the final say.
+        timestamps = self.owner._get_metadata(user)["collections"]
+        return timestamps.get(self.collection) is not None
+
+    def get_items(self, user, **kwds):
+        promoter = self.owner.promoter
+        if self._read_through_cache(user, kwds):
+            promoter.record_read(self.collection)
+            return self.promoted.get_items(user, **kwds)
+        res = super(AdaptiveManager, self).get_items(user, **kwds)
+        # Use full reads of the collection to keep track of its size.
+        size = None
+        if all(kwds.get(kwd) is None for kwd in _PARTIAL_READ_KWDS):
+            size = sum(len(bso.get("payload", "")) for bso in res["items"])
+        promoter.record_read(self.collection, size)
+        return res
+
+    def get_item_ids(self, user, **kwds):
+        self.owner.promoter.record_read(self.collection)
+        if self._read_through_cache(user, kwds):
+            return self.promoted.get_item_ids(user, **kwds)
+        return super(AdaptiveManager, self).get_item_ids(user, **kwds)
+
+    def get_item(self, user, item):
+        self.owner.promoter.record_read(self.collection)
+        if self._read_through_cache(user):
+            return self.promoted.get_item(user, item)
+        return super(AdaptiveManager, self).get_item(user, item)
+
+    def get_item_timestamp(self, user, item):
+        self.owner.promoter.record_read(self.collection)
+        if self._read_through_cache(user):
+            return self.promoted.get_item_timestamp(user, item)
+        return super(AdaptiveManager, self).get_item_timestamp(user, item)
@@ -0,0 +1,256 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Cache for the mapping between collection names and ids.
+
+Every storage request needs to translate between collection names and the
+integer ids under which they're stored, but the mapping very rarely changes.
+The CollectionNameCache class keeps recently-used entries in memory, evicting
+the least-recently-used ones once it grows too big.
+
+Each worker process would otherwise have to warm up its own copy of the cache,
+so it can also be backed by a "snapshot" file of the full mapping that is
+shared by all processes on a host.  The file is memory-mapped and searched in
+place, so its contents are held only once in the OS page cache no matter how
+many processes are reading it.  Any process that finds the snapshot to be out
+of date can refresh it from the database.
+
+"""
+
+import os
+import mmap
+import time
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from mozsvc.metrics import annotate_request
+
+
+logger = logging.getLogger(__name__)
+
+# Default maximum number of non-fixed entries to keep in memory.
+MAX_COLLECTIONS_CACHE_SIZE = 1000
+
+# Default number of seconds after which the snapshot file is refreshed.
+SNAPSHOT_REFRESH_INTERVAL = 60
+
+# Minimum number of seconds between checks for a new snapshot file.
+SNAPSHOT_CHECK_INTERVAL = 1
+
+
+class CollectionNameCache(object):
+    """Bounded LRU cache of collection (id, name) pairs.
+
+    The given "fixed" mapping of ids to names, e.g. the standard collections,
+    is always available and never evicted.  Other entries are evicted in
+    least-recently-used order once there are more than max_size of them.
+
+    If snapshot_file is given, then lookups that miss the in-memory cache
+    will search that file before reporting a miss.  Lookups may be given a
+    "loader" callable returning all (id, name) pairs from the database, which
+    will be used to refresh the file if it's missing the requested entry and
+    is more than snapshot_refresh_interval seconds old.
+
+    The number of hits and misses are counted in the "hits" and "misses"
+    attributes, and also reported as metrics on the current request.
+    """
+
+    def __init__(self, fixed=None, max_size=MAX_COLLECTIONS_CACHE_SIZE,
+                 snapshot_file=None,
+                 snapshot_refresh_interval=SNAPSHOT_REFRESH_INTERVAL):
+        self.max_size = max_size
+        self.snapshot_file = snapshot_file
+        self.snapshot_refresh_interval = snapshot_refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self._fixed_by_id = dict(fixed or {})
+        self._fixed_by_name = dict((name, id)
+                                   for id, name in self._fixed_by_id.items())
+        self._ids_by_name = OrderedDict()
+        self._names_by_id = {}
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_stat = None
+        self._snapshot_checked = 0
+
+    def get_id(self, name, loader=None):
+        """Get the id for the named collection, or raise KeyError."""
+        try:
+            return self._fixed_by_name[name]
+        except KeyError:
+            pass
+        with self._lock:
+            try:
+                id = self._ids_by_name.pop(name)
+            except KeyError:
+                pass
+            else:
+                self._ids_by_name[name] = id
+                self._record_hit()
+                return id
+        id = self._find_in_snapshot(" %s\n" % (name,), True, loader)
+        if id is None:
+            self._record_miss()
+            raise KeyError(name)
+        self.set(id, name)
+        self._record_hit()
+        return id
+
+    def get_name(self, id, loader=None):
+        """Get the name of the collection with given id, or raise KeyError."""
+        try:
+            return self._fixed_by_id[id]
+        except KeyError:
+            pass
+        with self._lock:
+            try:
+                name = self._names_by_id[id]
+            except KeyError:
+                pass
+            else:
+                # Mark it as recently used.
+                self._ids_by_name[name] = self._ids_by_name.pop(name)
+                self._record_hit()
+                return name
+        name = self._find_in_snapshot("\n%d " % (id,), False, loader)
+        if name is None:
+            self._record_miss()
+            raise KeyError(id)
+        self.set(id, name)
+        self._record_hit()
+        return name
+
+    def set(self, id, name):
+        """Cache the given collection (id, name) pair."""
+        if name in self._fixed_by_name:
+            return
+        with self._lock:
+            old_id = self._ids_by_name.pop(name, None)
+            if old_id is not None:
+                self._names_by_id.pop(old_id, None)
+            self._ids_by_name[name] = id
+            self._names_by_id[id] = name
+            while len(self._ids_by_name) > self.max_size:
+                old_name, old_id = self._ids_by_name.popitem(last=False)
+                self._names_by_id.pop(old_id, None)
+
+    def clear(self):
+        """Remove all non-fixed entries from the in-memory cache."""
+        with self._lock:
+            self._ids_by_name.clear()
+            self._names_by_id.clear()
+
+    def _record_hit(self):
+        self.hits += 1
+        annotate_request(None, "syncstorage.storage.collections_cache.hit", 1)
+
+    def _record_miss(self):
+        self.misses += 1
+        annotate_request(None, "syncstorage.storage.collections_cache.miss", 1)
+
+    #
+    # Management of the shared snapshot file.
+    #
+    # The file contains one "<id> <name>" record per line, with a leading
+    # newline so that every record can be found by searching for either
+    # "\n<id> " or " <name>\n".  Collection names can't contain whitespace,
+    # so these searches are unambiguous.
+    #
+
+    def snapshot_is_stale(self):
+        """Check whether the snapshot file needs to be refreshed."""
+        if self.snapshot_file is None:
+            return False
+        try:
+            mtime = os.stat(self.snapshot_file).st_mtime
+        except OSError:
+            return True
+        return mtime + self.snapshot_refresh_interval < time.time()
+
+    def refresh_snapshot(self, collections):
+        """Replace the snapshot file with the given (id, name) pairs.
+
+        The new file is written alongside the old one and then atomically
+        renamed into place, so that readers never see a partial file.
+        """
+        if self.snapshot_file is None:
+            return
+        dirname = os.path.dirname(os.path.abspath(self.snapshot_file))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".collections")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write("\n")
+                for id, name in collections:
+                    f.write("%d %s\n" % (id, name))
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, self.snapshot_file)
+        except Exception:
+            logger.exception("Failed to refresh collections snapshot")
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+        # Make sure we pick up the new file on our next lookup.
+        self._snapshot_checked = 0
+
+    def _find_in_snapshot(self, needle, id_wanted, loader=None):
+        """Search the snapshot file for the given record fragment.
+
+        Returns the id or name from the matching record, depending on the
+        value of id_wanted, or None if there's no such record.  If there's
+        no such record and the file is stale, it will be refreshed using
+        the given loader and searched again.
+        """
+        if self.snapshot_file is None:
+            return None
+        snapshot = self._get_snapshot()
+        start = -1 if snapshot is None else snapshot.find(needle)
+        if start == -1:
+            if loader is None or not self.snapshot_is_stale():
+                return None
+            self.refresh_snapshot(loader())
+            snapshot = self._get_snapshot()
+            start = -1 if snapshot is None else snapshot.find(needle)
+            if start == -1:
+                return None
+        if id_wanted:
+            end = start
+            start = snapshot.rfind("\n", 0, end) + 1
+            return int(snapshot[start:end])
+        start += len(needle)
+        end = snapshot.find("\n", start)
+        return snapshot[start:end]
+
+    def _get_snapshot(self):
+        """Get the memory-mapped snapshot file, if any.
+
+        This re-maps the file if it has been replaced since it was last
+        mapped, checking no more than once every SNAPSHOT_CHECK_INTERVAL.
+        """
+        if self.snapshot_file is None:
+            return None
+        now = time.time()
+        if now - self._snapshot_checked < SNAPSHOT_CHECK_INTERVAL:
+            return self._snapshot
+        with self._lock:
+            self._snapshot_checked = now
+            try:
+                st = os.stat(self.snapshot_file)
+            except OSError:
+                self._snapshot = self._snapshot_stat = None
+                return None
+            stat = (st.st_ino, st.st_mtime, st.st_size)
+            if stat != self._snapshot_stat:
+                try:
+                    with open(self.snapshot_file, "rb") as f:
+                        self._snapshot = mmap.mmap(f.fileno(), 0,
+                                                   access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError):
+                    logger.exception("Failed to map collections snapshot")
+                    self._snapshot = None
+                self._snapshot_stat = stat
+            return self._snapshot
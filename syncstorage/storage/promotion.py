@@ -0,0 +1,273 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Adaptive promotion of hot collections into memcache.
+
+The memcached backend caches only the collections named in its config, and
+passes everything else straight through to the underlying store.  Some other
+collections turn out to be small and read on nearly every sync, and would be
+better off cached as well.
+
+The CollectionPromoter class watches how often each collection is read and
+how big it is, and decides which ones should be cached.  Time is divided into
+windows of a fixed length, and at the end of each window:
+
+    * collections read at least min_reads times in the window, and with a
+      measured average size of at most max_size bytes, are promoted into
+      the cache;
+    * promoted collections read fewer than half that many times, or whose
+      average size has grown beyond max_size bytes, are demoted again;
+    * promoted collections whose cache hit ratio is below min_hit_ratio,
+      e.g. because they're written as often as they're read, are demoted
+      and not promoted again for several windows.
+
+At most max_promoted collections are promoted at once, preferring the most
+frequently read.  The size of a collection is only known once it has been
+read in full, and collections whose size isn't known are never promoted.
+Otherwise a large collection that's only ever read in part could be
+promoted, and every miss on the cache would then read all of it.
+
+The decisions are made separately by each process, based on the reads that
+it sees.  Statistics are kept per collection name, summed across all users,
+rather than for each user's copy of a collection.  Promotion and demotion are
+logged along with the hit ratio that was achieved.  A summary of the current
+state is logged at the end of each window, and is also available from the
+report() method.
+
+"""
+
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Default length in seconds of the window over which reads are counted.
+DEFAULT_WINDOW = 60
+
+# Default number of reads per window needed for promotion.
+DEFAULT_MIN_READS = 100
+
+# Default maximum average size in bytes of a promoted collection.
+DEFAULT_MAX_SIZE = 64 * 1024
+
+# Default maximum number of collections that can be promoted at once.
+DEFAULT_MAX_PROMOTED = 10
+
+# Maximum number of distinct collections to track.
+MAX_TRACKED_COLLECTIONS = 1000
+
+# Default minimum hit ratio needed to stay promoted.
+DEFAULT_MIN_HIT_RATIO = 0.5
+
+# Number of windows for which a collection with a low hit ratio is excluded.
+DEMOTION_COOLDOWN_WINDOWS = 10
+
+# Weight given to each new size measurement in the running average.
+SIZE_AVERAGE_WEIGHT = 0.2
+
+# Maximum number of collections to include in the summary logged per window.
+MAX_LOGGED_COLLECTIONS = 20
+
+
+class _CollectionStats(object):
+    """Statistics tracked for each collection."""
+
+    __slots__ = ("reads", "last_reads", "size", "hits", "misses",
+                 "promoted", "cooldown")
+
+    def __init__(self):
+        self.reads = 0
+        self.last_reads = 0
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.promoted = False
+        self.cooldown = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return float(self.hits) / total
+
+
+class CollectionPromoter(object):
+    """Policy for promoting frequently-read collections into the cache.
+
+    Callers should report each read of a collection with record_read(),
+    passing its total size in bytes if it was read in full.  Reads of a
+    promoted collection should also be reported as a hit or a miss on the
+    cache, using record_hit() or record_miss().
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, min_reads=DEFAULT_MIN_READS,
+                 max_size=DEFAULT_MAX_SIZE, max_promoted=DEFAULT_MAX_PROMOTED,
+                 min_hit_ratio=DEFAULT_MIN_HIT_RATIO):
+        self.window = window
+        self.min_reads = min_reads
+        self.max_size = max_size
+        self.max_promoted = max_promoted
+        self.min_hit_ratio = min_hit_ratio
+        self._stats = {}
+        self._promoted = frozenset()
+        self._window_end = time.time() + window
+        self._lock = threading.Lock()
+
+    def is_promoted(self, collection):
+        """Check whether the named collection should be cached."""
+        return collection in self._promoted
+
+    def record_read(self, collection, size=None):
+        """Record a read of the named collection."""
+        with self._lock:
+            now = time.time()
+            if now >= self._window_end:
+                self._end_window(now)
+            stats = self._stats.get(collection)
+            if stats is None:
+                if len(self._stats) >= MAX_TRACKED_COLLECTIONS:
+                    return
+                stats = self._stats[collection] = _CollectionStats()
+            stats.reads += 1
+            if size is not None:
+                self._record_size(collection, stats, size)
+
+    def record_hit(self, collection):
+        """Record a read of the named collection that hit the cache."""
+        with self._lock:
+            stats = self._stats.get(collection)
+            if stats is not None:
+                stats.hits += 1
+
+    def record_miss(self, collection, size=None):
+        """Record a read of the named collection that missed the cache."""
+        with self._lock:
+            stats = self._stats.get(collection)
+            if stats is not None:
+                stats.misses += 1
+                if size is not None:
+                    self._record_size(collection, stats, size)
+
+    def report(self):
+        """Get a summary of the tracked collections.
+
+        This returns a list of dicts, one for each collection that has
+        been promoted or read in the current or previous window, listing
+        promoted collections first and then in decreasing order of reads.
+        """
+        with self._lock:
+            return self._report()
+
+    def _report(self):
+        report = []
+        for collection, stats in self._stats.iteritems():
+            if not (stats.promoted or stats.reads or stats.last_reads):
+                continue
+            report.append({
+                "collection": collection,
+                "promoted": stats.promoted,
+                "reads": stats.last_reads,
+                "size": stats.size,
+                "hits": stats.hits,
+                "misses": stats.misses,
+                "hit_ratio": stats.hit_ratio,
+            })
+        report.sort(key=lambda r: (not r["promoted"], -r["reads"]))
+        return report
+
+    def _log_report(self):
+        """Log a one-line summary of the report, for use by operators."""
+        report = self._report()
+        if not report:
+            return
+        entries = []
+        for r in report[:MAX_LOGGED_COLLECTIONS]:
+            details = ["%d reads" % (r["reads"],)]
+            if r["size"] is not None:
+                details.append("%d bytes" % (r["size"],))
+            if r["promoted"]:
+                details.insert(0, "promoted")
+                if r["hit_ratio"] is not None:
+                    details.append("hit ratio %.2f" % (r["hit_ratio"],))
+            entries.append("%s (%s)" % (r["collection"], ", ".join(details)))
+        logger.info("Collection reads per %ss, across all users: %s",
+                    self.window, "; ".join(entries))
+
+    def _record_size(self, collection, stats, size):
+        if stats.size is None:
+            stats.size = size
+        else:
+            stats.size += (size - stats.size) * SIZE_AVERAGE_WEIGHT
+        # Demote a collection as soon as it's known to be too big.
+        if stats.promoted and stats.size > self.max_size:
+            self._demote(collection, stats)
+            self._update_promoted()
+
+    def _demote(self, collection, stats):
+        stats.promoted = False
+        hit_ratio = stats.hit_ratio
+        logger.info("Demoting collection %r from the cache, after %d hits "
+                    "and %d misses (hit ratio %s)", collection, stats.hits,
+                    stats.misses,
+                    "n/a" if hit_ratio is None else "%.2f" % (hit_ratio,))
+
+    def _update_promoted(self):
+        self._promoted = frozenset(collection
+                                   for collection, stats in self._stats.items()
+                                   if stats.promoted)
+
+    def _end_window(self, now):
+        """Update the set of promoted collections at the end of a window."""
+        # If several windows have gone by, there were no reads in the others.
+        # A window of zero length re-evaluates things on every read.
+        if self.window and now >= self._window_end + self.window:
+            for stats in self._stats.itervalues():
+                stats.reads = 0
+        candidates = []
+        for collection, stats in self._stats.items():
+            stats.last_reads = stats.reads
+            stats.reads = 0
+            if stats.cooldown:
+                stats.cooldown -= 1
+            if stats.size is None:
+                small_enough = too_big = False
+            else:
+                small_enough = stats.size <= self.max_size
+                too_big = not small_enough
+            if stats.promoted:
+                hit_ratio = stats.hit_ratio
+                if stats.hits + stats.misses < self.min_reads:
+                    hit_ratio = None
+                if hit_ratio is not None and hit_ratio < self.min_hit_ratio:
+                    self._demote(collection, stats)
+                    stats.cooldown = DEMOTION_COOLDOWN_WINDOWS
+                elif too_big or stats.last_reads * 2 < self.min_reads:
+                    self._demote(collection, stats)
+                else:
+                    candidates.append((stats.last_reads, collection, stats))
+            elif stats.cooldown:
+                pass
+            elif small_enough and stats.last_reads >= self.min_reads:
+                candidates.append((stats.last_reads, collection, stats))
+            elif not stats.last_reads:
+                # Forget about collections that are no longer being read.
+                del self._stats[collection]
+        candidates.sort(reverse=True)
+        for _, collection, stats in candidates[self.max_promoted:]:
+            if stats.promoted:
+                self._demote(collection, stats)
+        for _, collection, stats in candidates[:self.max_promoted]:
+            if not stats.promoted:
+                stats.promoted = True
+                stats.hits = stats.misses = 0
+                logger.info("Promoting collection %r into the cache, "
+                            "with %d reads per %ss", collection,
+                            stats.last_reads, self.window)
+        self._update_promoted()
+        self._window_end = now + self.window
+        self._log_report()
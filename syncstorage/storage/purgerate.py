@@ -0,0 +1,115 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Adaptive rate control for purging of expired items.
+
+Expired items are purged by repeatedly deleting a batch of them until there
+are none left.  Deleting too much at once competes with user traffic for the
+database, while deleting too little when the database is idle means falling
+behind the rate at which items expire.
+
+The PurgeRateController class is fed the observed latency of each batch of
+deletes, and optionally the replication lag of the database, and uses them
+to adjust the size of the next batch and the time to sleep before running
+it.  Batch sizes grow while deletes complete well within the target latency,
+and are halved with a growing sleep between batches when the database shows
+signs of being overloaded.
+
+"""
+
+import time
+
+
+# Default number of seconds that a single batch of deletes should take.
+DEFAULT_TARGET_LATENCY = 0.5
+
+# Default maximum number of seconds to sleep between batches.
+DEFAULT_MAX_SLEEP = 10
+
+# Sleeps shorter than this are not worth doing.
+MIN_SLEEP = 0.01
+
+
+class PurgeRateController(object):
+    """Controller for the batch size and pacing of a purge loop.
+
+    The loop should delete up to batch_size items at a time, and after each
+    batch should call record() with the number of items deleted and the time
+    taken, then sleep for the number of seconds that it returns.
+
+    The batch size is kept between min_batch_size and max_batch_size, which
+    default to a tenth and ten times the initial batch size respectively.
+    A batch is considered to have overloaded the database if it took longer
+    than target_latency seconds, or if the replication lag is greater than
+    max_replication_lag seconds.
+
+    The controller also keeps track of the overall rate of the purge, in
+    the "num_purged", "num_batches", "num_throttled", "busy_time" and
+    "sleep_time" attributes and the "rows_per_second" property.
+    """
+
+    def __init__(self, batch_size, min_batch_size=None, max_batch_size=None,
+                 target_latency=DEFAULT_TARGET_LATENCY,
+                 max_sleep=DEFAULT_MAX_SLEEP, max_replication_lag=None):
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size or max(1, batch_size // 10)
+        self.max_batch_size = max_batch_size or batch_size * 10
+        self.target_latency = float(target_latency)
+        self.max_sleep = float(max_sleep)
+        self.max_replication_lag = max_replication_lag
+        self.sleep = 0.0
+        self.num_purged = 0
+        self.num_batches = 0
+        self.num_throttled = 0
+        self.busy_time = 0
+        self.sleep_time = 0
+
+    def is_overloaded(self, duration, replication_lag=None):
+        """Check whether the observed load calls for backing off."""
+        if duration > self.target_latency:
+            return True
+        if self.max_replication_lag is not None:
+            if replication_lag is not None:
+                if replication_lag > self.max_replication_lag:
+                    return True
+        return False
+
+    def record(self, rowcount, duration, replication_lag=None):
+        """Record the outcome of a batch, returning the time to sleep."""
+        self.num_batches += 1
+        self.num_purged += rowcount
+        self.busy_time += duration
+        if self.is_overloaded(duration, replication_lag):
+            # Back off quickly, sleeping at least as long as the batch took
+            # so that we use no more than half of the database's time.
+            self.num_throttled += 1
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            sleep = max(self.sleep * 2, duration, self.target_latency)
+            self.sleep = min(self.max_sleep, sleep)
+        else:
+            # Speed up gradually, but only if the batch was actually full
+            # and there's plenty of headroom under the target latency.
+            if rowcount >= self.batch_size:
+                if duration < self.target_latency / 2:
+                    self.batch_size = min(self.max_batch_size,
+                                          self.batch_size * 3 // 2)
+            self.sleep /= 2
+            if self.sleep < MIN_SLEEP:
+                self.sleep = 0
+        self.sleep_time += self.sleep
+        return self.sleep
+
+    @property
+    def rows_per_second(self):
+        """The overall purge rate, including time spent sleeping."""
+        elapsed = self.busy_time + self.sleep_time
+        if elapsed <= 0:
+            return 0.0
+        return self.num_purged / elapsed
+
+    def wait(self):
+        """Sleep for the currently-recommended time between batches."""
+        if self.sleep > 0:
+            time.sleep(self.sleep)
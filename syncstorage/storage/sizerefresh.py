@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Background recalculation of per-user storage sizes.
+
+The memcached backend keeps a running total of each user's storage size, and
+periodically reconciles it with the underlying store to account for changes
+that it didn't see, such as items being purged when their ttl expires.  That
+means scanning all of the user's items, which is too slow to do as part of an
+ordinary request.
+
+The BackgroundRefresher class runs such recalculations in a small pool of
+worker threads within the process.  Requests that find a stale value can
+queue the user for a refresh and carry on using the stale value, which will
+be brought up to date shortly afterwards.
+
+"""
+
+import Queue
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Default number of worker threads.
+DEFAULT_NUM_WORKERS = 1
+
+# Default maximum number of users waiting to be refreshed.
+DEFAULT_MAX_PENDING = 1000
+
+
+class BackgroundRefresher(object):
+    """Pool of worker threads calling a refresh function for queued users.
+
+    Each user is queued at most once; scheduling a user who is already
+    waiting to be refreshed has no effect.  If there are more than max_pending
+    users waiting, then further users are dropped rather than queued, on the
+    basis that they will be scheduled again by some later request.
+
+    The worker threads are started on first use, and run as daemon threads
+    so that they don't prevent the process from exiting.  Call close() to
+    stop them cleanly.  Any errors from the refresh function are logged and
+    otherwise ignored.
+    """
+
+    def __init__(self, refresh, num_workers=DEFAULT_NUM_WORKERS,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.refresh = refresh
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self._queue = Queue.Queue(max_pending)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._closed = False
+
+    def schedule(self, user):
+        """Queue the given user for a refresh.
+
+        This returns True if the user was queued or already waiting, and
+        False if they were dropped because the queue is full or closed.
+        """
+        uid = user["uid"]
+        with self._lock:
+            if self._closed:
+                return False
+            if uid in self._pending:
+                return True
+            try:
+                self._queue.put_nowait(user)
+            except Queue.Full:
+                return False
+            self._pending.add(uid)
+            if not self._workers:
+                self._start_workers()
+        return True
+
+    def join(self):
+        """Wait until all queued users have been refreshed."""
+        self._queue.join()
+
+    def close(self):
+        """Refresh any queued users, and stop the worker threads.
+
+        Users scheduled after this is called are dropped.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = self._workers
+        # Each worker exits when it takes one of these from the queue.
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _start_workers(self):
+        for _ in xrange(self.num_workers):
+            worker = threading.Thread(target=self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _run(self):
+        while True:
+            user = self._queue.get()
+            if user is None:
+                self._queue.task_done()
+                return
+            try:
+                # Remove it from the pending set before starting, so that
+                # changes made during the refresh can schedule another one.
+                with self._lock:
+                    self._pending.discard(user["uid"])
+                self.refresh(user)
+            except Exception:
+                logger.exception("Error refreshing user %r", user["uid"])
+            finally:
+                self._queue.task_done()
@@ -23,17 +23,22 @@ from google.cloud.spanner_v1 import param_types
 from mozsvc.metrics import metrics_timer
 
 from syncstorage.bso import BSO
-from syncstorage.util import get_timestamp
+from syncstorage.util import get_timestamp, Timestamp
 from syncstorage.storage import (SyncStorage,
                                  ConflictError,
                                  CollectionNotFoundError,
                                  ItemNotFoundError,
                                  InvalidBatch,
                                  InvalidOffsetError,
-                                 BATCH_LIFETIME)
+                                 BATCH_LIFETIME,
+                                 encode_index_offset,
+                                 decode_index_offset)
+from syncstorage.storage.namecache import (
+    CollectionNameCache,
+    MAX_COLLECTIONS_CACHE_SIZE,
+    SNAPSHOT_REFRESH_INTERVAL)
 from syncstorage.storage.sql import (
     FIRST_CUSTOM_COLLECTION_ID,
-    MAX_COLLECTIONS_CACHE_SIZE,
     STANDARD_COLLECTIONS,
     queries_generic as queries,
     ts2bigint,
@@ -57,7 +62,7 @@ EPOCH = datetime.datetime.utcfromtimestamp(0)
 def dt2ts(dt):
     """Convert a Python datetime to seconds"""
     val = (dt.replace(tzinfo=None) - EPOCH).total_seconds()
-    return get_timestamp(math.floor(val * 100) / 100)
+    return Timestamp(int(math.floor(val * 100)))
 
 
 def ts2dt(ts):
@@ -128,13 +133,16 @@ class SpannerStorage(SyncStorage):
         if self.standard_collections and dbkwds.get("create_tables", False):
             raise Exception("Creating tables in Spanner must be done manually")
 
-        # A local in-memory cache for the name => collectionid mapping.
-        self._collections_by_name = {}
-        self._collections_by_id = {}
-        if self.standard_collections:
-            for id, name in STANDARD_COLLECTIONS.iteritems():
-                self._collections_by_name[name] = id
-                self._collections_by_id[id] = name
+        # A local cache for the name <=> collectionid mapping, optionally
+        # backed by a snapshot file shared with other processes.
+        self._collections = CollectionNameCache(
+            STANDARD_COLLECTIONS if self.standard_collections else None,
+            max_size=int(dbkwds.get("collections_cache_size",
+                                    MAX_COLLECTIONS_CACHE_SIZE)),
+            snapshot_file=dbkwds.get("collections_snapshot_file"),
+            snapshot_refresh_interval=int(dbkwds.get(
+                "collections_snapshot_refresh", SNAPSHOT_REFRESH_INTERVAL)),
+        )
 
         # A thread-local to track active sessions.
         self._tldata = threading.local()
@@ -341,6 +349,13 @@ class SpannerStorage(SyncStorage):
         offset = params.pop("offset", None)
         if offset is not None:
             self.decode_offset(params, offset)
+        if "id_bound" in params:
+            bind["id_bound"] = params["id_bound"]
+            bind_types["id_bound"] = param_types.STRING
+            if params["index_bound"] is not None:
+                bind["index_bound"] = params["index_bound"]
+                bind_types["index_bound"] = param_types.INT64
+        if "offset" in params:
             bind["offset"] = params["offset"]
             bind_types["offset"] = param_types.INT64
             if limit is None:
@@ -398,9 +413,16 @@ class SpannerStorage(SyncStorage):
 
     def encode_next_offset(self, params, items):
         sort = params.get("sort", None)
-        # Use a simple numeric offset for sortindex ordering.
+        # Use a (sortindex, id) bound for sortindex ordering.
         if sort == "index":
-            return str(params.get("offset", 0) + len(items))
+            if items:
+                return encode_index_offset(items[-1].get("sortindex"),
+                                           items[-1]["id"])
+            # Nothing was returned, so resume from the same position.
+            if "id_bound" in params:
+                return encode_index_offset(params["index_bound"],
+                                           params["id_bound"])
+            return str(params.get("offset", 0))
         # Find an appropriate upper bound for faster timestamp ordering.
         bound = items[-1]["modified"]
         bound_as_bigint = ts2bigint(bound)
@@ -429,8 +451,14 @@ class SpannerStorage(SyncStorage):
         sort = params.get("sort", None)
         try:
             if sort == "index":
-                # When sorting by sortindex, it's just a numeric offset.
-                params["offset"] = int(offset)
+                # When sorting by sortindex, it's a (sortindex, id) bound.
+                # Older versions used a numeric offset, which we still accept.
+                if ":" not in offset:
+                    params["offset"] = int(offset)
+                else:
+                    index_bound, id_bound = decode_index_offset(offset)
+                    params["index_bound"] = index_bound
+                    params["id_bound"] = id_bound
             else:
                 # When sorting by timestamp, it's a (bound, offset) pair.
                 bound, offset = map(int, offset.split(":", 1))
@@ -853,7 +881,8 @@ class SpannerStorage(SyncStorage):
         """
         # Grab it from the cache if we can.
         try:
-            return self._collections_by_name[collection]
+            return self._collections.get_id(collection,
+                                            self._load_all_collections)
         except KeyError:
             pass
 
@@ -900,7 +929,7 @@ class SpannerStorage(SyncStorage):
         else:
             collectionid = result[0]
 
-        self._cache_collection_id(collectionid, collection)
+        self._collections.set(collectionid, collection)
         return collectionid
 
     def _load_collection_names(self, collection_ids):
@@ -920,7 +949,8 @@ class SpannerStorage(SyncStorage):
         # build a list of any ids whose names are not cached.
         for id in collection_ids:
             try:
-                names[id] = self._collections_by_id[id]
+                names[id] = self._collections.get_name(
+                    id, self._load_all_collections)
             except KeyError:
                 uncached_ids.append(id)
         # Use a single query to fetch the names for all uncached collections.
@@ -944,7 +974,7 @@ class SpannerStorage(SyncStorage):
                 )
             for id, name in uncached_names:
                 names[id] = name
-                self._cache_collection_id(id, name)
+                self._collections.set(id, name)
         # Check that we actually got a name for each specified id.
         for id in collection_ids:
             if id not in names:
@@ -964,15 +994,10 @@ class SpannerStorage(SyncStorage):
         names = self._load_collection_names(collection_ids)
         return dict([(names[id], value) for id, value in values])
 
-    def _cache_collection_id(self, collectionid, collection):
-        """Cache the given collection (id, name) pair for fast lookup."""
-        if len(self._collections_by_name) > MAX_COLLECTIONS_CACHE_SIZE:
-            msg = "More than %d collections have been created, " \
-                  "refusing to cache them all"
-            logger.warn(msg % (MAX_COLLECTIONS_CACHE_SIZE,))
-        else:
-            self._collections_by_name[collection] = collectionid
-            self._collections_by_id[collectionid] = collection
+    def _load_all_collections(self):
+        """Load all collections, for the shared snapshot file."""
+        with self._database.snapshot() as snapshot:
+            return list(snapshot.execute_sql(getq(queries.ALL_COLLECTIONS)))
 
     @with_session
     def is_migrating(self, session, user):
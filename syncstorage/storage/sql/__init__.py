@@ -13,25 +13,35 @@ use case it consists of three database tables:
 
 For efficiency when dealing with large datasets, the plugin also supports
 sharding of the BSO items into multiple tables named "bso0" through "bsoN".
-This behaviour is off by default; pass shard=True to enable it.
+This behaviour is off by default; pass shard=True to enable it.  The shards
+can also be spread across several database servers by passing shard_sqluris.
 """
 
+import time
 import logging
 import functools
 import threading
 import contextlib
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 from sqlalchemy.exc import IntegrityError
 
 from syncstorage.bso import BSO
-from syncstorage.util import get_timestamp
+from syncstorage.util import get_timestamp, Timestamp
 from syncstorage.storage import (SyncStorage,
                                  ConflictError,
                                  CollectionNotFoundError,
                                  ItemNotFoundError,
                                  InvalidOffsetError,
-                                 BATCH_LIFETIME)
+                                 BATCH_LIFETIME,
+                                 encode_index_offset,
+                                 decode_index_offset)
+from syncstorage.storage.namecache import (CollectionNameCache,
+                                           MAX_COLLECTIONS_CACHE_SIZE,
+                                           SNAPSHOT_REFRESH_INTERVAL)
+from syncstorage.storage.purgerate import (PurgeRateController,
+                                           DEFAULT_TARGET_LATENCY,
+                                           DEFAULT_MAX_SLEEP)
 
 from syncstorage.storage.sql.dbconnect import (DBConnector, MAX_TTL,
                                                BackendError)
@@ -52,7 +62,13 @@ STANDARD_COLLECTIONS = {1: "clients", 2: "crypto", 3: "forms", 4: "history",
 
 FIRST_CUSTOM_COLLECTION_ID = 100
 
-MAX_COLLECTIONS_CACHE_SIZE = 1000
+# Default maximum number of batches of expired items to purge from a single
+# table in one go, to avoid getting stuck indefinitely on that table.
+MAX_PURGE_ITERATIONS = 100
+
+# Default number of seconds of upcoming expiries to count when estimating
+# the rate at which items expire from a table.
+PURGE_EXPIRY_WINDOW = 300
 
 
 assert FIRST_CUSTOM_COLLECTION_ID > len(STANDARD_COLLECTIONS)
@@ -60,11 +76,13 @@ assert FIRST_CUSTOM_COLLECTION_ID > max(STANDARD_COLLECTIONS)
 
 
 def ts2bigint(timestamp):
+    if type(timestamp) is Timestamp:
+        return timestamp.centis * 10
     return int(timestamp * 1000)
 
 
 def bigint2ts(bigint):
-    return get_timestamp(bigint / 1000.0)
+    return Timestamp.from_millis(bigint)
 
 
 def convert_db_errors(func):
@@ -109,6 +127,25 @@ def with_session(func):
     return with_session_wrapper
 
 
+def with_read_session(func):
+    """Method decorator to magic a read-only "session" object into existence.
+
+    This works like the @with_session decorator, but if a new session needs
+    to be created then it may be routed to one of the read replicas of the
+    database.  It must only be used on methods that never write to the db,
+    and that take the user object as their first argument.
+    """
+    @functools.wraps(func)
+    def with_read_session_wrapper(self, *args, **kwds):
+        # If the first argument is already a session object, just use that.
+        if args and isinstance(args[0], SQLStorageSession):
+            return func(self, *args, **kwds)
+        # Otherwise, magic one into existence using threadlocals.
+        with self._get_or_create_session(read_user=args[0]) as session:
+            return func(self, session, *args, **kwds)
+    return with_read_session_wrapper
+
+
 class SQLStorage(SyncStorage):
     """Storage plugin implemented using an SQL database.
 
@@ -124,11 +161,74 @@ class SQLStorage(SyncStorage):
 
         * shard/shardsize:       enable sharding of the BSO table
 
+        * shard_sqluris:         URIs of database servers across which to
+                                 spread the BSO shards, along with all
+                                 other per-user data.
+
         * force_consistent_sort_order:  use an explicit total ordering when
                                         sorting items in the FIND_ITEMS query;
                                         expensive and unnecessary on older
                                         versions of MySQL.
 
+        * track_collection_usage:  maintain per-collection item counts and
+                                   sizes in the user_collections table,
+                                   rather than aggregating over the BSO
+                                   table when they are requested.  Items
+                                   that have expired are still counted
+                                   until purgettl removes them.
+
+        * replica_sqluris:       URIs of read replicas of the database, to
+                                 which read-locked sessions and info queries
+                                 will be routed.
+
+        * replica_pin_seconds:   after writing to the db, route that user's
+                                 reads to the primary for this many seconds,
+                                 so that they're not affected by replica lag.
+                                 The pins are kept in the primary db, so
+                                 they apply to every process using it.
+
+        * snapshot_reads:        take read locks by opening a read-only
+                                 consistent-snapshot transaction, rather
+                                 than by taking shared row locks.
+
+        * collections_cache_size:  maximum number of custom collection names
+                                   to cache in memory.
+
+        * collections_snapshot_file:  path of a file, shared by all processes
+                                      on the host, in which to keep a snapshot
+                                      of all collection names.
+
+        * collections_snapshot_refresh:  refresh the collections snapshot file
+                                         after this many seconds.
+
+        * partition_by_ttl:      on MySQL or PostgreSQL, range-partition the
+                                 batch tables by time, so that expired batches
+                                 are purged by dropping whole partitions.
+
+        * ttl_partition_interval:  number of seconds of batches to hold in
+                                   each partition of the batch tables.
+
+        * purge_target_latency:  when purging expired items, adjust the size
+                                 of each batch of deletes so that it takes
+                                 about this many seconds.
+
+        * purge_min_batch_size/purge_max_batch_size:  bounds on the size of
+                                                      each batch of deletes.
+
+        * purge_max_sleep:       maximum number of seconds to sleep between
+                                 batches of deletes when backing off.
+
+        * purge_max_replication_lag:  back off purging while any of the read
+                                      replicas is lagging by more than this
+                                      many seconds.
+
+        * purge_max_iterations:  maximum number of batches to purge from each
+                                 table in one go, or zero for no limit.
+
+        * purge_expiry_window:   number of seconds of upcoming expiries used
+                                 to estimate whether purging is keeping up,
+                                 or zero to skip the estimate.
+
     """
 
     def __init__(self, sqluri, standard_collections=False, **dbkwds):
@@ -139,6 +239,28 @@ class SQLStorage(SyncStorage):
             dbkwds.get("optimize_table_before_purge", True)
         self._optimize_table_after_purge = \
             dbkwds.get("optimize_table_after_purge", True)
+        self.track_collection_usage = \
+            dbkwds.get("track_collection_usage", False)
+        self.replica_pin_seconds = \
+            int(dbkwds.get("replica_pin_seconds", 10))
+        self.snapshot_reads = dbkwds.get("snapshot_reads", False)
+        self.purge_target_latency = float(dbkwds.get(
+            "purge_target_latency", DEFAULT_TARGET_LATENCY))
+        self.purge_min_batch_size = \
+            int(dbkwds.get("purge_min_batch_size", 0)) or None
+        self.purge_max_batch_size = \
+            int(dbkwds.get("purge_max_batch_size", 0)) or None
+        self.purge_max_sleep = \
+            float(dbkwds.get("purge_max_sleep", DEFAULT_MAX_SLEEP))
+        self.purge_max_replication_lag = \
+            dbkwds.get("purge_max_replication_lag")
+        if self.purge_max_replication_lag is not None:
+            self.purge_max_replication_lag = \
+                float(self.purge_max_replication_lag)
+        self.purge_max_iterations = \
+            int(dbkwds.get("purge_max_iterations", MAX_PURGE_ITERATIONS))
+        self.purge_expiry_window = \
+            int(dbkwds.get("purge_expiry_window", PURGE_EXPIRY_WINDOW))
         self._default_find_params = {
             "force_consistent_sort_order":
                 dbkwds.get("force_consistent_sort_order", False),
@@ -156,23 +278,80 @@ class SQLStorage(SyncStorage):
                     if self.dbconnector.driver == "postgres":
                         raise
 
-        # A local in-memory cache for the name => collectionid mapping.
-        self._collections_by_name = {}
-        self._collections_by_id = {}
-        if self.standard_collections:
-            for id, name in STANDARD_COLLECTIONS.iteritems():
-                self._collections_by_name[name] = id
-                self._collections_by_id[id] = name
+        # A local cache for the name <=> collectionid mapping, optionally
+        # backed by a snapshot file shared with other processes.
+        self._collections = CollectionNameCache(
+            STANDARD_COLLECTIONS if self.standard_collections else None,
+            max_size=int(dbkwds.get("collections_cache_size",
+                                    MAX_COLLECTIONS_CACHE_SIZE)),
+            snapshot_file=dbkwds.get("collections_snapshot_file"),
+            snapshot_refresh_interval=int(dbkwds.get(
+                "collections_snapshot_refresh", SNAPSHOT_REFRESH_INTERVAL)),
+        )
 
         # A thread-local to track active sessions.
         self._tldata = threading.local()
 
-    def _get_or_create_session(self):
-        """Get an existing session if one exists, or start a new one if not."""
+    def _get_or_create_session(self, read_user=None, shard_server=None):
+        """Get an existing session if one exists, or start a new one if not.
+
+        If read_user is given then any new session will only be used to read
+        that user's data, and so it may be routed to a read replica.  If
+        shard_server is given then any new session will send queries that
+        are not about a specific user to that server.
+        """
         try:
             return self._tldata.session
         except AttributeError:
-            return SQLStorageSession(self)
+            connection = None
+            if read_user is not None:
+                connection = self._connect_to_replica(read_user["uid"])
+            return SQLStorageSession(self, connection=connection,
+                                     shard_server=shard_server)
+
+    #
+    # APIs for routing of reads to replicas.
+    #
+    # Replication is asynchronous, so a replica may not yet reflect a write
+    # that the user has just made.  To give users a consistent view of their
+    # own writes, we pin them to the primary db for a few seconds after each
+    # write, measured from the new collection timestamp.  The pins are kept
+    # in the replica_pins table on the primary db, and written as part of the
+    # same transaction as the write, so they apply to every process using
+    # the db.  Checking a pin is a single primary-key lookup, which keeps the
+    # read load on the primary small.  The pins assume that the replicas lag
+    # by less than replica_pin_seconds.
+    #
+
+    def _connect_to_replica(self, userid):
+        """Get a connection for reading the given user's data from a replica.
+
+        This returns None if there are no read replicas, or if the user
+        has been pinned to the primary db by a recent write.
+        """
+        dbconnector = self.dbconnector
+        if not dbconnector.replica_engines:
+            return None
+        with dbconnector.connect() as connection:
+            pinned_until = connection.query_scalar("PRIMARY_PIN", {
+                "userid": userid,
+            })
+        if pinned_until is not None:
+            if bigint2ts(pinned_until) > get_timestamp():
+                return None
+        return dbconnector.connect(replica=True)
+
+    def _pin_to_primary(self, session, userid):
+        """Route the user's reads to the primary db after a write."""
+        if not self.dbconnector.replica_engines:
+            return
+        if self.replica_pin_seconds <= 0:
+            return
+        pinned_until = session.timestamp + self.replica_pin_seconds
+        session.insert_or_update("replica_pins", [{
+            "userid": userid,
+            "pinned_until": ts2bigint(pinned_until),
+        }])
 
     #
     # APIs for collection-level locking.
@@ -190,6 +369,13 @@ class SQLStorage(SyncStorage):
     # than explicit locking, but our ops team have expressed concerns about
     # the efficiency of that approach at scale.
     #
+    # If the "snapshot_reads" option is enabled then read locks instead use
+    # the database's multi-version concurrency control, opening a read-only
+    # REPEATABLE READ transaction and selecting without any row locks.  All
+    # reads in that transaction see a consistent snapshot of the data as of
+    # its first query, and readers neither block nor are blocked by writers.
+    # Write locks are unaffected.
+    #
 
     # Note: you can't use the @with_session decorator here.
     # It doesn't work right because of the generator-contextmanager thing.
@@ -197,7 +383,16 @@ class SQLStorage(SyncStorage):
     def lock_for_read(self, user, collection):
         """Acquire a shared read lock on the named collection."""
         userid = user["uid"]
-        with self._get_or_create_session() as session:
+        with self._get_or_create_session(read_user=user) as session:
+            # The snapshot transaction must be started before any other query
+            # on the connection, so it can't be used in a session that's
+            # already active.  That session's locks keep us consistent anyway.
+            params = {"userid": userid}
+            use_snapshot = self.snapshot_reads and \
+                not session.in_transaction(params)
+            if use_snapshot:
+                session.query("SET_TRANSACTION_SNAPSHOT", params)
+                session.query("BEGIN_TRANSACTION_SNAPSHOT", params)
             try:
                 collectionid = self._get_collection_id(session, collection)
             except CollectionNotFoundError:
@@ -209,10 +404,14 @@ class SQLStorage(SyncStorage):
             if (userid, collectionid) in session.locked_collections:
                 yield None
                 return
-            # Begin a transaction and take a lock in the database.
-            params = {"userid": userid, "collectionid": collectionid}
-            session.query("BEGIN_TRANSACTION_READ")
-            ts = session.query_scalar("LOCK_COLLECTION_READ", params)
+            # Begin a transaction and take a lock in the database,
+            # or just read from the snapshot if we have one.
+            params["collectionid"] = collectionid
+            if use_snapshot:
+                ts = session.query_scalar("COLLECTION_TIMESTAMP", params)
+            else:
+                session.query("BEGIN_TRANSACTION_READ", params)
+                ts = session.query_scalar("LOCK_COLLECTION_READ", params)
             if ts is not None:
                 ts = bigint2ts(ts)
                 session.cache[(userid, collectionid)].last_modified = ts
@@ -231,12 +430,14 @@ class SQLStorage(SyncStorage):
         """Acquire an exclusive write lock on the named collection."""
         userid = user["uid"]
         with self._get_or_create_session() as session:
+            if session.connection.replica is not None:
+                raise RuntimeError("Can't write-lock in a read-only session")
             collectionid = self._get_collection_id(session, collection, True)
             locked = session.locked_collections.get((userid, collectionid))
             if locked == 0:
                 raise RuntimeError("Can't escalate read-lock to write-lock")
             params = {"userid": userid, "collectionid": collectionid}
-            session.query("BEGIN_TRANSACTION_WRITE")
+            session.query("BEGIN_TRANSACTION_WRITE", params)
             ts = session.query_scalar("LOCK_COLLECTION_WRITE", params)
             if ts is not None:
                 ts = bigint2ts(ts)
@@ -256,7 +457,7 @@ class SQLStorage(SyncStorage):
     # APIs to operate on the entire storage.
     #
 
-    @with_session
+    @with_read_session
     def get_storage_timestamp(self, session, user):
         """Returns the last-modified timestamp for the entire storage."""
         userid = user["uid"]
@@ -265,7 +466,7 @@ class SQLStorage(SyncStorage):
         }, default=0)
         return bigint2ts(ts)
 
-    @with_session
+    @with_read_session
     def get_collection_timestamps(self, session, user):
         """Returns the collection timestamps for a user."""
         userid = user["uid"]
@@ -277,41 +478,80 @@ class SQLStorage(SyncStorage):
             res[collection] = bigint2ts(res[collection])
         return res
 
-    @with_session
+    @with_read_session
     def get_collection_counts(self, session, user):
         """Returns the collection counts."""
         userid = user["uid"]
-        res = session.query_fetchall("COLLECTIONS_COUNTS", {
-            "userid": userid,
-            "ttl": int(session.timestamp),
-        })
+        if self.track_collection_usage:
+            usage = self._get_tracked_usage(session, userid)
+            res = ((collectionid, count)
+                   for collectionid, (count, size) in usage.iteritems())
+        else:
+            res = session.query_fetchall("COLLECTIONS_COUNTS", {
+                "userid": userid,
+                "ttl": int(session.timestamp),
+            })
         return self._map_collection_names(session, res)
 
-    @with_session
+    @with_read_session
     def get_collection_sizes(self, session, user):
         """Returns the total size for each collection."""
         userid = user["uid"]
-        res = session.query_fetchall("COLLECTIONS_SIZES", {
-            "userid": userid,
-            "ttl": int(session.timestamp),
-        })
+        if self.track_collection_usage:
+            usage = self._get_tracked_usage(session, userid)
+            res = ((collectionid, size)
+                   for collectionid, (count, size) in usage.iteritems())
+        else:
+            res = session.query_fetchall("COLLECTIONS_SIZES", {
+                "userid": userid,
+                "ttl": int(session.timestamp),
+            })
         # Some db backends return a Decimal() instance for this aggregate.
         # We want just a plain old integer.
         rows = ((row[0], int(row[1])) for row in res)
         return self._map_collection_names(session, rows)
 
-    @with_session
-    def get_total_size(self, session, user, recalculate=False):
+    def get_total_size(self, user, recalculate=False):
         """Returns the total size a user's stored data."""
+        # The tracked size may drift if a write fails part-way through,
+        # so reconcile it if asked to recalculate.  That's a write, so it
+        # can't be done in a session on a read replica.
+        if recalculate and self.track_collection_usage:
+            with self._get_or_create_session() as session:
+                self.recalculate_collection_usage(session, user)
+                return self._get_total_size(session, user)
+        return self._get_total_size(user)
+
+    @with_read_session
+    def _get_total_size(self, session, user):
+        """Query the total size of a user's stored data."""
         userid = user["uid"]
-        size = session.query_scalar("STORAGE_SIZE", {
-            "userid": userid,
-            "ttl": int(session.timestamp),
-        }, default=0)
+        if self.track_collection_usage:
+            usage = self._get_tracked_usage(session, userid)
+            size = sum(size for (count, size) in usage.itervalues())
+        else:
+            size = session.query_scalar("STORAGE_SIZE", {
+                "userid": userid,
+                "ttl": int(session.timestamp),
+            }, default=0)
         # Some db backends return a Decimal() instance for this aggregate.
         # We want just a plain old integer.
         return int(size)
 
+    def _get_tracked_usage(self, session, userid):
+        """Get the tracked (count, size) of each of the user's collections.
+
+        Unlike the aggregates over the BSO table, these include any items
+        that have expired but not yet been purged.  The counters are brought
+        back into line as purgettl removes such items, or by recalculating
+        them with recalculate_collection_usage().
+        """
+        usage = {}
+        for collectionid, count, size in session.query_fetchall(
+                "TRACKED_COLLECTIONS_USAGE", {"userid": userid}):
+            usage[collectionid] = (count, int(size))
+        return usage
+
     @with_session
     def delete_storage(self, session, user):
         """Removes all data for the user."""
@@ -322,6 +562,45 @@ class SQLStorage(SyncStorage):
         session.query("DELETE_ALL_COLLECTIONS", {
             "userid": userid,
         })
+        self._pin_to_primary(session, userid)
+
+    @with_session
+    def recalculate_collection_usage(self, session, user):
+        """Recalculate the tracked item counts and sizes for a user.
+
+        The tracked usage counters are adjusted incrementally on each write,
+        but they count all rows present in the database, including expired
+        items that have not yet been purged.  This method purges any such
+        items for the given user and then recalculates the counters from
+        scratch, so that they exactly match the user's visible data.
+
+        This may be called with only a single collection write-locked, so
+        all of the user's counters are locked before they're calculated.
+        Otherwise a concurrent write to another collection could commit in
+        the meantime, and its increment would be lost when they're reset.
+        """
+        userid = user["uid"]
+        session.query("LOCK_COLLECTIONS_USAGE", {
+            "userid": userid,
+        })
+        session.query("PURGE_USER_EXPIRED_ITEMS", {
+            "userid": userid,
+            "ttl": int(session.timestamp),
+        })
+        usage = list(session.query_fetchall("CALCULATE_COLLECTIONS_USAGE", {
+            "userid": userid,
+        }))
+        session.query("RESET_COLLECTIONS_USAGE", {
+            "userid": userid,
+        })
+        for collectionid, count, size in usage:
+            session.query("SET_COLLECTION_USAGE", {
+                "userid": userid,
+                "collectionid": collectionid,
+                "count": count,
+                "size": int(size),
+            })
+        self._pin_to_primary(session, userid)
 
     #
     # APIs to operate on an individual collection
@@ -442,15 +721,22 @@ class SQLStorage(SyncStorage):
         encoded as "bound:offset" with efficient pagination granularity
         limited by the number of items with the same timestamp.
 
-        When sorting by sortindex, we cannot use an index anyway, and we have
-        no bound on the number of items that might share a single sortindex.
-        There's therefore not much to be gained by trying to be clever, and
-        we just use a simple numeric offset.
+        When sorting by sortindex, we have no bound on the number of items
+        that might share a single sortindex, so we use the (sortindex, id)
+        pair of the last item as the bound.  This is a total ordering, so
+        we can seek directly to the next item without any numeric offset.
         """
         sort = params.get("sort", None)
-        # Use a simple numeric offset for sortindex ordering.
+        # Use a (sortindex, id) bound for sortindex ordering.
         if sort == "index":
-            return str(params.get("offset", 0) + len(items))
+            if items:
+                return encode_index_offset(items[-1].get("sortindex"),
+                                           items[-1]["id"])
+            # Nothing was returned, so resume from the same position.
+            if "id_bound" in params:
+                return encode_index_offset(params["index_bound"],
+                                           params["id_bound"])
+            return str(params.get("offset", 0))
         # Find an appropriate upper bound for faster timestamp ordering.
         bound = items[-1]["modified"]
         bound_as_bigint = ts2bigint(bound)
@@ -485,8 +771,14 @@ class SQLStorage(SyncStorage):
         sort = params.get("sort", None)
         try:
             if sort == "index":
-                # When sorting by sortindex, it's just a numeric offset.
-                params["offset"] = int(offset)
+                # When sorting by sortindex, it's a (sortindex, id) bound.
+                # Older versions used a numeric offset, which we still accept.
+                if ":" not in offset:
+                    params["offset"] = int(offset)
+                else:
+                    index_bound, id_bound = decode_index_offset(offset)
+                    params["index_bound"] = index_bound
+                    params["id_bound"] = id_bound
             else:
                 # When sorting by timestamp, it's a (bound, offset) pair.
                 bound, offset = map(int, offset.split(":", 1))
@@ -521,8 +813,12 @@ class SQLStorage(SyncStorage):
             "payload": "",
             "payload_size": 0,
         }
+        usage = None
+        if self.track_collection_usage:
+            usage = self._get_rows_usage_delta(session, userid,
+                                               collectionid, rows)
         session.insert_or_update("bso", rows, defaults)
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid, usage)
 
     @with_session
     def create_batch(self, session, user, collection):
@@ -598,9 +894,12 @@ class SQLStorage(SyncStorage):
             "ttl_base": int(session.timestamp),
             "modified": ts2bigint(session.timestamp)
         }
+        usage = None
+        if self.track_collection_usage:
+            usage = self._get_batch_usage_delta(session, params)
         session.query("APPLY_BATCH_UPDATE", params)
         session.query("APPLY_BATCH_INSERT", params)
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid, usage)
 
     @metrics_timer("syncstorage.storage.sql.close_batch")
     @with_session
@@ -630,6 +929,7 @@ class SQLStorage(SyncStorage):
         })
         if count == 0:
             raise CollectionNotFoundError
+        self._pin_to_primary(session, userid)
         return self.get_storage_timestamp(user)
 
     @with_session
@@ -637,32 +937,97 @@ class SQLStorage(SyncStorage):
         """Deletes multiple items from a collection."""
         userid = user["uid"]
         collectionid = self._get_collection_id(session, collection)
+        usage = None
+        if self.track_collection_usage and items:
+            sizes = session.query_fetchall("ITEMS_USAGE", {
+                "userid": userid,
+                "collectionid": collectionid,
+                "ids": items,
+            })
+            count_delta = size_delta = 0
+            for id, size in sizes:
+                count_delta -= 1
+                size_delta -= size
+            usage = (count_delta, size_delta)
         session.query("DELETE_ITEMS", {
             "userid": userid,
             "collectionid": collectionid,
             "ids": items,
         })
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid, usage)
+
+    def _touch_collection(self, session, userid, collectionid, usage=None):
+        """Update the last-modified timestamp of the given collection.
 
-    def _touch_collection(self, session, userid, collectionid):
-        """Update the last-modified timestamp of the given collection."""
+        If given, the usage argument is a (count, size) pair giving the
+        change in the tracked usage of the collection.
+        """
         params = {
             "userid": userid,
             "collectionid": collectionid,
             "modified": ts2bigint(session.timestamp),
         }
+        if usage is None:
+            touch_query = "TOUCH_COLLECTION"
+            init_query = "INIT_COLLECTION"
+        else:
+            touch_query = "TOUCH_COLLECTION_USAGE"
+            init_query = "INIT_COLLECTION_USAGE"
+            params["count_delta"], params["size_delta"] = usage
+        self._pin_to_primary(session, userid)
         # The common case will be an UPDATE, so try that first.
         # If it doesn't update any rows then do an INSERT.
-        rowcount = session.query("TOUCH_COLLECTION", params)
+        rowcount = session.query(touch_query, params)
         if rowcount != 1:
             try:
-                session.query("INIT_COLLECTION", params)
+                rowcount = session.query(init_query, params)
             except IntegrityError:
                 # Someone else inserted it at the same time.
                 if self.dbconnector.driver == "postgres":
                     raise
+                rowcount = 0
+            # Make sure that a concurrent insert doesn't lose our usage delta.
+            if rowcount != 1 and usage is not None:
+                session.query(touch_query, params)
         return session.timestamp
 
+    def _get_rows_usage_delta(self, session, userid, collectionid, rows):
+        """Calculate the change in usage from upserting the given BSO rows."""
+        sizes = dict(session.query_fetchall("ITEMS_USAGE", {
+            "userid": userid,
+            "collectionid": collectionid,
+            "ids": [row["id"] for row in rows],
+        }))
+        count_delta = size_delta = 0
+        for row in rows:
+            new_size = row.get("payload_size")
+            old_size = sizes.get(row["id"])
+            if old_size is None:
+                # A new row, with an empty payload if none was given.
+                count_delta += 1
+                new_size = new_size or 0
+                size_delta += new_size
+            elif new_size is None:
+                # An existing row that keeps its current payload.
+                new_size = old_size
+            else:
+                size_delta += new_size - old_size
+            # Later rows might update the same item.
+            sizes[row["id"]] = new_size
+        return (count_delta, size_delta)
+
+    def _get_batch_usage_delta(self, session, params):
+        """Calculate the change in usage from applying the given batch."""
+        rows = session.query_fetchall("BATCH_ITEMS_USAGE", params)
+        count_delta = size_delta = 0
+        for id, new_size, old_size in rows:
+            if old_size is None:
+                count_delta += 1
+                size_delta += new_size or 0
+            elif new_size is not None:
+                size_delta += new_size - old_size
+        return (count_delta, size_delta)
+
     #
     # Items APIs
     #
@@ -708,10 +1073,15 @@ class SQLStorage(SyncStorage):
             "payload": "",
             "payload_size": 0,
         }
+        usage = None
+        if self.track_collection_usage:
+            usage = self._get_rows_usage_delta(session, userid,
+                                               collectionid, [row])
         num_created = session.insert_or_update("bso", [row], defaults)
+        modified = self._touch_collection(session, userid, collectionid, usage)
         return {
             "created": bool(num_created),
-            "modified": self._touch_collection(session, userid, collectionid)
+            "modified": modified,
         }
 
     def _prepare_bso_row(self, session, userid, collectionid, item, data):
@@ -760,146 +1130,315 @@ class SQLStorage(SyncStorage):
         """Deletes a single item from a collection."""
         userid = user["uid"]
         collectionid = self._get_collection_id(session, collection)
-        rowcount = session.query("DELETE_ITEM", {
+        params = {
             "userid": userid,
             "collectionid": collectionid,
             "item": item,
             "ttl": int(session.timestamp),
-        })
+        }
+        usage = None
+        if self.track_collection_usage:
+            size = session.query_scalar("ITEM_USAGE", params, default=0)
+            usage = (-1, -size)
+        rowcount = session.query("DELETE_ITEM", params)
         if rowcount == 0:
             raise ItemNotFoundError
-        return self._touch_collection(session, userid, collectionid)
+        return self._touch_collection(session, userid, collectionid, usage)
 
     #
     # Administrative/maintenance methods.
     #
     def purge_expired_items(self, grace_period=0, max_per_loop=1000):
         """Purges expired items from the bso and batch-related tables."""
-        res = self._purge_expired_bsos(grace_period, max_per_loop)
-        num_bso_rows_purged = res["num_purged"]
-        is_complete = res["is_complete"]
-
-        res = self._purge_expired_batches(grace_period, max_per_loop)
-        num_batches_purged = res["num_purged"]
-        is_complete = is_complete and res["is_complete"]
-
-        res = self._purge_expired_batch_items(grace_period, max_per_loop)
-        num_bui_rows_purged = res["num_purged"]
-        is_complete = is_complete and res["is_complete"]
-
+        num_purged = {"bso": 0, "batches": 0, "bui": 0}
+        is_complete = True
+        keeping_up = True
+        for task in self.get_purge_tasks(grace_period, max_per_loop):
+            res = task.run()
+            num_purged[task.kind] += res["num_purged"]
+            is_complete = is_complete and res["is_complete"]
+            keeping_up = keeping_up and res["keeping_up"]
         return {
-            "num_batches_purged": num_batches_purged,
-            "num_bso_rows_purged": num_bso_rows_purged,
-            "num_bui_rows_purged": num_bui_rows_purged,
+            "num_batches_purged": num_purged["batches"],
+            "num_bso_rows_purged": num_purged["bso"],
+            "num_bui_rows_purged": num_purged["bui"],
             "is_complete": is_complete,
+            "keeping_up": keeping_up,
         }
 
-    def _purge_expired_bsos(self, grace_period=0, max_per_loop=1000):
-        """Purges BSOs with an expired TTL from the database."""
-        # Get the set of all BSO tables in the database.
-        # This will be different depending on whether sharding is done.
-        if not self.dbconnector.shard:
-            tables = set(("bso",))
-        else:
-            tables = set(self.dbconnector.get_bso_table(i).name
-                         for i in xrange(self.dbconnector.shardsize))
-            assert len(tables) == self.dbconnector.shardsize
-        # Purge each table in turn, summing rowcounts.
-        num_purged = 0
-        is_incomplete = False
-        for table in sorted(tables):
-            res = self._purge_items_loop(table, "PURGE_SOME_EXPIRED_ITEMS", {
-                "bso": table,
-                "grace": grace_period,
-                "maxitems": max_per_loop,
-            })
-            num_purged += res["num_purged"]
-            is_incomplete = is_incomplete or not res["is_complete"]
-        return {
-            "num_purged": num_purged,
-            "is_complete": not is_incomplete,
-        }
+    def get_purge_tasks(self, grace_period=0, max_per_loop=1000):
+        """Get a list of independent tasks for purging expired items.
 
-    def _purge_expired_batches(self, grace_period=0, max_per_loop=1000):
-        self._maybe_optimize_table_before_purge("OPTIMIZE_BATCHES_TABLE")
+        Each task purges a single table on a single database server, so
+        the tasks can safely be run concurrently.  Calling task.run() does
+        the purge and returns a dict describing the outcome, which includes
+        at least the keys "num_purged", "is_complete" and "keeping_up" as
+        documented in _purge_items_loop().  The task's "kind" is one of
+        "bso", "batches" or "bui", identifying the type of table that it
+        purges.
+
+        The max_per_loop argument gives the initial number of items to
+        delete at a time, which will be adjusted according to the load
+        on the database.
+        """
+        dbconnector = self.dbconnector
+        tasks = []
+        # Get the set of all BSO tables in the database, along with the
+        # server holding each.  This will be different depending on whether
+        # sharding is done.
+        if not dbconnector.shard:
+            bso_tables = set([("bso", None)])
+        else:
+            bso_tables = set((dbconnector.get_bso_table(i).name,
+                              dbconnector.get_shard_server(i))
+                             for i in xrange(dbconnector.shardsize))
+            assert len(bso_tables) == dbconnector.shardsize
+        # Tracked usage has to be updated along with each batch of deletes.
+        purge_query = "PURGE_SOME_EXPIRED_ITEMS"
+        if self.track_collection_usage:
+            purge_query = self._purge_tracked_items
+        for table, server in sorted(bso_tables):
+            run = functools.partial(self._purge_items_loop, table,
+                                    purge_query, {
+                                        "bso": table,
+                                        "grace": grace_period,
+                                        "maxitems": max_per_loop,
+                                    }, server, "COUNT_EXPIRING_ITEMS")
+            tasks.append(PurgeTask(table, server, "bso", run))
+        # Each shard server has its own batch_uploads table.
+        for server in dbconnector.get_shard_servers():
+            run = functools.partial(self._purge_expired_batches,
+                                    grace_period, max_per_loop, server)
+            tasks.append(PurgeTask("batch_uploads", server, "batches", run))
+        # Get the set of all BUI tables in the database.  This will be
+        # different depending on whether sharding is done, and every
+        # shard server has a full set of them.
+        if not dbconnector.shard:
+            bui_tables = set(("batch_upload_items",))
+        else:
+            bui_tables = set(dbconnector.get_batch_item_table(i).name
+                             for i in xrange(dbconnector.shardsize))
+            assert len(bui_tables) == dbconnector.shardsize
+        for server in dbconnector.get_shard_servers():
+            for table in sorted(bui_tables):
+                run = functools.partial(self._purge_expired_batch_items,
+                                        table, grace_period, max_per_loop,
+                                        server)
+                tasks.append(PurgeTask(table, server, "bui", run))
+        return tasks
+
+    def _purge_expired_batches(self, grace_period=0, max_per_loop=1000,
+                               shard_server=None):
+        if self.dbconnector.partition_by_ttl:
+            return self._purge_expired_partitions("batch_uploads",
+                                                  grace_period, shard_server)
+        self._maybe_optimize_table_before_purge("OPTIMIZE_BATCHES_TABLE",
+                                                shard_server=shard_server)
         res = self._purge_items_loop("batch_uploads", "PURGE_BATCHES", {
             "lifetime": BATCH_LIFETIME,
             "grace": grace_period,
             "maxitems": max_per_loop,
-        })
-        self._maybe_optimize_table_after_purge("OPTIMIZE_BATCHES_TABLE")
+        }, shard_server, "COUNT_EXPIRING_BATCHES")
+        self._maybe_optimize_table_after_purge("OPTIMIZE_BATCHES_TABLE",
+                                               shard_server=shard_server)
         return res
 
-    def _purge_expired_batch_items(self, grace_period=0, max_per_loop=1000):
-        # Get the set of all BUI tables in the database.
-        # This will be different depending on whether sharding is done.
-        if not self.dbconnector.shard:
-            tables = set(("batch_upload_items",))
-        else:
-            tables = set(self.dbconnector.get_batch_item_table(i).name
-                         for i in xrange(self.dbconnector.shardsize))
-            assert len(tables) == self.dbconnector.shardsize
-        # Purge each table in turn, summing rowcounts.
-        num_purged = 0
-        is_incomplete = False
-        for table in sorted(tables):
-            self._maybe_optimize_table_before_purge("OPTIMIZE_BUI_TABLE", {
-                "bui": table
-            })
-            res = self._purge_items_loop(table, "PURGE_BATCH_CONTENTS", {
-                "bui": table,
-                "lifetime": BATCH_LIFETIME,
-                "grace": grace_period,
-                "maxitems": max_per_loop,
-            })
-            num_purged += res["num_purged"]
-            is_incomplete = is_incomplete or not res["is_complete"]
-            self._maybe_optimize_table_after_purge("OPTIMIZE_BUI_TABLE", {
-                "bui": table
-            })
+    def _purge_expired_batch_items(self, table, grace_period=0,
+                                   max_per_loop=1000, shard_server=None):
+        if self.dbconnector.partition_by_ttl:
+            return self._purge_expired_partitions(table, grace_period,
+                                                  shard_server)
+        self._maybe_optimize_table_before_purge("OPTIMIZE_BUI_TABLE", {
+            "bui": table
+        }, shard_server)
+        res = self._purge_items_loop(table, "PURGE_BATCH_CONTENTS", {
+            "bui": table,
+            "lifetime": BATCH_LIFETIME,
+            "grace": grace_period,
+            "maxitems": max_per_loop,
+        }, shard_server, "COUNT_EXPIRING_BATCH_CONTENTS")
+        self._maybe_optimize_table_after_purge("OPTIMIZE_BUI_TABLE", {
+            "bui": table
+        }, shard_server)
+        return res
+
+    def _purge_expired_partitions(self, table, grace_period=0,
+                                  shard_server=None):
+        """Purge expired batches by dropping whole partitions of a table.
+
+        A partition is dropped once every batch that it can hold has expired,
+        so there is no row-at-a-time deleting and no need to optimize the
+        table afterwards.  The number of items purged is approximate, since
+        it's taken from the database's table statistics.
+        """
+        logger.info("Dropping expired partitions of %s", table)
+        dbconnector = self.dbconnector
+        now = int(time.time())
+        dropped = dbconnector.drop_ttl_partitions(
+            table, now - BATCH_LIFETIME - grace_period, shard_server)
+        num_purged = sum(num_rows for _, num_rows in dropped)
+        logger.info("Dropped %d expired partitions of %s, holding about %d "
+                    "items", len(dropped), table, num_purged)
+        # Batches beyond the last partition go into the catch-all partition,
+        # which is never dropped.  So we're falling behind unless partitions
+        # are being created ahead of time.
+        partitions = dbconnector.get_ttl_partitions(table, shard_server)
+        keeping_up = bool(partitions) and partitions[-1][0] > now
+        if not keeping_up:
+            logger.warning("There are no partitions of %s for new batches; "
+                           "create more with partitionttl.py", table)
         return {
             "num_purged": num_purged,
-            "is_complete": not is_incomplete,
+            "is_complete": True,
+            "num_partitions_dropped": len(dropped),
+            "keeping_up": keeping_up,
         }
 
-    def _purge_items_loop(self, table, query, params):
-        """Helper function to incrementally purge items in a loop."""
+    def _purge_tracked_items(self, session, params):
+        """Purge a batch of expired items, updating the tracked usage.
+
+        The expired items are listed and then deleted a collection at a time,
+        with the collection locked so that the decrement to its counters
+        can't race with a concurrent write of the same items.
+        """
+        expired = defaultdict(list)
+        for userid, collectionid, id in session.query_fetchall(
+                "LIST_SOME_EXPIRED_ITEMS", params):
+            expired[(userid, collectionid)].append(id)
+        num_purged = 0
+        for (userid, collectionid), ids in sorted(expired.iteritems()):
+            group_params = params.copy()
+            group_params.update({
+                "userid": userid,
+                "collectionid": collectionid,
+                "ids": ids,
+            })
+            session.query("LOCK_COLLECTION_WRITE", group_params)
+            count, size = session.query_fetchone("EXPIRED_ITEMS_USAGE",
+                                                 group_params)
+            group_params["count"] = count
+            group_params["size"] = size or 0
+            num_purged += session.query("PURGE_EXPIRED_ITEMS", group_params)
+            session.query("DECREMENT_COLLECTION_USAGE", group_params)
+        return num_purged
+
+    def _purge_items_loop(self, table, query, params, shard_server=None,
+                          count_query=None):
+        """Helper function to incrementally purge items in a loop.
+
+        Items are deleted in batches, whose size and spacing are adjusted
+        by a PurgeRateController according to how long each batch takes
+        and, if so configured, the replication lag of the read replicas.
+        The result is a dict with the following keys:
+
+            * num_purged:       the number of items purged
+            * is_complete:      whether all expired items were purged
+            * num_batches:      the number of batches of deletes that were run
+            * num_throttled:    the number of batches that triggered back-off
+            * batch_size:       the final batch size chosen by the controller
+            * rows_per_second:  the purge rate, including time spent sleeping
+            * expiry_rate:      estimated number of items expiring per second,
+                                or None if it wasn't estimated
+            * keeping_up:       whether the purge is keeping ahead of the rate
+                                at which items expire
+
+        If given, count_query is used to count the items expiring in the next
+        purge_expiry_window seconds, giving the expected expiry rate.  The
+        query may also be a function taking (session, params) and returning
+        the number of items that it purged.
+        """
         # Purge some items, a few at a time, in a loop.
         # We set an upper limit on the number of iterations, to avoid
         # getting stuck indefinitely on a single table.
         logger.info("Purging expired items from %s", table)
-        MAX_ITERS = 100
-        num_iters = 1
-        num_purged = 0
+        params = params.copy()
+        controller = PurgeRateController(
+            params["maxitems"],
+            min_batch_size=self.purge_min_batch_size,
+            max_batch_size=self.purge_max_batch_size,
+            target_latency=self.purge_target_latency,
+            max_sleep=self.purge_max_sleep,
+            max_replication_lag=self.purge_max_replication_lag,
+        )
+        # Only the main database has read replicas whose lag we can check.
+        check_replication_lag = self.purge_max_replication_lag is not None \
+            and shard_server is None and self.dbconnector.replica_engines
         is_incomplete = False
-        # Note that we take a new session for each run of the query.
-        # This avoids holding open a long-running transaction, so
-        # the incrementality can let other jobs run properly.
-        with self._get_or_create_session() as session:
-            params["now"] = int(session.timestamp)
-            rowcount = session.query(query, params)
-        while rowcount > 0:
-            num_purged += rowcount
-            logger.debug("After %d iterations, %s items purged",
-                         num_iters, num_purged)
-            num_iters += 1
-            if num_iters > MAX_ITERS:
-                logger.debug("Too many iterations, bailing out.")
-                is_incomplete = True
+        while True:
+            params["maxitems"] = controller.batch_size
+            # Note that we take a new session for each run of the query.
+            # This avoids holding open a long-running transaction, so
+            # the incrementality can let other jobs run properly.
+            t_start = time.time()
+            with self._get_or_create_session(shard_server=shard_server) \
+                    as session:
+                params.setdefault("now", int(session.timestamp))
+                if callable(query):
+                    rowcount = query(session, params)
+                else:
+                    rowcount = session.query(query, params)
+            if rowcount <= 0:
                 break
-            with self._get_or_create_session() as session:
-                rowcount = session.query(query, params)
-        logger.info("Purged %d expired items from %s", num_purged, table)
+            replication_lag = None
+            if check_replication_lag:
+                replication_lag = self.dbconnector.get_replication_lag()
+            controller.record(rowcount, time.time() - t_start,
+                              replication_lag)
+            logger.debug("After %d iterations, %s items purged; next batch "
+                         "size is %d, after sleeping %.2f seconds",
+                         controller.num_batches, controller.num_purged,
+                         controller.batch_size, controller.sleep)
+            if self.purge_max_iterations > 0:
+                if controller.num_batches >= self.purge_max_iterations:
+                    logger.debug("Too many iterations, bailing out.")
+                    is_incomplete = True
+                    break
+            controller.wait()
+        # Estimate how quickly items are expiring, to tell whether we're
+        # purging them fast enough to keep up.
+        expiry_rate = None
+        if count_query is not None and self.purge_expiry_window > 0:
+            params["window"] = self.purge_expiry_window
+            with self._get_or_create_session(shard_server=shard_server) \
+                    as session:
+                num_expiring = session.query_scalar(count_query, params,
+                                                    default=0)
+            expiry_rate = num_expiring / float(self.purge_expiry_window)
+        # If we got through the whole backlog then we're ahead of the expiry
+        # rate for now.  If not, we can still be catching up so long as we
+        # purge items faster than they expire.
+        rows_per_second = controller.rows_per_second
+        keeping_up = not is_incomplete
+        if is_incomplete and expiry_rate is not None:
+            keeping_up = rows_per_second > expiry_rate
+        logger.info("Purged %d expired items from %s in %d batches "
+                    "(%.1f rows/sec, batch size %d, throttled %d times)",
+                    controller.num_purged, table, controller.num_batches,
+                    rows_per_second, controller.batch_size,
+                    controller.num_throttled)
+        if expiry_rate is not None:
+            logger.info("Items are expiring from %s at %.1f/sec",
+                        table, expiry_rate)
+        if not keeping_up:
+            logger.warning("Purging of %s is falling behind the rate at "
+                           "which items expire", table)
         # We use "is_incomplete" rather than "is_complete" in the code above
         # because we expect that, most of the time, the purge will complete.
         # So it's more efficient to flag the case when it doesn't.
         # But the caller really wants to know is_complete.
         return {
-            "num_purged": num_purged,
+            "num_purged": controller.num_purged,
             "is_complete": not is_incomplete,
+            "num_batches": controller.num_batches,
+            "num_throttled": controller.num_throttled,
+            "batch_size": controller.batch_size,
+            "rows_per_second": rows_per_second,
+            "expiry_rate": expiry_rate,
+            "keeping_up": keeping_up,
         }
 
-    def _maybe_optimize_table_before_purge(self, query, params={}):
+    def _maybe_optimize_table_before_purge(self, query, params={},
+                                           shard_server=None):
         """Run an `OPTIMIZE TABLE` if configured to do so before purge.
 
         Purging expired items involves doing a bunch of in-order deletes,
@@ -914,10 +1453,12 @@ class SQLStorage(SyncStorage):
         """
         if self._optimize_table_before_purge:
             if self.dbconnector.driver == "mysql":
-                with self._get_or_create_session() as session:
+                with self._get_or_create_session(shard_server=shard_server) \
+                        as session:
                     session.query(query, params)
 
-    def _maybe_optimize_table_after_purge(self, query, params={}):
+    def _maybe_optimize_table_after_purge(self, query, params={},
+                                          shard_server=None):
         """Run an `OPTIMIZE TABLE` if configured to do so after purge.
 
         Purging expired items involves doing a bunch of in-order deletes,
@@ -931,9 +1472,29 @@ class SQLStorage(SyncStorage):
         """
         if self._optimize_table_after_purge:
             if self.dbconnector.driver == "mysql":
-                with self._get_or_create_session() as session:
+                with self._get_or_create_session(shard_server=shard_server) \
+                        as session:
                     session.query(query, params)
 
+    def get_shard_distribution(self):
+        """Report how users are distributed across the shard servers.
+
+        This returns a list with an entry for each database server holding
+        per-user data, giving a password-free form of its URI, the BSO shards
+        that it holds, and the number of distinct users with data on it.
+        """
+        distribution = []
+        for server in self.dbconnector.get_shard_servers():
+            with self._get_or_create_session(shard_server=server) as session:
+                num_users = session.query_scalar("COUNT_USERS", default=0)
+            engine = self.dbconnector.get_shard_engine(server)
+            distribution.append({
+                "sqluri": repr(engine.url),
+                "shards": self.dbconnector.get_shards(server),
+                "num_users": num_users,
+            })
+        return distribution
+
     #
     # Private methods for manipulating collections.
     #
@@ -947,7 +1508,8 @@ class SQLStorage(SyncStorage):
         """
         # Grab it from the cache if we can.
         try:
-            return self._collections_by_name[collection]
+            return self._collections.get_id(
+                collection, self._collections_loader(session))
         except KeyError:
             pass
 
@@ -975,7 +1537,7 @@ class SQLStorage(SyncStorage):
         if self.standard_collections:
             assert collectionid >= FIRST_CUSTOM_COLLECTION_ID
 
-        self._cache_collection_id(collectionid, collection)
+        self._collections.set(collectionid, collection)
         return collectionid
 
     def _get_collection_name(self, session, collectionid):
@@ -985,7 +1547,8 @@ class SQLStorage(SyncStorage):
         will be raised.
         """
         try:
-            return self._collections_by_id[collectionid]
+            return self._collections.get_name(
+                collectionid, self._collections_loader(session))
         except KeyError:
             pass
 
@@ -994,7 +1557,7 @@ class SQLStorage(SyncStorage):
         })
         if collection is None:
             raise CollectionNotFoundError
-        self._cache_collection_id(collectionid, collection)
+        self._collections.set(collectionid, collection)
         return collection
 
     def _load_collection_names(self, session, collection_ids):
@@ -1010,11 +1573,12 @@ class SQLStorage(SyncStorage):
         """
         names = {}
         uncached_ids = []
+        loader = self._collections_loader(session)
         # Extract as many names as possible from the cache, and
         # build a list of any ids whose names are not cached.
         for id in collection_ids:
             try:
-                names[id] = self._collections_by_id[id]
+                names[id] = self._collections.get_name(id, loader)
             except KeyError:
                 uncached_ids.append(id)
         # Use a single query to fetch the names for all uncached collections.
@@ -1024,7 +1588,7 @@ class SQLStorage(SyncStorage):
             })
             for id, name in uncached_names:
                 names[id] = name
-                self._cache_collection_id(id, name)
+                self._collections.set(id, name)
         # Check that we actually got a name for each specified id.
         for id in collection_ids:
             if id not in names:
@@ -1044,15 +1608,23 @@ class SQLStorage(SyncStorage):
         names = self._load_collection_names(session, collection_ids)
         return dict([(names[id], value) for id, value in values])
 
-    def _cache_collection_id(self, collectionid, collection):
-        """Cache the given collection (id, name) pair for fast lookup."""
-        if len(self._collections_by_name) > MAX_COLLECTIONS_CACHE_SIZE:
-            msg = "More than %d collections have been created, "\
-                  "refusing to cache them all"
-            logger.warn(msg % (MAX_COLLECTIONS_CACHE_SIZE,))
-        else:
-            self._collections_by_name[collection] = collectionid
-            self._collections_by_id[collectionid] = collection
+    def _collections_loader(self, session):
+        """Get a callable to load all collections, for the shared snapshot."""
+        def load_all_collections():
+            return list(session.query_fetchall("ALL_COLLECTIONS"))
+        return load_all_collections
+
+
+class PurgeTask(namedtuple("PurgeTask", "table shard_server kind run")):
+    """A task that purges expired items from one table on one server."""
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        if self.shard_server is None:
+            return self.table
+        return "%s@%d" % (self.table, self.shard_server)
 
 
 class SQLStorageSession(object):
@@ -1067,9 +1639,15 @@ class SQLStorageSession(object):
 
     """
 
-    def __init__(self, storage, timestamp=None):
+    def __init__(self, storage, timestamp=None, connection=None,
+                 shard_server=None):
         self.storage = storage
-        self.connection = storage.dbconnector.connect()
+        if connection is None:
+            connection = storage.dbconnector.connect(shard_server=shard_server)
+        self.connection = connection
+        self.shard_connections = {}
+        if shard_server is not None:
+            self.shard_connections[shard_server] = self.connection
         self.timestamp = get_timestamp(timestamp)
         self.cache = defaultdict(SQLCachedCollectionData)
         self.locked_collections = {}
@@ -1085,35 +1663,68 @@ class SQLStorageSession(object):
         else:
             self.rollback()
 
+    def _get_connection(self, params):
+        """Get the connection to use for a query with the given params.
+
+        Queries about a specific user are sent to the shard server holding
+        that user's data, if there is one.  Everything else is sent to the
+        session's default connection.
+        """
+        dbconnector = self.storage.dbconnector
+        server = dbconnector.get_shard_server(params.get("userid"))
+        if server is None:
+            return self.connection
+        try:
+            return self.shard_connections[server]
+        except KeyError:
+            connection = dbconnector.connect(shard_server=server)
+            self.shard_connections[server] = connection
+            return connection
+
+    def _get_all_connections(self):
+        """Get all connections used by the session, default one first."""
+        connections = [self.connection]
+        for connection in self.shard_connections.itervalues():
+            if connection is not self.connection:
+                connections.append(connection)
+        return connections
+
+    def in_transaction(self, params={}):
+        """Check whether a query with the given params would join an
+        already-active database transaction."""
+        return self._get_connection(params).in_transaction
+
     @convert_db_errors
     def insert_or_update(self, table, items, defaults=None):
         """Do a bulk insert/update of the given items."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.insert_or_update(table, items, defaults)
+        connection = self._get_connection(items[0] if items else {})
+        return connection.insert_or_update(table, items, defaults)
 
     @convert_db_errors
     def query(self, query, params={}):
         """Execute a database query, returning the rowcount."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query(query, params)
+        return self._get_connection(params).query(query, params)
 
     @convert_db_errors
     def query_scalar(self, query, params={}, default=None):
         """Execute a database query, returning a single scalar value."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_scalar(query, params, default)
+        connection = self._get_connection(params)
+        return connection.query_scalar(query, params, default)
 
     @convert_db_errors
     def query_fetchone(self, query, params={}):
         """Execute a database query, returning the first result."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_fetchone(query, params)
+        return self._get_connection(params).query_fetchone(query, params)
 
     @convert_db_errors
     def query_fetchall(self, query, params={}):
         """Execute a database query, returning iterator over the results."""
         assert self._nesting_level > 0, "Session has not been started"
-        return self.connection.query_fetchall(query, params)
+        return self._get_connection(params).query_fetchall(query, params)
 
     def begin(self):
         """Enter the context of this session.
@@ -1132,15 +1743,25 @@ class SQLStorageSession(object):
         """Successfully exit the context of this session.
 
         Once each entered context has been exited, this method will commit
-        the underlying database transaction and close the connection.
+        the underlying database transaction and close the connection.  If
+        the session used several shard servers then the default connection
+        is committed first, so that collections are created before any data
+        that refers to them.
         """
         self._nesting_level -= 1
         assert self._nesting_level >= 0
         if self._nesting_level == 0:
+            connections = self._get_all_connections()
             try:
-                self.connection.commit()
+                while connections:
+                    connections[0].commit()
+                    connections.pop(0)
             finally:
-                del self.storage._tldata.session
+                try:
+                    for connection in connections:
+                        connection.rollback()
+                finally:
+                    del self.storage._tldata.session
             if self.locked_collections:
                 msg = "You must unlock all collections before ending a session"
                 raise RuntimeError(msg)
@@ -1156,7 +1777,8 @@ class SQLStorageSession(object):
         assert self._nesting_level >= 0
         if self._nesting_level == 0:
             try:
-                self.connection.rollback()
+                for connection in self._get_all_connections():
+                    connection.rollback()
             finally:
                 del self.storage._tldata.session
             if self.locked_collections:
@@ -15,27 +15,39 @@ backend.  It provides three database tables:
 For efficiency when dealing with large datasets, this module also supports
 sharding of the BSO items into multiple tables named "bso0" through "bsoN".
 This behaviour is off by default; pass shard=True to enable it.
+
+On MySQL and PostgreSQL, the batch upload tables can also be range-partitioned
+by the time at which each batch was created, so that expired batches can be
+purged by dropping whole partitions rather than deleting individual rows.
+This behaviour is off by default; pass partition_by_ttl=True to enable it.
 """
 
 import os
 import re
 import sys
 import copy
+import time
+import random
 import logging
+import sqlite3
 import urlparse
 import traceback
 import functools
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
 import sqlalchemy.event
 from sqlalchemy import create_engine
 from sqlalchemy.util.queue import Queue
 from sqlalchemy.pool import NullPool, QueuePool
-from sqlalchemy.sql import insert, update, text as sqltext
-from sqlalchemy.exc import DBAPIError, OperationalError, TimeoutError
+from sqlalchemy.sql import (insert, update, select, tuple_,
+                            text as sqltext)
+from sqlalchemy.exc import (DBAPIError, OperationalError, ProgrammingError,
+                            TimeoutError)
 from sqlalchemy import (Integer, String, Text, BigInteger,
                         MetaData, Column, Table, Index, SmallInteger)
 from sqlalchemy.dialects import postgresql, mysql
+from sqlalchemy.schema import CreateTable
 
 from mozsvc.metrics import metrics_timer, annotate_request
 from mozsvc.exceptions import BackendError
@@ -59,6 +71,41 @@ SAFE_TO_KILL_QUERY = re.compile(SAFE_TO_KILL_QUERY, re.I)
 # The ttl to use for rows that are never supposed to expire.
 MAX_TTL = 2100000000
 
+# Regex to find string interpolation variables in pre-built queries.
+QUERY_VARS_RE = re.compile(r"%\((bso|bui|ids)\)s")
+
+# Query parameters whose values change the structure of a query that is
+# built by a function, rather than just being bound into it.
+QUERY_SHAPE_PARAMS = ("fields", "sort", "force_consistent_sort_order")
+
+# Maximum number of rendered queries to cache in each DBConnector, beyond
+# which the least recently used ones are evicted.
+MAX_QUERY_CACHE_SIZE = 10000
+
+# Number of prepared statements to cache on each sqlite connection.
+# The rendered query cache means that we send a small set of identical
+# query strings, so the driver can re-use most of its prepared statements.
+SQLITE_CACHED_STATEMENTS = 500
+
+# SQLite supports the INSERT ... ON CONFLICT DO UPDATE syntax from 3.24.0.
+SQLITE_SUPPORTS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Maximum number of bind parameters to use in a single upsert query.
+# This is the default limit for SQLite versions before 3.32.0.
+MAX_UPSERT_PARAMS = 999
+
+# Default number of seconds of batch creation times to hold in each partition
+# of the batch tables, when they are partitioned by time.
+TTL_PARTITION_INTERVAL = 60 * 60
+
+# Default number of seconds ahead of the current time for which to create
+# partitions of the batch tables.
+TTL_PARTITIONS_AHEAD = 60 * 60 * 24
+
+# Regex to match the names of the time-range partitions of a table, which
+# end with the time at which their range ends.
+TTL_PARTITION_NAME_RE = re.compile(r"_?p(\d+)$")
+
 metadata = MetaData()
 
 
@@ -88,8 +135,11 @@ collections = Table(
 
 # Table mapping (user_id, collection_id) => collection-level metadata.
 #
-# This table holds collection-level metadata on a per-user basis.  Currently
-# the only such metadata is the last-modified timestamp of the collection.
+# This table holds collection-level metadata on a per-user basis.  This is
+# the last-modified timestamp of the collection and, if usage tracking is
+# enabled, the number of items in the collection and their total size.
+# The usage columns count every row physically present in the BSO table,
+# including expired items that have not yet been purged.
 
 user_collections = Table(
     "user_collections",
@@ -98,7 +148,27 @@ user_collections = Table(
            autoincrement=False),
     Column("collection", Integer, primary_key=True, nullable=False,
            autoincrement=False),
-    Column("last_modified", BigInteger, nullable=False)
+    Column("last_modified", BigInteger, nullable=False),
+    Column("item_count", Integer, nullable=False,
+           server_default=sqltext("0")),
+    Column("total_bytes", BigInteger, nullable=False,
+           server_default=sqltext("0"))
+)
+
+
+# Table mapping user_id => time until which to read from the primary db.
+#
+# This table is only used when there are read replicas.  Each write records
+# the time until which the user's reads must be sent to the primary db, so
+# that every process using the db sees it.  There's at most one row per
+# user, which is overwritten by each of their writes.
+
+replica_pins = Table(
+    "replica_pins",
+    metadata,
+    Column("userid", Integer, primary_key=True, nullable=False,
+           autoincrement=False),
+    Column("pinned_until", BigInteger, nullable=False)
 )
 
 
@@ -161,12 +231,27 @@ def _get_bso_columns(table_name):
         # Index on "modified" for easy filtering by timestamp.
         Index("%s_usr_col_mod_idx" % (table_name,),
               "userid", "collection", "modified"),
-        # There is intentinally no index on "sortindex".
+        # There is intentinally no index on "sortindex" by default.
         # Clients almost always filter on "modified" using the above index,
         # and cannot take advantage of a separate index for sorting.
+        # See get_sortindex_index() for an optional index to help paginate
+        # through large collections in sortindex order.
     )
 
 
+def get_sortindex_index(table):
+    """Get an Index object for sorting the given BSO table by sortindex.
+
+    This index lets queries that sort by sortindex, and paginate using
+    a (sortindex, id) bound, seek directly to the required position.
+    It's not part of the default table definition, but can be created by
+    passing create_sortindex_index=True along with create_tables=True.
+    """
+    return Index("%s_usr_col_sortidx_idx" % (table.name,),
+                 table.c.userid, table.c.collection,
+                 table.c.sortindex, table.c.id)
+
+
 #  If the storage controller is not doing sharding based on userid,
 #  then it will use the single "bso" table below for BSO storage.
 
@@ -313,17 +398,24 @@ class DBConnector(object):
     on top of the SQLAlchemy engine/connection machinery, with the following
     additional features:
 
-        * transparent sharding of BSO storage tables
+        * transparent sharding of BSO storage tables, optionally spread
+          across multiple database servers
         * use pre-defined queries rather than inline construction of SQL
+        * caching of the final rendered form of each query
         * accessor methods that automatically clean up database resources
         * automatic retry of connections that are invalidated by the server
+        * optional routing of read-only connections to read replicas
+        * optional partitioning of the batch tables by time
 
     """
 
     def __init__(self, sqluri, create_tables=False, pool_size=100,
                  no_pool=False, pool_recycle=60, reset_on_return=True,
                  pool_max_overflow=10, pool_max_backlog=-1, pool_timeout=30,
-                 shard=False, shardsize=100, **kwds):
+                 shard=False, shardsize=100, cache_queries=True,
+                 create_sortindex_index=False, replica_sqluris=None,
+                 shard_sqluris=None, partition_by_ttl=False,
+                 ttl_partition_interval=TTL_PARTITION_INTERVAL, **kwds):
 
         parsed_sqluri = urlparse.urlparse(sqluri)
         self.sqluri = sqluri
@@ -340,6 +432,13 @@ class DBConnector(object):
         self.shard = shard
         self.shardsize = shardsize
 
+        self.partition_by_ttl = partition_by_ttl
+        self.ttl_partition_interval = int(ttl_partition_interval)
+        if self.partition_by_ttl:
+            if self.driver not in ("mysql", "postgres"):
+                msg = "Partitioning by ttl requires MySQL or PostgreSQL"
+                raise ValueError(msg)
+
         # Construct the pooling-related arguments for SQLAlchemy engine.
         sqlkw = {}
         sqlkw["logging_name"] = "syncstorage"
@@ -361,6 +460,8 @@ class DBConnector(object):
             # connection objects between threads.
             if not no_pool:
                 sqlkw["connect_args"]["check_same_thread"] = False
+            sqlkw["connect_args"]["cached_statements"] = \
+                SQLITE_CACHED_STATEMENTS
             # If using a :memory: database, we must use a QueuePool of size
             # 1 so that a single connection is shared by all threads.
             if parsed_sqluri.path.lower() in ("/", "/:memory:"):
@@ -372,32 +473,63 @@ class DBConnector(object):
                 sqlkw["max_overflow"] = 0
 
         # Create the engine.
-        # We set the umask during this call, to ensure that any sqlite
-        # databases will be created with secure permissions by default.
-        old_umask = os.umask(0077)
-        try:
-            self.engine = create_engine(sqluri, **sqlkw)
-        finally:
-            os.umask(old_umask)
+        self.engine = self._create_engine(sqluri, sqlkw)
+
+        # Create an engine for each of the read replicas, if any.
+        # Each gets its own connection pool, with the same settings as that
+        # of the primary.  They must use the same driver as the primary,
+        # since they will be sent the same rendered queries.
+        if isinstance(replica_sqluris, basestring):
+            replica_sqluris = replica_sqluris.split()
+        self.replica_sqluris = list(replica_sqluris or ())
+        self.replica_engines = []
+        for replica_sqluri in self.replica_sqluris:
+            scheme = urlparse.urlparse(replica_sqluri).scheme.lower()
+            if scheme != parsed_sqluri.scheme.lower():
+                msg = "Read replicas must use the same db driver as primary"
+                raise ValueError(msg)
+            replica_engine = self._create_engine(replica_sqluri, sqlkw)
+            self.replica_engines.append(replica_engine)
+
+        # Create an engine for each of the shard servers, if any.
+        # Contiguous ranges of BSO shards are assigned to each server, which
+        # then holds all the per-user data for the users in those shards.
+        # The main database holds only the global table of collection names.
+        if isinstance(shard_sqluris, basestring):
+            shard_sqluris = shard_sqluris.split()
+        self.shard_sqluris = list(shard_sqluris or ())
+        self.shard_engines = []
+        if self.shard_sqluris:
+            if not self.shard:
+                msg = "You must enable sharding to use shard servers"
+                raise ValueError(msg)
+            if len(self.shard_sqluris) > self.shardsize:
+                msg = "You cannot have more shard servers than shards"
+                raise ValueError(msg)
+            if self.replica_sqluris:
+                msg = "You cannot use read replicas with shard servers"
+                raise ValueError(msg)
+        for shard_sqluri in self.shard_sqluris:
+            scheme = urlparse.urlparse(shard_sqluri).scheme.lower()
+            if scheme != parsed_sqluri.scheme.lower():
+                msg = "Shard servers must use the same db driver as primary"
+                raise ValueError(msg)
+            shard_engine = self._create_engine(shard_sqluri, sqlkw)
+            self.shard_engines.append(shard_engine)
 
         # Create the tables if necessary.
         if create_tables:
             collections.create(self.engine, checkfirst=True)
-            user_collections.create(self.engine, checkfirst=True)
-            batch_uploads.create(self.engine, checkfirst=True)
             # only create migration if "[storage]:allow_migration" flag
             # is set
             if kwds.get("allow_migration", False):
                 migration.create(self.engine, checkfirst=True)
-            if not self.shard:
-                bso.create(self.engine, checkfirst=True)
-                bui.create(self.engine, checkfirst=True)
-            else:
-                for idx in xrange(self.shardsize):
-                    bsoN = get_bso_table(idx)
-                    bsoN.create(self.engine, checkfirst=True)
-                    buiN = get_batch_item_table(idx)
-                    buiN.create(self.engine, checkfirst=True)
+            if self.replica_engines:
+                replica_pins.create(self.engine, checkfirst=True)
+            for server in self.get_shard_servers():
+                engine = self.get_shard_engine(server)
+                self._create_user_tables(engine, self.get_shards(server),
+                                         create_sortindex_index)
 
         # Load the pre-built queries to use with this database backend.
         # Currently we have a generic set of queries, and some queries specific
@@ -415,12 +547,31 @@ class DBConnector(object):
                 if nm.isupper():
                     self._prebuilt_queries[nm] = getattr(queries, nm)
 
+        # Pre-parse the string queries to find their interpolation variables,
+        # and prepare a cache for the final rendered form of each query.
+        self._query_vars = {}
+        for nm, query in self._prebuilt_queries.iteritems():
+            if isinstance(query, basestring):
+                qvars = frozenset(QUERY_VARS_RE.findall(query))
+                self._query_vars[nm] = qvars
+        self.cache_queries = cache_queries
+        self._query_cache = OrderedDict()
+        self._annotated_query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+
         # Constuct a Dialect object to use for rendering query objects.
         # This forces rendering of bindparams using the "named" style,
         # so that the resulting string is compatible with sqltext().
         self._render_query_dialect = copy.copy(self.engine.dialect)
         self._render_query_dialect.paramstyle = "named"
 
+        # New partitioned tables need some partitions to write into.
+        if create_tables and self.partition_by_ttl:
+            until = int(time.time()) + TTL_PARTITIONS_AHEAD
+            for server in self.get_shard_servers():
+                for table in self.get_partitioned_tables():
+                    self.create_ttl_partitions(table, until, server)
+
         # PyMySQL Connection objects hold a reference to their most recent
         # Result object, which can cause large datasets to remain in memory.
         # Explicitly clear it when returning a connection to the pool.
@@ -430,18 +581,282 @@ class DBConnector(object):
                 if conn:
                     conn._result = None
 
-            sqlalchemy.event.listen(self.engine.pool, "checkin",
-                                    clear_result_on_pool_checkin)
+            for engine in [self.engine] + self.replica_engines:
+                sqlalchemy.event.listen(engine.pool, "checkin",
+                                        clear_result_on_pool_checkin)
+
+    def _create_engine(self, sqluri, sqlkw):
+        """Create an SQLAlchemy engine for the given database URI."""
+        # We set the umask during this call, to ensure that any sqlite
+        # databases will be created with secure permissions by default.
+        old_umask = os.umask(0077)
+        try:
+            return create_engine(sqluri, **sqlkw)
+        finally:
+            os.umask(old_umask)
+
+    def _create_user_tables(self, engine, shards, create_sortindex_index):
+        """Create the tables holding per-user data in the given database.
+
+        Only the given BSO shards are created, but all batch_upload_items
+        shards are needed since they're selected by batchid, not userid.
+        """
+        user_collections.create(engine, checkfirst=True)
+        self._create_batch_table(engine, batch_uploads)
+        if not self.shard:
+            bso.create(engine, checkfirst=True)
+            self._create_batch_table(engine, bui)
+            if create_sortindex_index:
+                self._create_sortindex_index(engine, bso)
+        else:
+            for idx in xrange(self.shardsize):
+                if idx in shards:
+                    bsoN = get_bso_table(idx)
+                    bsoN.create(engine, checkfirst=True)
+                    if create_sortindex_index:
+                        self._create_sortindex_index(engine, bsoN)
+                buiN = get_batch_item_table(idx)
+                self._create_batch_table(engine, buiN)
+
+    def _create_batch_table(self, engine, table):
+        """Create one of the batch tables, partitioned by time if enabled.
+
+        The batch tables are keyed by millisecond batch id, so they can be
+        range-partitioned on that column.  Each table starts out with just a
+        catch-all partition for batches beyond the last range, and ranges
+        are then added by create_ttl_partitions().
+        """
+        if not self.partition_by_ttl:
+            table.create(engine, checkfirst=True)
+            return
+        if engine.has_table(table.name):
+            return
+        ddl = str(CreateTable(table).compile(dialect=engine.dialect)).strip()
+        with engine.begin() as connection:
+            if self.driver == "mysql":
+                connection.execute(ddl + " PARTITION BY RANGE (batch) ("
+                                   "PARTITION pmax VALUES LESS THAN MAXVALUE)")
+            else:
+                connection.execute(ddl + " PARTITION BY RANGE (batch)")
+                connection.execute("CREATE TABLE %s_pdefault PARTITION OF %s "
+                                   "DEFAULT" % (table.name, table.name))
+
+    def _create_sortindex_index(self, engine, table):
+        """Create the optional sortindex index on a BSO table."""
+        index = get_sortindex_index(table)
+        try:
+            index.create(engine)
+        except (OperationalError, ProgrammingError), e:
+            # Not every database supports "CREATE INDEX IF NOT EXISTS",
+            # so we assume that any error means that it already exists.
+            logger.debug("Not creating index %s: %s", index.name, e)
+        finally:
+            # Don't leave it attached to the shared Table object, since
+            # that would cause it to be created along with the table.
+            table.indexes.discard(index)
+
+    def connect(self, replica=False, shard_server=None):
+        """Create a new DBConnection object from this connector.
+
+        If replica is true and there are read replicas configured, then the
+        connection will be made to one of them chosen at random.  Callers
+        must not use such a connection for anything that writes to the db.
 
-    def connect(self, *args, **kwds):
-        """Create a new DBConnection object from this connector."""
+        If shard_server is given then the connection will be made to that
+        shard server, rather than to the main database.
+        """
+        if shard_server is not None:
+            return DBConnection(self, shard_server=shard_server)
+        if replica and self.replica_engines:
+            index = random.randrange(len(self.replica_engines))
+            return DBConnection(self, index)
         return DBConnection(self)
 
+    def get_replication_lag(self):
+        """Get the replication lag of the most-lagged read replica.
+
+        This returns the lag in seconds, or None if there are no read
+        replicas or their lag can't be determined.
+        """
+        max_lag = None
+        for replica in xrange(len(self.replica_engines)):
+            with DBConnection(self, replica) as connection:
+                row = connection.query_fetchone("REPLICATION_LAG")
+            if row is None:
+                continue
+            if self.driver == "mysql":
+                lag = row["Seconds_Behind_Master"]
+            else:
+                lag = row[0]
+            if lag is not None:
+                max_lag = max(max_lag, float(lag))
+        return max_lag
+
+    #
+    # Management of time-range partitions of the batch tables.
+    #
+    # Each partition holds the batches created during one interval of
+    # ttl_partition_interval seconds, and is named for the time at which
+    # that interval ends.  On MySQL the partitions are named "p<time>" and
+    # a catch-all "pmax" holds anything beyond the last one.  On PostgreSQL
+    # they are separate tables named "<table>_p<time>", with a catch-all
+    # "<table>_pdefault" default partition.
+    #
+
+    def get_partitioned_tables(self):
+        """Get the names of the tables that are partitioned by time.
+
+        Every shard server has its own copy of each of these tables.
+        """
+        if not self.partition_by_ttl:
+            return []
+        tables = [batch_uploads.name]
+        if not self.shard:
+            tables.append(bui.name)
+        else:
+            tables.extend(get_batch_item_table(idx).name
+                          for idx in xrange(self.shardsize))
+        return tables
+
+    def get_ttl_partitions(self, table, shard_server=None):
+        """Get the time-range partitions of the given table.
+
+        This returns a sorted list of (end time, approximate row count)
+        tuples, one for each partition other than the catch-all partition.
+        """
+        partitions = []
+        with self.connect(shard_server=shard_server) as connection:
+            rows = connection.query_fetchall("LIST_TTL_PARTITIONS", {
+                "table": table,
+            })
+            for name, num_rows in rows:
+                match = TTL_PARTITION_NAME_RE.search(name)
+                if match is not None:
+                    num_rows = max(int(num_rows or 0), 0)
+                    partitions.append((int(match.group(1)), num_rows))
+        partitions.sort()
+        return partitions
+
+    def create_ttl_partitions(self, table, until, shard_server=None):
+        """Create partitions of the given table covering times up to until.
+
+        New partitions are only ever added after the last existing one, and
+        the first partition of a table also covers all earlier times.  This
+        returns the list of end times of the newly-created partitions.
+        """
+        interval = self.ttl_partition_interval
+        partitions = self.get_ttl_partitions(table, shard_server)
+        if partitions:
+            start = partitions[-1][0]
+        else:
+            start = int(time.time()) // interval * interval
+        ends = range(start + interval, until + interval, interval)
+        if not ends:
+            return []
+        if self.driver == "mysql":
+            ddl = ["ALTER TABLE %s REORGANIZE PARTITION pmax INTO (" % table]
+            for end in ends:
+                ddl.append("PARTITION p%d VALUES LESS THAN (%d), "
+                           % (end, end * 1000))
+            ddl.append("PARTITION pmax VALUES LESS THAN MAXVALUE)")
+            ddls = ["".join(ddl)]
+        else:
+            # PostgreSQL refuses to create a partition whose range overlaps
+            # rows in the default partition, e.g. batches written after the
+            # last partition was dropped.  So we detach the default partition
+            # while creating the new ones, move any such rows across, and
+            # then re-attach it, all in a single transaction.
+            default = "%s_pdefault" % (table,)
+            ddls = ["ALTER TABLE %s DETACH PARTITION %s" % (table, default)]
+            lower = "%d" % (start * 1000,) if partitions else "MINVALUE"
+            for end in ends:
+                ddls.append("CREATE TABLE %s_p%d PARTITION OF %s "
+                            "FOR VALUES FROM (%s) TO (%d)"
+                            % (table, end, table, lower, end * 1000))
+                lower = "%d" % (end * 1000,)
+            moved = "batch < %d" % (ends[-1] * 1000,)
+            if partitions:
+                moved += " AND batch >= %d" % (start * 1000,)
+            ddls.append("INSERT INTO %s SELECT * FROM %s WHERE %s"
+                        % (table, default, moved))
+            ddls.append("DELETE FROM %s WHERE %s" % (default, moved))
+            ddls.append("ALTER TABLE %s ATTACH PARTITION %s DEFAULT"
+                        % (table, default))
+        with self.connect(shard_server=shard_server) as connection:
+            for ddl in ddls:
+                connection.execute(ddl, annotations={
+                    "queryName": "CREATE_TTL_PARTITIONS",
+                })
+        logger.info("Created %d partitions of %s, up to %d",
+                    len(ends), table, ends[-1])
+        return ends
+
+    def drop_ttl_partitions(self, table, before, shard_server=None):
+        """Drop partitions of the given table whose range ends by before.
+
+        This returns a list of (end time, approximate row count) tuples for
+        the dropped partitions.
+        """
+        partitions = [(end, num_rows) for end, num_rows
+                      in self.get_ttl_partitions(table, shard_server)
+                      if end <= before]
+        if not partitions:
+            return []
+        if self.driver == "mysql":
+            ddls = ["ALTER TABLE %s DROP PARTITION %s" % (
+                table, ", ".join("p%d" % (end,) for end, _ in partitions))]
+        else:
+            ddls = ["DROP TABLE %s_p%d" % (table, end)
+                    for end, _ in partitions]
+        with self.connect(shard_server=shard_server) as connection:
+            for ddl in ddls:
+                connection.execute(ddl, annotations={
+                    "queryName": "DROP_TTL_PARTITIONS",
+                })
+        return partitions
+
+    def get_shard_servers(self):
+        """Get the list of servers holding per-user data.
+
+        This will be a list of indexes into the configured shard servers,
+        or [None] if all data is held in the main database.
+        """
+        if not self.shard_engines:
+            return [None]
+        return range(len(self.shard_engines))
+
+    def get_shard_server(self, userid):
+        """Get the shard server holding data for the given userid.
+
+        This returns None if there are no shard servers configured, in which
+        case the user's data is held in the main database.
+        """
+        if not self.shard_engines or userid is None:
+            return None
+        shard = userid % self.shardsize
+        return shard * len(self.shard_engines) // self.shardsize
+
+    def get_shard_engine(self, shard_server):
+        """Get the engine for the given shard server."""
+        if shard_server is None:
+            return self.engine
+        return self.shard_engines[shard_server]
+
+    def get_shards(self, shard_server):
+        """Get the indexes of the BSO shards held on the given server."""
+        if not self.shard:
+            return []
+        return [idx for idx in xrange(self.shardsize)
+                if self.get_shard_server(idx) == shard_server]
+
     def get_query(self, name, params):
         """Get the named pre-built query.
 
-        This method returns an SQLAlchemy query object for the named query,
-        after performing some sharding based on the given parameters.
+        This method returns the string form of the named query, after
+        performing some sharding based on the given parameters.  The result
+        is cached so that the work is only done once for each distinct shape
+        of query.  Any extra bind parameters needed by the query will be
+        added into the params dict.
         """
         # Get the pre-built query with that name.
         # It might be None, a string query, or a callable returning the query.
@@ -452,34 +867,96 @@ class DBConnector(object):
         # If it's None then just return it, indicating a no-op.
         if query is None:
             return None
-        # If it's a callable, call it with the sharded bso table.
+        # Work out everything that goes into producing the final query.
         if callable(query):
             bso = self.get_bso_table(params.get("userid"))
-            return query(bso, params)
-        # If it's a string, do some interpolation and return it.
-        # XXX TODO: we could pre-parse these queries at load time to look for
-        # string interpolation variables, saving some time on each call.
-        assert isinstance(query, basestring)
-        qvars = {}
-        if "%(bso)s" in query:
-            if "bso" in params:
-                qvars["bso"] = params["bso"]
-            else:
-                qvars["bso"] = self.get_bso_table(params["userid"])
-        if "%(bui)s" in query:
-            if "bui" in params:
-                qvars["bui"] = params["bui"]
-            else:
-                qvars["bui"] = self.get_batch_item_table(params["batch"])
-        if "%(ids)s" in query:
-            bindparams = []
+            shape = frozenset((k, v is None) for k, v in params.iteritems())
+            shape_values = tuple(self._get_shape_value(params.get(k))
+                                 for k in QUERY_SHAPE_PARAMS)
+            num_ids = len(params["ids"]) if "ids" in params else None
+            cache_key = (name, bso.name, shape, shape_values, num_ids)
+            expand_ids = num_ids is not None
+        else:
+            qvars = {}
+            qvars_needed = self._query_vars[name]
+            if "bso" in qvars_needed:
+                if "bso" in params:
+                    qvars["bso"] = params["bso"]
+                else:
+                    qvars["bso"] = self.get_bso_table(params["userid"])
+            if "bui" in qvars_needed:
+                if "bui" in params:
+                    qvars["bui"] = params["bui"]
+                else:
+                    qvars["bui"] = self.get_batch_item_table(params["batch"])
+            if "ids" in qvars_needed:
+                qvars["ids"] = len(params["ids"])
+            cache_key = (name, str(qvars.get("bso")), str(qvars.get("bui")),
+                         qvars.get("ids"))
+            expand_ids = "ids" in qvars
+        # The individual ids are always passed as separate bindparams.
+        if expand_ids:
             for i, id in enumerate(params["ids"]):
                 params["id%d" % (i,)] = id
-                bindparams.append(":id%d" % (i,))
-            qvars["ids"] = "(" + ",".join(bindparams) + ")"
-        if qvars:
-            query = query % qvars
-        return query
+        # Use the cached form of the query if we have one.
+        cached = self._get_cached_query(self._query_cache, cache_key)
+        if cached is not None:
+            query_str, default_params = cached
+        else:
+            if callable(query):
+                query = query(bso, params)
+                query_str, default_params = self._compile_query(query)
+            else:
+                if "ids" in qvars:
+                    bindparams = (":id%d" % (i,) for i in xrange(qvars["ids"]))
+                    qvars["ids"] = "(" + ",".join(bindparams) + ")"
+                if qvars:
+                    query = query % qvars
+                query_str, default_params = query, {}
+            self._cache_query(self._query_cache, cache_key,
+                              (query_str, default_params))
+        for param, value in default_params.iteritems():
+            params.setdefault(param, value)
+        return query_str
+
+    def _get_shape_value(self, value):
+        """Get a hashable version of a param value that affects query shape."""
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
+    def _compile_query(self, query):
+        """Compile an SQLAlchemy query object into its string form.
+
+        This returns the query string along with a dict of any parameter
+        values that were bound into the query object itself.
+        """
+        compiled = query.compile(dialect=self._render_query_dialect)
+        default_params = {}
+        for param, value in compiled.params.iteritems():
+            if value is not None:
+                default_params[param] = value
+        return str(compiled), default_params
+
+    def _get_cached_query(self, cache, key):
+        """Get a rendered query from the cache, or None if it's not there."""
+        with self._query_cache_lock:
+            try:
+                value = cache.pop(key)
+            except KeyError:
+                return None
+            # Re-insert it to mark it as most recently used.
+            cache[key] = value
+            return value
+
+    def _cache_query(self, cache, key, value):
+        """Cache the given rendered query, evicting the least recently used."""
+        if not self.cache_queries:
+            return
+        with self._query_cache_lock:
+            cache[key] = value
+            while len(cache) > MAX_QUERY_CACHE_SIZE:
+                cache.popitem(last=False)
 
     def get_bso_table(self, userid):
         """Get the BSO table object for the given userid."""
@@ -558,7 +1035,7 @@ def report_backend_errors(func):
         try:
             return func(self, *args, **kwds)
         except Exception, exc:
-            if not is_operational_db_error(self._connector.engine, exc):
+            if not is_operational_db_error(self._engine, exc):
                 raise
             # An unexpected database-level error.
             # Log the error, then normalize it into a BackendError instance.
@@ -583,12 +1060,23 @@ class DBConnection(object):
     transaction.  The transaction is opened the first time a query is
     executed and is closed by calling either the commit() or rollback()
     method.
+
+    If the connection is to one of the connector's read replicas, then the
+    index of that replica is available as the "replica" attribute.  It will
+    be None for connections to the primary database.  Likewise for the index
+    of the shard server in the "shard_server" attribute.
     """
 
-    def __init__(self, connector):
+    def __init__(self, connector, replica=None, shard_server=None):
         self._connector = connector
         self._connection = None
         self._transaction = None
+        self.replica = replica
+        self.shard_server = shard_server
+        if replica is not None:
+            self._engine = connector.replica_engines[replica]
+        else:
+            self._engine = connector.get_shard_engine(shard_server)
 
     def __enter__(self):
         return self
@@ -599,6 +1087,11 @@ class DBConnection(object):
         else:
             self.rollback()
 
+    @property
+    def in_transaction(self):
+        """Whether a transaction has been started on this connection."""
+        return self._transaction is not None
+
     @report_backend_errors
     def commit(self):
         """Commit the active transaction and close the connection."""
@@ -641,7 +1134,7 @@ class DBConnection(object):
         connection = self._connection
         session_was_active = True
         if connection is None:
-            connection = self._connector.engine.connect()
+            connection = self._engine.connect()
             transaction = connection.begin()
             session_was_active = False
         try:
@@ -654,7 +1147,7 @@ class DBConnection(object):
                 query_str = self._render_query(query, params, annotations)
                 return self._exec_with_cleanup(connection, query_str, **params)
             except DBAPIError, exc:
-                if not is_retryable_db_error(self._connector.engine, exc):
+                if not is_retryable_db_error(self._engine, exc):
                     raise
                 if session_was_active:
                     raise
@@ -662,7 +1155,7 @@ class DBConnection(object):
                 if not exc.connection_invalidated:
                     transaction.rollback()
                     connection.close()
-                connection = self._connector.engine.connect()
+                connection = self._engine.connect()
                 transaction = connection.begin()
                 annotations["retry"] = "1"
                 query_str = self._render_query(query, params, annotations)
@@ -684,7 +1177,12 @@ class DBConnection(object):
 
         The cleanup currently works only for the PyMySQL driver.  Other
         drivers will still execute fine, they just won't get the cleanup.
+
+        Queries sent to a read replica also have their execution time
+        recorded in a per-replica metric, so that lagging or overloaded
+        replicas can be identified.
         """
+        start = time.time()
         try:
             return connection.execute(sqltext(query_str), **params)
         except Exception:
@@ -711,7 +1209,7 @@ class DBConnection(object):
                 # Use a freshly-created connection so that we don't block
                 # waiting for something from the pool.  Unfortunately this
                 # requires use of a private API and raw cursor access.
-                cleanup_conn = self._connector.engine.pool._create_connection()
+                cleanup_conn = self._engine.pool._create_connection()
                 try:
                     cleanup_cursor = cleanup_conn.connection.cursor()
                     try:
@@ -733,23 +1231,39 @@ class DBConnection(object):
                 finally:
                     # Always re-raise the original error.
                     raise exc, val, tb
+        finally:
+            if self.replica is not None:
+                metric = "syncstorage.storage.sql.replica%d.execute"
+                metric = metric % (self.replica,)
+                annotate_request(None, metric, time.time() - start)
 
     def _render_query(self, query, params, annotations):
         """Render a query into its final string form, to send to database.
 
         This method does any final tweaks to the string form of the query
         immediately before it is sent to the database.  Currently its only
-        job is to add annotations in a comment on the query.
+        job is to add annotations in a comment on the query.  The result is
+        cached for string queries, since they are re-used many times.
         """
         # Convert SQLAlchemy expression objects into a string.
+        # These are built with inline values and so can't be cached.
         if isinstance(query, basestring):
             query_str = query
+            cache_key = None
+            if annotations:
+                cache_key = (query_str, tuple(sorted(annotations.items())))
+                connector = self._connector
+                cached = connector._get_cached_query(
+                    connector._annotated_query_cache, cache_key)
+                if cached is not None:
+                    return cached
         else:
             dialect = self._connector._render_query_dialect
             compiled = query.compile(dialect=dialect)
             for param, value in compiled.params.iteritems():
                 params.setdefault(param, value)
             query_str = str(compiled)
+            cache_key = None
         # Join all the annotations into a comment string.
         if annotations:
             annotation_items = sorted(annotations.items())
@@ -761,6 +1275,10 @@ class DBConnection(object):
                 query_str = query_str + " " + comment
             else:
                 query_str = comment + " " + query_str
+            if cache_key is not None:
+                connector = self._connector
+                connector._cache_query(connector._annotated_query_cache,
+                                       cache_key, query_str)
         return query_str
 
     def query(self, query_name, params=None, annotations=None):
@@ -834,7 +1352,8 @@ class DBConnection(object):
         For generic database backends, the best we can do is try each insert,
         catch any IntegrityErrors and retry as an update.  For MySQL however
         we can use the "ON DUPLICATE KEY UPDATE" syntax to do the operation
-        in a single query.
+        in a single query, and for PostgreSQL and SQLite we can use the
+        similar "ON CONFLICT DO UPDATE" syntax.
 
         The number of newly-inserted rows is returned.
         """
@@ -858,9 +1377,14 @@ class DBConnection(object):
         else:
             table = metadata.tables[table]
         # Dispatch to an appropriate implementation.
-        if self._connector.driver == "mysql":
+        driver = self._connector.driver
+        if driver == "mysql":
             return self._upsert_onduplicatekey(table, items, defaults,
                                                annotations)
+        elif driver == "postgres" or \
+                (driver == "sqlite" and SQLITE_SUPPORTS_UPSERT):
+            return self._upsert_onconflict(table, items, defaults,
+                                           annotations)
         else:
             return self._upsert_generic(table, items, defaults, annotations)
 
@@ -969,3 +1493,137 @@ class DBConnection(object):
             finally:
                 res.close()
         return num_created
+
+    def _upsert_onconflict(self, table, items, defaults, annotations):
+        """Upsert a batch of items using the ON CONFLICT DO UPDATE syntax.
+
+        This is a custom batch upsert implementation for PostgreSQL and
+        SQLite.  The resulting query will be something like the following,
+        where M is the number of fields in each item, N is the number of items
+        being inserted and p1 through pK are the primary key columns:
+
+            INSERT INTO table (c1, ..., cM)
+            VALUES (:c10, ..., :cM0), ..., (:c1N, ... :cMN)
+            ON CONFLICT (p1, ..., pK)
+            DO UPDATE SET c1 = excluded.c1, ..., cM = excluded.cM
+
+        Unlike MySQL, these databases do not report how many of the rows were
+        updated rather than inserted.  For PostgreSQL we return a flag from
+        each inserted row to find out, and for SQLite we look for existing
+        rows before doing the upsert.
+        """
+        userid = items[0].get("userid")
+        pk_fields = [key.name for key in table.primary_key]
+        for item in items:
+            assert item.get("userid") == userid
+            for field in pk_fields:
+                if field not in item:
+                    msg = "Item is missing primary key column %r"
+                    raise ValueError(msg % (field,))
+        returning = self._connector.driver == "postgres"
+        if not returning:
+            existing = self._find_existing_keys(table, pk_fields, items,
+                                                annotations)
+        # Group the items to be inserted into batches that all have the same
+        # set of fields, and so can be sent as a single query.  PostgreSQL
+        # refuses to update the same row twice in a single query, so start
+        # a new batch if the same item appears again.  We also need to keep
+        # each query within the database's limit on bind parameters.
+        batches = []
+        current_batches = {}
+        for item in items:
+            fields = frozenset(item.iterkeys())
+            key = tuple(item[field] for field in pk_fields)
+            batch = current_batches.get(fields)
+            if batch is None or key in batch["keys"] or \
+                    len(batch["items"]) >= batch["max_items"]:
+                num_fields = len(fields.union(defaults or ()))
+                batch = {
+                    "items": [],
+                    "keys": set(),
+                    "max_items": max(1, MAX_UPSERT_PARAMS // num_fields),
+                }
+                current_batches[fields] = batch
+                batches.append(batch["items"])
+            batch["items"].append(item)
+            batch["keys"].add(key)
+        # Now construct and send an appropriate query for each batch.
+        num_created = 0
+        for batch in batches:
+            # Since we're crafting SQL by hand, assert that each field is
+            # actually a plain alphanum field name.  Can't be too careful...
+            update_fields = [f for f in batch[0] if f not in pk_fields]
+            insert_fields = batch[0].keys()
+            if defaults is not None:
+                for field in defaults:
+                    if field not in batch[0]:
+                        insert_fields.append(field)
+            assert all(SAFE_FIELD_NAME_RE.match(f) for f in pk_fields)
+            assert all(SAFE_FIELD_NAME_RE.match(f) for f in insert_fields)
+            # Each item corresponds to a set of bindparams and a matching
+            # entry in the "VALUES" clause of the query.
+            query = "INSERT INTO %s (%s) VALUES "\
+                    % (table.name, ",".join(insert_fields))
+            binds = [":%s%%(num)d" % field for field in insert_fields]
+            pattern = "(%s) " % ",".join(binds)
+            params = {}
+            vclauses = []
+            for num, item in enumerate(batch):
+                vclauses.append(pattern % {"num": num})
+                for field in insert_fields:
+                    try:
+                        value = item[field]
+                    except KeyError:
+                        value = defaults[field]
+                    params["%s%d" % (field, num)] = value
+            query += ",".join(vclauses)
+            # The ON CONFLICT clause updates all the given fields.
+            query += " ON CONFLICT (%s)" % (",".join(pk_fields),)
+            if update_fields:
+                updates = ["%s = excluded.%s" % (f, f) for f in update_fields]
+                query += " DO UPDATE SET " + ",".join(updates)
+            else:
+                query += " DO NOTHING"
+            # PostgreSQL can tell us which rows were newly inserted, since
+            # they won't have an "xmax" transaction id from a previous write.
+            if returning:
+                query += " RETURNING (xmax = 0)"
+            # Now we can execute it as one big query.
+            res = self.execute(query, params, annotations)
+            try:
+                if returning:
+                    num_created += sum(1 for row in res if row[0])
+            finally:
+                res.close()
+        # For SQLite, count the items whose keys did not previously exist.
+        if not returning:
+            for item in items:
+                key = tuple(item[field] for field in pk_fields)
+                if key not in existing:
+                    existing.add(key)
+                    num_created += 1
+        return num_created
+
+    def _find_existing_keys(self, table, pk_fields, items, annotations):
+        """Find which of the given items already exist in the table.
+
+        This returns a set containing the primary key values of each of the
+        given items that already has a corresponding row in the table.
+        """
+        annotations = annotations.copy()
+        annotations["queryName"] = annotations["queryName"] + "_EXISTING"
+        pk_columns = [table.c[field] for field in pk_fields]
+        keys = list(set(tuple(item[f] for f in pk_fields) for item in items))
+        existing = set()
+        chunk_size = MAX_UPSERT_PARAMS // len(pk_fields)
+        for i in xrange(0, len(keys), chunk_size):
+            query = select(pk_columns)
+            chunk = keys[i:i + chunk_size]
+            query = query.where(tuple_(*pk_columns).in_(chunk))
+            res = self.execute(query, {}, annotations)
+            try:
+                for row in res:
+                    existing.add(tuple(row))
+            finally:
+                res.close()
+        return existing
@@ -15,9 +15,17 @@ string interpolation variables with special meaning:
     * %(bui)s:   insert the name of the user's sharded batch_upload_items table
     * %(ids)s:   insert a list of items matching the "ids" query parameter.
 
+The rendered form of each query is cached by the query loader.  Functions
+are called only once for each distinct "shape" of query parameters, meaning
+which parameters are given and whether they are None, the number of "ids",
+and the values of "fields", "sort" and "force_consistent_sort_order".  Any
+other values must be referred to using bindparams so that the cached query
+can be re-used.  The list of "ids" is made available as individual bindparams
+named "id0" to "idN".
+
 """
 
-from sqlalchemy.sql import select, bindparam
+from sqlalchemy.sql import select, bindparam, and_, or_
 
 # Queries operating on all collections in the storage.
 
@@ -38,16 +46,32 @@ COLLECTIONS_SIZES = "SELECT collection, SUM(payload_size) FROM %(bso)s "\
                     "WHERE userid=:userid AND ttl>:ttl "\
                     "GROUP BY collection"
 
+# When usage tracking is enabled, the per-collection counts and sizes are
+# read from user_collections rather than aggregated over the BSO table.
+
+TRACKED_COLLECTIONS_USAGE = "SELECT collection, item_count, total_bytes "\
+                            "FROM user_collections WHERE userid=:userid "\
+                            "AND item_count>0"
+
 DELETE_ALL_BSOS = "DELETE FROM %(bso)s WHERE userid=:userid"
 
 DELETE_ALL_COLLECTIONS = "DELETE FROM user_collections WHERE userid=:userid"
 
+PRIMARY_PIN = "SELECT pinned_until FROM replica_pins WHERE userid=:userid"
+
 # Queries for locking/unlocking a collection.
 
 BEGIN_TRANSACTION_READ = None
 
 BEGIN_TRANSACTION_WRITE = None
 
+# This applies to the next transaction, which is explicitly started
+# so that its snapshot is established immediately.
+SET_TRANSACTION_SNAPSHOT = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, "\
+                           "READ ONLY"
+
+BEGIN_TRANSACTION_SNAPSHOT = "START TRANSACTION WITH CONSISTENT SNAPSHOT"
+
 LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid "\
                        "LOCK IN SHARE MODE"
@@ -67,6 +91,8 @@ COLLECTION_NAME = "SELECT name FROM collections "\
 COLLECTION_NAMES = "SELECT collectionid, name FROM collections "\
                    "WHERE collectionid IN %(ids)s"
 
+ALL_COLLECTIONS = "SELECT collectionid, name FROM collections"
+
 # This adds a dummy collection at (:id - 1) so the next autoincr value is :id.
 SET_MIN_COLLECTION_ID = "INSERT INTO collections (collectionid, name) "\
                         "VALUES (:collectionid - 1, \"\")"
@@ -81,6 +107,18 @@ INIT_COLLECTION = "INSERT INTO user_collections "\
 TOUCH_COLLECTION = "UPDATE user_collections SET last_modified=:modified "\
                    "WHERE userid=:userid AND collection=:collectionid"
 
+INIT_COLLECTION_USAGE = "INSERT INTO user_collections "\
+                        "(userid, collection, last_modified, "\
+                        "item_count, total_bytes) "\
+                        "VALUES (:userid, :collectionid, :modified, "\
+                        ":count_delta, :size_delta)"
+
+TOUCH_COLLECTION_USAGE = "UPDATE user_collections SET "\
+                         "last_modified=:modified, "\
+                         "item_count=item_count + :count_delta, "\
+                         "total_bytes=total_bytes + :size_delta "\
+                         "WHERE userid=:userid AND collection=:collectionid"
+
 COLLECTION_TIMESTAMP = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid"
 
@@ -93,6 +131,29 @@ DELETE_COLLECTION = "DELETE FROM user_collections WHERE userid=:userid "\
 DELETE_ITEMS = "DELETE FROM %(bso)s WHERE userid=:userid "\
                "AND collection=:collectionid AND id IN %(ids)s"
 
+# Queries for calculating changes in usage when usage tracking is enabled.
+# Note that these deliberately include expired items, since the usage
+# counters reflect all the rows actually present in the BSO table.
+
+ITEMS_USAGE = "SELECT id, payload_size FROM %(bso)s WHERE userid=:userid "\
+              "AND collection=:collectionid AND id IN %(ids)s"
+
+BATCH_ITEMS_USAGE = """
+    SELECT
+        %(bui)s.id,
+        %(bui)s.payload_size,
+        existing.payload_size
+    FROM %(bui)s
+    LEFT OUTER JOIN %(bso)s AS existing
+    ON
+        existing.userid = %(bui)s.userid AND
+        existing.collection = :collection AND
+        existing.id = %(bui)s.id
+    WHERE
+        %(bui)s.batch = :batch AND
+        %(bui)s.userid = :userid
+"""
+
 CREATE_BATCH = "INSERT INTO batch_uploads (batch, userid, collection) "\
                      "VALUES (:batch, :userid, :collection)"
 
@@ -198,13 +259,22 @@ MIGRATION_CHECK = """
     LIMIT 1
 """
 
+# Query for reporting how many users have data stored in a database.
+# This is used to monitor the distribution of users across shard servers.
+
+COUNT_USERS = "SELECT COUNT(DISTINCT userid) FROM user_collections"
+
 
-def FIND_ITEMS(bso, params):
+def FIND_ITEMS(bso, params, sortindex_nulls_first=False):
     """Item search query.
 
     Unlike all the other pre-built queries, this one really can't be written
     as a simple string.  We need to include/exclude various WHERE clauses
     based on the values provided at runtime.
+
+    When sorting by sortindex, items with a NULL sortindex may come either
+    first or last depending on the database.  Pass sortindex_nulls_first=True
+    for databases that sort them first, so that pagination works correctly.
     """
     fields = params.get("fields", None)
     if fields is None:
@@ -215,8 +285,9 @@ def FIND_ITEMS(bso, params):
     query = query.where(bso.c.collection == bindparam("collectionid"))
     # Filter by the various query parameters.
     if "ids" in params:
-        # Sadly, we can't use a bindparam in an "IN" expression.
-        query = query.where(bso.c.id.in_(params.get("ids")))
+        # Sadly, we can't use a single bindparam in an "IN" expression.
+        ids = [bindparam("id%d" % (i,)) for i in xrange(len(params["ids"]))]
+        query = query.where(bso.c.id.in_(ids))
     if "newer" in params:
         query = query.where(bso.c.modified > bindparam("newer"))
     if "newer_eq" in params:
@@ -227,6 +298,22 @@ def FIND_ITEMS(bso, params):
         query = query.where(bso.c.modified <= bindparam("older_eq"))
     if "ttl" in params:
         query = query.where(bso.c.ttl > bindparam("ttl"))
+    if "id_bound" in params:
+        # Seek to the item following the given (sortindex, id) pair when
+        # sorting by descending sortindex, taking care with NULL values.
+        after_id = bso.c.id < bindparam("id_bound")
+        if params.get("index_bound") is None:
+            bound = and_(bso.c.sortindex.is_(None), after_id)
+            if sortindex_nulls_first:
+                bound = or_(bound, bso.c.sortindex.isnot(None))
+        else:
+            bound = or_(
+                bso.c.sortindex < bindparam("index_bound"),
+                and_(bso.c.sortindex == bindparam("index_bound"), after_id),
+            )
+            if not sortindex_nulls_first:
+                bound = or_(bound, bso.c.sortindex.is_(None))
+        query = query.where(bound)
     # Sort it in the order requested.
     # We always sort by *something*, so that limit/offset work consistently.
     # The default order is by timestamp, which is efficient due to the index.
@@ -242,17 +329,18 @@ def FIND_ITEMS(bso, params):
         order_args = [bso.c.modified.desc(), bso.c.id.asc()]
     # ...but unfortunately, sorting by "id" causes a significant slowdown on
     # older versions of MySQL, so it's disabled by default and must be
-    # explicitly opted in to via config.
-    if not params.get("force_consistent_sort_order", False):
-        order_args.pop()
+    # explicitly opted in to via config.  The exception is sorting by
+    # sortindex, which needs a total ordering for pagination to work,
+    # and which can use an index on (sortindex, id) if one is present.
+    if sort != "index":
+        if not params.get("force_consistent_sort_order", False):
+            order_args.pop()
     query = query.order_by(*order_args)
     # Apply limit and/or offset.
-    limit = params.get("limit", None)
-    if limit is not None:
-        query = query.limit(limit)
-    offset = params.get("offset", None)
-    if offset is not None:
-        query = query.offset(offset)
+    if params.get("limit", None) is not None:
+        query = query.limit(bindparam("limit"))
+    if params.get("offset", None) is not None:
+        query = query.offset(bindparam("offset"))
     return query
 
 
@@ -261,6 +349,9 @@ def FIND_ITEMS(bso, params):
 DELETE_ITEM = "DELETE FROM %(bso)s WHERE userid=:userid AND "\
               "collection=:collectionid AND id=:item AND ttl>:ttl"\
 
+ITEM_USAGE = "SELECT payload_size FROM %(bso)s WHERE userid=:userid AND "\
+             "collection=:collectionid AND id=:item AND ttl>:ttl"
+
 ITEM_DETAILS = "SELECT id, sortindex, modified, payload "\
                "FROM %(bso)s WHERE collection=:collectionid "\
                "AND userid=:userid AND id=:item AND ttl>:ttl"
@@ -287,6 +378,100 @@ PURGE_BATCHES = """
     WHERE batch < (:now - :lifetime - :grace) * 1000
 """
 
+# When usage tracking is enabled, expired items are purged one collection at
+# a time so that the usage counters can be decremented in the same
+# transaction.  The ttl is checked again on delete, in case an item was
+# rewritten after it was listed.
+
+LIST_SOME_EXPIRED_ITEMS = """
+    SELECT userid, collection, id FROM %(bso)s
+    WHERE ttl < (:now - :grace)
+    ORDER BY ttl LIMIT :maxitems
+"""
+
+EXPIRED_ITEMS_USAGE = """
+    SELECT COUNT(id), SUM(payload_size) FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid
+    AND id IN %(ids)s AND ttl < (:now - :grace)
+"""
+
+PURGE_EXPIRED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND collection = :collectionid
+    AND id IN %(ids)s AND ttl < (:now - :grace)
+"""
+
+DECREMENT_COLLECTION_USAGE = """
+    UPDATE user_collections
+    SET item_count = item_count - :count, total_bytes = total_bytes - :size
+    WHERE userid = :userid AND collection = :collectionid
+"""
+
+# Queries to count the items that will expire within the next :window
+# seconds, used to estimate whether purging is keeping up with expiry.
+
+COUNT_EXPIRING_ITEMS = """
+    SELECT COUNT(*) FROM %(bso)s
+    WHERE ttl >= (:now - :grace) AND ttl < (:now - :grace + :window)
+"""
+
+COUNT_EXPIRING_BATCHES = """
+    SELECT COUNT(*) FROM batch_uploads
+    WHERE batch >= (:now - :lifetime - :grace) * 1000
+    AND batch < (:now - :lifetime - :grace + :window) * 1000
+"""
+
+COUNT_EXPIRING_BATCH_CONTENTS = """
+    SELECT COUNT(*) FROM %(bui)s
+    WHERE batch >= (:now - :lifetime - :grace) * 1000
+    AND batch < (:now - :lifetime - :grace + :window) * 1000
+"""
+
+# Query for the replication lag of a read replica, in seconds.  There's no
+# generic way to find this, so by default it's unknown.
+
+REPLICATION_LAG = None
+
+# Query for the names and approximate sizes of the partitions of a table,
+# which only exist on databases that support partitioning by ttl.
+
+LIST_TTL_PARTITIONS = None
+
+# Queries for reconciling the usage counters of a single user.  All of the
+# user's counters are locked first, so that concurrent writes to other
+# collections can't be lost when they're reset.  Expired items are purged
+# next, so that the recalculated counters match what the user can see.
+
+LOCK_COLLECTIONS_USAGE = """
+    SELECT collection FROM user_collections
+    WHERE userid = :userid
+    FOR UPDATE
+"""
+
+PURGE_USER_EXPIRED_ITEMS = """
+    DELETE FROM %(bso)s
+    WHERE userid = :userid AND ttl <= :ttl
+"""
+
+CALCULATE_COLLECTIONS_USAGE = """
+    SELECT collection, COUNT(collection), SUM(payload_size)
+    FROM %(bso)s
+    WHERE userid = :userid
+    GROUP BY collection
+"""
+
+RESET_COLLECTIONS_USAGE = """
+    UPDATE user_collections
+    SET item_count = 0, total_bytes = 0
+    WHERE userid = :userid
+"""
+
+SET_COLLECTION_USAGE = """
+    UPDATE user_collections
+    SET item_count = :count, total_bytes = :size
+    WHERE userid = :userid AND collection = :collectionid
+"""
+
 PURGE_BATCH_CONTENTS = """
     DELETE FROM %(bui)s
     WHERE batch < (:now - :lifetime - :grace) * 1000
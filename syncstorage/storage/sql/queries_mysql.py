@@ -28,6 +28,19 @@ PURGE_BATCH_CONTENTS = """
     ORDER BY batch LIMIT :maxitems
 """
 
+# The lag is reported in the "Seconds_Behind_Master" column of the result.
+
+REPLICATION_LAG = """
+    SHOW SLAVE STATUS
+"""
+
+LIST_TTL_PARTITIONS = """
+    SELECT partition_name, table_rows
+    FROM information_schema.partitions
+    WHERE table_schema = DATABASE() AND table_name = :table
+    AND partition_name IS NOT NULL
+"""
+
 OPTIMIZE_BATCHES_TABLE = """
     OPTIMIZE TABLE batch_uploads
 """
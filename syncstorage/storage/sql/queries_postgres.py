@@ -8,8 +8,18 @@ This module overrides some queries from queries_generic.py with code
 tailored to PostgreSQL.
 """
 
+from syncstorage.storage.sql import queries_generic
+
+
 # Queries for locking/unlocking a collection.
 
+# The driver has already implicitly begun a transaction by the time this
+# is executed, and the snapshot is taken by its first following query.
+SET_TRANSACTION_SNAPSHOT = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, "\
+                           "READ ONLY"
+
+BEGIN_TRANSACTION_SNAPSHOT = None
+
 LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid "\
                        "FOR SHARE"
@@ -35,6 +45,16 @@ INIT_COLLECTION = "INSERT INTO user_collections "\
                   "    (SELECT 1 FROM user_collections "\
                   "     WHERE userid=:userid AND collection=:collectionid)"
 
+INIT_COLLECTION_USAGE = "INSERT INTO user_collections "\
+                        "(userid, collection, last_modified, "\
+                        "item_count, total_bytes) "\
+                        "  SELECT :userid, :collectionid, :modified, "\
+                        "         :count_delta, :size_delta "\
+                        "  WHERE NOT EXISTS "\
+                        "    (SELECT 1 FROM user_collections "\
+                        "     WHERE userid=:userid "\
+                        "     AND collection=:collectionid)"
+
 # Postgres uses a special sequence thingamabob to handle auto-increment
 # columns, so we need a special way to pin its minimum value.
 
@@ -66,3 +86,38 @@ PURGE_BATCH_CONTENTS = """
     DELETE FROM %(bui)s
     WHERE batch < (:now - :lifetime - :grace)::BIGINT * 1000
 """
+
+COUNT_EXPIRING_BATCHES = """
+    SELECT COUNT(*) FROM batch_uploads
+    WHERE batch >= (:now - :lifetime - :grace)::BIGINT * 1000
+    AND batch < (:now - :lifetime - :grace + :window)::BIGINT * 1000
+"""
+
+COUNT_EXPIRING_BATCH_CONTENTS = """
+    SELECT COUNT(*) FROM %(bui)s
+    WHERE batch >= (:now - :lifetime - :grace)::BIGINT * 1000
+    AND batch < (:now - :lifetime - :grace + :window)::BIGINT * 1000
+"""
+
+# This is NULL on a replica that has yet to replay any transactions.
+
+REPLICATION_LAG = """
+    SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+"""
+
+LIST_TTL_PARTITIONS = """
+    SELECT child.relname, child.reltuples::BIGINT
+    FROM pg_inherits
+    JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+    JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+    WHERE parent.relname = :table
+"""
+
+
+# Postgres sorts NULL values after all other values, so items with no
+# sortindex come first when sorting by descending sortindex.
+
+
+def FIND_ITEMS(bso, params):
+    """Item search query, allowing for Postgres' sort order of NULLs."""
+    return queries_generic.FIND_ITEMS(bso, params, sortindex_nulls_first=True)
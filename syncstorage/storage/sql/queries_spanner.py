@@ -1,4 +1,4 @@
-from sqlalchemy.sql import select, bindparam, text
+from sqlalchemy.sql import select, bindparam, text, and_, or_
 
 DATABASE_CREATE_DDL = """\
 CREATE TABLE user_collections (
@@ -103,6 +103,20 @@ def FIND_ITEMS(bso, params):
         query = query.where(bso.c.modified <= bindparam("older_eq"))
     if "ttl" in params:
         query = query.where(bso.c.ttl > bindparam("ttl"))
+    if "id_bound" in params:
+        # Seek to the item following the given (sortindex, id) pair when
+        # sorting by descending sortindex.  Spanner sorts NULLs first in
+        # ascending order, and hence last in descending order.
+        after_id = bso.c.id < bindparam("id_bound")
+        if params.get("index_bound") is None:
+            bound = and_(bso.c.sortindex.is_(None), after_id)
+        else:
+            bound = or_(
+                bso.c.sortindex < bindparam("index_bound"),
+                and_(bso.c.sortindex == bindparam("index_bound"), after_id),
+                bso.c.sortindex.is_(None),
+            )
+        query = query.where(bound)
     sort = params.get("sort", None)
     if sort == 'index':
         order_args = [bso.c.sortindex.desc(), bso.c.id.desc()]
@@ -14,12 +14,21 @@ BEGIN_TRANSACTION_READ = "BEGIN DEFERRED TRANSACTION"
 
 BEGIN_TRANSACTION_WRITE = "BEGIN EXCLUSIVE TRANSACTION"
 
+# SQLite's SHARED lock already gives a consistent snapshot, and
+# doesn't block writers at all when using write-ahead logging.
+SET_TRANSACTION_SNAPSHOT = None
+
+BEGIN_TRANSACTION_SNAPSHOT = "BEGIN DEFERRED TRANSACTION"
+
 LOCK_COLLECTION_READ = "SELECT last_modified FROM user_collections "\
                        "WHERE userid=:userid AND collection=:collectionid"
 
 LOCK_COLLECTION_WRITE = "SELECT last_modified FROM user_collections "\
                         "WHERE userid=:userid AND collection=:collectionid"
 
+# The EXCLUSIVE lock taken by any write already covers all the counters.
+LOCK_COLLECTIONS_USAGE = None
+
 # We can use INSERT OR REPLACE to apply a batch in a single query.
 # However, to correctly cope with with partial data udpates, we need
 # to join onto the original table in the SELECT clause so that we
@@ -0,0 +1,167 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Write-behind persistence of collections that are stored only in memcached.
+
+Cache-only collections are lost whenever memcached is restarted or evicts
+them, after which every client re-uploads its data at once.  The memcached
+backend can instead save a snapshot of each such collection to the underlying
+store some time after it's written, and reload it from there on a cache miss.
+
+The WriteBehindQueue class schedules those saves.  Writes only have to note
+that the collection is dirty, which is done in memory, and a worker thread
+saves it once it has been dirty for a given delay.  Any further writes in the
+meantime are coalesced into the same save.  Saves are made no more than a
+given number of times per second, so that a burst of writes turns into a
+steady trickle of load on the underlying store.
+
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+# Default number of seconds to wait before saving a dirty collection.
+DEFAULT_FLUSH_DELAY = 10
+
+# Default maximum number of saves to make per second.
+DEFAULT_MAX_FLUSH_RATE = 10
+
+# Default maximum number of dirty collections waiting to be saved.
+DEFAULT_MAX_DIRTY = 10000
+
+
+class WriteBehindQueue(object):
+    """Queue of dirty collections to be saved by a background thread.
+
+    The flush function is called with a user, a collection name, and a flag
+    saying whether the collection was deleted.  It will be called for each
+    scheduled collection once it has been dirty for delay seconds, with at
+    least 1 / max_rate seconds between the start of each call.  If more than
+    max_dirty collections are waiting, further ones are dropped.
+
+    The number of collections waiting is available from the "depth" property.
+    The "flush_lag" attribute records how long the most recently-saved
+    collection had been waiting, and "num_flushed" and "num_dropped" count
+    the collections that have been saved and dropped respectively.
+    """
+
+    def __init__(self, flush, delay=DEFAULT_FLUSH_DELAY,
+                 max_rate=DEFAULT_MAX_FLUSH_RATE,
+                 max_dirty=DEFAULT_MAX_DIRTY):
+        self.flush = flush
+        self.delay = float(delay)
+        self.max_rate = float(max_rate)
+        self.max_dirty = max_dirty
+        self.flush_lag = 0
+        self.num_flushed = 0
+        self.num_dropped = 0
+        # Entries are [user, collection, deleted, dirty_since], keyed by
+        # (uid, collection) and queued in the order that they became dirty.
+        self._entries = {}
+        self._order = deque()
+        self._flushing = 0
+        self._cond = threading.Condition()
+        self._worker = None
+        self._closed = False
+
+    @property
+    def depth(self):
+        """The number of dirty collections waiting to be saved."""
+        return len(self._entries)
+
+    def schedule(self, user, collection, deleted=False):
+        """Note that the given collection is dirty and needs to be saved.
+
+        This returns True if the collection was queued or already waiting,
+        and False if it was dropped because the queue is full or closed.
+        """
+        key = (user["uid"], collection)
+        with self._cond:
+            if self._closed:
+                self.num_dropped += 1
+                return False
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[2] = deleted
+                return True
+            if len(self._entries) >= self.max_dirty:
+                self.num_dropped += 1
+                return False
+            self._entries[key] = [user, collection, deleted, time.time()]
+            self._order.append(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run)
+                self._worker.daemon = True
+                self._worker.start()
+            self._cond.notify()
+        return True
+
+    def join(self):
+        """Wait until all dirty collections have been saved.
+
+        This ignores the delay, saving any waiting collections immediately.
+        """
+        with self._cond:
+            delay = self.delay
+            self.delay = 0
+            try:
+                self._cond.notify()
+                while self._entries or self._flushing:
+                    self._cond.wait(0.01)
+            finally:
+                self.delay = delay
+
+    def close(self):
+        """Save any dirty collections immediately, and stop the worker.
+
+        Collections scheduled after this is called are dropped.
+        """
+        with self._cond:
+            self._closed = True
+            self.delay = 0
+            self._cond.notify()
+            worker = self._worker
+        if worker is not None:
+            worker.join()
+
+    def _run(self):
+        last_flush = 0
+        while True:
+            with self._cond:
+                while not self._order:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                key = self._order[0]
+                due = self._entries[key][3] + self.delay
+                now = time.time()
+                if due > now:
+                    # This will be woken early if join() clears the delay.
+                    self._cond.wait(due - now)
+                    continue
+                self._order.popleft()
+                user, collection, deleted, dirty_since = self._entries.pop(key)
+                self._flushing += 1
+            try:
+                if self.max_rate > 0:
+                    wait = last_flush + 1 / self.max_rate - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                last_flush = time.time()
+                self.flush(user, collection, deleted)
+                self.flush_lag = time.time() - dirty_since
+                self.num_flushed += 1
+            except Exception:
+                logger.exception("Error saving collection %r for user %r",
+                                 collection, user["uid"])
+            finally:
+                with self._cond:
+                    self._flushing -= 1
+                    self._cond.notify_all()
@@ -37,6 +37,7 @@ from syncstorage.tests.functional.support import run_live_functional_tests
 from syncstorage.util import json_loads, json_dumps
 from syncstorage.tweens import WEAVE_INVALID_WBO, WEAVE_SIZE_LIMIT_EXCEEDED
 from syncstorage.storage import ConflictError
+from syncstorage import views
 from syncstorage.views.validators import BATCH_MAX_IDS
 from syncstorage.views.util import get_limit_config
 
@@ -2224,6 +2225,85 @@ class TestStoragePaginated(TestStorage):
     TEST_INI_FILE = "tests-paginated.ini"
 
 
+class TestStorageStreaming(TestStorage):
+    """Storage testcases run with paginated responses being streamed."""
+
+    TEST_INI_FILE = "tests-streaming.ini"
+
+    def test_streaming_of_full_collection(self):
+        bsos = [{"id": "%02d" % (i,), "payload": _PLD, "sortindex": i}
+                for i in xrange(10)]
+        self.retry_post_json(self.root + "/storage/xxx_col2", bsos)
+        ids = ["%02d" % (i,) for i in reversed(xrange(10))]
+        url = self.root + "/storage/xxx_col2?full=1&sort=index"
+
+        resp = self.app.get(url)
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 10)
+        self.assertTrue("X-Weave-Next-Offset" not in resp.headers)
+        self.assertEquals([bso["id"] for bso in resp.json], ids)
+
+        resp = self.app.get(url, headers=[("Accept", "application/newlines")])
+        self.assertEquals(resp.content_type, "application/newlines")
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 10)
+        lines = resp.body.strip().split("\n")
+        self.assertEquals([json_loads(line)["id"] for line in lines], ids)
+
+        # Filters are applied to the number of records, too.
+        resp = self.app.get(url + "&newer=0&ids=01,02,03")
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 3)
+        self.assertEquals([bso["id"] for bso in resp.json], ["03", "02", "01"])
+
+        # Limits that span several internal pages are respected,
+        # and give an offset token that picks up where they left off.
+        resp = self.app.get(url + "&limit=6")
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 6)
+        self.assertEquals([bso["id"] for bso in resp.json], ids[:6])
+        next_offset = resp.headers["X-Weave-Next-Offset"]
+        resp = self.app.get(url + "&limit=6&offset=" + next_offset)
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 4)
+        self.assertEquals([bso["id"] for bso in resp.json], ids[6:])
+        self.assertTrue("X-Weave-Next-Offset" not in resp.headers)
+        resp = self.app.get(url + "&offset=" + next_offset)
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 4)
+        self.assertEquals([bso["id"] for bso in resp.json], ids[6:])
+
+        # Preconditions are still checked before anything is sent.
+        ts = float(resp.headers["X-Last-Modified"])
+        self.app.get(url, headers={"X-If-Modified-Since": str(ts)},
+                     status=304)
+        resp = self.app.get(self.root + "/storage/nonexistent?full=1")
+        self.assertEquals(resp.json, [])
+
+    def test_streaming_fails_cleanly_if_collection_is_modified(self):
+        # This can't be run against a live server.
+        if self.distant:
+            raise unittest2.SkipTest
+
+        bsos = [{"id": "%02d" % (i,), "payload": _PLD} for i in xrange(10)]
+        self.retry_post_json(self.root + "/storage/xxx_col2", bsos)
+        get_collection = views.get_collection
+
+        def get_collection_then_modify(request):
+            # Write to the collection between fetching the first page
+            # and fetching the second, as a concurrent request might.
+            res = get_collection(request)
+            if "offset" not in request.validated:
+                storage = request.validated["storage"]
+                storage.set_item(request.user, "xxx_col2", "00",
+                                 {"payload": "modified"})
+            return res
+
+        views.get_collection = get_collection_then_modify
+        try:
+            url = self.root + "/storage/xxx_col2?full=1"
+            self.app.get(url, status=412)
+        finally:
+            views.get_collection = get_collection
+        resp = self.app.get(url)
+        self.assertEquals(int(resp.headers["X-Weave-Records"]), 10)
+        self.assertEquals(len(resp.json), 10)
+
+
 class TestStorageWithBatchUploadDisabled(TestStorage):
     """Storage testcases run with batch uploads disabled via feature flag."""
 
@@ -2362,6 +2442,27 @@ class TestStorageMemcachedCacheOnly(TestStorageMemcached):
     TEST_INI_FILE = "tests-memcached-cacheonly.ini"
 
 
+class TestStorageMemcachedPromote(TestStorageMemcached):
+    """Storage testcases run against the memcached backend, if available.
+
+    These tests are configured to promote every collection into the cache
+    as soon as it has been read.
+    """
+
+    TEST_INI_FILE = "tests-memcached-promote.ini"
+
+
+class TestStorageMemcachedRing(TestStorageMemcached):
+    """Storage testcases run against the memcached backend, if available.
+
+    These tests are configured to spread keys over two cache servers, with
+    the metadata replicated to both.  They're actually the same server
+    under different names, so that they can share a single memcached.
+    """
+
+    TEST_INI_FILE = "tests-memcached-ring.ini"
+
+
 if __name__ == "__main__":
     # When run as a script, this file will execute the
     # functional tests against a live webserver.
@@ -112,10 +112,17 @@ class StorageTestCase(TestCase):
                     c.execute('DROP TABLE batch_upload_items')
             # Explicitly free any pooled connections.
             storage.dbconnector.engine.dispose()
+            for engine in getattr(storage.dbconnector, "replica_engines", ()):
+                engine.dispose()
+            for engine in getattr(storage.dbconnector, "shard_engines", ()):
+                engine.dispose()
         # Find any sqlite database files and delete them.
         for key, value in self.config.registry.settings.iteritems():
-            if key.endswith(".sqluri"):
-                sqluri = urlparse.urlparse(value)
-                if sqluri.scheme == 'sqlite' and ":memory:" not in value:
-                    if os.path.isfile(sqluri.path):
-                        os.remove(sqluri.path)
+            if key.endswith(".sqluri") or key.endswith(".shard_sqluris"):
+                if isinstance(value, basestring):
+                    value = value.split()
+                for sqluri in value:
+                    parsed = urlparse.urlparse(sqluri)
+                    if parsed.scheme == 'sqlite' and ":memory:" not in sqluri:
+                        if os.path.isfile(parsed.path):
+                            os.remove(parsed.path)
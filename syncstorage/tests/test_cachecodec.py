@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest2
+
+from syncstorage.bso import BSO
+from syncstorage.util import Timestamp, get_timestamp
+from syncstorage.storage.cachecodec import (JSONCodec,
+                                            BinaryCodec,
+                                            load_codec,
+                                            FORMAT_MARSHAL,
+                                            FORMAT_MARSHAL_ZLIB,
+                                            lz4)
+
+
+def _make_collection(num_items, payload_size=100):
+    return {
+        "modified": get_timestamp("1234567890.12"),
+        "items": dict(("item%d" % (i,), {
+            "id": "item%d" % (i,),
+            "payload": "x" * payload_size,
+            "modified": get_timestamp(1234567800 + i),
+            "sortindex": i,
+            "ttl": None if i % 2 else 1234567890 + i,
+        }) for i in xrange(num_items)),
+    }
+
+
+class TestCacheCodecs(unittest2.TestCase):
+
+    def test_binary_codec_round_trips_collection_data(self):
+        codec = BinaryCodec()
+        data = _make_collection(10)
+        decoded = codec.decode(codec.encode(data))
+        self.assertEquals(decoded, data)
+        self.assertTrue(type(decoded["modified"]) is Timestamp)
+        item = decoded["items"]["item3"]
+        self.assertTrue(type(item["modified"]) is Timestamp)
+        self.assertTrue(type(item["sortindex"]) is int)
+
+    def test_binary_codec_matches_json_round_trip(self):
+        data = {
+            1234: {"created": 1234, "items": [{"id": "a", "ttl": 5}]},
+            "timestamps": (get_timestamp(), 12.5, None, True),
+        }
+        json_codec = JSONCodec()
+        binary_codec = BinaryCodec()
+        expected = json_codec.decode(json_codec.encode(data))
+        self.assertEquals(binary_codec.decode(binary_codec.encode(data)),
+                          expected)
+        self.assertEquals(expected["timestamps"][1], Timestamp(1250))
+
+    def test_binary_codec_accepts_subclasses_of_builtin_types(self):
+        bso = BSO({"id": "a", "payload": "b", "sortindex": 1})
+        data = {"items": [bso]}
+        decoded = BinaryCodec().decode(BinaryCodec().encode(data))
+        self.assertEquals(decoded, data)
+        self.assertTrue(type(decoded["items"][0]) is dict)
+
+    def test_binary_codec_is_smaller_than_json(self):
+        data = _make_collection(100)
+        self.assertTrue(len(BinaryCodec().encode(data)) <
+                        len(JSONCodec().encode(data)))
+
+    def test_binary_codec_compresses_above_threshold(self):
+        codec = BinaryCodec(compress_threshold=1024)
+        small = codec.encode(_make_collection(1))
+        self.assertEquals(small[0], FORMAT_MARSHAL)
+        data = _make_collection(100)
+        large = codec.encode(data)
+        self.assertEquals(large[0], FORMAT_MARSHAL_ZLIB)
+        self.assertTrue(len(large) < len(BinaryCodec("none").encode(data)))
+        self.assertEquals(codec.decode(large), data)
+
+    def test_codecs_can_read_each_others_values(self):
+        data = _make_collection(50)
+        codecs = [JSONCodec(), BinaryCodec(), BinaryCodec("none"),
+                  BinaryCodec(compress_threshold=0)]
+        for writer in codecs:
+            encoded = writer.encode(data)
+            for reader in codecs:
+                self.assertEquals(reader.decode(encoded), data)
+
+    def test_json_codec_output_is_unchanged(self):
+        self.assertEquals(JSONCodec().encode({"modified": Timestamp(1234)}),
+                          '{"modified": 12.34}')
+
+    def test_load_codec(self):
+        self.assertTrue(isinstance(load_codec("json", compression="lz4"),
+                                   JSONCodec))
+        codec = load_codec("binary", compress_threshold=10)
+        self.assertTrue(isinstance(codec, BinaryCodec))
+        self.assertEquals(codec.compress_threshold, 10)
+        codec = load_codec("syncstorage.storage.cachecodec:BinaryCodec",
+                           compression="none")
+        self.assertEquals(codec.compression, None)
+        self.assertRaises(ValueError, load_codec, "binary",
+                          compression="bzip2")
+
+    def test_lz4_compression(self):
+        if lz4 is None:
+            self.assertRaises(ValueError, BinaryCodec, "lz4")
+            raise unittest2.SkipTest("lz4 is not installed")
+        codec = BinaryCodec("lz4", compress_threshold=0)
+        data = _make_collection(100)
+        self.assertEquals(codec.decode(codec.encode(data)), data)
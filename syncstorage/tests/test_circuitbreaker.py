@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+import unittest2
+
+from mozsvc.exceptions import BackendError
+
+from syncstorage.storage.circuitbreaker import (CircuitBreaker,
+                                                CircuitOpenError,
+                                                CLOSED, OPEN, HALF_OPEN)
+
+
+class TestCircuitBreaker(unittest2.TestCase):
+
+    def _fail(self, breaker):
+        try:
+            with breaker.guard():
+                raise BackendError("oops")
+        except CircuitOpenError:
+            raise
+        except BackendError:
+            pass
+
+    def test_consecutive_failures_trip_the_breaker(self):
+        changes = []
+        breaker = CircuitBreaker(max_failures=3, reset_timeout=60,
+                                 on_state_change=lambda *a: changes.append(a))
+        self._fail(breaker)
+        self._fail(breaker)
+        # A success resets the count.
+        with breaker.guard():
+            pass
+        self._fail(breaker)
+        self._fail(breaker)
+        self.assertEquals(breaker.state, CLOSED)
+        self._fail(breaker)
+        self.assertEquals(breaker.state, OPEN)
+        self.assertEquals(breaker.num_trips, 1)
+        self.assertEquals(changes, [(CLOSED, OPEN)])
+        # Calls are now refused without being made.
+        calls = []
+        with self.assertRaises(CircuitOpenError) as cm:
+            with breaker.guard():
+                calls.append(True)
+        self.assertEquals(calls, [])
+        self.assertTrue(0 < cm.exception.retry_after <= 60)
+        self.assertEquals(breaker.num_refused, 1)
+
+    def test_other_errors_do_not_count_as_failures(self):
+        breaker = CircuitBreaker(max_failures=1)
+        with self.assertRaises(KeyError):
+            with breaker.guard():
+                raise KeyError("oops")
+        self.assertEquals(breaker.state, CLOSED)
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker(max_failures=2, slow_call_time=0.01)
+        for _ in xrange(2):
+            with breaker.guard():
+                time.sleep(0.02)
+        self.assertEquals(breaker.state, OPEN)
+        # They can be ignored.
+        breaker = CircuitBreaker(max_failures=2, slow_call_time=0)
+        for _ in xrange(2):
+            with breaker.guard():
+                time.sleep(0.02)
+        self.assertEquals(breaker.state, CLOSED)
+
+    def test_half_open_probes_for_recovery(self):
+        changes = []
+        breaker = CircuitBreaker(max_failures=1, reset_timeout=0.05,
+                                 on_state_change=lambda *a: changes.append(a))
+        self._fail(breaker)
+        self.assertRaises(CircuitOpenError, self._fail, breaker)
+        time.sleep(0.06)
+        # A failed probe opens it again.
+        self._fail(breaker)
+        self.assertEquals(breaker.state, OPEN)
+        self.assertEquals(breaker.num_trips, 2)
+        time.sleep(0.06)
+        # Only one probe is let through at a time.
+        with breaker.guard():
+            self.assertEquals(breaker.state, HALF_OPEN)
+            self.assertFalse(breaker.allow())
+        self.assertEquals(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertEquals(changes, [(CLOSED, OPEN), (OPEN, HALF_OPEN),
+                                    (HALF_OPEN, OPEN), (OPEN, HALF_OPEN),
+                                    (HALF_OPEN, CLOSED)])
+
+    def test_breaker_can_be_disabled(self):
+        breaker = CircuitBreaker(max_failures=0)
+        for _ in xrange(100):
+            self._fail(breaker)
+        self.assertEquals(breaker.state, CLOSED)
@@ -0,0 +1,55 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest2
+
+from syncstorage.storage.hashring import HashRing
+
+
+_KEYS = ["%d:metadata" % (uid,) for uid in xrange(10000)]
+
+
+class TestHashRing(unittest2.TestCase):
+
+    def test_keys_are_spread_evenly(self):
+        ring = HashRing(["a:1", "b:1", "c:1", "d:1"])
+        counts = {}
+        for key in _KEYS:
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEquals(sorted(counts), ["a:1", "b:1", "c:1", "d:1"])
+        for count in counts.itervalues():
+            self.assertTrue(1500 < count < 3500, count)
+        # The mapping depends only on the nodes, not their order.
+        other_ring = HashRing(["d:1", "c:1", "b:1", "a:1"])
+        for key in _KEYS[:100]:
+            self.assertEquals(ring.get_node(key), other_ring.get_node(key))
+
+    def test_changing_nodes_moves_few_keys(self):
+        ring = HashRing(["a:1", "b:1", "c:1"])
+        bigger_ring = HashRing(["a:1", "b:1", "c:1", "d:1"])
+        moved = 0
+        for key in _KEYS:
+            node = ring.get_node(key)
+            new_node = bigger_ring.get_node(key)
+            if new_node != node:
+                # Keys only move onto the new node.
+                self.assertEquals(new_node, "d:1")
+                moved += 1
+        self.assertTrue(0.15 < moved / float(len(_KEYS)) < 0.35, moved)
+        # Removing it again puts them back where they were.
+        for key in _KEYS[:100]:
+            if bigger_ring.get_node(key) != "d:1":
+                self.assertEquals(ring.get_node(key),
+                                  bigger_ring.get_node(key))
+
+    def test_replicas_are_on_distinct_nodes(self):
+        ring = HashRing(["a:1", "b:1", "c:1"], vnodes=10)
+        for key in _KEYS[:100]:
+            nodes = ring.get_nodes(key, 2)
+            self.assertEquals(len(set(nodes)), 2)
+            self.assertEquals(nodes[0], ring.get_node(key))
+            self.assertEquals(sorted(ring.get_nodes(key, 5)),
+                              ["a:1", "b:1", "c:1"])
+        self.assertRaises(ValueError, HashRing, [])
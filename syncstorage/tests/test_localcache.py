@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+import unittest2
+
+from syncstorage.storage.localcache import LocalCache
+
+
+class TestLocalCache(unittest2.TestCase):
+
+    def test_values_are_cached_until_they_expire(self):
+        cache = LocalCache(ttl=0.05)
+        self.assertEquals(cache.get("a"), None)
+        cache.set("a", 1)
+        self.assertEquals(cache.get("a"), 1)
+        self.assertTrue("a" in cache)
+        time.sleep(0.06)
+        self.assertFalse("a" in cache)
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 2)
+        self.assertAlmostEquals(cache.hit_ratio, 1.0 / 3)
+
+    def test_least_recently_used_values_are_evicted(self):
+        cache = LocalCache(max_size=2)
+        cache.set("one", 1)
+        cache.set("two", 2)
+        # Touch "one" so that "two" becomes the least recently used.
+        self.assertEquals(cache.get("one"), 1)
+        cache.set("three", 3)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get("one"), 1)
+        self.assertEquals(cache.get("three"), 3)
+        self.assertEquals(cache.get("two"), None)
+
+    def test_values_can_be_discarded(self):
+        cache = LocalCache()
+        self.assertEquals(cache.hit_ratio, None)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        cache.delete("missing")
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(cache.get("b"), 2)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+        # Checking for a value doesn't count as a lookup.
+        self.assertFalse("b" in cache)
+        self.assertEquals(cache.hits + cache.misses, 2)
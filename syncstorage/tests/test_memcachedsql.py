@@ -2,12 +2,44 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import atexit
 import unittest2
 import time
 
+from pyramid.request import Request
+from pyramid.threadlocal import manager
+
 try:
     from syncstorage.storage.memcached import MemcachedStorage  # NOQA
+    from syncstorage.storage.memcached import (MemcachedClient,
+                                               HashRingMemcachedClient)
     from syncstorage.storage.memcached import SIZE_RECALCULATION_PERIOD
+    from syncstorage.storage.memcached import TTL_EXPIRY_GRACE_PERIOD
+    from syncstorage.storage.memcached import ROUND_TRIPS_METRIC
+    from syncstorage.storage.memcached import SIZE_REFRESHES_METRIC
+    from syncstorage.storage.memcached import (SORT_ORDER_REBUILDS_METRIC,
+                                               SORT_ORDERS_VERSION)
+    from syncstorage.storage.memcached import (_is_metadata_key,
+                                               _metadata_version)
+    from syncstorage.storage.memcached import (WRITE_BEHIND_DEPTH_METRIC,
+                                               SNAPSHOT_RELOADS_METRIC)
+    from syncstorage.storage.memcached import (PROMOTED_HITS_METRIC,
+                                               PROMOTED_MISSES_METRIC)
+    from syncstorage.storage.writebehind import WriteBehindQueue
+    from syncstorage.storage.promotion import CollectionPromoter
+    from syncstorage.storage.localcache import LocalCache
+    from syncstorage.storage.memcached import (LOCAL_METADATA_HITS_METRIC,
+                                               LOCAL_METADATA_MISSES_METRIC)
+    from syncstorage.storage.memcached import (LEASE_FILLS_METRIC,
+                                               LEASE_WAITS_METRIC,
+                                               LEASE_FALLBACKS_METRIC)
+    from syncstorage.storage.memcached import (BREAKER_TRIPS_METRIC,
+                                               BREAKER_RECOVERIES_METRIC,
+                                               BREAKER_REFUSED_METRIC,
+                                               BREAKER_FALLBACKS_METRIC)
+    from syncstorage.storage.circuitbreaker import (CircuitOpenError,
+                                                    CircuitBreaker,
+                                                    CLOSED, OPEN)
     MEMCACHED = True
 except ImportError:
     MEMCACHED = False
@@ -36,6 +68,9 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
 
         settings = self.config.registry.settings
         self.storage = load_storage_from_settings("storage", settings)
+        # Many of these tests change memcache directly, as another process
+        # would, and expect to see the result immediately.
+        self.storage.local_metadata = None
 
         # Check that memcached is actually running.
         try:
@@ -44,6 +79,11 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         except BackendError:
             raise unittest2.SkipTest
 
+    def tearDown(self):
+        # Stop any background threads before their databases go away.
+        self.storage.close()
+        super(TestMemcachedSQLStorage, self).tearDown()
+
     def test_basic(self):
         # just make sure calls goes through
         self.storage.set_item(_USER, 'xxx_col1', '1', {'payload': _PLD})
@@ -147,6 +187,10 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         collection = self.storage.cache.get('1:c:tabs')
         self.assertEquals(collection, None)
 
+    def test_paginating_cached_collections_by_sortindex(self):
+        self.check_sortindex_pagination("meta")
+        self.check_sortindex_pagination("tabs")
+
     def test_size(self):
         # storing 2 BSOs
         self.storage.set_item(_USER, 'foo', '1', {'payload': _PLD})
@@ -292,6 +336,783 @@ class TestMemcachedSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(storage.get_total_size(_USER), len(_PLD))
         self.assertEquals(storage.get_total_size(_USER, True), 0)
 
+    def test_stale_sizes_are_recalculated_in_the_background(self):
+        storage = self.storage
+        sqlstorage = self.storage.storage
+        storage.set_item(_USER, 'foo', '1', {'payload': _PLD})
+        storage.get_total_size(_USER, True)
+        sqlstorage.delete_item(_USER, 'foo', '1')
+
+        # A fresh size is used as-is.
+        metrics = self._collect_metrics(storage.get_total_size, _USER)
+        self.assertFalse(SIZE_REFRESHES_METRIC in metrics)
+
+        # A stale size is still used, but queued for recalculation.
+        metadata = storage.cache.get('1:metadata')
+        metadata['last_size_recalc'] -= SIZE_RECALCULATION_PERIOD + 1
+        storage.cache.set('1:metadata', metadata)
+        sizes = []
+        metrics = self._collect_metrics(
+            lambda: sizes.append(storage.get_total_size(_USER)))
+        self.assertEquals(sizes, [len(_PLD)])
+        self.assertEquals(metrics.get(SIZE_REFRESHES_METRIC), 1)
+        storage.size_refresher.join()
+        self.assertEquals(storage.cache.get('1:metadata')['size'], 0)
+        self.assertEquals(storage.get_total_size(_USER), 0)
+
+        # Without a background refresher, stale sizes are left alone.
+        storage.size_refresher.close()
+        storage.size_refresher = None
+        storage.cache.set('1:metadata', metadata)
+        self.assertEquals(storage.get_total_size(_USER), len(_PLD))
+        self.assertEquals(storage.get_total_size(_USER, True), 0)
+
+    def _collect_metrics(self, func, *args):
+        req = Request.blank("/")
+        req.metrics = {}
+        manager.push({"request": req, "registry": self.config.registry})
+        try:
+            func(*args)
+        finally:
+            manager.pop()
+        return req.metrics
+
+    def _count_round_trips(self, func, *args):
+        return self._collect_metrics(func, *args).get(ROUND_TRIPS_METRIC, 0)
+
+    def test_reading_cached_collection_takes_one_round_trip(self):
+        storage = self.storage
+        storage.set_item(_USER, 'meta', '1', {'payload': _PLD})
+        storage.set_item(_USER, 'tabs', '1', {'payload': _PLD})
+
+        def read_collection(collection):
+            with storage.lock_for_read(_USER, collection):
+                ts = storage.get_collection_timestamp(_USER, collection)
+                items = storage.get_items(_USER, collection)["items"]
+                self.assertEquals(items[0]["modified"], ts)
+                self.assertEquals(storage.get_item(_USER, collection, '1'),
+                                  items[0])
+
+        self.assertEquals(self._count_round_trips(read_collection, 'meta'), 1)
+        # Cache-only collections also need to take and release their lock.
+        self.assertEquals(self._count_round_trips(read_collection, 'tabs'), 3)
+
+    def test_writes_use_prefetched_data(self):
+        storage = self.storage
+        storage.set_item(_USER, 'meta', '1', {'payload': _PLD})
+        time.sleep(0.01)
+
+        def write_collection():
+            with storage.lock_for_write(_USER, 'meta'):
+                storage.get_collection_timestamp(_USER, 'meta')
+                storage.set_item(_USER, 'meta', '2', {'payload': _PLD})
+
+        # One prefetch, a CAS and a set of the metadata, and a delete
+        # and re-add of the collection data.
+        self.assertEquals(self._count_round_trips(write_collection), 5)
+        items = storage.get_items(_USER, 'meta')["items"]
+        self.assertEquals(sorted(item["id"] for item in items), ['1', '2'])
+
+    def test_writes_retry_if_prefetched_metadata_changes(self):
+        storage = self.storage
+        storage.set_item(_USER, 'meta', '1', {'payload': _PLD})
+        storage.set_item(_USER, 'xxx_col1', '1', {'payload': _PLD})
+        # Use a separate client to simulate a concurrent request.
+        other_cache = MemcachedClient(None, storage.cache.key_prefix)
+        time.sleep(0.01)
+
+        with storage.lock_for_write(_USER, 'meta'):
+            storage.get_collection_timestamp(_USER, 'meta')
+            metadata = other_cache.get('1:metadata')
+            metadata['collections']['xxx_col2'] = metadata['modified']
+            other_cache.set('1:metadata', metadata)
+            # The stale prefetched metadata is still in use.
+            self.assertFalse('xxx_col2' in
+                             storage.get_collection_timestamps(_USER))
+            ts = storage.set_item(_USER, 'meta', '2', {'payload': _PLD})
+
+        timestamps = storage.get_collection_timestamps(_USER)
+        self.assertEquals(timestamps['meta'], ts['modified'])
+        self.assertTrue('xxx_col2' in timestamps)
+
+    def test_prefetched_values_are_not_shared_between_callers(self):
+        cache = self.storage.cache
+        cache.set('test', {'a': 1})
+        with cache.prefetching(['test', 'missing']):
+            cache.get('test')['b'] = 2
+            self.assertEquals(cache.get('test'), {'a': 1})
+            self.assertEquals(cache.gets('missing'), (None, None))
+            cache.set('test', {'c': 3})
+            self.assertEquals(cache.get('test'), {'c': 3})
+        self.assertFalse(cache.is_prefetched('test'))
+
+    def test_chunked_collection_layout(self):
+        storage = self.storage
+        storage.cache_collection_chunks = 4
+        items = [{'id': str(i), 'payload': _PLD} for i in xrange(20)]
+        ts = storage.set_items(_USER, 'meta', items)
+        index = storage.cache.get('1:c:meta')
+        self.assertEquals(index['modified'], ts)
+        self.assertEquals(index['chunks'], [ts.centis] * 4)
+        num_items = 0
+        for i in xrange(4):
+            chunk = storage.cache.get('1:c:meta:%d:%d' % (i, ts.centis))
+            num_items += len(chunk['items'])
+        self.assertEquals(num_items, 20)
+
+        # Writing a single item only replaces the chunk that holds it.
+        time.sleep(0.01)
+        res = storage.set_item(_USER, 'meta', '7', {'payload': 'updated'})
+        versions = storage.cache.get('1:c:meta')['chunks']
+        changed = [i for i, v in enumerate(versions) if v != ts.centis]
+        self.assertEquals(len(changed), 1)
+        self.assertEquals(versions[changed[0]], res['modified'].centis)
+        old_key = '1:c:meta:%d:%d' % (changed[0], ts.centis)
+        self.assertEquals(storage.cache.get(old_key), None)
+        self.assertEquals(storage.get_item(_USER, 'meta', '7')['payload'],
+                          'updated')
+        self.assertEquals(len(storage.get_items(_USER, 'meta')['items']), 20)
+
+        # Deleting items empties their chunks entirely.
+        time.sleep(0.01)
+        storage.delete_items(_USER, 'meta', [str(i) for i in xrange(19)])
+        versions = storage.cache.get('1:c:meta')['chunks']
+        self.assertEquals(len([v for v in versions if v]), 1)
+        items = storage.get_items(_USER, 'meta')['items']
+        self.assertEquals([item['id'] for item in items], ['19'])
+
+        # Deleting the collection clears out all the chunks.
+        storage.delete_collection(_USER, 'meta')
+        self.assertEquals(storage.cache.get('1:c:meta'), None)
+        for i, version in enumerate(versions):
+            key = '1:c:meta:%d:%d' % (i, version)
+            self.assertEquals(storage.cache.get(key), None)
+
+    def test_evicted_chunks_are_reloaded_from_storage(self):
+        storage = self.storage
+        storage.cache_collection_chunks = 4
+        items = [{'id': str(i), 'payload': _PLD} for i in xrange(20)]
+        ts = storage.set_items(_USER, 'meta', items)
+        storage.cache.delete('1:c:meta:0:%d' % (ts.centis,))
+        self.assertEquals(len(storage.get_items(_USER, 'meta')['items']), 20)
+        self.assertEquals(storage.cache.get('1:c:meta')['chunks'],
+                          [ts.centis] * 4)
+        # Cache-only collections can't be reloaded, so they're lost entirely.
+        storage.set_items(_USER, 'tabs', items)
+        versions = storage.cache.get('1:c:tabs')['chunks']
+        storage.cache.delete('1:c:tabs:0:%d' % (versions[0],))
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _USER, 'tabs')
+        # The remaining chunks are cleaned up rather than left orphaned.
+        for i, version in enumerate(versions):
+            key = '1:c:tabs:%d:%d' % (i, version)
+            self.assertEquals(storage.cache.get(key), None)
+
+    def test_clearing_cached_collection_deletes_its_chunks(self):
+        storage = self.storage
+        storage.cache_collection_chunks = 4
+        items = [{'id': str(i), 'payload': _PLD} for i in xrange(20)]
+        ts = storage.set_items(_USER, 'meta', items)
+        # Writes that can't update the cache in-place leave it cleared,
+        # and must take the chunks with it.
+        time.sleep(0.01)
+        storage.set_item(_USER, 'meta', '7', {'sortindex': 2})
+        self.assertEquals(storage.cache.get('1:c:meta'), None)
+        for i in xrange(4):
+            key = '1:c:meta:%d:%d' % (i, ts.centis)
+            self.assertEquals(storage.cache.get(key), None)
+        self.assertEquals(len(storage.get_items(_USER, 'meta')['items']), 20)
+
+    def test_switching_between_chunked_and_single_key_layouts(self):
+        storage = self.storage
+        storage.set_item(_USER, 'tabs', '1', {'payload': _PLD})
+        self.assertTrue('items' in storage.cache.get('1:c:tabs'))
+        # Data in a single key is still readable, and converted on write.
+        storage.cache_collection_chunks = 4
+        self.assertEquals(len(storage.get_items(_USER, 'tabs')['items']), 1)
+        time.sleep(0.01)
+        storage.set_item(_USER, 'tabs', '2', {'payload': _PLD})
+        versions = storage.cache.get('1:c:tabs')['chunks']
+        self.assertEquals(len(versions), 4)
+        self.assertEquals(len(storage.get_items(_USER, 'tabs')['items']), 2)
+        # Changing the number of chunks converts it again.
+        storage.cache_collection_chunks = 2
+        self.assertEquals(len(storage.get_items(_USER, 'tabs')['items']), 2)
+        time.sleep(0.01)
+        storage.set_item(_USER, 'tabs', '3', {'payload': _PLD})
+        self.assertEquals(len(storage.cache.get('1:c:tabs')['chunks']), 2)
+        for i, version in enumerate(versions):
+            key = '1:c:tabs:%d:%d' % (i, version)
+            self.assertEquals(storage.cache.get(key), None)
+        # And back to a single key.
+        storage.cache_collection_chunks = 0
+        time.sleep(0.01)
+        storage.set_item(_USER, 'tabs', '4', {'payload': _PLD})
+        self.assertEquals(len(storage.cache.get('1:c:tabs')['items']), 4)
+
+    def test_cache_fills_are_guarded_by_a_lease(self):
+        storage = self.storage
+        storage.set_item(_USER, 'meta', '1', {'payload': _PLD})
+        storage.cache.delete('1:metadata')
+        storage.cache.delete('1:c:meta')
+
+        def read_collection():
+            storage.get_collection_timestamp(_USER, 'meta')
+            storage.get_items(_USER, 'meta')
+
+        metrics = self._collect_metrics(read_collection)
+        self.assertEquals(metrics.get(LEASE_FILLS_METRIC), 2)
+        self.assertFalse(LEASE_WAITS_METRIC in metrics)
+        self.assertTrue(storage.cache.get('1:metadata') is not None)
+        self.assertTrue(storage.cache.get('1:c:meta') is not None)
+        # The leases are released once the data has been filled in.
+        self.assertEquals(storage.cache.get('1:metadata:lease'), None)
+        self.assertEquals(storage.cache.get('1:c:meta:lease'), None)
+
+    def test_requests_wait_for_the_lease_holder_then_fall_back(self):
+        storage = self.storage
+        storage.cache_fill_wait = 0.2
+        storage.set_item(_USER, 'meta', '1', {'payload': _PLD})
+        storage.cache.delete('1:metadata')
+        # Simulate some other request holding the lease.
+        storage.cache.set('1:metadata:lease', True)
+        start = time.time()
+        metrics = self._collect_metrics(storage.get_collection_timestamps,
+                                        _USER)
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEquals(metrics.get(LEASE_WAITS_METRIC), 1)
+        self.assertEquals(metrics.get(LEASE_FALLBACKS_METRIC), 1)
+        self.assertFalse(LEASE_FILLS_METRIC in metrics)
+        # It read from the storage, but left the filling to the lease holder.
+        self.assertEquals(storage.cache.get('1:metadata'), None)
+        # Requests stop waiting as soon as the lease holder fills it in.
+        storage.cache.delete('1:metadata:lease')
+        storage.get_collection_timestamps(_USER)
+        storage.cache.set('1:metadata:lease', True)
+        metrics = self._collect_metrics(storage.get_collection_timestamps,
+                                        _USER)
+        self.assertFalse(LEASE_WAITS_METRIC in metrics)
+        # Writes can still proceed while the lease is held.
+        storage.cache.delete('1:metadata')
+        time.sleep(0.01)
+        storage.set_item(_USER, 'meta', '2', {'payload': _PLD})
+        self.assertEquals(len(storage.get_items(_USER, 'meta')['items']), 2)
+
+    def test_cache_fill_leases_can_be_disabled(self):
+        storage = self.storage
+        storage.cache_fill_lease_ttl = 0
+        storage.set_item(_USER, 'meta', '1', {'payload': _PLD})
+        storage.cache.delete('1:metadata')
+        storage.cache.set('1:metadata:lease', True)
+        metrics = self._collect_metrics(storage.get_collection_timestamps,
+                                        _USER)
+        self.assertFalse(LEASE_WAITS_METRIC in metrics)
+        self.assertTrue(storage.cache.get('1:metadata') is not None)
+        storage.cache.delete('1:metadata:lease')
+
+    def test_write_behind_of_cache_only_collections(self):
+        storage = self.storage
+        sqlstorage = self.storage.storage
+        storage.write_behind = WriteBehindQueue(storage._save_snapshot,
+                                                delay=60)
+        metrics = self._collect_metrics(storage.set_item, _USER, 'tabs', '1',
+                                        {'payload': _PLD, 'ttl': 100})
+        self.assertEquals(metrics.get(WRITE_BEHIND_DEPTH_METRIC), 1)
+        time.sleep(0.01)
+        storage.set_item(_USER, 'tabs', '2', {'payload': _PLD})
+        time.sleep(0.01)
+        storage.write_behind.join()
+        self.assertEquals(storage.write_behind.num_flushed, 1)
+        items = sqlstorage.get_items(_USER, 'tabs:snapshot')['items']
+        self.assertEquals([item['id'] for item in items], ['snapshot'])
+
+        # The snapshot is hidden from the collection listings.
+        storage.cache.delete('1:metadata')
+        self.assertEquals(storage.get_collection_timestamps(_USER).keys(),
+                          ['tabs'])
+        self.assertEquals(storage.get_collection_counts(_USER), {'tabs': 2})
+        self.assertEquals(storage.get_collection_sizes(_USER),
+                          {'tabs': len(_PLD) * 2})
+        self.assertEquals(storage.get_total_size(_USER, True), len(_PLD) * 2)
+        # Saving it doesn't count as a change to the storage.
+        self.assertEquals(storage.get_storage_timestamp(_USER),
+                          storage.get_collection_timestamp(_USER, 'tabs'))
+
+        # It's reloaded if the cached data goes missing.
+        expected = storage.get_items(_USER, 'tabs')
+        storage.cache.delete('1:c:tabs')
+        storage.get_collection_timestamp(_USER, 'tabs')
+        result = []
+        metrics = self._collect_metrics(
+            lambda: result.append(storage.get_items(_USER, 'tabs')))
+        self.assertEquals(metrics.get(SNAPSHOT_RELOADS_METRIC), 1)
+        self.assertEquals(result[0], expected)
+
+        # But not if the collection was deleted.
+        time.sleep(0.01)
+        storage.delete_collection(_USER, 'tabs')
+        storage.write_behind.join()
+        self.assertRaises(CollectionNotFoundError,
+                          sqlstorage.get_items, _USER, 'tabs:snapshot')
+        self.assertRaises(CollectionNotFoundError,
+                          storage.get_items, _USER, 'tabs')
+
+    def test_close_saves_pending_snapshots(self):
+        storage = self.storage
+        sqlstorage = self.storage.storage
+        storage.write_behind = WriteBehindQueue(storage._save_snapshot,
+                                                delay=60)
+        storage.set_item(_USER, 'tabs', '1', {'payload': _PLD})
+        self.assertEquals(storage.write_behind.depth, 1)
+        self.assertRaises(CollectionNotFoundError,
+                          sqlstorage.get_items, _USER, 'tabs:snapshot')
+        storage.close()
+        self.assertEquals(storage.write_behind.num_flushed, 1)
+        items = sqlstorage.get_items(_USER, 'tabs:snapshot')['items']
+        self.assertEquals([item['id'] for item in items], ['snapshot'])
+
+    def test_storage_is_closed_at_exit(self):
+        registered = []
+        register = atexit.register
+        atexit.register = registered.append
+        try:
+            self.config.include("syncstorage.storage")
+        finally:
+            atexit.register = register
+        storage = self.config.registry["syncstorage:storage:default"]
+        self.assertEquals(registered, [storage.close])
+
+    def test_auto_promotion_of_hot_collections(self):
+        storage = self.storage
+        # Use a zero-length window, so that any collection read
+        # in one call is promoted by the next.
+        storage.promoter = CollectionPromoter(window=0, min_reads=1,
+                                              min_hit_ratio=0)
+        storage.set_item(_USER, 'xxx_col1', '1', {'payload': _PLD})
+
+        def read_collection():
+            with storage.lock_for_read(_USER, 'xxx_col1'):
+                return storage.get_items(_USER, 'xxx_col1')['items']
+
+        read_collection()
+        self.assertFalse(storage.promoter.is_promoted('xxx_col1'))
+        metrics = self._collect_metrics(read_collection)
+        self.assertTrue(storage.promoter.is_promoted('xxx_col1'))
+        self.assertFalse(PROMOTED_MISSES_METRIC in metrics)
+        self.assertEquals(storage.cache.get('1:c:xxx_col1'), None)
+
+        # Once promoted, the collection is read through the cache.
+        metrics = self._collect_metrics(read_collection)
+        self.assertEquals(metrics.get(PROMOTED_MISSES_METRIC), 1)
+        self.assertTrue(storage.cache.get('1:c:xxx_col1') is not None)
+        metrics = self._collect_metrics(read_collection)
+        self.assertEquals(metrics.get(PROMOTED_HITS_METRIC), 1)
+        self.assertEquals(metrics.get(ROUND_TRIPS_METRIC), 1)
+
+        # Writes go straight to the database, making the cache stale.
+        time.sleep(0.01)
+        storage.set_item(_USER, 'xxx_col1', '2', {'payload': _PLD})
+        metrics = self._collect_metrics(read_collection)
+        self.assertEquals(metrics.get(PROMOTED_MISSES_METRIC), 1)
+        self.assertEquals(sorted(item['id'] for item in read_collection()),
+                          ['1', '2'])
+        self.assertEquals(storage.get_item(_USER, 'xxx_col1', '2')['payload'],
+                          _PLD)
+        time.sleep(0.01)
+        storage.delete_item(_USER, 'xxx_col1', '2')
+        self.assertEquals([item['id'] for item in read_collection()], ['1'])
+        time.sleep(0.01)
+        storage.set_item(_USER, 'xxx_col1', '2', {'payload': _PLD})
+
+        # Collections that turn out to be too big are demoted.
+        storage.promoter.max_size = len(_PLD)
+        self.assertEquals(len(read_collection()), 2)
+        self.assertFalse(storage.promoter.is_promoted('xxx_col1'))
+        self.assertEquals(storage.cache.get('1:c:xxx_col1'), None)
+        report = storage.promoter.report()
+        self.assertEquals(report[0]["collection"], 'xxx_col1')
+        self.assertEquals(report[0]["hits"], 3)
+        self.assertEquals(report[0]["misses"], 4)
+
+    def test_size_recalculation_after_write_with_metadata_in_memory(self):
+        storage = self.storage
+        storage.local_metadata = LocalCache(ttl=60)
+        storage.set_item(_USER, 'foo', '1', {'payload': _PLD})
+        # The in-memory copy written by set_item has no casid,
+        # but the recalculated size must still reach memcache.
+        self.assertEquals(storage.get_total_size(_USER, True), len(_PLD))
+        metadata = storage.cache.get('1:metadata')
+        self.assertEquals(metadata['size'], len(_PLD))
+        self.assertTrue(metadata['last_size_recalc'] > 0)
+
+    def test_metadata_is_kept_in_memory_between_requests(self):
+        storage = self.storage
+        storage.local_metadata = LocalCache(ttl=60)
+        storage.set_item(_USER, 'foo', '1', {'payload': _PLD})
+        ts = storage.get_collection_timestamp(_USER, 'foo')
+
+        # Reads use the in-memory copy, without any round trips.
+        metrics = self._collect_metrics(storage.get_collection_timestamps,
+                                        _USER)
+        self.assertEquals(metrics.get(LOCAL_METADATA_HITS_METRIC), 1)
+        self.assertFalse(ROUND_TRIPS_METRIC in metrics)
+        self.assertEquals(self._count_round_trips(
+            storage.get_storage_timestamp, _USER), 0)
+
+        # Callers can't modify the in-memory copy.
+        storage.get_collection_timestamps(_USER)['foo'] = 0
+        self.assertEquals(storage.get_collection_timestamp(_USER, 'foo'), ts)
+
+        # Changes made by other processes go unseen until it expires.
+        metadata = storage.cache.get('1:metadata')
+        metadata['collections']['bar'] = ts
+        storage.cache.set('1:metadata', metadata)
+        self.assertFalse('bar' in storage.get_collection_timestamps(_USER))
+        storage.local_metadata.clear()
+        metrics = self._collect_metrics(storage.get_collection_timestamps,
+                                        _USER)
+        self.assertEquals(metrics.get(LOCAL_METADATA_MISSES_METRIC), 1)
+        self.assertTrue('bar' in storage.get_collection_timestamps(_USER))
+
+        # Changes made by this process are seen immediately.
+        time.sleep(0.01)
+        ts = storage.set_item(_USER, 'foo', '2', {'payload': _PLD})['modified']
+        self.assertEquals(self._count_round_trips(
+            storage.get_collection_timestamp, _USER, 'foo'), 0)
+        self.assertEquals(storage.get_collection_timestamp(_USER, 'foo'), ts)
+        self.assertEquals(storage.get_total_size(_USER), len(_PLD) * 2)
+
+        # Writers always read the latest metadata from memcache.
+        metadata = storage.cache.get('1:metadata')
+        metadata['collections']['baz'] = ts
+        storage.cache.set('1:metadata', metadata)
+        time.sleep(0.01)
+        with storage.lock_for_write(_USER, 'foo'):
+            self.assertTrue('baz' in storage.get_collection_timestamps(_USER))
+        self.assertTrue(storage.local_metadata.hit_ratio > 0.5)
+
+        # It can be disabled.
+        storage.local_metadata = None
+        metrics = self._collect_metrics(storage.get_collection_timestamps,
+                                        _USER)
+        self.assertEquals(metrics.get(ROUND_TRIPS_METRIC), 1)
+        self.assertFalse(LOCAL_METADATA_HITS_METRIC in metrics)
+
+    def test_cached_collections_keep_their_items_sorted(self):
+        storage = self.storage
+
+        def check_sort_orders(key):
+            data = storage.cache.get(key)
+            if 'items' in data:
+                chunks = [data]
+            else:
+                # Each chunk holds the sorted ids of its own items.
+                self.assertFalse('by_modified' in data)
+                chunks = []
+                for i, version in enumerate(data['chunks']):
+                    if version:
+                        chunk_key = '%s:%d:%d' % (key, i, version)
+                        chunks.append(storage.cache.get(chunk_key))
+            modified = []
+            for chunk in chunks:
+                items = chunk['items']
+                by_modified = sorted(items, key=lambda id: (
+                    items[id]['modified'], id))
+                by_index = sorted(items, key=lambda id: (
+                    items[id].get('sortindex'), id))
+                self.assertEquals(chunk['by_modified'], by_modified)
+                self.assertEquals(chunk['by_index'], by_index)
+                modified.extend(items[id]['modified'] for id in by_modified)
+            return modified
+
+        for num_chunks in (0, 4):
+            storage.cache_collection_chunks = num_chunks
+            storage.set_items(_USER, 'tabs', [
+                {'id': str(i), 'payload': _PLD, 'sortindex': i % 3}
+                for i in xrange(10)
+            ])
+            time.sleep(0.01)
+            storage.set_items(_USER, 'tabs', [
+                {'id': '3', 'payload': _PLD},
+                {'id': '11', 'payload': _PLD},
+                {'id': '5', 'sortindex': 7},
+            ])
+            time.sleep(0.01)
+            storage.delete_items(_USER, 'tabs', ['0', '7'])
+            ts1, ts2 = sorted(set(check_sort_orders('1:c:tabs')))
+
+            # Reads are answered from the sorted ids.
+            def get_ids(**kwds):
+                return storage.get_item_ids(_USER, 'tabs', **kwds)
+
+            self.assertEquals(get_ids(sort='oldest')['items'],
+                              ['1', '2', '4', '5', '6', '8', '9', '11', '3'])
+            self.assertEquals(get_ids(sort='newest')['items'],
+                              ['11', '3', '1', '2', '4', '5', '6', '8', '9'])
+            self.assertEquals(get_ids(sort='index')['items'],
+                              ['5', '8', '2', '4', '1', '9', '6', '3', '11'])
+            self.assertEquals(get_ids(newer=ts1, sort='oldest')['items'],
+                              ['11', '3'])
+            self.assertEquals(get_ids(older=ts2, sort='newest', limit=2,
+                                      offset=3)['items'], ['5', '6'])
+            self.assertEquals(get_ids(newer=ts1, sort='index')['items'],
+                              ['3', '11'])
+            res = get_ids(sort='index', limit=4)
+            self.assertEquals(res['items'], ['5', '8', '2', '4'])
+            res = get_ids(sort='index', limit=4, offset=res['next_offset'])
+            self.assertEquals(res['items'], ['1', '9', '6', '3'])
+            res = get_ids(sort='index', limit=4, offset=res['next_offset'])
+            self.assertEquals(res['items'], ['11'])
+            self.assertEquals(res['next_offset'], None)
+            res = get_ids(ids=['9', '3', '0'], sort='oldest')
+            self.assertEquals(res['items'], ['9', '3'])
+            time.sleep(0.01)
+            storage.delete_collection(_USER, 'tabs')
+
+        # Data cached without the sorted ids is sorted when read,
+        # and has them added on the next write.
+        storage.cache_collection_chunks = 0
+        storage.set_items(_USER, 'meta', [{'id': 'b', 'payload': _PLD},
+                                          {'id': 'a', 'payload': _PLD}])
+        data = storage.cache.get('1:c:meta')
+        del data['by_modified']
+        del data['by_index']
+        del data['sort_orders']
+        storage.cache.set('1:c:meta', data)
+        metrics = self._collect_metrics(storage.get_item_ids, _USER, 'meta')
+        self.assertEquals(metrics.get(SORT_ORDER_REBUILDS_METRIC), 1)
+        time.sleep(0.01)
+        storage.set_item(_USER, 'meta', 'c', {'payload': _PLD})
+        check_sort_orders('1:c:meta')
+        metrics = self._collect_metrics(storage.get_item_ids, _USER, 'meta')
+        self.assertFalse(SORT_ORDER_REBUILDS_METRIC in metrics)
+
+        # Sorted ids stamped with an older version or timestamp, as left by
+        # code that didn't keep them up to date, are checked and rebuilt too,
+        # even if there are the right number of them.
+        for stamp in ([0, None], [SORT_ORDERS_VERSION, 0]):
+            data = storage.cache.get('1:c:meta')
+            self.assertEquals(data['sort_orders'],
+                              [SORT_ORDERS_VERSION, data['modified']])
+            data['by_modified'].reverse()
+            data['sort_orders'][:] = stamp
+            storage.cache.set('1:c:meta', data)
+            res = []
+            metrics = self._collect_metrics(
+                lambda: res.append(storage.get_item_ids(_USER, 'meta',
+                                                        sort='oldest')))
+            self.assertEquals(metrics.get(SORT_ORDER_REBUILDS_METRIC), 1)
+            self.assertEquals(res[0]['items'], ['a', 'b', 'c'])
+            time.sleep(0.01)
+            storage.set_item(_USER, 'meta', 'c', {'payload': _PLD})
+
+        # Chunks cached without them are rewritten in full on the next write.
+        storage.cache_collection_chunks = 4
+        time.sleep(0.01)
+        storage.set_item(_USER, 'meta', 'd', {'payload': _PLD})
+        versions = storage.cache.get('1:c:meta')['chunks']
+        for i, version in enumerate(versions):
+            if version:
+                chunk_key = '1:c:meta:%d:%d' % (i, version)
+                chunk = storage.cache.get(chunk_key)
+                del chunk['by_modified']
+                storage.cache.set(chunk_key, chunk)
+        metrics = self._collect_metrics(storage.get_item_ids, _USER, 'meta')
+        self.assertEquals(metrics.get(SORT_ORDER_REBUILDS_METRIC), 1)
+        time.sleep(0.01)
+        storage.set_item(_USER, 'meta', 'e', {'payload': _PLD})
+        check_sort_orders('1:c:meta')
+        metrics = self._collect_metrics(storage.get_item_ids, _USER, 'meta')
+        self.assertFalse(SORT_ORDER_REBUILDS_METRIC in metrics)
+
+    def test_expired_items_are_found_by_ttl_order(self):
+        storage = self.storage
+        storage.set_items(_USER, 'tabs', [
+            {'id': 'a', 'payload': _PLD, 'ttl': 1000},
+            {'id': 'b', 'payload': _PLD},
+            {'id': 'c', 'payload': _PLD, 'ttl': 2000},
+            {'id': 'd', 'payload': _PLD, 'ttl': 3000},
+        ])
+        data = storage.cache.get('1:c:tabs')
+        self.assertEquals(data['by_ttl'], ['a', 'c', 'd'])
+
+        # Pretend that some of them expired a while ago.  Data without
+        # the ttl order has it added when read.
+        now = int(time.time())
+        data['items']['c']['ttl'] = now - 10
+        data['items']['d']['ttl'] = now - TTL_EXPIRY_GRACE_PERIOD - 10
+        del data['by_ttl']
+        storage.cache.set('1:c:tabs', data)
+        res = storage.get_item_ids(_USER, 'tabs', sort='oldest')
+        self.assertEquals(res['items'], ['a', 'b'])
+        self.assertRaises(ItemNotFoundError,
+                          storage.get_item, _USER, 'tabs', 'c')
+
+        # Writes purge the items that expired before the grace period.
+        time.sleep(0.01)
+        storage.set_item(_USER, 'tabs', 'e', {'payload': _PLD, 'ttl': 10})
+        data = storage.cache.get('1:c:tabs')
+        self.assertEquals(sorted(data['items']), ['a', 'b', 'c', 'e'])
+        self.assertEquals(data['by_ttl'], ['c', 'e', 'a'])
+        self.assertEquals(len(data['by_modified']), 4)
+
+        # Changing the ttl moves the item within the order.
+        time.sleep(0.01)
+        storage.set_items(_USER, 'tabs', [{'id': 'a', 'ttl': 1},
+                                          {'id': 'e', 'ttl': None}])
+        data = storage.cache.get('1:c:tabs')
+        self.assertEquals(data['by_ttl'], ['c', 'a'])
+        res = storage.get_item_ids(_USER, 'tabs', sort='oldest')
+        self.assertEquals(res['items'], ['a', 'b', 'e'])
+
+    def test_circuit_breaker_trips_on_memcache_failures(self):
+        breaker = CircuitBreaker("memcached", max_failures=2,
+                                 reset_timeout=60)
+        cache = MemcachedClient("127.0.0.1:1", breaker=breaker)
+        metrics = self._collect_metrics(self.assertRaises,
+                                        BackendError, cache.get, 'x')
+        self.assertEquals(metrics.get(ROUND_TRIPS_METRIC), 1)
+        self.assertRaises(BackendError, cache.get, 'x')
+        self.assertEquals(breaker.state, OPEN)
+        self.assertEquals(breaker.num_trips, 1)
+        # Later calls fail without even trying to connect.
+        metrics = self._collect_metrics(self.assertRaises,
+                                        CircuitOpenError, cache.get, 'x')
+        self.assertEquals(metrics.get(BREAKER_REFUSED_METRIC), 1)
+        self.assertFalse(ROUND_TRIPS_METRIC in metrics)
+
+    def test_storage_falls_back_while_circuit_breaker_is_open(self):
+        storage = self.storage
+        storage.set_item(_USER, 'meta', 'global', {'payload': _PLD})
+        storage.set_item(_USER, 'tabs', 'home', {'payload': _PLD})
+        storage.set_item(_USER, 'foo', 'bar', {'payload': _PLD})
+        breaker = storage.cache.breaker
+        breaker.reset_timeout = 60
+        metrics = self._collect_metrics(
+            lambda: [breaker.record_failure()
+                     for _ in xrange(breaker.max_failures)])
+        self.assertEquals(breaker.state, OPEN)
+        self.assertEquals(metrics.get(BREAKER_TRIPS_METRIC), 1)
+
+        # Reads of the metadata and cached collections use the database.
+        def read():
+            with storage.lock_for_read(_USER, 'meta'):
+                res = storage.get_item(_USER, 'meta', 'global')
+                self.assertEquals(res['payload'], _PLD)
+            timestamps = storage.get_collection_timestamps(_USER)
+            self.assertEquals(sorted(timestamps), ['foo', 'meta'])
+            self.assertEquals(storage.get_collection_counts(_USER),
+                              {'foo': 1, 'meta': 1})
+        metrics = self._collect_metrics(read)
+        self.assertFalse(ROUND_TRIPS_METRIC in metrics)
+        self.assertTrue(metrics.get(BREAKER_FALLBACKS_METRIC) > 1)
+
+        # Writes, cache-only collections and cache locks fail fast.
+        time.sleep(0.01)
+        self.assertRaises(CircuitOpenError, storage.set_item,
+                          _USER, 'foo', 'baz', {'payload': _PLD})
+        self.assertRaises(CircuitOpenError, storage.get_items, _USER, 'tabs')
+        storage.cache_lock = True
+        self.assertRaises(CircuitOpenError,
+                          storage.lock_for_read(_USER, 'foo').__enter__)
+        storage.cache_lock = False
+        self.assertTrue(breaker.num_refused > 0)
+
+        # Once memcache can be reached again, the breaker closes.
+        breaker.reset_timeout = 0
+        metrics = self._collect_metrics(storage.get_items, _USER, 'tabs')
+        self.assertEquals(breaker.state, CLOSED)
+        self.assertEquals(metrics.get(BREAKER_RECOVERIES_METRIC), 1)
+        time.sleep(0.01)
+        storage.set_item(_USER, 'foo', 'baz', {'payload': _PLD})
+        self.assertEquals(storage.get_collection_counts(_USER),
+                          {'foo': 2, 'meta': 1, 'tabs': 1})
+
+    def test_metadata_is_replicated_across_the_hash_ring(self):
+        prefix = self.storage.cache.key_prefix
+        storage = MemcachedStorage(self.storage.storage,
+                                   cache_servers="127.0.0.1:11211 127.0.0.1:1",
+                                   cache_key_prefix=prefix,
+                                   cached_collections="meta",
+                                   cache_metadata_replicas=2,
+                                   cache_breaker_failures=1,
+                                   cache_local_metadata=False)
+        cache = storage.cache
+        self.assertTrue(isinstance(cache, HashRingMemcachedClient))
+        self.assertEquals(cache.servers, ["127.0.0.1:1", "127.0.0.1:11211"])
+        self.assertEquals(sorted(cache.get_servers('1:metadata')),
+                          cache.servers)
+        self.assertEquals(len(cache.get_servers('1:c:meta')), 1)
+
+        # With one server down, the metadata can still be read and written.
+        # Failures open the breaker for that server, after which it's
+        # skipped without waiting for it.
+        storage.set_item(_USER, 'foo', '1', {'payload': _PLD})
+        ts = storage.get_collection_timestamp(_USER, 'foo')
+        dead_breaker = cache.clients["127.0.0.1:1"].breaker
+        self.assertEquals(dead_breaker.num_trips, 1)
+        self.assertEquals(self._count_round_trips(
+            storage.get_collection_timestamp, _USER, 'foo'), 1)
+        time.sleep(0.01)
+        ts = storage.set_item(_USER, 'foo', '2', {'payload': _PLD})['modified']
+        self.assertEquals(storage.get_collection_timestamp(_USER, 'foo'), ts)
+        self.assertEquals(storage.get_total_size(_USER), len(_PLD) * 2)
+        self.assertEquals(cache.get_replicas('1:metadata'),
+                          [('127.0.0.1:11211', cache.get('1:metadata'))])
+
+        # Casids are sent back to the server that they came from.
+        data, casid = cache.gets('1:metadata')
+        self.assertEquals(casid[0], '127.0.0.1:11211')
+        self.assertTrue(cache.cas('1:metadata', data, casid))
+        self.assertFalse(cache.cas('1:metadata', data, casid))
+        with cache.prefetching(['1:metadata']):
+            data, casid = cache.gets('1:metadata')
+        self.assertTrue(cache.cas('1:metadata', data, casid))
+
+    def test_newest_replica_of_metadata_wins(self):
+        # Use two different key prefixes on the one server, to simulate
+        # two servers that can be read and written independently.
+        prefix = self.storage.cache.key_prefix
+        clients = {
+            "a": MemcachedClient("127.0.0.1:11211", prefix + "a:"),
+            "b": MemcachedClient("127.0.0.1:11211", prefix + "b:"),
+        }
+        cache = HashRingMemcachedClient(clients, replicate=_is_metadata_key,
+                                        num_replicas=2,
+                                        version=_metadata_version)
+        self.storage.cache = cache
+        self.storage.set_item(_USER, 'foo', '1', {'payload': _PLD})
+        stale = cache.get('1:metadata')
+        time.sleep(0.01)
+        ts = self.storage.set_item(_USER, 'foo', '2',
+                                   {'payload': _PLD})['modified']
+
+        # A server that missed some writes, e.g. while its breaker was open,
+        # is outvoted by the others however the ring orders them.
+        for server in ("a", "b"):
+            clients[server].set('1:metadata', stale)
+            self.assertEquals(cache.get('1:metadata')['modified'], ts)
+            self.assertEquals(cache.gets('1:metadata')[1][0],
+                              "b" if server == "a" else "a")
+            with cache.prefetching(['1:metadata']):
+                self.assertEquals(cache.get('1:metadata')['modified'], ts)
+            # Writes bring it up to date again.
+            data, casid = cache.gets('1:metadata')
+            self.assertTrue(cache.cas('1:metadata', data, casid))
+            self.assertEquals(clients[server].get('1:metadata'), data)
+
+        # Copies to the other replicas don't replace newer values,
+        # and metadata marked as dirty counts as newer than any other.
+        data, casid = clients["a"].gets('1:metadata')
+        dirty = dict(data, modified=None)
+        clients["b"].set('1:metadata', dirty)
+        self.assertEquals(cache.get('1:metadata')['modified'], None)
+        self.assertTrue(cache.cas('1:metadata', data, ("a", casid)))
+        self.assertEquals(clients["b"].get('1:metadata'), dirty)
+        self.assertEquals(cache.get('1:metadata')['modified'], None)
+        cache.set('1:metadata', data)
+        self.assertEquals(cache.get('1:metadata')['modified'], ts)
+
 
 def test_suite():
     suite = unittest2.TestSuite()
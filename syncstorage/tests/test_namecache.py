@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+
+import unittest2
+
+from syncstorage.storage.namecache import CollectionNameCache
+
+
+class TestCollectionNameCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.tempdir, "collections")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_fixed_entries_are_never_evicted(self):
+        cache = CollectionNameCache({1: "clients", 2: "crypto"}, max_size=2)
+        for id in xrange(100, 110):
+            cache.set(id, "custom%d" % (id,))
+        self.assertEquals(cache.get_id("clients"), 1)
+        self.assertEquals(cache.get_name(2), "crypto")
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = CollectionNameCache(max_size=2)
+        cache.set(100, "one")
+        cache.set(101, "two")
+        # Touch "one" so that "two" becomes the least recently used.
+        self.assertEquals(cache.get_id("one"), 100)
+        cache.set(102, "three")
+        self.assertEquals(cache.get_name(100), "one")
+        self.assertEquals(cache.get_id("three"), 102)
+        self.assertRaises(KeyError, cache.get_id, "two")
+        self.assertRaises(KeyError, cache.get_name, 101)
+
+    def test_hits_and_misses_are_counted(self):
+        cache = CollectionNameCache()
+        self.assertRaises(KeyError, cache.get_id, "one")
+        cache.set(100, "one")
+        cache.get_id("one")
+        cache.get_name(100)
+        self.assertEquals(cache.hits, 2)
+        self.assertEquals(cache.misses, 1)
+
+    def test_lookups_can_be_served_from_snapshot_file(self):
+        loads = []
+
+        def loader():
+            loads.append(True)
+            return [(100, "one"), (101, "two")]
+
+        cache1 = CollectionNameCache(snapshot_file=self.snapshot_file)
+        self.assertEquals(cache1.get_id("two", loader), 101)
+        self.assertEquals(len(loads), 1)
+        # Another process can read the file without calling the loader.
+        cache2 = CollectionNameCache(snapshot_file=self.snapshot_file)
+        self.assertEquals(cache2.get_name(100, loader), "one")
+        self.assertEquals(cache2.get_id("two", loader), 101)
+        self.assertRaises(KeyError, cache2.get_id, "three", loader)
+        self.assertEquals(len(loads), 1)
+
+    def test_stale_snapshot_file_is_refreshed_on_miss(self):
+        collections = [(100, "one")]
+        cache = CollectionNameCache(snapshot_file=self.snapshot_file,
+                                    snapshot_refresh_interval=0)
+        self.assertEquals(cache.get_id("one", lambda: collections), 100)
+        collections.append((101, "two"))
+        os.utime(self.snapshot_file, (0, 0))
+        self.assertEquals(cache.get_name(101, lambda: collections), "two")
@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest2
+import testfixtures
+
+from syncstorage.storage.promotion import (CollectionPromoter,
+                                           DEMOTION_COOLDOWN_WINDOWS)
+
+
+WINDOW = 0.05
+
+
+class TestCollectionPromoter(unittest2.TestCase):
+
+    def _read(self, promoter, collection, count, size=None):
+        for _ in xrange(count):
+            promoter.record_read(collection, size)
+
+    def _next_window(self, promoter):
+        time.sleep(WINDOW)
+        promoter.record_read("xxx_other")
+
+    def test_frequently_read_collections_are_promoted(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=10)
+        self._read(promoter, "forms", 10, size=100)
+        self._read(promoter, "history", 9, size=100)
+        self.assertFalse(promoter.is_promoted("forms"))
+        self._next_window(promoter)
+        self.assertTrue(promoter.is_promoted("forms"))
+        self.assertFalse(promoter.is_promoted("history"))
+        # They stay promoted while read at least half as often.
+        self._read(promoter, "forms", 5)
+        self._next_window(promoter)
+        self.assertTrue(promoter.is_promoted("forms"))
+        self._read(promoter, "forms", 4)
+        self._next_window(promoter)
+        self.assertFalse(promoter.is_promoted("forms"))
+
+    def test_large_collections_are_not_promoted(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=10,
+                                      max_size=1000)
+        self._read(promoter, "forms", 10, size=2000)
+        self._read(promoter, "prefs", 10, size=100)
+        self._next_window(promoter)
+        self.assertFalse(promoter.is_promoted("forms"))
+        self.assertTrue(promoter.is_promoted("prefs"))
+        # They're demoted as soon as they're found to be too big.
+        promoter.record_miss("prefs", 500)
+        self.assertTrue(promoter.is_promoted("prefs"))
+        promoter.record_miss("prefs", 50000)
+        self.assertFalse(promoter.is_promoted("prefs"))
+
+    def test_collections_of_unknown_size_are_not_promoted(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=10)
+        # Partial reads don't tell us the size of the collection.
+        self._read(promoter, "history", 20)
+        self._next_window(promoter)
+        self.assertFalse(promoter.is_promoted("history"))
+        # Until it has been read in full.
+        self._read(promoter, "history", 19)
+        self._read(promoter, "history", 1, size=100)
+        self._next_window(promoter)
+        self.assertTrue(promoter.is_promoted("history"))
+
+    def test_number_of_promoted_collections_is_limited(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=10,
+                                      max_promoted=2)
+        self._read(promoter, "forms", 10, size=100)
+        self._read(promoter, "prefs", 20, size=100)
+        self._read(promoter, "addons", 30, size=100)
+        self._next_window(promoter)
+        self.assertFalse(promoter.is_promoted("forms"))
+        self.assertTrue(promoter.is_promoted("prefs"))
+        self.assertTrue(promoter.is_promoted("addons"))
+
+    def test_low_hit_ratio_demotes_with_cooldown(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=4,
+                                      min_hit_ratio=0.5)
+        self._read(promoter, "forms", 4, size=100)
+        self._next_window(promoter)
+        self.assertTrue(promoter.is_promoted("forms"))
+        self._read(promoter, "forms", 4)
+        promoter.record_hit("forms")
+        for _ in xrange(3):
+            promoter.record_miss("forms")
+        self._next_window(promoter)
+        self.assertFalse(promoter.is_promoted("forms"))
+        # It's not promoted again for a while, however often it's read.
+        for _ in xrange(DEMOTION_COOLDOWN_WINDOWS - 1):
+            self._read(promoter, "forms", 4)
+            self._next_window(promoter)
+            self.assertFalse(promoter.is_promoted("forms"))
+        self._read(promoter, "forms", 4)
+        self._next_window(promoter)
+        self.assertTrue(promoter.is_promoted("forms"))
+
+    def test_report(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=10)
+        self._read(promoter, "forms", 10, size=100)
+        self._read(promoter, "prefs", 5)
+        self._next_window(promoter)
+        promoter.record_hit("forms")
+        promoter.record_hit("forms")
+        promoter.record_hit("forms")
+        promoter.record_miss("forms", 100)
+        report = promoter.report()
+        self.assertEquals([r["collection"] for r in report],
+                          ["forms", "prefs", "xxx_other"])
+        self.assertEquals(report[0], {
+            "collection": "forms",
+            "promoted": True,
+            "reads": 10,
+            "size": 100,
+            "hits": 3,
+            "misses": 1,
+            "hit_ratio": 0.75,
+        })
+        self.assertFalse(report[1]["promoted"])
+        self.assertEquals(report[1]["hit_ratio"], None)
+
+    def test_summary_is_logged_at_end_of_each_window(self):
+        promoter = CollectionPromoter(window=WINDOW, min_reads=10)
+        self._read(promoter, "forms", 10, size=100)
+        self._read(promoter, "prefs", 5)
+        with testfixtures.LogCapture() as logs:
+            self._next_window(promoter)
+        self.assertEquals(len(logs.records), 2)
+        self.assertEquals(logs.records[1].getMessage(),
+                          "Collection reads per %ss, across all users: "
+                          "forms (promoted, 10 reads, 100 bytes); "
+                          "prefs (5 reads)" % (WINDOW,))
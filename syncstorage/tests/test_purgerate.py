@@ -0,0 +1,52 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest2
+
+from syncstorage.storage.purgerate import PurgeRateController
+
+
+class TestPurgeRateController(unittest2.TestCase):
+
+    def test_batch_size_grows_while_under_target_latency(self):
+        controller = PurgeRateController(100, target_latency=1)
+        self.assertEquals(controller.record(100, 0.1), 0)
+        self.assertEquals(controller.batch_size, 150)
+        # A partial batch means the backlog is cleared, so don't grow.
+        controller.record(20, 0.1)
+        self.assertEquals(controller.batch_size, 150)
+        for _ in xrange(20):
+            controller.record(controller.batch_size, 0.1)
+        self.assertEquals(controller.batch_size, 1000)
+
+    def test_backs_off_when_over_target_latency(self):
+        controller = PurgeRateController(100, target_latency=1, max_sleep=5)
+        self.assertEquals(controller.record(100, 2), 2)
+        self.assertEquals(controller.batch_size, 50)
+        self.assertEquals(controller.record(50, 2), 4)
+        self.assertEquals(controller.record(25, 2), 5)
+        self.assertEquals(controller.batch_size, 12)
+        self.assertEquals(controller.record(12, 2), 5)
+        self.assertEquals(controller.batch_size, 10)
+        self.assertEquals(controller.num_throttled, 4)
+        # Recovery halves the sleep each time.
+        self.assertEquals(controller.record(10, 0.6), 2.5)
+        self.assertEquals(controller.batch_size, 10)
+
+    def test_backs_off_on_replication_lag(self):
+        controller = PurgeRateController(100, max_replication_lag=5)
+        controller.record(100, 0.01, replication_lag=1)
+        self.assertEquals(controller.batch_size, 150)
+        self.assertTrue(controller.record(150, 0.01, replication_lag=10) > 0)
+        self.assertEquals(controller.batch_size, 75)
+
+    def test_rate_includes_sleep_time(self):
+        controller = PurgeRateController(100, target_latency=1)
+        self.assertEquals(controller.rows_per_second, 0)
+        controller.record(100, 2)
+        controller.record(50, 1)
+        self.assertEquals(controller.num_purged, 150)
+        self.assertEquals(controller.busy_time, 3)
+        self.assertEquals(controller.sleep_time, 3)
+        self.assertEquals(controller.rows_per_second, 25)
@@ -0,0 +1,56 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest2
+
+from syncstorage.util import json_loads
+from syncstorage.views.renderers import (StreamedItems,
+                                         JsonRenderer,
+                                         NewlinesRenderer)
+
+
+class TestStreamedItems(unittest2.TestCase):
+
+    def _pages(self):
+        yield [{"id": "a"}, {"id": "b"}]
+        yield []
+        yield [{"id": "c\n"}]
+        raise AssertionError("read past the end of the pages")
+
+    def test_json_is_rendered_one_page_at_a_time(self):
+        renderer = JsonRenderer(None)
+        chunks = renderer.render_value(StreamedItems(self._pages(), 3))
+        self.assertEquals(json_loads(next(chunks) + "]"),
+                          [{"id": "a"}, {"id": "b"}])
+        self.assertEquals(json_loads("[" + next(chunks)[1:] + "]"),
+                          [{"id": "c\n"}])
+        self.assertRaises(AssertionError, next, chunks)
+        chunks = renderer.render_value(StreamedItems(iter([]), 0))
+        self.assertEquals(json_loads("".join(chunks)), [])
+
+    def test_newlines_are_rendered_one_page_at_a_time(self):
+        renderer = NewlinesRenderer(None)
+        chunks = renderer.render_value(StreamedItems(self._pages(), 3))
+        self.assertEquals(next(chunks), '{"id": "a"}\n{"id": "b"}\n')
+        self.assertEquals(next(chunks), '')
+        self.assertEquals(next(chunks), '{"id": "c\\n"}\n')
+        self.assertRaises(AssertionError, next, chunks)
+
+    def test_pages_are_closed_when_rendering_is_abandoned(self):
+        closed = []
+
+        def pages():
+            try:
+                yield [{"id": "a"}]
+                yield [{"id": "b"}]
+            finally:
+                closed.append(True)
+
+        for renderer in (JsonRenderer(None), NewlinesRenderer(None)):
+            del closed[:]
+            chunks = renderer.render_value(StreamedItems(pages(), 2))
+            next(chunks)
+            self.assertEquals(closed, [])
+            chunks.close()
+            self.assertEquals(closed, [True])
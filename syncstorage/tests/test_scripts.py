@@ -5,12 +5,15 @@
 import os
 import sys
 import time
+import tempfile
 import unittest2
 import subprocess
 
 from mozsvc.exceptions import BackendError
 
+from syncstorage.util import json_dumps
 from syncstorage.tests.support import StorageTestCase
+from syncstorage.scripts.purgettl import PurgeCheckpoint, run_purge_task
 from syncstorage.storage import (load_storage_from_settings,
                                  NotFoundError,
                                  BATCH_LIFETIME)
@@ -109,6 +112,30 @@ class TestMemcacheManagementScripts(StorageTestCase):
         self.assertTrue("3:c:tabs" in output_keys)
 
 
+class TestMemcacheManagementScriptsRing(TestMemcacheManagementScripts):
+
+    TEST_INI_FILE = "tests-memcached-ring.ini"
+
+    def test_mcread_script_shows_servers(self):
+        self.storage.set_item(_USER2, "tabs", "test2", {"payload": "test2"})
+        ini_file = os.path.join(os.path.dirname(__file__), self.TEST_INI_FILE)
+        proc = spawn_script("mcread.py", "--show-servers", ini_file,
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+        proc.stdin.write("2\n")
+        proc.stdin.close()
+        output = [ln.split()[:2] for ln in proc.stdout]
+        assert proc.wait() == 0
+        # The metadata is on both servers, and the tabs on just one.
+        servers = self.storage.cache.get_servers("2:c:tabs")
+        self.assertEquals(len(servers), 1)
+        self.assertEquals(sorted(output), [
+            ["2:c:tabs", servers[0]],
+            ["2:metadata", "127.0.0.1:11211"],
+            ["2:metadata", "localhost:11211"],
+        ])
+
+
 class TestPurgeTTLScript(StorageTestCase):
 
     TEST_INI_FILE = "tests-hostname.ini"
@@ -197,3 +224,76 @@ class TestPurgeTTLScript(StorageTestCase):
         self.assertEquals(count_bso_items(), 1)
         self.assertEquals(count_bui_items(), 3)
         self.assertEquals(count_batches(), 1)
+
+    def test_purgettl_script_resumes_from_checkpoint(self):
+        key = "syncstorage:storage:host:another-test-host"
+        storage = self.config.registry[key]
+
+        def count_bso_items(table):
+            query = "SELECT COUNT(*) FROM %s /* queryName=COUNT_BSO_ITEMS */"
+            with storage.dbconnector.connect() as c:
+                return c.execute(query % (table,)).fetchall()[0][0]
+
+        storage.set_item(_USER1, "col", "test1", {"payload": "X", "ttl": 0})
+        storage.set_item(_USER2, "col", "test2", {"payload": "X", "ttl": 0})
+        time.sleep(1.1)
+
+        # Pretend that an earlier run had already purged user 1's table.
+        fd, checkpoint_file = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as f:
+            f.write(json_dumps({"completed": {
+                "another-test-host:bso1": {"num_purged": 0, "duration": 0},
+            }}))
+        try:
+            ini_file = os.path.join(os.path.dirname(__file__),
+                                    self.TEST_INI_FILE)
+            proc = spawn_script("purgettl.py",
+                                "--oneshot",
+                                "--grace-period=0",
+                                "--max-workers=4",
+                                "--checkpoint-file=" + checkpoint_file,
+                                ini_file)
+            assert proc.wait() == 0
+            self.assertEquals(count_bso_items("bso1"), 1)
+            self.assertEquals(count_bso_items("bso2"), 0)
+            # The checkpoint is cleared once the pass is complete.
+            self.assertFalse(os.path.exists(checkpoint_file))
+        finally:
+            if os.path.exists(checkpoint_file):
+                os.unlink(checkpoint_file)
+
+    def test_purgettl_only_checkpoints_completed_tasks(self):
+        checkpoint = PurgeCheckpoint()
+
+        def run_task(name, is_complete):
+            run_purge_task(self.config, checkpoint, name, lambda: {
+                "num_purged": 10,
+                "is_complete": is_complete,
+            })
+
+        run_task("complete", True)
+        run_task("incomplete", False)
+        self.assertTrue("complete" in checkpoint)
+        self.assertFalse("incomplete" in checkpoint)
+
+
+class TestShardReportScript(StorageTestCase):
+
+    TEST_INI_FILE = "tests-shard-servers.ini"
+
+    def test_shardreport_script(self):
+        settings = self.config.registry.settings
+        storage = load_storage_from_settings("storage", settings)
+        storage.set_item(_USER1, "col", "test", {"payload": "X"})
+        storage.set_item(_USER2, "col", "test", {"payload": "X"})
+        storage.set_item(_USER3, "col", "test", {"payload": "X"})
+        ini_file = os.path.join(os.path.dirname(__file__), self.TEST_INI_FILE)
+        proc = spawn_script("shardreport.py", ini_file,
+                            stdout=subprocess.PIPE)
+        output = [ln.split() for ln in proc.stdout]
+        assert proc.wait() == 0
+        # User 1 is in shards 0-1, users 2 and 3 are in shards 2-3.
+        self.assertEquals(len(output), 2)
+        self.assertEquals([ln[0] for ln in output], ["default", "default"])
+        self.assertEquals([ln[2:] for ln in output],
+                          [["0-1", "1"], ["2-3", "2"]])
@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest2
+import threading
+
+from syncstorage.storage.sizerefresh import BackgroundRefresher
+
+
+class TestBackgroundRefresher(unittest2.TestCase):
+
+    def setUp(self):
+        self.refreshers = []
+
+    def tearDown(self):
+        for refresher in self.refreshers:
+            refresher.close()
+
+    def _make_refresher(self, *args, **kwds):
+        refresher = BackgroundRefresher(*args, **kwds)
+        self.refreshers.append(refresher)
+        return refresher
+
+    def test_refreshes_queued_users_in_the_background(self):
+        refreshed = []
+        refresher = self._make_refresher(refreshed.append,
+                                         num_workers=2)
+        self.assertTrue(refresher.schedule({"uid": 1}))
+        self.assertTrue(refresher.schedule({"uid": 2}))
+        refresher.join()
+        self.assertEquals(sorted(user["uid"] for user in refreshed), [1, 2])
+        self.assertEquals(len(refresher._workers), 2)
+
+    def test_each_user_is_queued_only_once(self):
+        started = threading.Event()
+        release = threading.Event()
+        refreshed = []
+
+        def refresh(user):
+            if user["uid"] == 0:
+                started.set()
+                release.wait()
+            refreshed.append(user["uid"])
+
+        refresher = self._make_refresher(refresh, max_pending=2)
+        refresher.schedule({"uid": 0})
+        started.wait()
+        # The worker is now busy, so others have to wait in the queue.
+        self.assertTrue(refresher.schedule({"uid": 1}))
+        self.assertTrue(refresher.schedule({"uid": 1}))
+        self.assertTrue(refresher.schedule({"uid": 2}))
+        # Once the queue is full, further users are dropped.
+        self.assertFalse(refresher.schedule({"uid": 3}))
+        release.set()
+        refresher.join()
+        self.assertEquals(refreshed, [0, 1, 2])
+        # Users can be queued again once they've been refreshed.
+        self.assertTrue(refresher.schedule({"uid": 0}))
+        refresher.join()
+        self.assertEquals(refreshed, [0, 1, 2, 0])
+
+    def test_errors_do_not_stop_the_workers(self):
+        refreshed = []
+
+        def refresh(user):
+            if user["uid"] == 1:
+                raise RuntimeError("oops")
+            refreshed.append(user["uid"])
+
+        refresher = self._make_refresher(refresh)
+        refresher.schedule({"uid": 1})
+        refresher.schedule({"uid": 2})
+        refresher.join()
+        self.assertEquals(refreshed, [2])
+
+    def test_close_stops_the_workers(self):
+        refreshed = []
+        refresher = self._make_refresher(refreshed.append,
+                                         num_workers=2)
+        refresher.schedule({"uid": 1})
+        workers = list(refresher._workers)
+        refresher.close()
+        self.assertEquals(refreshed, [{"uid": 1}])
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        # Anything scheduled afterwards is dropped.
+        self.assertFalse(refresher.schedule({"uid": 2}))
+        refresher.join()
+        self.assertEquals(refreshed, [{"uid": 1}])
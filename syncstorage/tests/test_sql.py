@@ -2,16 +2,22 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import time
 import threading
 import uuid
 
+import unittest2
+
+from sqlalchemy import inspect
 from mozsvc.plugin import load_and_register
 from mozsvc.tests.support import get_test_configurator
 
 from syncstorage.tests.support import StorageTestCase
-from syncstorage.storage import load_storage_from_settings
+from syncstorage.storage import load_storage_from_settings, BATCH_LIFETIME
+from syncstorage.storage.sql import SQLStorage, dbconnect
 from syncstorage.storage.sql.dbconnect import (create_engine,
+                                               TTL_PARTITIONS_AHEAD,
                                                MigrationState,
                                                QueuePoolWithMaxBacklog)
 
@@ -200,6 +206,156 @@ class TestSQLStorage(StorageTestCase, StorageTestsMixin):
         self.assertEquals(len(self.storage.get_items(_USER, "col")["items"]),
                           5)
 
+    def test_purge_reports_rate_and_expiry_estimate(self):
+        items = [{"id": "SHORT" + str(i), "payload": str(i), "ttl": 0}
+                 for i in xrange(20)]
+        self.storage.set_items(_USER, "col", items)
+        items = [{"id": "LONG" + str(i), "payload": str(i), "ttl": 10}
+                 for i in xrange(6)]
+        self.storage.set_items(_USER, "col", items)
+        time.sleep(1)
+        table = self.storage.dbconnector.get_bso_table(_USER["uid"]).name
+        tasks = [task for task in self.storage.get_purge_tasks(max_per_loop=5)
+                 if task.kind == "bso" and task.table == table]
+        self.assertEquals(len(tasks), 1)
+        res = tasks[0].run()
+        self.assertEquals(res["num_purged"], 20)
+        self.assertTrue(res["is_complete"])
+        self.assertTrue(res["keeping_up"])
+        self.assertTrue(res["num_batches"] >= 1)
+        self.assertTrue(res["batch_size"] >= 5)
+        self.assertTrue(res["rows_per_second"] > 0)
+        # The long-lived items will expire within the estimation window.
+        self.assertEquals(res["expiry_rate"], 6 / 300.0)
+
+    def test_partitioning_requires_mysql_or_postgres(self):
+        self.assertRaises(ValueError, SQLStorage, "sqlite:///:memory:",
+                          partition_by_ttl=True)
+
+    def test_rendered_queries_are_cached(self):
+        dbconnector = self.storage.dbconnector
+        params = {"userid": 1, "collectionid": 2, "ids": ["a", "b"]}
+        query = dbconnector.get_query("DELETE_ITEMS", params)
+        self.assertEquals(params["id0"], "a")
+        self.assertEquals(params["id1"], "b")
+        params = {"userid": 1, "collectionid": 2, "ids": ["c", "d"]}
+        self.assertTrue(dbconnector.get_query("DELETE_ITEMS", params) is query)
+        self.assertEquals(params["id0"], "c")
+        params = {"userid": 1, "collectionid": 2, "ids": ["e"]}
+        self.assertNotEquals(dbconnector.get_query("DELETE_ITEMS", params),
+                             query)
+        # Queries built by functions are cached according to their shape.
+        params = {"userid": 1, "collectionid": 2, "sort": "index",
+                  "limit": 2}
+        query = dbconnector.get_query("FIND_ITEMS", params)
+        params = {"userid": 1, "collectionid": 2, "sort": "index",
+                  "limit": 7}
+        self.assertTrue(dbconnector.get_query("FIND_ITEMS", params) is query)
+        params = {"userid": 1, "collectionid": 2, "sort": "oldest",
+                  "limit": 7}
+        self.assertNotEquals(dbconnector.get_query("FIND_ITEMS", params),
+                             query)
+        params = {"userid": 1, "collectionid": 2, "sort": "index",
+                  "limit": None}
+        self.assertNotEquals(dbconnector.get_query("FIND_ITEMS", params),
+                             query)
+        # And they still give the right results.
+        self.storage.set_items(_USER, "col", [
+            {"id": str(i), "payload": _PLD, "sortindex": i}
+            for i in xrange(5)
+        ])
+        for limit in (1, 2, 3):
+            items = self.storage.get_items(_USER, "col", sort="index",
+                                           limit=limit)["items"]
+            self.assertEquals([item["id"] for item in items],
+                              ["4", "3", "2"][:limit])
+        items = self.storage.get_items(_USER, "col", ids=["1", "3"])["items"]
+        self.assertEquals(sorted(item["id"] for item in items), ["1", "3"])
+        items = self.storage.get_items(_USER, "col", ids=["2"])["items"]
+        self.assertEquals([item["id"] for item in items], ["2"])
+
+    def test_rendered_query_cache_evicts_least_recently_used(self):
+        dbconnector = self.storage.dbconnector
+        cache = dbconnector._query_cache
+        cache.clear()
+        old_max_size = dbconnect.MAX_QUERY_CACHE_SIZE
+        dbconnect.MAX_QUERY_CACHE_SIZE = 2
+        try:
+            dbconnector._cache_query(cache, "a", 1)
+            dbconnector._cache_query(cache, "b", 2)
+            self.assertEquals(dbconnector._get_cached_query(cache, "a"), 1)
+            dbconnector._cache_query(cache, "c", 3)
+            self.assertEquals(dbconnector._get_cached_query(cache, "a"), 1)
+            self.assertEquals(dbconnector._get_cached_query(cache, "b"), None)
+            self.assertEquals(dbconnector._get_cached_query(cache, "c"), 3)
+        finally:
+            dbconnect.MAX_QUERY_CACHE_SIZE = old_max_size
+
+    def test_sortindex_index_is_only_created_on_request(self):
+        for create_index in (False, True):
+            storage = SQLStorage("sqlite:///:memory:", create_tables=True,
+                                 create_sortindex_index=create_index)
+            engine = storage.dbconnector.engine
+            indexes = inspect(engine).get_indexes("bso")
+            names = [index["name"] for index in indexes]
+            self.assertEquals("bso_usr_col_sortidx_idx" in names,
+                              create_index)
+            # Paging by sortindex works either way.
+            storage.set_items(_USER, "col", [
+                {"id": str(i), "payload": _PLD, "sortindex": i % 2}
+                for i in xrange(5)
+            ])
+            res = storage.get_items(_USER, "col", sort="index", limit=2)
+            self.assertEquals([item["id"] for item in res["items"]],
+                              ["3", "1"])
+            res = storage.get_items(_USER, "col", sort="index", limit=2,
+                                    offset=res["next_offset"])
+            self.assertEquals([item["id"] for item in res["items"]],
+                              ["4", "2"])
+
+    def test_upsert_reports_number_of_items_created(self):
+        dbconnector = self.storage.dbconnector
+
+        def upsert(items):
+            defaults = {"modified": 1, "payload": "", "payload_size": 0}
+            rows = []
+            for item in items:
+                row = {"userid": 1, "collection": 2}
+                row.update(item)
+                rows.append(row)
+            with dbconnector.connect() as c:
+                return c.insert_or_update("bso", rows, defaults)
+
+        self.assertEquals(upsert([{"id": "a", "payload": "A"}]), 1)
+        self.assertEquals(upsert([{"id": "a", "payload": "AA"}]), 0)
+        # Items with different field sets, or repeated ids.
+        self.assertEquals(upsert([
+            {"id": "a", "sortindex": 1},
+            {"id": "b", "payload": "B"},
+            {"id": "b", "payload": "BB"},
+            {"id": "c", "ttl": int(time.time()) + 3600},
+            {"id": "c", "sortindex": 3},
+        ]), 2)
+        # Enough items to need splitting into several queries.
+        self.assertEquals(upsert([
+            {"id": str(i), "payload": "x", "sortindex": i}
+            for i in xrange(0, 1000, 2)
+        ]), 500)
+        self.assertEquals(upsert([
+            {"id": str(i), "payload": "y", "sortindex": i}
+            for i in xrange(1000)
+        ]), 500)
+        items = self.storage.get_items({"uid": 1}, "crypto",
+                                       ids=["a", "b", "c", "998", "999"])
+        items = dict((item["id"], item) for item in items["items"])
+        self.assertEquals(items["a"]["payload"], "AA")
+        self.assertEquals(items["a"]["sortindex"], 1)
+        self.assertEquals(items["b"]["payload"], "BB")
+        self.assertEquals(items["c"]["payload"], "")
+        self.assertEquals(items["c"]["sortindex"], 3)
+        self.assertEquals(items["998"]["payload"], "y")
+        self.assertEquals(items["999"]["sortindex"], 999)
+
     def _set_migrating_state(self, id, state):
         with self.storage.dbconnector.connect() as connect:
             connect.execute(
@@ -243,3 +399,398 @@ class TestSQLStorage(StorageTestCase, StorageTestsMixin):
                  "uid": 1}
             )
         )
+
+
+class TestSQLStorageWithUsageTracking(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-usage.ini"
+
+    def assertUsageMatchesItems(self, user):
+        # Compare the tracked usage with that aggregated over the bso table.
+        tracked = (self.storage.get_collection_counts(user),
+                   self.storage.get_collection_sizes(user),
+                   self.storage.get_total_size(user))
+        self.storage.track_collection_usage = False
+        try:
+            actual = (self.storage.get_collection_counts(user),
+                      self.storage.get_collection_sizes(user),
+                      self.storage.get_total_size(user))
+        finally:
+            self.storage.track_collection_usage = True
+        self.assertEquals(tracked, actual)
+
+    def test_usage_is_tracked_through_writes(self):
+        self.assertUsageMatchesItems(_USER)
+        # Creating and updating items.
+        self.storage.set_items(_USER, "col1", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20},
+            {"id": "b", "payload": "x" * 25},
+            {"id": "c", "sortindex": 1},
+        ])
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col1": 3})
+        self.assertEquals(self.storage.get_total_size(_USER), 35)
+        self.storage.set_item(_USER, "col1", "a", {"payload": "x" * 5})
+        self.storage.set_item(_USER, "col1", "c", {"sortindex": 2})
+        self.storage.set_item(_USER, "col2", "a", {"payload": "x" * 7})
+        self.assertUsageMatchesItems(_USER)
+        self.assertEquals(self.storage.get_total_size(_USER), 37)
+        # Applying a batch.
+        batch = self.storage.create_batch(_USER, "col1")
+        self.storage.append_items_to_batch(_USER, "col1", batch, [
+            {"id": "a", "payload": "x" * 50},
+            {"id": "c", "sortindex": 3},
+            {"id": "d", "payload": "x" * 100},
+            {"id": "e", "ttl": 100},
+        ])
+        self.storage.apply_batch(_USER, "col1", batch)
+        self.storage.close_batch(_USER, "col1", batch)
+        self.assertUsageMatchesItems(_USER)
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col1": 5, "col2": 1})
+        self.assertEquals(self.storage.get_collection_sizes(_USER),
+                          {"col1": 175, "col2": 7})
+        # Deleting items and collections.
+        self.storage.delete_item(_USER, "col1", "a")
+        self.storage.delete_items(_USER, "col1", ["b", "e", "nonexistent"])
+        self.assertUsageMatchesItems(_USER)
+        self.assertEquals(self.storage.get_total_size(_USER), 107)
+        self.storage.delete_collection(_USER, "col2")
+        self.assertUsageMatchesItems(_USER)
+        self.storage.delete_items(_USER, "col1", ["c", "d"])
+        self.assertUsageMatchesItems(_USER)
+        self.assertEquals(self.storage.get_collection_counts(_USER), {})
+        self.assertEquals(self.storage.get_total_size(_USER), 0)
+
+    def test_recalculation_of_usage_with_expired_items(self):
+        self.storage.set_items(_USER, "col", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20, "ttl": 0},
+        ])
+        time.sleep(1)
+        # The expired item is still counted until it's been reconciled.
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col": 2})
+        self.assertEquals(self.storage.get_collection_sizes(_USER),
+                          {"col": 30})
+        self.assertEquals(self.storage.get_total_size(_USER), 30)
+        self.assertEquals(self.storage.get_total_size(_USER, True), 10)
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col": 1})
+        self.assertUsageMatchesItems(_USER)
+        # Rewriting the expired item counts it as newly created.
+        self.storage.set_item(_USER, "col", "b", {"payload": "x" * 3})
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col": 2})
+        self.assertUsageMatchesItems(_USER)
+
+    def test_recalculation_keeps_writes_to_other_collections(self):
+        queries = []
+        dbconnector = self.storage.dbconnector
+        get_query = dbconnector.get_query
+
+        def recording_get_query(name, params):
+            queries.append(name)
+            return get_query(name, params)
+
+        dbconnector.get_query = recording_get_query
+        self.storage.set_items(_USER, "col1", [{"id": "a", "payload": "x"}])
+        # All of the user's counters are locked before being recalculated.
+        with self.storage.lock_for_write(_USER, "col2"):
+            self.storage.set_items(_USER, "col2", [{"id": "a"}])
+            self.storage.get_total_size(_USER, recalculate=True)
+        self.assertTrue(queries.index("LOCK_COLLECTIONS_USAGE") <
+                        queries.index("CALCULATE_COLLECTIONS_USAGE"))
+        self.assertUsageMatchesItems(_USER)
+
+    def test_purging_of_expired_items_updates_usage(self):
+        self.storage.set_items(_USER, "col1", [
+            {"id": "a", "payload": "x" * 10},
+            {"id": "b", "payload": "x" * 20, "ttl": 0},
+        ])
+        self.storage.set_items(_USER, "col2", [
+            {"id": "a", "payload": "x" * 30, "ttl": 0},
+        ])
+        time.sleep(1)
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col1": 2, "col2": 1})
+        res = self.storage.purge_expired_items(grace_period=0)
+        self.assertEquals(res["num_bso_rows_purged"], 2)
+        self.assertEquals(self.storage.get_collection_counts(_USER),
+                          {"col1": 1})
+        self.assertEquals(self.storage.get_collection_sizes(_USER),
+                          {"col1": 10})
+        self.assertUsageMatchesItems(_USER)
+
+
+class TestSQLStorageWithReadReplica(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-replica.ini"
+
+    def setUp(self):
+        super(TestSQLStorageWithReadReplica, self).setUp()
+        # Record which db each new connection is made to.
+        self.connections = []
+        dbconnector = self.storage.dbconnector
+        connect = dbconnector.connect
+
+        def recording_connect(replica=False, shard_server=None):
+            connection = connect(replica, shard_server)
+            self.connections.append(connection.replica)
+            return connection
+
+        dbconnector.connect = recording_connect
+
+    def test_reads_are_routed_to_replica_until_user_writes(self):
+        self.assertEquals(len(self.storage.dbconnector.replica_engines), 1)
+        # Read-locked sessions and info queries go to the replica, after
+        # checking on the primary that the user isn't pinned to it.
+        with self.storage.lock_for_read(_USER, "col"):
+            self.storage.get_collection_timestamps(_USER)
+        self.storage.get_collection_counts(_USER)
+        self.storage.get_total_size(_USER)
+        self.assertEquals(self.connections, [None, 0] * 3)
+        # Anything that writes goes to the primary.
+        del self.connections[:]
+        with self.storage.lock_for_write(_USER, "col"):
+            self.storage.set_items(_USER, "col", [{"id": "a"}])
+        self.storage.set_item(_USER, "col", "b", {})
+        self.assertEquals(self.connections, [None, None])
+        # Having written, the user's reads are pinned to the primary.
+        del self.connections[:]
+        with self.storage.lock_for_read(_USER, "col"):
+            items = self.storage.get_items(_USER, "col")["items"]
+            self.assertEquals([item["id"] for item in items], ["b", "a"])
+        self.storage.get_collection_counts(_USER)
+        self.storage.get_collection_counts({"uid": 2})
+        self.assertEquals(self.connections, [None, None] * 2 + [None, 0])
+        # Until the pin expires.
+        with self.storage.dbconnector.connect() as c:
+            c.execute("UPDATE replica_pins SET pinned_until=0 "
+                      "/* queryName=EXPIRE_PINS */")
+        del self.connections[:]
+        self.storage.get_collection_counts(_USER)
+        self.assertEquals(self.connections, [None, 0])
+
+    def test_deletes_pin_reads_to_the_primary(self):
+        self.storage.set_items(_USER, "col", [{"id": "a"}])
+        with self.storage.dbconnector.connect() as c:
+            c.execute("DELETE FROM replica_pins /* queryName=DELETE_PINS */")
+        self.storage.delete_collection(_USER, "col")
+        del self.connections[:]
+        self.assertEquals(self.storage.get_collection_timestamps(_USER), {})
+        self.assertEquals(self.connections, [None, None])
+
+    def test_pins_are_shared_between_processes(self):
+        # Another process using the same db sees the pins of this one.
+        settings = self.config.registry.settings
+        other_storage = load_storage_from_settings("storage", settings)
+        self.assertTrue(other_storage is not self.storage)
+        other_storage.set_items(_USER, "col", [{"id": "a"}])
+        del self.connections[:]
+        self.storage.get_collection_counts(_USER)
+        self.storage.get_collection_counts({"uid": 2})
+        self.assertEquals(self.connections, [None, None, None, 0])
+
+    def test_cannot_write_lock_in_a_replica_session(self):
+        with self.storage.lock_for_read(_USER, "col1"):
+            with self.assertRaises(RuntimeError):
+                with self.storage.lock_for_write(_USER, "col2"):
+                    pass
+
+
+class TestSQLStorageWithSnapshotReads(TestSQLStorage):
+
+    TEST_INI_FILE = "tests-snapshot.ini"
+
+    def setUp(self):
+        super(TestSQLStorageWithSnapshotReads, self).setUp()
+        # Record the name of each query that's executed.
+        self.queries = []
+        dbconnector = self.storage.dbconnector
+        get_query = dbconnector.get_query
+
+        def recording_get_query(name, params):
+            self.queries.append(name)
+            return get_query(name, params)
+
+        dbconnector.get_query = recording_get_query
+
+    def test_read_locks_use_snapshot_transaction(self):
+        self.storage.set_items(_USER, "col", [{"id": "a"}])
+        del self.queries[:]
+        with self.storage.lock_for_read(_USER, "col"):
+            self.storage.get_items(_USER, "col")
+        self.assertEquals(self.queries[:2], ["SET_TRANSACTION_SNAPSHOT",
+                                             "BEGIN_TRANSACTION_SNAPSHOT"])
+        self.assertTrue("COLLECTION_TIMESTAMP" in self.queries)
+        self.assertTrue("LOCK_COLLECTION_READ" not in self.queries)
+        # Write locks are taken as usual.
+        del self.queries[:]
+        time.sleep(0.01)
+        with self.storage.lock_for_write(_USER, "col"):
+            self.storage.set_items(_USER, "col", [{"id": "b"}])
+        self.assertTrue("LOCK_COLLECTION_WRITE" in self.queries)
+        self.assertTrue("BEGIN_TRANSACTION_SNAPSHOT" not in self.queries)
+
+    def test_snapshot_reads_do_not_take_the_write_lock(self):
+        self.storage.set_items(_USER, "col", [{"id": "a"}])
+        ts = self.storage.get_collection_timestamp(_USER, "col")
+        # Hold a snapshot read lock in another thread while taking a second
+        # one here.  This would block if either of them were exclusive.
+        locked = threading.Event()
+        release = threading.Event()
+        seen = []
+
+        def read_in_thread():
+            with self.storage.lock_for_read(_USER, "col"):
+                seen.append(self.storage.get_collection_timestamp(_USER,
+                                                                  "col"))
+                locked.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=read_in_thread)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(5))
+            start = time.time()
+            with self.storage.lock_for_read(_USER, "col"):
+                seen.append(self.storage.get_collection_timestamp(_USER,
+                                                                  "col"))
+            self.assertTrue(time.time() - start < 1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEquals(seen, [ts, ts])
+
+
+class TestSQLStorageWithShardServers(StorageTestCase, StorageTestsMixin):
+
+    TEST_INI_FILE = "tests-shard-servers.ini"
+
+    def setUp(self):
+        super(TestSQLStorageWithShardServers, self).setUp()
+        settings = self.config.registry.settings
+        self.storage = load_storage_from_settings("storage", settings)
+
+    def count_rows(self, shard_server, table):
+        query = "SELECT COUNT(*) FROM %s /* queryName=COUNT_ROWS */" % table
+        with self.storage.dbconnector.connect(shard_server=shard_server) as c:
+            return c.execute(query).fetchall()[0][0]
+
+    def test_user_data_is_spread_across_shard_servers(self):
+        dbconnector = self.storage.dbconnector
+        self.assertEquals(dbconnector.get_shards(0), [0, 1])
+        self.assertEquals(dbconnector.get_shards(1), [2, 3])
+        # User 1 is in shard 1 on server 0, user 2 in shard 2 on server 1.
+        user2 = {"uid": 2}
+        self.storage.set_items(_USER, "col", [{"id": "a"}, {"id": "b"}])
+        self.storage.set_items(user2, "col", [{"id": "c"}])
+        self.assertEquals(self.count_rows(0, "bso1"), 2)
+        self.assertEquals(self.count_rows(0, "user_collections"), 1)
+        self.assertEquals(self.count_rows(1, "bso2"), 1)
+        self.assertEquals(self.count_rows(1, "user_collections"), 1)
+        # The main database holds only the collection names.
+        engine = dbconnector.engine
+        self.assertTrue(engine.has_table("collections"))
+        self.assertFalse(engine.has_table("user_collections"))
+        self.assertFalse(engine.has_table("bso1"))
+        # Batches are kept with the rest of the user's data.
+        batchid = self.storage.create_batch(user2, "col")
+        self.storage.append_items_to_batch(user2, "col", batchid,
+                                           [{"id": "d"}])
+        self.assertEquals(self.count_rows(0, "batch_uploads"), 0)
+        self.assertEquals(self.count_rows(1, "batch_uploads"), 1)
+        self.storage.apply_batch(user2, "col", batchid)
+        self.storage.close_batch(user2, "col", batchid)
+        self.assertEquals(self.count_rows(1, "bso2"), 2)
+        self.assertEquals(self.storage.get_shard_distribution(), [
+            {"sqluri": repr(dbconnector.shard_engines[0].url),
+             "shards": [0, 1], "num_users": 1},
+            {"sqluri": repr(dbconnector.shard_engines[1].url),
+             "shards": [2, 3], "num_users": 1},
+        ])
+
+    def test_purging_fans_out_across_shard_servers(self):
+        for uid in xrange(4):
+            self.storage.set_items({"uid": uid}, "col", [
+                {"id": "short", "ttl": 0},
+                {"id": "long", "ttl": 100},
+            ])
+        time.sleep(1)
+        res = self.storage.purge_expired_items(grace_period=0)
+        self.assertEquals(res["num_bso_rows_purged"], 4)
+        for uid in xrange(4):
+            server = self.storage.dbconnector.get_shard_server(uid)
+            self.assertEquals(self.count_rows(server, "bso%d" % uid), 1)
+
+
+class TestSQLStorageWithTTLPartitions(StorageTestCase, StorageTestsMixin):
+
+    TEST_INI_FILE = "tests-partitioned.ini"
+
+    def setUp(self):
+        sqluri = os.environ.get("MOZSVC_SQLURI", "")
+        if "mysql" not in sqluri and "postgres" not in sqluri:
+            raise unittest2.SkipTest("partitioning needs MySQL or PostgreSQL")
+        super(TestSQLStorageWithTTLPartitions, self).setUp()
+        settings = self.config.registry.settings
+        self.storage = load_storage_from_settings("storage", settings)
+
+    def count_rows(self, table):
+        query = "SELECT COUNT(*) FROM %s /* queryName=COUNT_ROWS */" % table
+        with self.storage.dbconnector.connect() as c:
+            return c.execute(query).fetchall()[0][0]
+
+    def test_partitions_are_created_ahead_of_time(self):
+        dbconnector = self.storage.dbconnector
+        self.assertEquals(dbconnector.get_partitioned_tables(),
+                          ["batch_uploads", "batch_upload_items"])
+        for table in dbconnector.get_partitioned_tables():
+            ends = [end for end, _ in dbconnector.get_ttl_partitions(table)]
+            self.assertEquals(ends, range(ends[0], ends[-1] + 60, 60))
+            self.assertTrue(ends[-1] + 60 > time.time() + TTL_PARTITIONS_AHEAD)
+            # Creating them again is a no-op.
+            self.assertEquals(dbconnector.create_ttl_partitions(
+                table, ends[-1]), [])
+
+    def test_expired_batches_are_purged_by_dropping_partitions(self):
+        dbconnector = self.storage.dbconnector
+        batchid = self.storage.create_batch(_USER, "col")
+        self.storage.append_items_to_batch(_USER, "col", batchid,
+                                           [{"id": "a"}, {"id": "b"}])
+        self.assertEquals(self.count_rows("batch_uploads"), 1)
+        self.assertEquals(self.count_rows("batch_upload_items"), 2)
+        # Use a negative grace period to pretend that time has moved on
+        # by a couple of partitions.
+        num_partitions = len(dbconnector.get_ttl_partitions("batch_uploads"))
+        res = self.storage.purge_expired_items(
+            grace_period=-BATCH_LIFETIME - 120)
+        self.assertTrue(res["is_complete"])
+        self.assertTrue(res["keeping_up"])
+        self.assertEquals(self.count_rows("batch_uploads"), 0)
+        self.assertEquals(self.count_rows("batch_upload_items"), 0)
+        self.assertTrue(len(dbconnector.get_ttl_partitions("batch_uploads"))
+                        < num_partitions)
+        # Once all the partitions are gone, the purge is falling behind.
+        res = self.storage.purge_expired_items(
+            grace_period=-BATCH_LIFETIME - TTL_PARTITIONS_AHEAD - 120)
+        self.assertFalse(res["keeping_up"])
+        self.assertEquals(dbconnector.get_ttl_partitions("batch_uploads"), [])
+        # Writes still succeed, into the catch-all partition.
+        self.storage.create_batch(_USER, "col")
+        self.assertEquals(self.count_rows("batch_uploads"), 1)
+
+    def test_new_partitions_take_over_rows_from_the_catch_all(self):
+        dbconnector = self.storage.dbconnector
+        now = int(time.time())
+        dbconnector.drop_ttl_partitions("batch_uploads",
+                                        now + TTL_PARTITIONS_AHEAD + 120)
+        self.assertEquals(dbconnector.get_ttl_partitions("batch_uploads"), [])
+        self.storage.create_batch(_USER, "col")
+        ends = dbconnector.create_ttl_partitions("batch_uploads", now + 120)
+        self.assertTrue(len(ends) > 0)
+        self.assertEquals(self.count_rows("batch_uploads"), 1)
+        if dbconnector.driver == "postgres":
+            self.assertEquals(self.count_rows("batch_uploads_pdefault"), 0)
@@ -11,7 +11,8 @@ import uuid
 from syncstorage.storage import (SyncStorage,
                                  ConflictError,
                                  ItemNotFoundError,
-                                 CollectionNotFoundError)
+                                 CollectionNotFoundError,
+                                 InvalidOffsetError)
 
 _USER1 = {'uid': 1, 'fxa_uid': str(uuid.uuid4())}
 _USER2 = {'uid': 2, 'fxa_uid': str(uuid.uuid4())}
@@ -122,6 +123,41 @@ class StorageTestsMixin(object):
         items = self.storage.get_items(_USER1, 'xxx_col1')["items"]
         self.assertEquals(len(items), 0)
 
+    def test_paginating_by_sortindex(self):
+        self.check_sortindex_pagination("xxx_col1")
+
+    def check_sortindex_pagination(self, collection):
+        # Lots of items sharing the same sortindex, plus some without one.
+        items = []
+        for i in xrange(20):
+            item = {"id": "item:%02d" % (i,), "payload": _PLD}
+            item["sortindex"] = (i % 4) if i % 5 else None
+            items.append(item)
+        self.storage.set_items(_USER1, collection, items)
+        res = self.storage.get_item_ids(_USER1, collection, sort="index")
+        all_ids = res["items"]
+        self.assertEquals(sorted(all_ids), sorted(i["id"] for i in items))
+        # Paging through with any limit should see all items, in order.
+        for limit in (1, 3, 7):
+            seen_ids = []
+            offset = None
+            while True:
+                kwds = {"sort": "index", "limit": limit}
+                if offset is not None:
+                    kwds["offset"] = offset
+                res = self.storage.get_items(_USER1, collection, **kwds)
+                seen_ids.extend(item["id"] for item in res["items"])
+                offset = res["next_offset"]
+                if offset is None:
+                    break
+            self.assertEquals(seen_ids, all_ids)
+        # Plain numeric offsets are still accepted.
+        res = self.storage.get_item_ids(_USER1, collection, sort="index",
+                                        limit=4, offset="6")
+        self.assertEquals(res["items"], all_ids[6:10])
+        self.assertRaises(InvalidOffsetError, self.storage.get_items,
+                          _USER1, collection, sort="index", offset="x:!!!")
+
     def test_collection_locking_enforces_consistency(self):
         # Create the collection and get initial timestamp.
         bso = {"id": "TEST", "payload": _PLD}
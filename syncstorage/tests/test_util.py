@@ -0,0 +1,49 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import decimal
+
+import unittest2
+
+from syncstorage.util import (get_timestamp, json_dumps, json_loads,
+                              Timestamp, TWO_DECIMAL_PLACES)
+
+
+class TestTimestamp(unittest2.TestCase):
+
+    def test_conversion_matches_decimal_quantization(self):
+        for value in ("1", "1.5", "1.234", "1.001", "-1.009", " 12.10 ",
+                      ".5", "5.", "1e3", 1428.341, 12, 1.1,
+                      1600000000.123456):
+            expected = decimal.Decimal(str(value)).quantize(
+                TWO_DECIMAL_PLACES, rounding=decimal.ROUND_CEILING)
+            ts = get_timestamp(value)
+            self.assertTrue(isinstance(ts, Timestamp))
+            self.assertEquals(ts, expected)
+            self.assertEquals(str(ts), str(expected))
+            self.assertEquals(hash(ts), hash(expected))
+
+    def test_invalid_values_are_rejected(self):
+        for value in ("", ".", "abc", "inf", "nan", "1.2.3"):
+            self.assertRaises(ValueError, get_timestamp, value)
+
+    def test_arithmetic_and_comparison(self):
+        ts = get_timestamp("12.30")
+        self.assertEquals(ts.centis, 1230)
+        self.assertEquals(ts + 1, get_timestamp("13.30"))
+        self.assertEquals(ts - get_timestamp("0.31"), get_timestamp("11.99"))
+        self.assertEquals(int(ts * 1000), 12300)
+        self.assertEquals(int(ts), 12)
+        self.assertEquals(float(ts), 12.3)
+        self.assertTrue(12 < ts < 13)
+        self.assertTrue(ts < decimal.Decimal("12.31"))
+        self.assertEquals(Timestamp.from_millis(12301), get_timestamp(12.31))
+
+    def test_json_format_has_two_decimal_places(self):
+        data = {"modified": get_timestamp(12), "other": get_timestamp("1.5")}
+        self.assertEquals(json_dumps([data["modified"], data["other"]]),
+                          "[12.00, 1.50]")
+        loaded = json_loads(json_dumps(data), timestamps=True)
+        self.assertEquals(loaded, data)
+        self.assertTrue(isinstance(loaded["modified"], Timestamp))
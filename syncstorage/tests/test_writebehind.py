@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+import unittest2
+
+from syncstorage.storage.writebehind import WriteBehindQueue
+
+
+class TestWriteBehindQueue(unittest2.TestCase):
+
+    def setUp(self):
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+
+    def _make_queue(self, *args, **kwds):
+        queue = WriteBehindQueue(*args, **kwds)
+        self.queues.append(queue)
+        return queue
+
+    def test_saves_are_delayed_and_coalesced(self):
+        flushed = []
+        queue = self._make_queue(
+            lambda *args: flushed.append(args + (time.time(),)),
+            delay=0.2, max_rate=0)
+        start = time.time()
+        self.assertTrue(queue.schedule({"uid": 1}, "tabs"))
+        self.assertTrue(queue.schedule({"uid": 2}, "tabs"))
+        self.assertTrue(queue.schedule({"uid": 1}, "tabs", deleted=True))
+        self.assertEquals(queue.depth, 2)
+        while queue.num_flushed < 2:
+            time.sleep(0.01)
+        self.assertEquals([args[:3] for args in flushed],
+                          [({"uid": 1}, "tabs", True),
+                           ({"uid": 2}, "tabs", False)])
+        self.assertTrue(flushed[0][3] - start >= 0.2)
+        self.assertTrue(queue.flush_lag >= 0.2)
+        self.assertEquals(queue.depth, 0)
+
+    def test_join_saves_immediately(self):
+        flushed = []
+        queue = self._make_queue(lambda *args: flushed.append(args),
+                                 delay=60, max_rate=0)
+        queue.schedule({"uid": 1}, "tabs")
+        queue.join()
+        self.assertEquals(flushed, [({"uid": 1}, "tabs", False)])
+        self.assertEquals(queue.delay, 60)
+
+    def test_saves_are_rate_limited(self):
+        flushed = []
+        queue = self._make_queue(lambda *args: flushed.append(time.time()),
+                                 delay=0, max_rate=20)
+        for uid in xrange(5):
+            queue.schedule({"uid": uid}, "tabs")
+        queue.join()
+        self.assertEquals(len(flushed), 5)
+        self.assertTrue(flushed[-1] - flushed[0] >= 4 * 0.05 - 0.01)
+
+    def test_drops_collections_when_full(self):
+        queue = self._make_queue(lambda *args: None, delay=60, max_dirty=2)
+        self.assertTrue(queue.schedule({"uid": 1}, "tabs"))
+        self.assertTrue(queue.schedule({"uid": 2}, "tabs"))
+        self.assertTrue(queue.schedule({"uid": 1}, "tabs"))
+        self.assertFalse(queue.schedule({"uid": 3}, "tabs"))
+        self.assertEquals(queue.num_dropped, 1)
+        self.assertEquals(queue.depth, 2)
+
+    def test_errors_do_not_stop_the_worker(self):
+        flushed = []
+
+        def flush(user, collection, deleted):
+            if user["uid"] == 1:
+                raise RuntimeError("oops")
+            flushed.append(user["uid"])
+
+        queue = self._make_queue(flush, delay=0, max_rate=0)
+        queue.schedule({"uid": 1}, "tabs")
+        queue.schedule({"uid": 2}, "tabs")
+        queue.join()
+        self.assertEquals(flushed, [2])
+        self.assertEquals(queue.num_flushed, 1)
+
+    def test_close_saves_immediately_and_stops_the_worker(self):
+        flushed = []
+        queue = self._make_queue(lambda *args: flushed.append(args),
+                                 delay=60, max_rate=0)
+        queue.schedule({"uid": 1}, "tabs")
+        worker = queue._worker
+        queue.close()
+        self.assertEquals(flushed, [({"uid": 1}, "tabs", False)])
+        self.assertFalse(worker.is_alive())
+        # Anything scheduled afterwards is dropped.
+        self.assertFalse(queue.schedule({"uid": 2}, "tabs"))
+        self.assertEquals(queue.num_dropped, 1)
+        self.assertEquals(queue.depth, 0)
@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import re
 import time
 import decimal
 import simplejson
@@ -9,18 +10,198 @@ import simplejson
 
 TWO_DECIMAL_PLACES = decimal.Decimal("1.00")
 
+# Matches the common forms of timestamp string, which can be parsed directly
+# into a Timestamp.  Anything else is parsed via the decimal module.
+TIMESTAMP_STRING_RE = re.compile(r"^\s*(-?)(\d*)(?:\.(\d*))?\s*$")
+
+
+class Timestamp(decimal.Decimal):
+    """A syncstorage timestamp, held as an integer number of centiseconds.
+
+    Timestamps are always quantized to two decimal places, so they can be
+    represented exactly as an integer.  This class keeps that integer in its
+    "centis" attribute and uses it to implement formatting, comparison and
+    simple arithmetic, avoiding the much slower pure-python decimal machinery
+    on the request path.
+
+    It subclasses decimal.Decimal only so that it interoperates with other
+    Decimal values, e.g. those parsed from JSON, and so that it's rendered
+    verbatim by simplejson's use_decimal support.  Any operation that's not
+    implemented here falls back to the full Decimal behaviour.
+    """
+
+    __slots__ = ("centis",)
+
+    def __new__(cls, centis):
+        self = object.__new__(cls)
+        self.centis = centis
+        # Fill in the Decimal internals directly, as the decimal module
+        # itself does when creating new instances.
+        self._sign = 1 if centis < 0 else 0
+        self._int = str(abs(centis))
+        self._exp = -2
+        self._is_special = False
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (self.centis,))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __str__(self):
+        if self.centis < 0:
+            return "-%d.%02d" % divmod(-self.centis, 100)
+        return "%d.%02d" % divmod(self.centis, 100)
+
+    def __repr__(self):
+        return "Timestamp('%s')" % (self,)
+
+    def __hash__(self):
+        # This must match Decimal.__hash__ for equal values, which uses the
+        # float hash for values that can be represented exactly as floats.
+        if self.centis % 25 == 0:
+            return hash(self.centis / 100.0)
+        return hash((self._sign, len(self._int) - 2, self._int.rstrip("0")))
+
+    def __nonzero__(self):
+        return self.centis != 0
+
+    def __int__(self):
+        # Like Decimal, this truncates towards zero.
+        if self.centis < 0:
+            return -(-self.centis // 100)
+        return self.centis // 100
+
+    def __long__(self):
+        return long(int(self))
+
+    __trunc__ = __int__
+
+    def __float__(self):
+        return self.centis / 100.0
+
+    def __eq__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__eq__(self, other)
+        return self.centis == centis
+
+    def __ne__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__ne__(self, other)
+        return self.centis != centis
+
+    def __lt__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__lt__(self, other)
+        return self.centis < centis
+
+    def __le__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__le__(self, other)
+        return self.centis <= centis
+
+    def __gt__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__gt__(self, other)
+        return self.centis > centis
+
+    def __ge__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__ge__(self, other)
+        return self.centis >= centis
+
+    def __neg__(self, context=None):
+        return Timestamp(-self.centis)
+
+    def __add__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__add__(self, other)
+        return Timestamp(self.centis + centis)
+
+    __radd__ = __add__
+
+    def __sub__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__sub__(self, other)
+        return Timestamp(self.centis - centis)
+
+    def __rsub__(self, other, context=None):
+        centis = _as_centis(other)
+        if centis is None:
+            return decimal.Decimal.__rsub__(self, other)
+        return Timestamp(centis - self.centis)
+
+    def __mul__(self, other, context=None):
+        if not isinstance(other, (int, long)):
+            return decimal.Decimal.__mul__(self, other)
+        return Timestamp(self.centis * other)
+
+    __rmul__ = __mul__
+
+    @classmethod
+    def from_millis(cls, millis):
+        """Create a Timestamp from integer milliseconds, rounding up."""
+        return cls(-(-int(millis) // 10))
+
+
+def _as_centis(value):
+    """Get the given integer or Timestamp as integer centiseconds.
+
+    This returns None for any other type of value, which must be handled
+    by the generic decimal code.
+    """
+    if type(value) is Timestamp:
+        return value.centis
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value * 100
+    return None
+
 
 def get_timestamp(value=None):
     """Transforms a python time value into a syncstorage timestamp."""
     if value is None:
         value = time.time()
+    elif type(value) is Timestamp:
+        return value
+    elif isinstance(value, (int, long)):
+        return Timestamp(value * 100)
+    if isinstance(value, float):
+        value = str(value)
+    if isinstance(value, basestring):
+        match = TIMESTAMP_STRING_RE.match(value)
+        if match is not None:
+            sign, whole, frac = match.groups()
+            if whole or frac:
+                frac = frac or ""
+                centis = int(whole or "0") * 100 + int((frac + "00")[:2])
+                # Round towards positive infinity.
+                if sign:
+                    centis = -centis
+                elif frac[2:].strip("0"):
+                    centis += 1
+                return Timestamp(centis)
     try:
         if not isinstance(value, decimal.Decimal):
             value = decimal.Decimal(str(value))
-        return value.quantize(TWO_DECIMAL_PLACES,
-                              rounding=decimal.ROUND_CEILING)
+        value = value.quantize(TWO_DECIMAL_PLACES,
+                               rounding=decimal.ROUND_CEILING)
     except decimal.InvalidOperation, e:
         raise ValueError(str(e))
+    if value.is_nan():
+        raise ValueError("Invalid timestamp: %s" % (value,))
+    return Timestamp(int(value.scaleb(2)))
 
 
 def json_dumps(value):
@@ -28,6 +209,12 @@ def json_dumps(value):
     return simplejson.dumps(value, use_decimal=True)
 
 
-def json_loads(value):
-    """Decimal-aware version of json.loads()."""
+def json_loads(value, timestamps=False):
+    """Decimal-aware version of json.loads().
+
+    If timestamps is true then all non-integer numbers in the data are
+    taken to be timestamps, and are loaded as Timestamp instances.
+    """
+    if timestamps:
+        return simplejson.loads(value, parse_float=get_timestamp)
     return simplejson.loads(value, use_decimal=True)
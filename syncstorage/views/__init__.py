@@ -3,6 +3,8 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import logging
+import cPickle
+import tempfile
 
 from base64 import b64encode
 
@@ -30,6 +32,7 @@ from syncstorage.views.decorators import (convert_storage_errors,
                                           check_storage_quota,
                                           check_migration)
 from syncstorage.views.util import get_resource_timestamp, get_limit_config
+from syncstorage.views.renderers import StreamedItems
 
 
 logger = logging.getLogger(__name__)
@@ -66,6 +69,9 @@ COLLECTION_ID_REGEX = "[a-zA-Z0-9._-]{1,32}"
 
 ONE_KB = 1024.0
 
+# Streamed responses are spooled to disk once they grow beyond this size.
+STREAM_SPOOL_MAX_MEMORY = 1024 * 1024
+
 
 def default_acl(request):
     """Default ACL: only the owner is allowed access.
@@ -285,6 +291,10 @@ def get_collection_with_internal_pagination(request):
     This wrapper view breaks up such requests so that they use the
     pagination API internally, which is more respectful of server
     resources and avoids bogging down queries from other users.
+
+    If the "storage.stream_collection_responses" setting is enabled then
+    paginated requests for full BSOs are also streamed back to the client
+    one page at a time, rather than being accumulated in memory.
     """
     try:
         settings = request.registry.settings
@@ -297,39 +307,100 @@ def get_collection_with_internal_pagination(request):
         if limit is not None and limit < batch_size:
             return get_collection(request)
         # Otherwise, we'll have to paginate internally for reduce db load.
+        if request.validated.get("full", False):
+            if settings.get("storage.stream_collection_responses", False):
+                return stream_collection(request, limit, batch_size)
         items = []
-        request.validated["limit"] = batch_size
-        while True:
-            # Do the actual fetch, knowing it won't be too big.
-            res = get_collection(request)
-            items.extend(res)
-            if limit is not None:
-                max_left = limit - len(items)
-                # If we've fetched up to the requested limit then stop,
-                # leaving the X-Weave-Next-Offset header intact.
-                if max_left <= 0:
-                    break
-                request.validated["limit"] = min(max_left, batch_size)
-            # Check Next-Offset to see if we've fetched all available items.
-            try:
-                offset = request.response.headers.pop("X-Weave-Next-Offset")
-            except KeyError:
-                break
-            # Fetch again, using the given offset token and sanity-checking
-            # that the collection has not been concurrently modified.
-            # Taking a collection lock here would defeat the point of this
-            # pagination, which is to free up db resources.
-            request.validated["offset"] = offset
-            if "if_unmodified_since" not in request.validated:
-                last_modified = request.response.headers["X-Last-Modified"]
-                last_modified = get_timestamp(last_modified)
-                request.validated["if_unmodified_since"] = last_modified
+        for page in paginate_collection(request, limit, batch_size):
+            items.extend(page)
         return items
     except NotFoundError:
         # For b/w compat, non-existent collections must return an empty list.
         return []
 
 
+def paginate_collection(request, limit, batch_size):
+    """Generator yielding the contents of a collection, one page at a time.
+
+    Each page is fetched by a separate call to get_collection(), asking
+    for at most batch_size items.  Once the generator is exhausted, the
+    X-Weave-Next-Offset header will be set only if there were more items
+    available beyond the requested limit.
+    """
+    num_items = 0
+    request.validated["limit"] = batch_size
+    while True:
+        # Do the actual fetch, knowing it won't be too big.
+        res = get_collection(request)
+        num_items += len(res)
+        # Check Next-Offset to see if we've fetched all available items.
+        # It's removed while yielding each page, so that it's not left
+        # behind on a response that was streamed before the final page.
+        offset = request.response.headers.pop("X-Weave-Next-Offset", None)
+        if limit is not None:
+            max_left = limit - num_items
+            # If we've fetched up to the requested limit then stop,
+            # leaving the X-Weave-Next-Offset header intact.
+            if max_left <= 0:
+                if offset is not None:
+                    request.response.headers["X-Weave-Next-Offset"] = offset
+                yield res
+                break
+            request.validated["limit"] = min(max_left, batch_size)
+        yield res
+        if offset is None:
+            break
+        # Fetch again, using the given offset token and sanity-checking
+        # that the collection has not been concurrently modified.
+        # Taking a collection lock here would defeat the point of this
+        # pagination, which is to free up db resources.
+        request.validated["offset"] = offset
+        if "if_unmodified_since" not in request.validated:
+            last_modified = request.response.headers["X-Last-Modified"]
+            last_modified = get_timestamp(last_modified)
+            request.validated["if_unmodified_since"] = last_modified
+
+
+def stream_collection(request, limit, batch_size):
+    """Get the full contents of a collection as a stream of pages.
+
+    The pages are read just as for any other internally-paginated request,
+    each under its own short collection lock, so a concurrent modification
+    fails the request with the usual precondition error.  Rather than being
+    accumulated in a list, each page is spooled to a temporary file as soon
+    as it has been read, which is only kept in memory while it's small.
+
+    The body is then rendered from the spool one page at a time, so only a
+    single page of items is held in memory and no database resources are
+    held while it's sent.  Since everything has been read by then, the
+    X-Weave-Records and X-Weave-Next-Offset headers are exact.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_MAX_MEMORY)
+    try:
+        count = 0
+        for page in paginate_collection(request, limit, batch_size):
+            cPickle.dump(page, spool, cPickle.HIGHEST_PROTOCOL)
+            count += len(page)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return StreamedItems(_read_spooled_pages(spool), count)
+
+
+def _read_spooled_pages(spool):
+    """Generator yielding the pages from a spool, then closing it."""
+    try:
+        while True:
+            try:
+                page = cPickle.load(spool)
+            except EOFError:
+                break
+            yield page
+    finally:
+        spool.close()
+
+
 @sleep_and_retry_on_conflict
 @with_collection_lock
 @check_precondition_headers
@@ -2,11 +2,29 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import contextlib
 
 from syncstorage.util import json_dumps
 from syncstorage.views.util import get_resource_timestamp
 
 
+class StreamedItems(object):
+    """A list of items that will be rendered incrementally, page by page.
+
+    Views can return an instance of this class in place of a list, to have
+    the renderer produce the response body as a WSGI app_iter rather than
+    as a single string.  The total number of items must be given up front,
+    since it's reported in the X-Weave-Records header.
+    """
+
+    def __init__(self, pages, count):
+        self.pages = pages
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
 class SyncStorageRenderer(object):
     """Base renderer class for syncstorage response rendering."""
 
@@ -41,12 +59,24 @@ class JsonRenderer(SyncStorageRenderer):
         super(JsonRenderer, self).adjust_response(value, request, response)
         if response.content_type == response.default_content_type:
             response.content_type = "application/json"
-        if isinstance(value, (list, tuple)):
+        if isinstance(value, (list, tuple, StreamedItems)):
             response.headers["X-Weave-Records"] = str(len(value))
 
     def render_value(self, value):
+        if isinstance(value, StreamedItems):
+            return self._render_pages(value.pages)
         return json_dumps(value)
 
+    def _render_pages(self, pages):
+        # Output each page as a chunk of the list, sans enclosing brackets.
+        separator = "["
+        with _closing_pages(pages):
+            for page in pages:
+                if page:
+                    yield separator + json_dumps(page)[1:-1]
+                    separator = ","
+        yield "[]" if separator == "[" else "]"
+
 
 class NewlinesRenderer(SyncStorageRenderer):
     """Pyramid renderer producing lists in application/newlines format."""
@@ -58,6 +88,16 @@ class NewlinesRenderer(SyncStorageRenderer):
         response.headers["X-Weave-Records"] = str(len(value))
 
     def render_value(self, value):
+        if isinstance(value, StreamedItems):
+            return self._render_pages(value.pages)
+        return self._render_lines(value)
+
+    def _render_pages(self, pages):
+        with _closing_pages(pages):
+            for page in pages:
+                yield self._render_lines(page)
+
+    def _render_lines(self, value):
         data = []
         for line in value:
             line = json_dumps(line)
@@ -67,6 +107,17 @@ class NewlinesRenderer(SyncStorageRenderer):
         return ''.join(data)
 
 
+@contextlib.contextmanager
+def _closing_pages(pages):
+    """Close the pages once rendering finishes, even if it's abandoned."""
+    try:
+        yield pages
+    finally:
+        close = getattr(pages, "close", None)
+        if close is not None:
+            close()
+
+
 def includeme(config):
     here = "syncstorage.views.renderers:"
     config.add_renderer("sync-json", here + "JsonRenderer")